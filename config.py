@@ -63,6 +63,37 @@ DEFAULT_PORT = 5000
 # Host binding (luôn giữ 0.0.0.0 cho Replit)
 SERVER_HOST = "0.0.0.0"
 
+# Worker pool xử lý request song song (tránh 1 request chậm chặn toàn bộ server)
+# Environment variables SERVER_POOL_SIZE, SERVER_QUEUE_SIZE, SERVER_BACKLOG sẽ override
+SERVER_POOL_SIZE = 32       # Số worker thread xử lý request cùng lúc
+SERVER_QUEUE_SIZE = 128     # Số kết nối chờ tối đa khi mọi worker đều bận (vượt quá → 503)
+SERVER_BACKLOG = 256        # Accept backlog của listening socket
+
+# Chế độ chạy server (environment variable SERVER_MODE sẽ override)
+# - "threaded": NexoraXHTTPRequestHandler + worker pool (mặc định)
+# - "asyncio": các endpoint AI proxy chạy dạng coroutine non-blocking, giữ được
+#   hàng nghìn request đang chờ upstream mà không cần 1 thread/request. Streaming (SSE)
+#   của /api/gemini/stream, /api/llm7/chat, /api/llm7/gpt-5-chat cũng được relay native;
+#   search pipeline (/api/llm7/gemini-search), static, auth, admin vẫn chạy qua bridge
+#   thread pool nên mỗi request đó vẫn chiếm 1 thread trong lúc chờ upstream
+# - "prefork": supervisor fork N worker process dùng chung port qua SO_REUSEPORT
+#   (mỗi worker chạy worker pool như "threaded"), tận dụng nhiều CPU core
+SERVER_MODE = "threaded"
+
+# Số worker process cho prefork mode (0 = số CPU core). Environment variable SERVER_WORKERS sẽ override
+SERVER_WORKERS = 0
+
+# Thread pool nền dùng chung cho call SingleFlight, hedged request và làm mới cache stale: giới hạn
+# số thread phát sinh ngoài worker pool. Hết slot thì call chạy luôn trong thread của request
+# (không hedge, không làm mới nền)
+# Environment variable BACKGROUND_WORKERS sẽ override
+BACKGROUND_WORKERS = 16
+
+# HTTP/1.1 keep-alive: giữ kết nối cho nhiều request (JS modules, API calls)
+# Environment variables KEEPALIVE_IDLE_TIMEOUT, KEEPALIVE_MAX_REQUESTS sẽ override
+KEEPALIVE_IDLE_TIMEOUT = 5      # Giây chờ request tiếp theo trước khi đóng kết nối idle (0 = tắt keep-alive)
+KEEPALIVE_MAX_REQUESTS = 100    # Số request tối đa trên một kết nối
+
 # ===========================================
 # ADVANCED SETTINGS
 # ===========================================
@@ -111,32 +142,290 @@ def get_allowed_origins():
 # Request timeout (seconds) - Optimized for better performance
 REQUEST_TIMEOUT = 30
 
+# Socket timeout (seconds) cho từng nhóm route (timeout_class trong route registry)
+# - "fast": auth/admin/status, "default": API thường, "slow": AI proxy có thể chờ upstream lâu
+ROUTE_TIMEOUTS = {
+    "fast": 10,
+    "default": REQUEST_TIMEOUT,
+    "slow": 120,
+}
+
+# Pool kết nối HTTPS keep-alive tới upstream (Gemini, LLM7, Serper, SerpAPI, Pollinations, GitHub)
+# Environment variables UPSTREAM_POOL_MAX_IDLE, UPSTREAM_POOL_IDLE_TIMEOUT, UPSTREAM_POOL_HEALTH_CHECK sẽ override
+UPSTREAM_POOL_MAX_IDLE = 8          # Số kết nối idle tối đa giữ lại cho mỗi host
+UPSTREAM_POOL_IDLE_TIMEOUT = 30     # Giây; kết nối idle lâu hơn sẽ bị đóng thay vì tái sử dụng
+UPSTREAM_POOL_HEALTH_CHECK = True   # Kiểm tra socket còn sống (upstream chưa đóng) trước khi tái sử dụng
+
+# Policy cho từng upstream (timeout giây, số lần retry thêm, backoff cơ sở/tối đa, status được retry)
+# Environment variables UPSTREAM_<NAME>_TIMEOUT, UPSTREAM_<NAME>_RETRIES sẽ override (vd: UPSTREAM_LLM7_RETRIES=1)
+# "circuit": tên circuit breaker dùng chung (các biến thể Gemini chung 1 breaker; None = không dùng breaker)
+# "slow_call": attempt chậm hơn ngưỡng này (giây) được tính là "chậm" cho circuit breaker
+# "hedge": bật hedged request (chỉ cho call ngắn, idempotent): chưa có response sau p95 latency
+#   (hoặc "hedge_after" giây khi chưa đủ mẫu) thì gửi thêm 1 bản, lấy response về trước;
+#   số hedge tối đa bằng "hedge_max_rate" × số call gần đây
+UPSTREAM_POLICIES = {
+    "default": {"timeout": REQUEST_TIMEOUT, "retries": 0, "backoff": 1.0, "max_backoff": 10.0, "retry_statuses": [502, 503, 504], "slow_call": 20,
+                "hedge": False, "hedge_after": 2.0, "hedge_max_rate": 0.1, "key_pool": None},
+    "gemini": {"timeout": REQUEST_TIMEOUT, "retries": 1, "key_pool": "gemini"},
+    "gemini_vision": {"timeout": 60, "retries": 1, "circuit": "gemini", "key_pool": "gemini", "slow_call": 45},
+    "gemini_optimizer": {"timeout": 15, "retries": 0, "circuit": "gemini", "key_pool": "gemini", "slow_call": 10, "hedge": True},   # bước phụ của search, lỗi thì dùng query gốc
+    "llm7": {"timeout": REQUEST_TIMEOUT, "retries": 2, "key_pool": "llm7"},
+    "serper": {"timeout": REQUEST_TIMEOUT, "retries": 1, "key_pool": "serper", "hedge": True, "hedge_after": 1.5},
+    "serpapi": {"timeout": REQUEST_TIMEOUT, "retries": 1, "key_pool": "serpapi"},
+    "pollinations": {"timeout": 120, "retries": 0, "slow_call": 90},      # tạo ảnh lâu, retry sẽ tốn gấp đôi thời gian
+    "github": {"timeout": 30, "retries": 1, "circuit": None},           # OAuth login: lỗi phải trả về thật, không fail-fast
+}
+
+# Circuit breaker cho từng upstream: mở khi tỉ lệ lỗi hoặc tỉ lệ attempt chậm trong cửa sổ
+# gần nhất vượt ngưỡng → fail-fast (503 CIRCUIT_OPEN) trong open_seconds, sau đó cho
+# half_open_probes request thăm dò; thăm dò thành công thì đóng lại, lỗi thì mở tiếp
+# Environment variables CIRCUIT_BREAKER_<KEY> (vd CIRCUIT_BREAKER_OPEN_SECONDS) sẽ override
+CIRCUIT_BREAKER_SETTINGS = {
+    "window": 20,             # Số attempt gần nhất dùng để tính tỉ lệ
+    "min_calls": 5,           # Cần ít nhất ngần này attempt trong cửa sổ trước khi được mở
+    "error_rate": 0.5,        # Tỉ lệ lỗi (5xx, 429, timeout, lỗi kết nối) để mở
+    "slow_rate": 0.8,         # Tỉ lệ attempt chậm hơn policy "slow_call" để mở
+    "open_seconds": 30,       # Thời gian fail-fast trước khi thăm dò lại
+    "half_open_probes": 1,    # Số request thăm dò đồng thời ở trạng thái half-open
+}
+
+# Retry budget toàn cục: tổng số retry tới mọi upstream trong cửa sổ trượt `window` giây không vượt quá
+# min_per_second * window + ratio * số call → khi upstream sập, retry không nhân tải lên nó
+# Environment variables RETRY_BUDGET_<KEY> (vd RETRY_BUDGET_RATIO) sẽ override
+RETRY_BUDGET = {
+    "ratio": 0.1,             # Retry tối đa bằng 10% số call gần đây
+    "min_per_second": 0.5,    # Luôn cho phép vài retry khi traffic thấp
+    "window": 10,             # Giây
+}
+
+# Pool API key: mỗi service có thể có nhiều key (phân cách bằng dấu phẩy trong environment
+# variable <SERVICE>_API_KEYS / <SERVICE>_API_KEY, hoặc list JSON trong config_store.json).
+# Request được chia đều giữa các key; key bị 429 sẽ nghỉ theo Retry-After, không có thì
+# nghỉ API_KEY_COOLDOWN giây. Environment variable API_KEY_COOLDOWN sẽ override
+API_KEY_COOLDOWN = 60
+
+# Deadline end-to-end của một request nhiều bước (giây): tính từ lúc handler nhận request,
+# truyền qua mọi upstream call; timeout của từng bước bị giới hạn bởi thời gian còn lại.
+# Hết budget thì trả về kết quả một phần (vd kết quả Serper chưa có tóm tắt)
+# Environment variables REQUEST_DEADLINE_<KIND> (vd REQUEST_DEADLINE_SEARCH) sẽ override
+REQUEST_DEADLINES = {
+    "search": 40,   # /api/llm7/gemini-search: optimizer → Serper → tóm tắt Gemini
+    "flight": 30,   # Call upstream dùng chung của SingleFlight (không theo deadline của request nào)
+}
+
+# Câu hỏi thời gian trả lời bằng đồng hồ server + zoneinfo (không gọi API ngoài)
+# DEFAULT_TIMEZONE dùng khi câu hỏi không nêu địa điểm / múi giờ nào
+DEFAULT_TIMEZONE = "Asia/Ho_Chi_Minh"
+
+# Kiểm tra lệch giờ của server so với NTP (tuỳ chọn, chạy nền mỗi "interval" giây):
+# offset đo được được cộng vào câu trả lời thời gian, lệch quá "max_offset" giây thì log cảnh báo
+# Environment variable NTP_CHECK_ENABLED=1 sẽ bật, NTP_SERVER đổi server
+NTP_CHECK = {"enabled": False, "server": "pool.ntp.org", "interval": 3600, "timeout": 2.0, "max_offset": 2.0}
+
+# Cache trong bộ nhớ (LRU + TTL) cho kết quả upstream, giới hạn theo số entry và dung lượng ước tính
+# - ttl: thời gian sống mặc định của entry (giây)
+# - stale_seconds: entry hết TTL vẫn được trả về thêm ngần này giây trong khi làm mới ở nền
+#   (stale-while-revalidate); 0 = tắt
+# max_entries = 0 sẽ tắt cache. Environment variables CACHE_<NAME>_<KEY> (vd CACHE_SERPER_MAX_ENTRIES) sẽ override
+CACHE_SETTINGS = {
+    "serper": {"max_entries": 500, "max_bytes": 8 * 1024 * 1024, "stale_seconds": 600},   # TTL theo loại query, xem SERPER_CACHE_TTLS
+    "optimizer": {"max_entries": 2000, "max_bytes": 2 * 1024 * 1024, "ttl": 6 * 3600},   # prompt → optimized_query/keywords/reasoning
+    "vision": {"max_entries": 1000, "max_bytes": 4 * 1024 * 1024, "ttl": 7 * 24 * 3600},  # sha256 ảnh → mô tả Gemini Vision
+    "enhance": {"max_entries": 1000, "max_bytes": 1024 * 1024, "ttl": 24 * 3600},       # prompt → enhanced_prompt (/api/enhance-prompt)
+    "response": {"max_entries": 500, "max_bytes": 4 * 1024 * 1024, "ttl": 600},         # câu trả lời chat 1 lượt (RESPONSE_CACHE_ENABLED)
+    "static": {"max_entries": 256, "max_bytes": 32 * 1024 * 1024, "ttl": 24 * 3600},    # file .css/.js/.html, đọc lại khi mtime đổi
+}
+
+# Cache câu trả lời cho request chat 1 lượt giống hệt nhau (cùng model + system prompt + messages),
+# áp dụng cho /api/llm7/chat và /api/gemini. Tắt mặc định vì câu trả lời lặp lại y hệt cho cùng câu hỏi
+# Environment variable RESPONSE_CACHE_ENABLED=1 sẽ bật; từng request bỏ qua cache bằng "cache": false
+# trong body hoặc header Cache-Control: no-cache
+RESPONSE_CACHE_ENABLED = False
+
+# Tier trên đĩa cho cache mô tả ảnh (giữ được qua restart): thư mục chứa <sha256>.json, "" = chỉ cache trong bộ nhớ
+# Environment variable VISION_CACHE_DIR sẽ override (vd ".cache/vision")
+VISION_CACHE_DIR = ""
+
+# TTL (giây) của kết quả Serper theo loại query (xem classify_search_query trong server.py):
+# tin tức/giá cả/thời tiết thay đổi nhanh nên TTL ngắn, định nghĩa gần như không đổi
+SERPER_CACHE_TTLS = {
+    "news": 300,
+    "price": 300,
+    "weather": 900,
+    "definition": 7 * 24 * 3600,
+    "default": 3600,
+}
+
+# Chuỗi failover cho các chat endpoint (/api/llm7/chat, /api/llm7/gpt-5-chat): bước đầu luôn là LLM7
+# với đúng model client chọn; MODEL_FALLBACK_CHAINS chỉ liệt kê các bước dự phòng theo sau, theo
+# model logic ("default" cho mọi model khác). Provider lỗi timeout, lỗi kết nối, 5xx hoặc
+# circuit đang mở thì request tự chuyển sang bước tiếp theo, miễn là còn trong
+# MODEL_FALLBACK_DEADLINE giây kể từ khi bắt đầu gọi. Provider hỗ trợ: "llm7", "gemini"
+# Environment variables MODEL_FALLBACK_DEADLINE và MODEL_FALLBACK_ENABLED (false = tắt failover) sẽ override
+MODEL_FALLBACK_CHAINS = {
+    "default": [
+        {"provider": "gemini", "model": "gemini-2.5-flash"},
+    ],
+}
+MODEL_FALLBACK_DEADLINE = 60
+
 # Maximum file upload size (bytes)
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 
+# Request body lớn hơn ngưỡng này (vd ảnh base64 gửi /api/llm7/chat) được ghi dần vào file tạm
+# thay vì giữ trong RAM trong lúc nhận. Environment variable REQUEST_BODY_SPOOL_THRESHOLD sẽ override
+REQUEST_BODY_SPOOL_THRESHOLD = 1024 * 1024  # 1MB
+
+def get_request_body_spool_threshold():
+    """Ngưỡng (bytes) để spool request body ra file tạm"""
+    return max(0, int(os.getenv('REQUEST_BODY_SPOOL_THRESHOLD', REQUEST_BODY_SPOOL_THRESHOLD)))
+
+def get_upstream_pool_settings():
+    """Lấy cấu hình pool kết nối upstream: (max_idle_per_host, idle_timeout, health_check)"""
+    max_idle = int(os.getenv('UPSTREAM_POOL_MAX_IDLE', UPSTREAM_POOL_MAX_IDLE))
+    idle_timeout = float(os.getenv('UPSTREAM_POOL_IDLE_TIMEOUT', UPSTREAM_POOL_IDLE_TIMEOUT))
+    health_check = os.getenv('UPSTREAM_POOL_HEALTH_CHECK', str(UPSTREAM_POOL_HEALTH_CHECK)).strip().lower() in ('1', 'true', 'yes')
+    return max(0, max_idle), max(0.0, idle_timeout), health_check
+
+def get_upstream_policy(name):
+    """Lấy policy của một upstream (merge với "default" và environment overrides)"""
+    policy = dict(UPSTREAM_POLICIES["default"])
+    policy.update(UPSTREAM_POLICIES.get(name, {}))
+    env_prefix = f"UPSTREAM_{name.upper()}_"
+    if os.getenv(env_prefix + 'TIMEOUT'):
+        policy["timeout"] = float(os.getenv(env_prefix + 'TIMEOUT'))
+    if os.getenv(env_prefix + 'RETRIES'):
+        policy["retries"] = max(0, int(os.getenv(env_prefix + 'RETRIES')))
+    if os.getenv(env_prefix + 'HEDGE'):
+        policy["hedge"] = os.getenv(env_prefix + 'HEDGE').strip().lower() in ('1', 'true', 'yes')
+    policy.setdefault("circuit", name)
+    return policy
+
+def get_circuit_breaker_settings():
+    """Lấy cấu hình circuit breaker (dict, đã áp dụng environment overrides)"""
+    settings = dict(CIRCUIT_BREAKER_SETTINGS)
+    for key, default in CIRCUIT_BREAKER_SETTINGS.items():
+        value = os.getenv(f"CIRCUIT_BREAKER_{key.upper()}")
+        if value:
+            settings[key] = type(default)(value)
+    return settings
+
+def get_retry_budget_settings():
+    """Lấy cấu hình retry budget (dict, đã áp dụng environment overrides)"""
+    settings = dict(RETRY_BUDGET)
+    for key in RETRY_BUDGET:
+        value = os.getenv(f"RETRY_BUDGET_{key.upper()}")
+        if value:
+            settings[key] = float(value)
+    return settings
+
+def get_model_fallback_chain(model_id):
+    """Chuỗi provider (list các dict provider/model) dùng cho một model chat
+
+    Bước đầu là LLM7 với chính model_id client yêu cầu, sau đó là các bước dự phòng trong config.
+    """
+    primary = {"provider": "llm7", "model": model_id}
+    if os.getenv('MODEL_FALLBACK_ENABLED', 'true').strip().lower() in ('0', 'false', 'no'):
+        return [primary]
+    fallbacks = MODEL_FALLBACK_CHAINS.get(model_id, MODEL_FALLBACK_CHAINS["default"])
+    return [primary] + [dict(step) for step in fallbacks]
+
+def get_model_fallback_deadline():
+    """Tổng thời gian (giây) cho cả chuỗi failover của một request"""
+    return max(1.0, float(os.getenv('MODEL_FALLBACK_DEADLINE', MODEL_FALLBACK_DEADLINE)))
+
+def get_cache_settings(name):
+    """Cấu hình của một cache (dict, đã áp dụng environment overrides)"""
+    settings = {"max_entries": 256, "max_bytes": 4 * 1024 * 1024, "ttl": 3600, "stale_seconds": 0}
+    settings.update(CACHE_SETTINGS.get(name, {}))
+    for key in list(settings):
+        value = os.getenv(f"CACHE_{name.upper()}_{key.upper()}")
+        if value:
+            settings[key] = max(0, int(value))
+    return settings
+
+def is_response_cache_enabled():
+    """Cache câu trả lời chat 1 lượt có bật không"""
+    value = os.getenv('RESPONSE_CACHE_ENABLED')
+    if value is None:
+        return RESPONSE_CACHE_ENABLED
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def get_vision_cache_dir():
+    """Thư mục tier trên đĩa của cache mô tả ảnh ("" = tắt)"""
+    return os.getenv('VISION_CACHE_DIR', VISION_CACHE_DIR).strip()
+
+def get_serper_cache_ttl(query_class):
+    """TTL (giây) cho kết quả Serper của một loại query"""
+    return SERPER_CACHE_TTLS.get(query_class, SERPER_CACHE_TTLS["default"])
+
+def get_ntp_check_settings():
+    """Cấu hình kiểm tra lệch giờ NTP (NTP_CHECK + env NTP_CHECK_ENABLED / NTP_SERVER)"""
+    settings = dict(NTP_CHECK)
+    enabled = os.getenv('NTP_CHECK_ENABLED')
+    if enabled is not None:
+        settings["enabled"] = enabled.strip().lower() in ('1', 'true', 'yes', 'on')
+    settings["server"] = os.getenv('NTP_SERVER', settings["server"])
+    return settings
+
+def get_request_deadline(kind):
+    """Deadline (giây) cho một loại request nhiều bước"""
+    value = os.getenv(f"REQUEST_DEADLINE_{kind.upper()}")
+    return max(1.0, float(value)) if value else float(REQUEST_DEADLINES.get(kind, REQUEST_TIMEOUT))
+
+def get_route_timeout(timeout_class):
+    """Lấy socket timeout (giây) cho một timeout class của route"""
+    return ROUTE_TIMEOUTS.get(timeout_class, ROUTE_TIMEOUTS["default"])
+
 def get_api_key(service):
     """
     Lấy API key từ config overrides, environment variables, hoặc config file
     Thứ tự ưu tiên: Config Override > Environment Variables > Config File
+    Service có nhiều key thì trả về key đầu tiên (xem get_api_keys)
+    """
+    keys = get_api_keys(service)
+    return keys[0] if keys else None
+
+def _split_api_keys(value):
+    """Chuẩn hoá giá trị key (chuỗi phân cách bằng dấu phẩy/xuống dòng hoặc list) thành list"""
+    if isinstance(value, (list, tuple)):
+        parts = [str(item) for item in value]
+    else:
+        parts = str(value or '').replace('\n', ',').split(',')
+    keys = []
+    for part in parts:
+        part = part.strip()
+        if part and part not in keys:
+            keys.append(part)
+    return keys
+
+def get_api_keys(service):
+    """
+    Lấy toàn bộ API key của một service (pool key)
+    Thứ tự ưu tiên: Config Override > <SERVICE>_API_KEYS > <SERVICE>_API_KEY > Config File
     """
     service_lower = service.lower()
     
     # Check override first (hot-reload support)
     with config_lock:
         if service_lower in config_override:
-            return config_override[service_lower]
+            return _split_api_keys(config_override[service_lower])
     
     # Then check environment variables
-    if service_lower == "gemini":
-        return os.getenv('GEMINI_API_KEY', GEMINI_API_KEY)
-    elif service_lower == "serpapi":
-        return os.getenv('SERPAPI_API_KEY', SERPAPI_API_KEY)
-    elif service_lower == "serper":
-        return os.getenv('SERPER_API_KEY', SERPER_API_KEY)
-    elif service_lower == "llm7":
-        return os.getenv('LLM7_API_KEY', LLM7_API_KEY)
-    else:
-        return None
+    defaults = {
+        "gemini": GEMINI_API_KEY,
+        "serpapi": SERPAPI_API_KEY,
+        "serper": SERPER_API_KEY,
+        "llm7": LLM7_API_KEY
+    }
+    if service_lower not in defaults:
+        return []
+    env_name = f"{service_lower.upper()}_API_KEY"
+    return _split_api_keys(os.getenv(env_name + 'S') or os.getenv(env_name, defaults[service_lower]))
+
+def get_api_key_cooldown():
+    """Số giây key bị nghỉ sau khi nhận 429 không kèm Retry-After"""
+    return max(0.0, float(os.getenv('API_KEY_COOLDOWN', API_KEY_COOLDOWN)))
 
 def get_github_oauth_credentials():
     """Lấy GitHub OAuth credentials từ environment variables hoặc config"""
@@ -162,7 +451,7 @@ def load_config_override():
         config_override = {}
 
 def save_config_override(service, api_key):
-    """Save config override to file"""
+    """Save config override to file (api_key có thể là list để cấu hình pool nhiều key)"""
     global config_override
     try:
         with config_lock:
@@ -178,6 +467,34 @@ def get_server_port():
     """Lấy port từ environment hoặc config"""
     return int(os.getenv('PORT', DEFAULT_PORT))
 
+def get_server_concurrency():
+    """Lấy cấu hình worker pool: (pool_size, queue_size, backlog)"""
+    pool_size = int(os.getenv('SERVER_POOL_SIZE', SERVER_POOL_SIZE))
+    queue_size = int(os.getenv('SERVER_QUEUE_SIZE', SERVER_QUEUE_SIZE))
+    backlog = int(os.getenv('SERVER_BACKLOG', SERVER_BACKLOG))
+    return max(1, pool_size), max(1, queue_size), max(1, backlog)
+
+def get_server_mode():
+    """Lấy chế độ server từ environment hoặc config"""
+    return os.getenv('SERVER_MODE', SERVER_MODE).strip().lower()
+
+def get_server_workers():
+    """Số worker process cho prefork mode"""
+    workers = int(os.getenv('SERVER_WORKERS', SERVER_WORKERS))
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+def get_background_workers():
+    """Số thread tối đa của thread pool nền (SingleFlight, hedge, làm mới cache)"""
+    return max(1, int(os.getenv('BACKGROUND_WORKERS', BACKGROUND_WORKERS)))
+
+def get_keepalive_settings():
+    """Lấy cấu hình keep-alive: (idle_timeout, max_requests)"""
+    idle_timeout = float(os.getenv('KEEPALIVE_IDLE_TIMEOUT', KEEPALIVE_IDLE_TIMEOUT))
+    max_requests = int(os.getenv('KEEPALIVE_MAX_REQUESTS', KEEPALIVE_MAX_REQUESTS))
+    return max(0.0, idle_timeout), max(1, max_requests)
+
 # Kiểm tra cấu hình khi import
 def check_config():
     """Kiểm tra xem API keys đã được cấu hình chưa"""
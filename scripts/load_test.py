@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Load test cho NexoraX AI server (chỉ dùng stdlib)
+
+Bắn N request song song vào server và báo cáo throughput, phân bố status code,
+số lần bị từ chối 503 SERVER_BUSY (hàng đợi worker pool đầy) và latency p50/p95/p99.
+
+Ví dụ:
+    # Server đang chạy sẵn
+    python scripts/load_test.py --url http://127.0.0.1:5000 --path /ping -c 64 -n 5000
+
+    # Tự khởi động server với pool nhỏ để kiểm tra tràn hàng đợi:
+    # --hold mở sẵn các kết nối keep-alive không gửi gì để chiếm worker
+    python scripts/load_test.py --spawn --pool-size 2 --queue-size 4 --hold 6 -c 32 -n 500
+
+    # Đăng nhập song song: kiểm tra khóa sessions/rate_limits khi ghi store
+    python scripts/load_test.py --spawn --scenario login -c 32 -n 400
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATIC_ENTRIES = ('index.html', 'admin.html', 'assets', 'src')
+
+
+def percentile(sorted_values, pct):
+    """Percentile theo nearest-rank trên list đã sort"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def wait_for_port(host, port, timeout=15.0):
+    """Chờ server mở port"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def spawn_server(port, pool_size, queue_size, mode, workdir):
+    """Khởi động server.py ở process con với cấu hình pool chỉ định
+
+    Chạy trong workdir tạm để acc.txt/sessions_store.json của load test không
+    lẫn vào dữ liệu thật; file tĩnh được symlink từ repo.
+    """
+    for name in STATIC_ENTRIES:
+        os.symlink(os.path.join(ROOT_DIR, name), os.path.join(workdir, name))
+    env = dict(os.environ)
+    env.pop('PORT', None)
+    env['SERVER_MODE'] = mode
+    env['SERVER_POOL_SIZE'] = str(pool_size)
+    env['SERVER_QUEUE_SIZE'] = str(queue_size)
+    return subprocess.Popen(
+        [sys.executable, os.path.join(ROOT_DIR, 'server.py'), str(port)],
+        cwd=workdir, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def hold_connections(host, port, count):
+    """Mở các kết nối keep-alive không gửi request để chiếm worker cho tới KEEPALIVE_TIMEOUT"""
+    held = []
+    for _ in range(count):
+        try:
+            held.append(socket.create_connection((host, port), timeout=5))
+        except OSError:
+            break
+    return held
+
+
+def build_request(scenario, path, index):
+    """Trả về (method, path, body, headers) cho request thứ index"""
+    if scenario == 'login':
+        # Nhiều request cùng username để tranh chấp rate_limits, xen kẽ sai mật khẩu
+        username = f"loadtest{index % 8}"
+        password = "LoadTest#2024" if index % 3 else "WrongPass#2024"
+        body = json.dumps({"username": username, "password": password}).encode('utf-8')
+        return 'POST', '/api/auth/login', body, {'Content-Type': 'application/json'}
+    return 'GET', path, None, {}
+
+
+def run_one(host, port, scenario, path, index, timeout):
+    """Gửi 1 request, trả về (status, code, latency_ms)"""
+    method, req_path, body, headers = build_request(scenario, path, index)
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request(method, req_path, body=body, headers=headers)
+        resp = conn.getresponse()
+        payload = resp.read()
+        code = ''
+        if resp.status >= 400 and resp.getheader('Content-Type', '').startswith('application/json'):
+            try:
+                code = json.loads(payload.decode('utf-8')).get('code', '')
+            except ValueError:
+                pass
+        return resp.status, code, (time.perf_counter() - started) * 1000
+    except (OSError, http.client.HTTPException) as e:
+        return 0, type(e).__name__, (time.perf_counter() - started) * 1000
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test cho NexoraX AI server")
+    parser.add_argument('--url', default='http://127.0.0.1:5055', help='Địa chỉ server')
+    parser.add_argument('--path', default='/ping', help='Path cho scenario get')
+    parser.add_argument('--scenario', choices=('get', 'login'), default='get')
+    parser.add_argument('-c', '--concurrency', type=int, default=32)
+    parser.add_argument('-n', '--requests', type=int, default=1000)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--hold', type=int, default=0, help='Số kết nối idle giữ worker trước khi bắn tải')
+    parser.add_argument('--spawn', action='store_true', help='Tự khởi động server.py tại port của --url')
+    parser.add_argument('--mode', default='threaded', help='SERVER_MODE khi --spawn')
+    parser.add_argument('--pool-size', type=int, default=4, help='SERVER_POOL_SIZE khi --spawn')
+    parser.add_argument('--queue-size', type=int, default=8, help='SERVER_QUEUE_SIZE khi --spawn')
+    args = parser.parse_args()
+
+    parsed = urllib.parse.urlparse(args.url)
+    host, port = parsed.hostname or '127.0.0.1', parsed.port or 80
+
+    server = None
+    if args.spawn:
+        workdir = tempfile.mkdtemp(prefix='nexorax-load-')
+        server = spawn_server(port, args.pool_size, args.queue_size, args.mode, workdir)
+        if not wait_for_port(host, port):
+            server.kill()
+            sys.exit("Server không khởi động được")
+
+    held = []
+    try:
+        if args.hold:
+            held = hold_connections(host, port, args.hold)
+            time.sleep(0.2)
+
+        statuses = Counter()
+        latencies = []
+        lock = threading.Lock()
+
+        def task(index):
+            status, code, latency = run_one(host, port, args.scenario, args.path, index, args.timeout)
+            with lock:
+                statuses[(status, code)] += 1
+                latencies.append(latency)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(task, range(args.requests)))
+        elapsed = time.perf_counter() - started
+    finally:
+        for sock in held:
+            sock.close()
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=10)
+
+    latencies.sort()
+    busy = sum(count for (status, code), count in statuses.items() if code == 'SERVER_BUSY')
+    print(f"Requests:     {args.requests} ({args.concurrency} song song, scenario {args.scenario})")
+    print(f"Thời gian:    {elapsed:.2f}s ({args.requests / elapsed:.1f} req/s)")
+    print(f"Latency ms:   p50 {percentile(latencies, 50):.1f} | p95 {percentile(latencies, 95):.1f} | "
+          f"p99 {percentile(latencies, 99):.1f} | max {latencies[-1] if latencies else 0:.1f}")
+    print(f"SERVER_BUSY:  {busy}")
+    for (status, code), count in sorted(statuses.items()):
+        label = f"{status} {code}".strip() if status else f"lỗi kết nối ({code})"
+        print(f"  {label:<40} {count}")
+
+
+if __name__ == '__main__':
+    main()
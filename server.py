@@ -6,6 +6,7 @@ Date: August 2025
 """
 
 import http.server
+import socket
 import socketserver
 import os
 import mimetypes
@@ -19,11 +20,36 @@ import time
 import secrets
 import threading
 import random
+import re
+import select
+import queue
+import asyncio
+import ssl
+import io
+import http.client
+import signal
+import unicodedata
+import base64
+import binascii
+import hashlib
+import tempfile
+import email.utils
+import struct
+import zoneinfo
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: không có flock, prefork mode cũng không hỗ trợ
+    fcntl = None
 
 # Import configuration
 try:
     import config
-    from config import get_api_key, check_config, get_allowed_origins, REQUEST_TIMEOUT, load_config_override, save_config_override, get_github_oauth_credentials, is_github_oauth_configured
+    from config import get_api_key, check_config, get_allowed_origins, REQUEST_TIMEOUT, load_config_override, save_config_override, get_github_oauth_credentials, is_github_oauth_configured, get_server_concurrency, get_server_mode, get_server_workers, get_background_workers, get_keepalive_settings, get_route_timeout, get_upstream_pool_settings, get_upstream_policy, get_circuit_breaker_settings, get_retry_budget_settings, get_api_keys, get_api_key_cooldown, get_model_fallback_chain, get_model_fallback_deadline, get_request_deadline, get_cache_settings, get_serper_cache_ttl, get_vision_cache_dir, is_response_cache_enabled, get_ntp_check_settings, get_request_body_spool_threshold, DEFAULT_TIMEZONE, UPSTREAM_POLICIES, MAX_FILE_SIZE
 except ImportError:
     # Fallback nếu không có config.py
     def get_api_key(service):
@@ -33,6 +59,42 @@ except ImportError:
             return os.getenv('SERPAPI_API_KEY')
         return None
     
+    def get_api_keys(service):
+        key = get_api_key(service)
+        return [key] if key else []
+    
+    def get_api_key_cooldown():
+        return 60.0
+    
+    def get_model_fallback_chain(model_id):
+        return [{"provider": "llm7", "model": model_id}]
+    
+    def get_model_fallback_deadline():
+        return 60.0
+    
+    def get_request_deadline(kind):
+        return 40.0
+    
+    def get_cache_settings(name):
+        return {"max_entries": 256, "max_bytes": 4 * 1024 * 1024, "ttl": 3600, "stale_seconds": 0}
+    
+    def get_serper_cache_ttl(query_class):
+        return 3600
+    
+    def get_vision_cache_dir():
+        return ""
+    
+    def is_response_cache_enabled():
+        return os.getenv('RESPONSE_CACHE_ENABLED', '').strip().lower() in ('1', 'true', 'yes', 'on')
+    
+    def get_ntp_check_settings():
+        return {"enabled": False, "server": "pool.ntp.org", "interval": 3600, "timeout": 2.0, "max_offset": 2.0}
+    
+    def get_request_body_spool_threshold():
+        return 1024 * 1024
+    
+    DEFAULT_TIMEZONE = "Asia/Ho_Chi_Minh"
+    
     def check_config():
         return []
     
@@ -47,6 +109,41 @@ except ImportError:
     def is_github_oauth_configured():
         client_id, client_secret = get_github_oauth_credentials()
         return bool(client_id and client_secret)
+    
+    def get_server_concurrency():
+        return 32, 128, 256
+    
+    def get_server_mode():
+        return os.getenv('SERVER_MODE', 'threaded').strip().lower()
+    
+    def get_server_workers():
+        return int(os.getenv('SERVER_WORKERS', 0)) or os.cpu_count() or 1
+    
+    def get_background_workers():
+        return 16
+    
+    def get_keepalive_settings():
+        return 5.0, 100
+    
+    def get_route_timeout(timeout_class):
+        return {"fast": 10, "slow": 120}.get(timeout_class, REQUEST_TIMEOUT)
+    
+    def get_upstream_pool_settings():
+        return 8, 30.0, True
+    
+    UPSTREAM_POLICIES = {"default": {"timeout": REQUEST_TIMEOUT, "retries": 0, "backoff": 1.0, "max_backoff": 10.0, "retry_statuses": [502, 503, 504], "slow_call": 20,
+                                     "hedge": False, "hedge_after": 2.0, "hedge_max_rate": 0.1, "key_pool": None}}
+    
+    def get_upstream_policy(name):
+        return dict(UPSTREAM_POLICIES["default"], circuit=name)
+    
+    def get_circuit_breaker_settings():
+        return {"window": 20, "min_calls": 5, "error_rate": 0.5, "slow_rate": 0.8, "open_seconds": 30, "half_open_probes": 1}
+    
+    def get_retry_budget_settings():
+        return {"ratio": 0.1, "min_per_second": 0.5, "window": 10}
+    
+    MAX_FILE_SIZE = 10 * 1024 * 1024
 
 # Configure logging with rotating file handler
 from logging.handlers import RotatingFileHandler
@@ -71,7 +168,7 @@ ACCOUNTS_FILE = 'acc.txt'
 SESSIONS_FILE = 'sessions_store.json'
 RATE_LIMIT_FILE = 'rate_limit_store.json'
 AI_HISTORY_FILE = 'ai_history.jsonl'
-file_lock = threading.Lock()
+file_lock = threading.RLock()  # RLock: sync_shared_state gọi loader khi đang giữ lock
 users = {}
 sessions = {}
 rate_limits = {}
@@ -80,10 +177,10 @@ SESSION_EXPIRY_HOURS = 168  # 7 days
 MAX_LOGIN_ATTEMPTS = 5
 RATE_LIMIT_WINDOW = 300  # 5 minutes in seconds
 
-# Retry configuration for LLM7 API
-MAX_RETRIES = 3
-BASE_BACKOFF = 1.0  # seconds
-MAX_BACKOFF = 10.0  # seconds
+# Prefork mode: đồng bộ users/sessions/rate_limits giữa các worker process qua file store
+SHARED_STATE_SYNC = False
+_store_signatures = {}
+_store_snapshots = {}
 
 # GitHub OAuth state storage (anti-CSRF)
 github_oauth_states = {}
@@ -213,1920 +310,2251 @@ QUY TẮC KHÁC:
 3. Khi cung cấp thông tin tìm kiếm, hãy trình bày rõ ràng và dễ hiểu.
 4. Giữ phong cách trò chuyện thân thiện, vui vẻ nhưng chuyên nghiệp."""
 
-def retry_request_with_backoff(url, headers, data, timeout=REQUEST_TIMEOUT, max_retries=MAX_RETRIES):  # type: ignore
-    """
-    Retry HTTP request with exponential backoff for transient errors
-    
-    Args:
-        url: API endpoint URL
-        headers: HTTP headers dict
-        data: Request payload (bytes)
-        timeout: Request timeout in seconds
-        max_retries: Maximum number of retry attempts
-    
-    Returns:
-        urllib.request HTTP response object (always returns or raises exception)
-    
-    Raises:
-        urllib.error.HTTPError: If final retry fails with HTTP error
-        urllib.error.URLError: If final retry fails with network error
-        TimeoutError: If final retry times out
-    """
-    last_exception = None
-    
-    for attempt in range(max_retries):
-        try:
-            req = urllib.request.Request(url, data=data, headers=headers)
-            response = urllib.request.urlopen(req, timeout=timeout)
-            
-            if attempt > 0:
-                logger.info(f"✅ Request succeeded on attempt {attempt + 1}/{max_retries}")
-            
-            return response
-            
-        except urllib.error.HTTPError as e:
-            last_exception = e
-            if e.code in [502, 503, 504]:
-                if attempt < max_retries - 1:
-                    backoff = min(BASE_BACKOFF * (2 ** attempt) + random.uniform(0, 1), MAX_BACKOFF)
-                    logger.warning(f"⚠️ HTTP {e.code} error on attempt {attempt + 1}/{max_retries}. Retrying in {backoff:.2f}s...")
-                    time.sleep(backoff)
-                    continue
-            raise
-            
-        except (urllib.error.URLError, TimeoutError, OSError) as e:
-            last_exception = e
-            error_type = type(e).__name__
-            
-            if attempt < max_retries - 1:
-                backoff = min(BASE_BACKOFF * (2 ** attempt) + random.uniform(0, 1), MAX_BACKOFF)
-                logger.warning(f"⚠️ {error_type} on attempt {attempt + 1}/{max_retries}: {str(e)}. Retrying in {backoff:.2f}s...")
-                time.sleep(backoff)
-                continue
-            else:
-                logger.error(f"❌ All {max_retries} attempts failed. Last error: {error_type} - {str(e)}")
-                raise
-    
-    if last_exception:
-        raise last_exception
+# ===========================================
+# UPSTREAM CONNECTION POOL
+# Giữ kết nối HTTPS keep-alive theo host để các upstream call không phải DNS + TCP + TLS handshake lại
+# ===========================================
 
-def load_users():
-    """Load users from acc.txt and return dict {username: password}"""
-    users = {}
-    try:
-        with file_lock:
-            if os.path.exists(ACCOUNTS_FILE):
-                with open(ACCOUNTS_FILE, 'r', encoding='utf-8') as f:
-                    for line in f:
-                        line = line.strip()
-                        if line and '|' in line:
-                            username, password = line.split('|', 1)
-                            users[username] = password
-    except Exception as e:
-        logger.error(f"Error loading users: {e}")
-    return users
+UPSTREAM_USER_AGENT = f"Python-urllib/{urllib.request.__version__}"
+_upstream_ssl_context = ssl.create_default_context()
 
-def save_user(username, password):
-    """Append new user to acc.txt and update in-memory cache"""
-    try:
-        with file_lock:
-            with open(ACCOUNTS_FILE, 'a', encoding='utf-8') as f:
-                f.write(f"{username}|{password}\n")
-            users[username] = password
-        return True
-    except Exception as e:
-        logger.error(f"Error saving user: {e}")
-        return False
+class UpstreamConnectionPool:
+    """Pool kết nối http.client theo (scheme, host, port) cho threaded mode"""
 
-def validate_username(username):
-    """Validate username format and strength"""
-    if not username:
-        return False, "Username không được để trống"
-    
-    if len(username) < 3:
-        return False, "Username phải có ít nhất 3 ký tự"
-    
-    if len(username) > 30:
-        return False, "Username không được vượt quá 30 ký tự"
-    
-    if '|' in username:
-        return False, "Username không được chứa ký tự '|'"
-    
-    import re
-    if not re.match(r'^[a-zA-Z0-9_]+$', username):
-        return False, "Username chỉ được chứa chữ cái, số và dấu gạch dưới"
-    
-    return True, "Valid"
+    def __init__(self, max_idle_per_host=8, idle_timeout=30, health_check=True):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self._idle = {}  # key -> [(connection, last_used)]
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale_retries": 0, "expired": 0, "unhealthy": 0, "released": 0}
 
-def validate_password(password):
-    """Validate password strength"""
-    if not password:
-        return False, "Password không được để trống"
-    
-    if len(password) < 6:
-        return False, "Password phải có ít nhất 6 ký tự"
-    
-    if len(password) > 100:
-        return False, "Password không được vượt quá 100 ký tự"
-    
-    if '|' in password:
-        return False, "Password không được chứa ký tự '|'"
-    
-    import re
-    has_letter = bool(re.search(r'[a-zA-Z]', password))
-    has_number = bool(re.search(r'[0-9]', password))
-    
-    if not (has_letter and has_number):
-        return False, "Password phải chứa cả chữ và số"
-    
-    return True, "Valid"
+    def acquire(self, key, timeout):
+        """Lấy kết nối idle còn dùng được hoặc tạo mới; trả về (connection, reused)"""
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                entry = idle.pop() if idle else None
+            if entry is None:
+                break
+            connection, last_used = entry
+            if time.time() - last_used > self.idle_timeout:
+                self._count("expired")
+                connection.close()
+            elif self.health_check and not self._is_alive(connection):
+                self._count("unhealthy")
+                connection.close()
+            else:
+                self._count("hits")
+                connection.timeout = timeout
+                connection.sock.settimeout(timeout)
+                return connection, True
 
-def check_user_exists(username):
-    """Check if username already exists"""
-    return username in users
+        self._count("misses")
+        scheme, host, port = key
+        if scheme == 'https':
+            connection = http.client.HTTPSConnection(host, port, timeout=timeout, context=_upstream_ssl_context)
+        else:
+            connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        return connection, False
 
-def authenticate_user(username, password):
-    """Verify username and password"""
-    return users.get(username) == password
+    def release(self, key, connection):
+        """Trả kết nối về pool (hoặc đóng nếu pool của host đã đầy)"""
+        if connection.sock is None:
+            return
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append((connection, time.time()))
+                self._stats["released"] += 1
+                return
+        connection.close()
 
-def load_sessions():
-    """Load sessions from JSON file and clean expired ones"""
-    try:
-        with file_lock:
-            if os.path.exists(SESSIONS_FILE):
-                with open(SESSIONS_FILE, 'r', encoding='utf-8') as f:
-                    stored_sessions = json.load(f)
-                    
-                # Clean expired sessions
-                current_time = time.time()
-                valid_sessions = {}
-                for session_id, data in stored_sessions.items():
-                    if current_time < data.get('expires_at', 0):
-                        # Keep full session data including remember_me flag
-                        valid_sessions[session_id] = {
-                            'username': data['username'],
-                            'expires_at': data['expires_at'],
-                            'remember_me': data.get('remember_me', False)
-                        }
-                    else:
-                        logger.info(f"Removed expired session for user: {data.get('username')}")
-                
-                return valid_sessions
-    except Exception as e:
-        logger.error(f"Error loading sessions: {e}")
-    return {}
+    def clear(self):
+        with self._lock:
+            entries = [entry for idle in self._idle.values() for entry in idle]
+            self._idle.clear()
+        for connection, _ in entries:
+            connection.close()
 
-def save_sessions():
-    """Save current sessions to JSON file preserving expiry timestamps"""
-    try:
-        with file_lock:
-            # Sessions are already in correct format with username and expires_at
-            with open(SESSIONS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(sessions, f, indent=2)
-        return True
-    except Exception as e:
-        logger.error(f"Error saving sessions: {e}")
-        return False
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["idle"] = {f"{scheme}://{host}:{port}": len(idle) for (scheme, host, port), idle in self._idle.items()}
+        total = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / total, 3) if total else 0
+        stats["max_idle_per_host"] = self.max_idle_per_host
+        stats["idle_timeout"] = self.idle_timeout
+        return stats
 
-def generate_session_id():
-    """Generate random session ID"""
-    return secrets.token_urlsafe(32)
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
 
-def create_session(username, remember_me=False, display_name=None):
-    """Create new session and return session_id"""
-    session_id = generate_session_id()
-    expiry_hours = (30 * 24) if remember_me else SESSION_EXPIRY_HOURS
-    sessions[session_id] = {
-        'username': username,
-        'expires_at': time.time() + (expiry_hours * 3600),
-        'remember_me': remember_me,
-        'display_name': display_name or username
-    }
-    save_sessions()  # Persist to file
-    logger.info(f"Session created for user: {username} (Remember me: {remember_me})")
-    return session_id
+    @staticmethod
+    def _is_alive(connection):
+        # Socket idle mà "readable" nghĩa là upstream đã đóng (EOF) hoặc gửi dữ liệu ngoài luồng
+        sock = connection.sock
+        if sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
 
-def get_user_from_session(session_id):
-    """Get username from session_id, checking expiry"""
-    session_data = sessions.get(session_id)
-    if not session_data:
-        return None
-    
-    # Check if session has expired
-    if time.time() >= session_data.get('expires_at', 0):
-        # Session expired, remove it
-        delete_session(session_id)
-        logger.info(f"Session expired for user: {session_data.get('username')}")
-        return None
-    
-    return session_data.get('username')
 
-def delete_session(session_id):
-    """Delete session"""
-    if session_id in sessions:
-        username = sessions[session_id].get('username', 'Unknown')
-        del sessions[session_id]
-        save_sessions()  # Persist to file
-        logger.info(f"Session deleted for user: {username}")
-        return True
-    return False
+UPSTREAM_POOL = UpstreamConnectionPool(*get_upstream_pool_settings())
 
-def load_rate_limits():
-    """Load rate limits from JSON file and clean expired ones"""
-    try:
-        with file_lock:
-            if os.path.exists(RATE_LIMIT_FILE):
-                with open(RATE_LIMIT_FILE, 'r', encoding='utf-8') as f:
-                    stored_limits = json.load(f)
-                    
-                current_time = time.time()
-                valid_limits = {}
-                for username, data in stored_limits.items():
-                    if current_time < data.get('locked_until', 0) or current_time - data.get('last_attempt', 0) < RATE_LIMIT_WINDOW:
-                        valid_limits[username] = data
-                
-                return valid_limits
-    except Exception as e:
-        logger.error(f"Error loading rate limits: {e}")
-    return {}
 
-def save_rate_limits():
-    """Save rate limits to JSON file"""
-    try:
-        with file_lock:
-            with open(RATE_LIMIT_FILE, 'w', encoding='utf-8') as f:
-                json.dump(rate_limits, f, indent=2)
-        return True
-    except Exception as e:
-        logger.error(f"Error saving rate limits: {e}")
-        return False
+class UpstreamCancelledError(ConnectionError):
+    """Attempt upstream đã bị huỷ (vd request thua của hedge)"""
 
-def check_rate_limit(username):
-    """Check if user is rate limited. Returns (is_limited, message, wait_time)"""
-    if username not in rate_limits:
-        return False, "", 0
-    
-    current_time = time.time()
-    user_limit = rate_limits[username]
-    
-    if current_time < user_limit.get('locked_until', 0):
-        wait_time = int(user_limit['locked_until'] - current_time)
-        return True, f"Tài khoản tạm khóa. Vui lòng thử lại sau {wait_time} giây", wait_time
-    
-    if current_time - user_limit.get('last_attempt', 0) >= RATE_LIMIT_WINDOW:
-        del rate_limits[username]
-        save_rate_limits()
-        return False, "", 0
-    
-    return False, "", 0
 
-def record_failed_attempt(username):
-    """Record a failed login attempt with exponential backoff"""
-    current_time = time.time()
-    
-    if username not in rate_limits:
-        rate_limits[username] = {
-            'attempts': 1,
-            'last_attempt': current_time,
-            'locked_until': 0
-        }
-    else:
-        if current_time - rate_limits[username].get('last_attempt', 0) >= RATE_LIMIT_WINDOW:
-            rate_limits[username] = {
-                'attempts': 1,
-                'last_attempt': current_time,
-                'locked_until': 0
-            }
-        else:
-            rate_limits[username]['attempts'] += 1
-            rate_limits[username]['last_attempt'] = current_time
-    
-    attempts = rate_limits[username]['attempts']
-    
-    if attempts >= MAX_LOGIN_ATTEMPTS:
-        if attempts <= 7:
-            lockout_duration = 60
-        elif attempts <= 10:
-            lockout_duration = 300
-        else:
-            lockout_duration = 1800
-        
-        rate_limits[username]['locked_until'] = current_time + lockout_duration
-        logger.warning(f"User {username} locked out for {lockout_duration}s after {attempts} failed attempts")
-    
-    save_rate_limits()
-    return attempts
+class UpstreamCancel:
+    """Cờ huỷ của một attempt upstream, truyền xuống _pooled_exchange
 
-def clear_rate_limit(username):
-    """Clear rate limit for successful login"""
-    if username in rate_limits:
-        del rate_limits[username]
-        save_rate_limits()
-        logger.info(f"Rate limit cleared for user: {username}")
+    cancel() shutdown kết nối attempt đang dùng (recv đang block lỗi ngay); attempt bị huỷ
+    không gửi lại trên kết nối mới, không trả kết nối về pool, chưa gửi thì không gửi nữa.
+    Kết nối được bỏ theo dõi (release) trước khi quay lại pool, nên cancel() không bao giờ
+    đụng tới kết nối mà request khác đã lấy ra.
+    """
 
-def rotate_session(old_session_id):
-    """Rotate session ID for security. Returns new session_id or None"""
-    if old_session_id not in sessions:
-        return None
-    
-    old_session_data = sessions[old_session_id]
-    username = old_session_data.get('username')
-    remember_me = old_session_data.get('remember_me', False)
-    
-    new_session_id = generate_session_id()
-    expiry_hours = (30 * 24) if remember_me else SESSION_EXPIRY_HOURS
-    
-    sessions[new_session_id] = {
-        'username': username,
-        'expires_at': time.time() + (expiry_hours * 3600),
-        'remember_me': remember_me
-    }
-    
-    del sessions[old_session_id]
-    save_sessions()
-    
-    logger.info(f"Session rotated for user: {username}")
-    return new_session_id
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connection = None
+        self.cancelled = False
 
-def cleanup_expired_data():
-    """Background task to cleanup expired sessions and rate limits"""
-    while True:
+    def attach(self, connection):
+        """Gắn kết nối sắp gửi request; False nếu attempt đã bị huỷ"""
+        with self._lock:
+            if self.cancelled:
+                return False
+            self._connection = connection
+            return True
+
+    def release(self, connection):
+        """Kết nối sắp trả về pool: bỏ theo dõi; False nếu attempt đã bị huỷ (phải đóng kết nối)"""
+        with self._lock:
+            if self._connection is connection:
+                self._connection = None
+            return not self.cancelled
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            connection, self._connection = self._connection, None
+        sock = connection.sock if connection is not None else None
+        if sock is None:
+            return
         try:
-            time.sleep(3600)
-            
-            current_time = time.time()
-            expired_sessions = []
-            for session_id, data in list(sessions.items()):
-                if current_time >= data.get('expires_at', 0):
-                    expired_sessions.append(session_id)
-            
-            for session_id in expired_sessions:
-                delete_session(session_id)
-            
-            if expired_sessions:
-                logger.info(f"Cleaned up {len(expired_sessions)} expired session(s)")
-            
-            expired_limits = []
-            for username, data in list(rate_limits.items()):
-                if current_time >= data.get('locked_until', 0) and current_time - data.get('last_attempt', 0) >= RATE_LIMIT_WINDOW:
-                    expired_limits.append(username)
-            
-            for username in expired_limits:
-                del rate_limits[username]
-            
-            if expired_limits:
-                save_rate_limits()
-                logger.info(f"Cleaned up {len(expired_limits)} expired rate limit(s)")
-                
-        except Exception as e:
-            logger.error(f"Error in cleanup task: {e}")
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
-def save_ai_history(username, model, prompt, response, metadata=None):
-    """Save AI call history to JSONL file with thread-safety"""
-    try:
-        history_entry = {
-            'timestamp': time.time(),
-            'username': username or 'anonymous',
-            'model': model,
-            'prompt': prompt[:500] if prompt else '',  # Limit prompt length
-            'response': response[:500] if response else '',  # Limit response length
-            'metadata': metadata or {}
-        }
-        
-        with file_lock:
-            with open(AI_HISTORY_FILE, 'a', encoding='utf-8') as f:
-                f.write(json.dumps(history_entry, ensure_ascii=False) + '\n')
-        
-        logger.debug(f"AI history saved: {username} - {model}")
-        return True
-    except Exception as e:
-        logger.error(f"Error saving AI history: {e}")
-        return False
 
-class NexoraXHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
-    """Custom HTTP request handler for NexoraX AI application"""
-    
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, directory=os.getcwd(), **kwargs)
-    
-    def _is_origin_allowed(self, origin):
-        """Check if origin is in secure allowed list"""
-        if not origin:
-            return True  # Allow requests without origin (server-to-server)
-        allowed_origins = get_allowed_origins()
-        # If allowed origins contains "*", allow all
-        if "*" in allowed_origins:
-            return True
-        return origin in allowed_origins
-    
-    def _send_cors_headers(self, origin=None):
-        """Send appropriate CORS headers securely"""
-        origin = origin or self.headers.get('Origin', '')
-        allowed_origins = get_allowed_origins()
-        
-        if "*" in allowed_origins:
-            # For production environments like Render/Replit
-            self.send_header('Access-Control-Allow-Origin', '*')
-        elif self._is_origin_allowed(origin) and origin:
-            self.send_header('Access-Control-Allow-Origin', origin)
-            self.send_header('Vary', 'Origin')
+class PooledResponse:
+    """Response từ pooled_urlopen, dùng như response của urllib.request.urlopen
+
+    Kết nối được trả về pool khi body đã đọc hết; đóng response khi body còn dở
+    (ví dụ chỉ cần geturl()) sẽ đóng luôn kết nối thay vì tái sử dụng.
+    """
+
+    def __init__(self, response, connection, pool_key, url, cancel=None):
+        self._response = response
+        self._connection = connection
+        self._pool_key = pool_key
+        self._cancel = cancel
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        self._release_if_done()
+        return data
+
+    def readline(self, limit=-1):
+        line = self._response.readline(limit)
+        self._release_if_done()
+        return line
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def settimeout(self, seconds):
+        """Đổi timeout chờ giữa 2 lần đọc (vd giới hạn theo Deadline khi đang đọc stream)"""
+        if self._connection.sock is not None:
+            self._connection.sock.settimeout(seconds)
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def info(self):
+        return self.headers
+
+    def close(self):
+        if self._connection is None:
+            return
+        if not self._release_if_done():
+            self._response.close()
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _release_if_done(self):
+        if self._connection is None or not self._response.isclosed():
+            return self._connection is None
+        released = self._cancel is None or self._cancel.release(self._connection)
+        if self._response.will_close or not released:
+            self._connection.close()
         else:
-            # Fallback to wildcard for production
-            self.send_header('Access-Control-Allow-Origin', '*')
-    
-    def _send_json_error(self, status_code, error_message, error_code):
-        """Send JSON error response with proper CORS"""
-        self.send_response(status_code)
-        self.send_header('Content-Type', 'application/json')
-        self._send_cors_headers()
-        self.end_headers()
-        error_response = json.dumps({
-            "error": error_message,
-            "code": error_code
-        })
-        self.wfile.write(error_response.encode('utf-8'))
-    
-    def _get_username_from_cookie(self):
-        """Extract username from session cookie"""
+            UPSTREAM_POOL.release(self._pool_key, self._connection)
+        self._connection = None
+        return True
+
+
+def _pooled_exchange(method, url, headers, data, timeout, cancel=None):
+    parts = urllib.parse.urlsplit(url)
+    scheme = parts.scheme or 'http'
+    key = (scheme, parts.hostname, parts.port or (443 if scheme == 'https' else 80))
+    target = parts.path or '/'
+    if parts.query:
+        target += '?' + parts.query
+
+    for attempt in range(2):
+        connection, reused = UPSTREAM_POOL.acquire(key, timeout)
+        if cancel is not None and not cancel.attach(connection):
+            UPSTREAM_POOL.release(key, connection)
+            raise UpstreamCancelledError(f"request tới {url} đã bị huỷ")
         try:
-            cookie_header = self.headers.get('Cookie', '')
-            if not cookie_header:
-                return None
-            
-            # Parse cookies
-            cookies = {}
-            for item in cookie_header.split(';'):
-                item = item.strip()
-                if '=' in item:
-                    key, value = item.split('=', 1)
-                    cookies[key] = value
-            
-            session_id = cookies.get('session_id')
-            if session_id:
-                return get_user_from_session(session_id)
-        except Exception as e:
-            logger.debug(f"Error extracting username from cookie: {e}")
-        return None
-    
-    def get_gemini_vision_description(self, image_data_base64):
-        """
-        Sử dụng Gemini 2.5 Flash để mô tả hình ảnh trước khi gửi cho các model khác.
-        Đây là model độc lập, không ảnh hưởng đến Gemini chính trên web.
-        """
+            connection.request(method, target, body=data, headers=headers)
+        except OSError as e:
+            connection.close()
+            if cancel is not None and cancel.cancelled:
+                raise UpstreamCancelledError(f"request tới {url} đã bị huỷ") from e
+            if reused and attempt == 0:
+                UPSTREAM_POOL._count("stale_retries")
+                continue
+            raise urllib.error.URLError(e)
         try:
-            api_key = get_api_key('gemini')
-            if not api_key:
-                return "Không có API Key cho Gemini Vision."
+            response = connection.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+            connection.close()
+            # Bị huỷ (shutdown socket) thì dừng hẳn, không gửi lại
+            if cancel is not None and cancel.cancelled:
+                raise UpstreamCancelledError(f"request tới {url} đã bị huỷ") from e
+            # Upstream đã đóng kết nối keep-alive cũ mà chưa trả lời: gửi lại trên kết nối mới
+            if reused and attempt == 0:
+                UPSTREAM_POOL._count("stale_retries")
+                continue
+            raise
+        except Exception:
+            connection.close()
+            raise
+        return PooledResponse(response, connection, key, url, cancel)
 
-            # Chuẩn bị dữ liệu base64 (bỏ prefix nếu có)
-            base64_data = image_data_base64
-            if ',' in image_data_base64:
-                base64_data = image_data_base64.split(',', 1)[1]
-
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}"
-            
-            payload = {
-                "contents": [{
-                    "parts": [
-                        {"text": "Hãy mô tả chi tiết nội dung của hình ảnh này bằng tiếng Việt. Nếu có chữ trong ảnh, hãy trích xuất toàn bộ văn bản đó. Trả về kết quả ngắn gọn nhưng đầy đủ thông tin nhất có thể."},
-                        {
-                            "inline_data": {
-                                "mime_type": "image/jpeg",
-                                "data": base64_data
-                            }
-                        }
-                    ]
-                }]
+
+def pooled_urlopen(request, timeout=REQUEST_TIMEOUT, max_redirects=5, cancel=None):
+    """Thay thế urllib.request.urlopen dùng kết nối keep-alive từ UPSTREAM_POOL
+
+    Giữ nguyên hành vi lỗi của urlopen: urllib.error.HTTPError khi status >= 400,
+    urllib.error.URLError khi không kết nối được, tự follow redirect.
+    cancel: UpstreamCancel để thread khác huỷ được request (UpstreamCancelledError).
+    """
+    if isinstance(request, str):
+        request = urllib.request.Request(request)
+    method = request.get_method()
+    url = request.full_url
+    data = request.data
+    headers = dict(request.header_items())
+    headers.setdefault('User-agent', UPSTREAM_USER_AGENT)
+    if data is not None:
+        headers.setdefault('Content-type', 'application/x-www-form-urlencoded')
+
+    for _ in range(max_redirects + 1):
+        response = _pooled_exchange(method, url, headers, data, timeout, cancel)
+        location = response.getheader('Location')
+        if response.status in (301, 302, 303, 307, 308) and location:
+            response.read()
+            response.close()
+            url = urllib.parse.urljoin(url, location)
+            if response.status == 303 or (response.status in (301, 302) and method == 'POST'):
+                method, data = 'GET', None
+                headers = {k: v for k, v in headers.items() if k.lower() not in ('content-type', 'content-length')}
+            continue
+        if response.status >= 400:
+            body = response.read()
+            response.close()
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+        return response
+
+    raise urllib.error.URLError(f"Quá nhiều redirect khi gọi {url}")
+
+# ===========================================
+# UPSTREAM CLIENT
+# Mọi call tới provider bên ngoài đi qua đây: timeout/retry/backoff theo UPSTREAM_POLICIES + metrics
+# ===========================================
+
+class UpstreamResponse:
+    """Response upstream đã đọc xong body (dùng chung cho threaded và asyncio mode)"""
+
+    def __init__(self, status, reason, headers, body, url):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.url = url
+        self._read = False
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+    def read(self):
+        # Giống urlopen: body chỉ đọc được một lần
+        if self._read:
+            return b''
+        self._read = True
+        return self.body
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class UpstreamMetrics:
+    """Latency / status / bytes theo từng upstream"""
+
+    LATENCY_SAMPLES = 256  # Số mẫu latency gần nhất giữ lại để tính percentile
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._providers = {}
+
+    def _entry(self, name):
+        entry = self._providers.get(name)
+        if entry is None:
+            entry = self._providers[name] = {
+                "calls": 0,
+                "errors": 0,
+                "retries": 0,
+                "bytes_in": 0,
+                "bytes_out": 0,
+                "total_latency": 0.0,
+                "max_latency": 0.0,
+                "hedges_fired": 0,
+                "hedges_won": 0,
+                "status_counts": {},
+                "latencies": deque(maxlen=self.LATENCY_SAMPLES),
+                "ttft": deque(maxlen=self.LATENCY_SAMPLES)  # time-to-first-token của các call streaming
             }
+        return entry
 
-            req = urllib.request.Request(
-                url,
-                data=json.dumps(payload).encode('utf-8'),
-                headers={'Content-Type': 'application/json'}
-            )
-            
-            # Tăng timeout lên 60 giây để tránh lỗi "The read operation timed out"
-            with urllib.request.urlopen(req, timeout=60) as response:
-                result = json.loads(response.read().decode('utf-8'))
-                if 'candidates' in result and len(result['candidates']) > 0:
-                    description = result['candidates'][0]['content']['parts'][0]['text']
-                    return description
-            return "Đang xử lý hình ảnh..." # Trả về text trung lập thay vì lỗi kỹ thuật
-        except Exception as e:
-            logger.error(f"Gemini Vision Error: {e}")
-            return "Đang xử lý hình ảnh..." # Trả về text trung lập thay vì lỗi kỹ thuật
+    def record(self, name, status, latency, bytes_in=0, bytes_out=0, error=None):
+        """Ghi nhận một attempt; status=None kèm error khi không nhận được response"""
+        status_key = str(status) if status is not None else type(error).__name__
+        with self._lock:
+            entry = self._entry(name)
+            entry["calls"] += 1
+            if status is None or status >= 400:
+                entry["errors"] += 1
+            entry["bytes_in"] += bytes_in
+            entry["bytes_out"] += bytes_out
+            entry["total_latency"] += latency
+            entry["max_latency"] = max(entry["max_latency"], latency)
+            entry["status_counts"][status_key] = entry["status_counts"].get(status_key, 0) + 1
+            entry["latencies"].append(latency)
 
-    def do_POST(self):
-        """Handle POST requests for API proxy"""
-        if self.path == '/api/gemini':
-            self.handle_gemini_proxy()
-        elif self.path == '/api/search':
-            self.handle_serpapi_search()
-        elif self.path == '/api/serpapi' or self.path == '/api/duckduckgo':
-            self.handle_serpapi_search()
-        elif self.path == '/api/search-with-ai':
-            self.handle_search_with_ai()
-        elif self.path == '/api/llm7/gpt-5-chat':
-            self.handle_llm7_gpt5chat()
-        elif self.path == '/api/llm7/gemini-search':
-            self.handle_llm7_gemini_search()
-        elif self.path == '/api/llm7/chat':
-            self.handle_llm7_chat()
-        elif self.path == '/api/enhance-prompt':
-            self.handle_enhance_prompt()
-        elif self.path == '/api/pollinations/generate':
-            self.handle_pollinations_generate()
-        elif self.path == '/api/auth/signup':
-            self.handle_auth_signup()
-        elif self.path == '/api/auth/login':
-            self.handle_auth_login()
-        elif self.path == '/api/auth/logout':
-            self.handle_auth_logout()
-        elif self.path == '/api/admin/users/delete':
-            self.handle_admin_delete_user()
-        elif self.path == '/api/admin/sessions/delete':
-            self.handle_admin_delete_session()
-        elif self.path == '/api/admin/rate-limits/clear':
-            self.handle_admin_clear_rate_limit()
-        elif self.path == '/api/admin/config/update':
-            self.handle_admin_config_update()
-        else:
-            self._send_json_error(404, "API endpoint không tồn tại", "NOT_FOUND")
+    def record_retry(self, name):
+        with self._lock:
+            self._entry(name)["retries"] += 1
 
-    def handle_gemini_proxy(self):
-        """Proxy requests to Gemini API using server-side API key"""
-        try:
-            # Get username from session cookie
-            username = self._get_username_from_cookie()
-            
-            # Get API key from config hoặc environment
-            api_key = get_api_key('gemini')
-            logger.info(f"API Key configured: {'Yes' if api_key and api_key != 'your_gemini_api_key_here' else 'No'}")
-            if not api_key or api_key == "your_gemini_api_key_here":
-                self._send_json_error(500, 
-                    "API key chưa được cấu hình. Vui lòng thêm GEMINI_API_KEY vào environment variables.",
-                    "API_KEY_MISSING")
-                return
-            
-            # Read request body
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
-            
-            # Extract model from request
-            model = request_data.get('model', 'gemini-2.5-flash')
-            
-            # Build Gemini API URL
-            gemini_url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}"
-            
-            # Get payload - supports both old and new format
-            payload = request_data.get('payload', {})
-            
-            # Extract prompt for history tracking
-            prompt_text = ""
-            if 'contents' in payload and isinstance(payload['contents'], list) and len(payload['contents']) > 0:
-                last_content = payload['contents'][-1]
-                if 'parts' in last_content and isinstance(last_content['parts'], list) and len(last_content['parts']) > 0:
-                    prompt_text = last_content['parts'][0].get('text', '')
-            
-            # The payload now contains the full conversation history in 'contents' array
-            # No need to modify - frontend already sends it in correct format
-            
-            # Prepare request for Gemini API
-            gemini_request = urllib.request.Request(
-                gemini_url,
-                data=json.dumps(payload).encode('utf-8'),
-                headers={'Content-Type': 'application/json'}
-            )
-            
-            # Make request to Gemini API with timeout
-            with urllib.request.urlopen(gemini_request, timeout=REQUEST_TIMEOUT) as response:
-                gemini_response = response.read()
-            
-            # Extract response text for history tracking
-            try:
-                response_data = json.loads(gemini_response.decode('utf-8'))
-                response_text = ""
-                if 'candidates' in response_data and len(response_data['candidates']) > 0:
-                    candidate = response_data['candidates'][0]
-                    if 'content' in candidate and 'parts' in candidate['content']:
-                        parts = candidate['content']['parts']
-                        if len(parts) > 0:
-                            response_text = parts[0].get('text', '')
-                
-                # Save AI history
-                save_ai_history(
-                    username=username,
-                    model=model,
-                    prompt=prompt_text,
-                    response=response_text,
-                    metadata={'endpoint': 'gemini_proxy'}
-                )
-            except Exception as e:
-                logger.debug(f"Error saving Gemini history: {e}")
-                
-            # Return response to client
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            # Send secure CORS headers
-            self._send_cors_headers()
-            self.end_headers()
-            self.wfile.write(gemini_response)
-            
-        except urllib.error.HTTPError as e:
-            # Forward exact status and error from Gemini API
-            try:
-                error_body = e.read().decode('utf-8')
-                self._send_json_error(e.code, f"Gemini API lỗi: {error_body}", "UPSTREAM_ERROR")
-            except:
-                self._send_json_error(e.code, f"Gemini API lỗi: {e.reason}", "UPSTREAM_ERROR")
-        except urllib.error.URLError as e:
-            logger.error(f"Gemini connection error: {e}")
-            self._send_json_error(502, "Không thể kết nối đến Gemini API", "CONNECTION_ERROR")
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in request: {e}")
-            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
-        except Exception as e:
-            logger.error(f"Gemini proxy error: {e}")
-            logger.error(f"Exception type: {type(e)}")
-            logger.error(f"Exception args: {e.args}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+    def record_hedge(self, name, won=False):
+        """Ghi một hedged request đã gửi (won=True: ghi thêm là hedge về trước)"""
+        with self._lock:
+            self._entry(name)["hedges_won" if won else "hedges_fired"] += 1
 
+    def sample_count(self, name):
+        with self._lock:
+            return len(self._entry(name)["latencies"])
 
-    def handle_serpapi_search(self):
-        """Handle SerpAPI search requests"""
-        try:
-            # Get API key from config hoặc environment
-            api_key = get_api_key('serpapi')
-            logger.info(f"SerpAPI Key configured: {'Yes' if api_key and api_key != 'your_serpapi_api_key_here' else 'No'}")
-            if not api_key or api_key == "your_serpapi_api_key_here":
-                self._send_json_error(500, 
-                    "SerpAPI key chưa được cấu hình. Vui lòng thêm SERPAPI_API_KEY vào environment variables.",
-                    "API_KEY_MISSING")
-                return
-            
-            # Read request body
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
-            
-            # Extract query from request
-            query = request_data.get('query', '')
-            if not query:
-                self._send_json_error(400, "Query không được để trống", "MISSING_QUERY")
-                return
-            
-            # Build SerpAPI URL for Google search
-            serpapi_url = "https://serpapi.com/search.json"
-            serpapi_params = {
-                "q": query,
-                "engine": "google",
-                "api_key": api_key,
-                "num": request_data.get('num', 10),  # Number of results
-                "hl": "vi",  # Vietnamese language
-                "gl": "vn"   # Vietnam location
-            }
-            
-            # Build URL with parameters
-            url_params = urllib.parse.urlencode(serpapi_params)
-            full_url = f"{serpapi_url}?{url_params}"
-            
-            # Make request to SerpAPI with timeout
-            serpapi_request = urllib.request.Request(full_url)
-            with urllib.request.urlopen(serpapi_request, timeout=REQUEST_TIMEOUT) as response:
-                serpapi_response = response.read().decode('utf-8')
-                serpapi_data = json.loads(serpapi_response)
-            
-            # Extract useful information from SerpAPI response
-            organic_results = serpapi_data.get('organic_results', [])
-            answer_box = serpapi_data.get('answer_box', {})
-            knowledge_graph = serpapi_data.get('knowledge_graph', {})
-            
-            search_results = {
-                "query": query,
-                "answer": answer_box.get('answer', ''),
-                "snippet": answer_box.get('snippet', ''),
-                "title": answer_box.get('title', ''),
-                "link": answer_box.get('link', ''),
-                "knowledge_graph": knowledge_graph,
-                "organic_results": organic_results[:5],  # Limit to first 5
-                "total_results": serpapi_data.get('search_information', {}).get('total_results', 0)
-            }
-            
-            # Format the response for better use with Gemini
-            formatted_response = {
-                "search_query": query,
-                "search_results": search_results,
-                "summary": self._format_serpapi_summary(search_results),
-                "timestamp": int(time.time()) if 'time' in globals() else None
-            }
-            
-            # Return response to client
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps(formatted_response, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-        except urllib.error.HTTPError as e:
-            try:
-                error_body = e.read().decode('utf-8')
-                self._send_json_error(e.code, f"SerpAPI lỗi: {error_body}", "UPSTREAM_ERROR")
-            except:
-                self._send_json_error(e.code, f"SerpAPI lỗi: {e.reason}", "UPSTREAM_ERROR")
-        except urllib.error.URLError as e:
-            logger.error(f"SerpAPI connection error: {e}")
-            self._send_json_error(502, "Không thể kết nối đến SerpAPI", "CONNECTION_ERROR")
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in SerpAPI request: {e}")
-            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
-        except Exception as e:
-            logger.error(f"SerpAPI search error: {e}")
-            logger.error(f"Exception type: {type(e)}")
-            logger.error(f"Exception args: {e.args}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
-    
-    def _format_serpapi_summary(self, search_results):
-        """Format SerpAPI search results into a readable summary"""
-        summary_parts = []
-        
-        if search_results.get('answer'):
-            summary_parts.append(f"Trả lời: {search_results['answer']}")
-        
-        if search_results.get('snippet'):
-            summary_parts.append(f"Tóm tắt: {search_results['snippet']}")
-        
-        if search_results.get('title'):
-            summary_parts.append(f"Tiêu đề: {search_results['title']}")
-        
-        # Add knowledge graph information
-        knowledge_graph = search_results.get('knowledge_graph', {})
-        if knowledge_graph.get('description'):
-            summary_parts.append(f"Mô tả: {knowledge_graph['description']}")
-        
-        # Add organic results
-        organic_results = search_results.get('organic_results', [])
-        if organic_results:
-            result_texts = []
-            for result in organic_results[:3]:  # First 3 results
-                if result.get('title') and result.get('snippet'):
-                    result_texts.append(f"{result['title']}: {result['snippet'][:100]}...")
-            if result_texts:
-                summary_parts.append(f"Kết quả tìm kiếm:\n" + "\n".join(f"- {text}" for text in result_texts))
-        
-        total_results = search_results.get('total_results', 0)
-        if total_results > 0:
-            summary_parts.append(f"Tổng số kết quả: {total_results:,}")
-        
-        return '\n\n'.join(summary_parts) if summary_parts else "Không tìm thấy thông tin phù hợp."
+    def record_ttft(self, name, seconds):
+        """Ghi time-to-first-token: từ lúc gửi request đến khi nhận được token đầu tiên"""
+        with self._lock:
+            self._entry(name)["ttft"].append(seconds)
 
-    def handle_search_with_ai(self):
-        """Handle search requests that combine SerpAPI results with Gemini AI processing"""
-        try:
-            # Get API keys for both Gemini and SerpAPI
-            gemini_key = get_api_key('gemini')
-            serpapi_key = get_api_key('serpapi')
-            
-            if not gemini_key or gemini_key == "your_gemini_api_key_here":
-                self._send_json_error(500, 
-                    "Gemini API key chưa được cấu hình. Vui lòng thêm GEMINI_API_KEY vào environment variables.",
-                    "API_KEY_MISSING")
+    def percentile(self, name, percent, series="latencies"):
+        """Latency (giây) tại percentile trên các mẫu gần nhất; None nếu chưa có dữ liệu"""
+        with self._lock:
+            samples = sorted(self._entry(name)[series])
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * percent / 100))
+        return samples[index]
+
+    def get_stats(self):
+        with self._lock:
+            names = list(self._providers)
+        stats = {}
+        for name in names:
+            with self._lock:
+                entry = self._providers[name]
+                calls = entry["calls"]
+                stats[name] = {
+                    "calls": calls,
+                    "errors": entry["errors"],
+                    "retries": entry["retries"],
+                    "hedges_fired": entry["hedges_fired"],
+                    "hedges_won": entry["hedges_won"],
+                    "bytes_in": entry["bytes_in"],
+                    "bytes_out": entry["bytes_out"],
+                    "avg_latency_ms": round(entry["total_latency"] / calls * 1000, 2) if calls else 0,
+                    "max_latency_ms": round(entry["max_latency"] * 1000, 2),
+                    "status_counts": dict(entry["status_counts"])
+                }
+            for percent in (50, 95, 99):
+                value = self.percentile(name, percent)
+                stats[name][f"p{percent}_ms"] = round(value * 1000, 2) if value is not None else None
+            for percent in (50, 95):
+                value = self.percentile(name, percent, series="ttft")
+                if value is not None:
+                    stats[name][f"ttft_p{percent}_ms"] = round(value * 1000, 2)
+        return stats
+
+
+UPSTREAM_METRICS = UpstreamMetrics()
+
+
+class CircuitOpenError(urllib.error.URLError):
+    """Circuit breaker của upstream đang mở: từ chối ngay thay vì chờ timeout"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"circuit '{name}' is open")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(TimeoutError):
+    """Request đã dùng hết thời gian của Deadline"""
+
+
+class Deadline:
+    """Thời hạn end-to-end của một request, truyền qua mọi upstream call của request đó
+
+    Mỗi bước lấy timeout bằng cap(): không vượt quá thời gian còn lại, nên tổng thời gian
+    của cả pipeline không vượt quá budget dù từng bước có timeout riêng.
+    """
+
+    def __init__(self, seconds):
+        self.budget = seconds
+        self.expires_at = time.time() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.time())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def cap(self, timeout=None, reserve=0.0):
+        """Timeout cho bước tiếp theo, chừa lại `reserve` giây cho các bước sau
+
+        Raise DeadlineExceededError nếu không còn thời gian cho bước này.
+        """
+        available = self.remaining() - reserve
+        if available <= 0:
+            raise DeadlineExceededError(f"request deadline of {self.budget:g}s exceeded")
+        return min(timeout, available) if timeout else available
+
+
+class CircuitBreaker:
+    """Circuit breaker closed → open → half_open cho một upstream
+
+    Đếm kết quả của N attempt gần nhất; khi tỉ lệ lỗi hoặc tỉ lệ chậm vượt ngưỡng thì mở
+    và từ chối mọi request trong open_seconds. Hết thời gian đó chỉ cho half_open_probes
+    request đi qua để thăm dò: thành công → đóng lại, lỗi/chậm → mở tiếp.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.settings = settings
+        self.state = self.CLOSED
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=settings["window"])  # (failed, slow) theo từng attempt
+        self._opened_at = 0.0
+        self._changed_at = time.time()
+        self._probes_in_flight = 0
+        self._stats = {"opened": 0, "rejected": 0, "probes": 0}
+
+    def before_call(self):
+        """Xin phép gọi upstream: trả về True nếu là request thăm dò, raise CircuitOpenError nếu đang mở"""
+        with self._lock:
+            if self.state == self.OPEN and time.time() - self._opened_at >= self.settings["open_seconds"]:
+                self._transition(self.HALF_OPEN)
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.HALF_OPEN and self._probes_in_flight < self.settings["half_open_probes"]:
+                self._probes_in_flight += 1
+                self._stats["probes"] += 1
+                return True
+            self._stats["rejected"] += 1
+            retry_after = max(1, int(self._opened_at + self.settings["open_seconds"] - time.time() + 0.999))
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record(self, probe, failed, slow=False):
+        """Ghi kết quả của một attempt đã được before_call cho phép"""
+        with self._lock:
+            if probe:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if self.state != self.HALF_OPEN:
+                    return  # breaker đã được reset/mở lại khi probe đang chạy
+                if failed or slow:
+                    self._open()
+                else:
+                    self._outcomes.clear()
+                    self._transition(self.CLOSED)
                 return
-                
-            if not serpapi_key or serpapi_key == "your_serpapi_api_key_here":
-                self._send_json_error(500, 
-                    "SerpAPI key chưa được cấu hình. Vui lòng thêm SERPAPI_API_KEY vào environment variables.",
-                    "API_KEY_MISSING")
+            if self.state != self.CLOSED:
+                return  # attempt bắt đầu trước khi breaker mở, không ảnh hưởng trạng thái nữa
+            self._outcomes.append((failed, slow))
+            total = len(self._outcomes)
+            if total < self.settings["min_calls"]:
                 return
+            error_rate = sum(1 for failed, _ in self._outcomes if failed) / total
+            slow_rate = sum(1 for _, slow in self._outcomes if slow) / total
+            if error_rate >= self.settings["error_rate"] or slow_rate >= self.settings["slow_rate"]:
+                self._open()
 
-            # Read request body
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
-            
-            # Extract user query
-            user_query = request_data.get('query', '')
-            if not user_query:
-                self._send_json_error(400, "Query không được để trống", "MISSING_QUERY")
-                return
+    def release_probe(self):
+        """Trả lại slot của probe bị huỷ giữa chừng mà không ghi kết quả"""
+        with self._lock:
+            self._probes_in_flight = max(0, self._probes_in_flight - 1)
 
-            # Step 1: Search SerpAPI
-            logger.info(f"Starting search for: {user_query}")
-            serpapi_url = "https://serpapi.com/search.json"
-            serpapi_params = {
-                "q": user_query,
-                "engine": "google",
-                "api_key": serpapi_key,
-                "num": 5,
-                "hl": "vi",
-                "gl": "vn"
-            }
-            
-            url_params = urllib.parse.urlencode(serpapi_params)
-            full_url = f"{serpapi_url}?{url_params}"
-            
-            serpapi_request = urllib.request.Request(full_url)
-            with urllib.request.urlopen(serpapi_request, timeout=REQUEST_TIMEOUT) as response:
-                serpapi_response = response.read().decode('utf-8')
-                serpapi_data = json.loads(serpapi_response)
+    def _open(self):
+        self._opened_at = time.time()
+        self._stats["opened"] += 1
+        self._transition(self.OPEN)
 
-            # Format search results for AI processing
-            search_context = self._format_search_context_for_ai(serpapi_data, user_query)
-            
-            # Step 2: Create enhanced prompt for Gemini
-            enhanced_prompt = self._create_search_enhanced_prompt(user_query, search_context)
-            
-            # Support conversation history - check if provided
-            conversation_history = request_data.get('conversation_history', [])
-            
-            # Step 3: Send to Gemini 3 Pro
-            gemini_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={gemini_key}"
-            
-            # Build contents array with conversation history + enhanced prompt
-            contents = []
-            if conversation_history:
-                # Use conversation history if provided
-                contents = conversation_history.copy()
-                # Update the last message with enhanced prompt
-                if contents:
-                    contents[-1]["parts"][0]["text"] = enhanced_prompt
-            else:
-                # Fallback to old format for backward compatibility
-                contents = [{
-                    "parts": [{
-                        "text": enhanced_prompt
-                    }]
-                }]
-            
-            gemini_payload = {
-                "contents": contents,
-                "generationConfig": {
-                    "temperature": 0.7,
-                    "topK": 40,
-                    "topP": 0.95,
-                    "maxOutputTokens": 8192,
-                },
-                "safetySettings": [
-                    {
-                        "category": "HARM_CATEGORY_HARASSMENT",
-                        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_HATE_SPEECH",
-                        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                    },
-                    {
-                        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-                    }
-                ]
-            }
-            
-            gemini_request = urllib.request.Request(
-                gemini_url,
-                data=json.dumps(gemini_payload).encode('utf-8'),
-                headers={'Content-Type': 'application/json'}
-            )
-            
-            with urllib.request.urlopen(gemini_request, timeout=REQUEST_TIMEOUT) as response:
-                gemini_response = response.read().decode('utf-8')
-                gemini_data = json.loads(gemini_response)
+    def _transition(self, state):
+        if state == self.state and state != self.OPEN:
+            return
+        logger.warning(f"🔌 Circuit '{self.name}': {self.state} → {state}")
+        self.state = state
+        self._changed_at = time.time()
 
-            # Format the final response
-            final_response = {
-                "query": user_query,
-                "model": "nexorax2-search",
-                "search_performed": True,
-                "search_results_count": len(serpapi_data.get('organic_results', [])),
-                "ai_response": gemini_data,
-                "search_context": search_context,
-                "timestamp": int(time.time())
+    def reset(self):
+        """Đóng breaker thủ công (admin) và xoá cửa sổ kết quả
+
+        Không đụng tới _probes_in_flight: probe đang chạy vẫn tự trả slot khi xong.
+        """
+        with self._lock:
+            self._outcomes.clear()
+            self._transition(self.CLOSED)
+
+    def get_stats(self):
+        with self._lock:
+            total = len(self._outcomes)
+            stats = {
+                "state": self.state,
+                "since": self._changed_at,
+                "window_calls": total,
+                "error_rate": round(sum(1 for failed, _ in self._outcomes if failed) / total, 3) if total else 0,
+                "slow_rate": round(sum(1 for _, slow in self._outcomes if slow) / total, 3) if total else 0,
+                "probes_in_flight": self._probes_in_flight,
+                "retry_after": max(0, round(self._opened_at + self.settings["open_seconds"] - time.time(), 1)) if self.state == self.OPEN else 0,
+                "settings": dict(self.settings)
             }
+            stats.update(self._stats)
+        return stats
 
-            # Return response to client
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps(final_response, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-            logger.info(f"Search with AI completed for query: {user_query}")
-            
-        except urllib.error.HTTPError as e:
-            try:
-                error_body = e.read().decode('utf-8')
-                self._send_json_error(e.code, f"API lỗi: {error_body}", "UPSTREAM_ERROR")
-            except:
-                self._send_json_error(e.code, f"API lỗi: {e.reason}", "UPSTREAM_ERROR")
-        except urllib.error.URLError as e:
-            logger.error(f"Search with AI connection error: {e}")
-            self._send_json_error(502, "Không thể kết nối đến dịch vụ tìm kiếm", "CONNECTION_ERROR")
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in search with AI request: {e}")
-            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
-        except Exception as e:
-            logger.error(f"Search with AI error: {e}")
-            logger.error(f"Exception type: {type(e)}")
-            logger.error(f"Exception args: {e.args}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
 
-    def handle_llm7_gpt5chat(self):
-        """Handle GPT-5-chat requests via LLM7.io"""
-        try:
-            # Get username from session cookie
-            username = self._get_username_from_cookie()
-            
-            # Get API key from config
-            api_key = get_api_key('llm7')
-            logger.info(f"LLM7 API Key configured: {'Yes' if api_key else 'No'}")
-            if not api_key:
-                self._send_json_error(500, 
-                    "LLM7 API key chưa được cấu hình. Vui lòng kiểm tra config.py",
-                    "API_KEY_MISSING")
-                return
-            
-            # Read request body
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
-            
-            # Extract message from request
-            message = request_data.get('message', '')
-            if not message:
-                self._send_json_error(400, "Message không được để trống", "MISSING_MESSAGE")
-                return
-            
-            # Extract files from request (for vision/image analysis)
-            files = request_data.get('files', [])
-            
-            # Build LLM7.io API URL for GPT-5-chat
-            llm7_url = "https://api.llm7.io/v1/chat/completions"
-            llm7_headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
-            
-            # Support conversation history - check if messages array is provided
-            conversation_messages = request_data.get('messages', [])
-            
-            # Build messages array with system prompt and conversation history
-            messages: list = [
-                {"role": "system", "content": get_llm7_system_prompt('gpt-5-chat')}
-            ]
-            
-            # Add conversation history if provided
-            if conversation_messages:
-                messages.extend(conversation_messages)
-            else:
-                # Fallback to old format for backward compatibility
-                messages.append({"role": "user", "content": message})
-            
-            # Add files to the last user message if present (for vision models)
-            if files and len(files) > 0:
-                # Find the last user message
-                for i in range(len(messages) - 1, -1, -1):
-                    if messages[i].get('role') == 'user':
-                        current_content = messages[i].get('content', '')
-                        
-                        # Step 1: Get image description from Gemini Vision (Independent processing)
-                        image_descriptions = []
-                        for file in files:
-                            base64_val = file.get('base64', '')
-                            if base64_val:
-                                desc = self.get_gemini_vision_description(base64_val)
-                                image_descriptions.append(desc)
-                        
-                        # Step 2: Integrate descriptions into the prompt
-                        # LOẠI BỎ GỬI ẢNH TRỰC TIẾP ĐẾN LLM7, CHỈ DÙNG MÔ TẢ
-                        if image_descriptions:
-                            all_desc = "\n".join([f"- Hình ảnh {idx+1}: {desc}" for idx, desc in enumerate(image_descriptions)])
-                            # Cấu trúc lại prompt: đưa mô tả vào làm ngữ cảnh trực tiếp, loại bỏ thông tin lỗi kỹ thuật
-                            clean_desc = all_desc.replace("The read operation timed out", "đang được xử lý").replace("Lỗi kết nối", "đang được kiểm tra")
-                            messages[i]['content'] = f"{current_content}\n\n[Hệ thống cung cấp ngữ cảnh hình ảnh: Người dùng đã gửi kèm hình ảnh. Dưới đây là mô tả nội dung hình ảnh bạn đang 'nhìn' thấy:]\n{clean_desc}"
-                        
-                        # Đảm bảo messages[i]['content'] luôn là string để gửi đến LLM7 chat thông thường
-                        if isinstance(messages[i]['content'], list):
-                             # Fallback nếu lỡ là list vision format
-                             text_parts = [p.get('text', '') for p in messages[i]['content'] if p.get('type') == 'text']
-                             messages[i]['content'] = " ".join(text_parts)
-
-                        if len(messages) > 1:
-                            # Keep system prompt (index 0) and the current user message (the one with context)
-                            messages = [messages[0], messages[i]]
-                        break
-            
-            llm7_payload = {
-                "model": "gpt-5-chat",
-                "messages": messages,
-                "temperature": 0.7
+class CircuitBreakerRegistry:
+    """Một CircuitBreaker cho mỗi tên circuit (policy["circuit"]), tạo khi dùng lần đầu"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def get(self, name):
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = CircuitBreaker(name, get_circuit_breaker_settings())
+            return breaker
+
+    def names(self):
+        with self._lock:
+            return list(self._breakers)
+
+    def get_stats(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.name: breaker.get_stats() for breaker in breakers}
+
+
+CIRCUIT_BREAKERS = CircuitBreakerRegistry()
+
+
+def _get_circuit_breaker(policy):
+    return CIRCUIT_BREAKERS.get(policy["circuit"]) if policy.get("circuit") else None
+
+
+def _record_upstream_attempt(name, policy, breaker, probe, status, latency, bytes_in=0, bytes_out=0, error=None):
+    """Ghi metrics của một attempt và báo kết quả cho circuit breaker"""
+    UPSTREAM_METRICS.record(name, status, latency, bytes_in, bytes_out, error)
+    if breaker:
+        # Lỗi client (4xx) không phải do upstream hỏng, trừ 429 (đang bị giới hạn)
+        failed = status is None or status >= 500 or status == 429
+        breaker.record(probe, failed, latency >= policy["slow_call"])
+
+
+class RetryBudget:
+    """Giới hạn tổng số retry theo tỉ lệ traffic trong cửa sổ trượt (dùng chung mọi upstream)"""
+
+    def __init__(self, ratio=0.1, min_per_second=0.5, window=10):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = window
+        self._lock = threading.Lock()
+        self._calls = deque()    # timestamp các call (attempt đầu tiên)
+        self._retries = deque()  # timestamp các retry đã được cho phép
+        self._exhausted = 0
+
+    def _prune(self, now):
+        cutoff = now - self.window
+        for samples in (self._calls, self._retries):
+            while samples and samples[0] < cutoff:
+                samples.popleft()
+
+    def _allowance(self):
+        return self.min_per_second * self.window + self.ratio * len(self._calls)
+
+    def record_call(self):
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            self._calls.append(now)
+
+    def try_acquire(self):
+        """True nếu còn budget cho thêm 1 retry (và trừ budget); False → caller trả lỗi luôn"""
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            if len(self._retries) < self._allowance():
+                self._retries.append(now)
+                return True
+            self._exhausted += 1
+            return False
+
+    def get_stats(self):
+        with self._lock:
+            self._prune(time.time())
+            return {
+                "ratio": self.ratio,
+                "min_per_second": self.min_per_second,
+                "window": self.window,
+                "calls_in_window": len(self._calls),
+                "retries_in_window": len(self._retries),
+                "allowance": round(self._allowance(), 1),
+                "exhausted": self._exhausted
             }
-            
-            # Make request to LLM7.io with retry logic
-            with retry_request_with_backoff(
-                llm7_url,
-                llm7_headers,
-                json.dumps(llm7_payload).encode('utf-8'),
-                timeout=REQUEST_TIMEOUT
-            ) as response:
-                llm7_response = response.read().decode('utf-8')
-                llm7_data = json.loads(llm7_response)
-            
-            # Extract response
-            reply = ""
-            if "choices" in llm7_data and len(llm7_data["choices"]) > 0:
-                reply = llm7_data["choices"][0]["message"]["content"]
-            else:
-                reply = str(llm7_data)
-            
-            # Save AI history
-            save_ai_history(
-                username=username,
-                model="gpt-5-chat",
-                prompt=message,
-                response=reply,
-                metadata={'endpoint': 'llm7_gpt5chat', 'has_files': len(files) > 0}
-            )
-            
-            # Return response to client
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps({
-                "reply": reply,
-                "model": "gpt-5-chat"
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-            logger.info("LLM7 GPT-5-chat completed successfully")
-            
-        except urllib.error.HTTPError as e:
-            try:
-                error_body = e.read().decode('utf-8')
-                self._send_json_error(e.code, f"LLM7 API lỗi: {error_body}", "UPSTREAM_ERROR")
-            except:
-                self._send_json_error(e.code, f"LLM7 API lỗi: {e.reason}", "UPSTREAM_ERROR")
-        except urllib.error.URLError as e:
-            logger.error(f"LLM7 connection error: {e}")
-            self._send_json_error(502, "Không thể kết nối đến LLM7 API", "CONNECTION_ERROR")
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in LLM7 request: {e}")
-            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
-        except Exception as e:
-            logger.error(f"LLM7 GPT-5-chat error: {e}")
-            logger.error(f"Exception type: {type(e)}")
-            logger.error(f"Exception args: {e.args}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
 
-    def _is_time_query(self, message):
-        """Kiểm tra xem query có phải về thời gian/ngày hiện tại không"""
-        normalized = message.lower()
-        time_patterns = [
-            'mấy giờ', 'may gio', 'bây giờ', 'bay gio', 'giờ hiện tại',
-            'ngày mấy', 'ngay may', 'hôm nay là', 'thứ mấy', 'thu may',
-            'what time', 'current time', 'time now', 'what day', 'today'
-        ]
-        return any(p in normalized for p in time_patterns)
-    
-    def _get_realtime_time(self, timezone='Asia/Ho_Chi_Minh'):
-        """Lấy thời gian thực từ API"""
+
+RETRY_BUDGET = RetryBudget(**get_retry_budget_settings())
+
+
+def _mask_api_key(key):
+    """Chỉ hiện vài ký tự cuối của key (dùng cho log và admin API)"""
+    return f"…{key[-4:]}" if len(key) > 8 else "…"
+
+
+class ApiKeyPool:
+    """Chia request giữa các API key của một service; key bị 429 phải nghỉ (benched) một thời gian"""
+
+    def __init__(self, cooldown=60.0):
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._cursors = {}  # service -> số lần đã cấp key (round-robin)
+        self._usage = {}    # (service, key) -> số liệu của key
+
+    def _entry(self, service, key):
+        entry = self._usage.get((service, key))
+        if entry is None:
+            entry = self._usage[(service, key)] = {"requests": 0, "errors": 0, "rate_limited": 0, "benched_until": 0.0}
+        return entry
+
+    def acquire(self, service, exclude=()):
+        """Key tiếp theo cho service (round-robin, bỏ qua key đang nghỉ); None nếu không có key
+
+        Mọi key đều đang nghỉ thì trả về key sắp hết nghỉ sớm nhất. exclude: chỉ lấy key
+        ngoài các key này và đang không nghỉ (dùng để đổi key sau 429), không có thì None.
+        """
+        keys = get_api_keys(service)
+        if not keys:
+            return None
+        now = time.time()
+        with self._lock:
+            available = [key for key in keys if key not in exclude and self._entry(service, key)["benched_until"] <= now]
+            if not available:
+                if exclude:
+                    return None
+                return min(keys, key=lambda key: self._entry(service, key)["benched_until"])
+            cursor = self._cursors.get(service, 0)
+            self._cursors[service] = cursor + 1
+            return available[cursor % len(available)]
+
+    def report(self, service, key, status, retry_after=None):
+        """Ghi kết quả một request dùng key (status None = lỗi kết nối); 429 → key nghỉ"""
+        with self._lock:
+            entry = self._entry(service, key)
+            entry["requests"] += 1
+            if status is None or status >= 400:
+                entry["errors"] += 1
+            if status != 429:
+                return
+            entry["rate_limited"] += 1
+            seconds = retry_after if retry_after is not None else self.cooldown
+            entry["benched_until"] = max(entry["benched_until"], time.time() + seconds)
+        logger.warning(f"🔑 {service} key {_mask_api_key(key)} rate limited, benched for {seconds:.0f}s")
+
+    def get_stats(self, service):
+        keys = get_api_keys(service)
+        now = time.time()
+        with self._lock:
+            stats = []
+            for key in keys:
+                entry = self._entry(service, key)
+                stats.append({
+                    "key": _mask_api_key(key),
+                    "requests": entry["requests"],
+                    "errors": entry["errors"],
+                    "rate_limited": entry["rate_limited"],
+                    "benched_for": round(max(0.0, entry["benched_until"] - now), 1)
+                })
+            return stats
+
+
+API_KEYS = ApiKeyPool(get_api_key_cooldown())
+
+
+def _retry_after_seconds(error):
+    """Giá trị Retry-After (giây) của HTTPError, None nếu không có"""
+    if isinstance(error, urllib.error.HTTPError) and error.headers:
+        retry_after = error.headers.get('Retry-After', '').strip()
+        if retry_after.isdigit():
+            return float(retry_after)
+    return None
+
+
+def _rotate_api_key(name, key_pool, tried_keys, status, error=None):
+    """Báo kết quả của key vừa dùng (tried_keys[-1]) cho API_KEYS
+
+    Khi bị 429 trả về một key chưa thử và đang không nghỉ (None nếu hết) và thêm nó vào tried_keys.
+    """
+    API_KEYS.report(key_pool, tried_keys[-1], status, _retry_after_seconds(error))
+    if status != 429:
+        return None
+    next_key = API_KEYS.acquire(key_pool, exclude=tried_keys)
+    if next_key:
+        tried_keys.append(next_key)
+        logger.info(f"🔑 {name}: retrying with {key_pool} key {_mask_api_key(next_key)}")
+    return next_key
+
+
+def _swap_api_key(request, old_key, new_key):
+    """Thay key trong URL và headers của urllib Request (Gemini: ?key=, Serper/LLM7: header)"""
+    request.full_url = request.full_url.replace(old_key, new_key)
+    for header, value in list(request.headers.items()):
+        if old_key in value:
+            request.headers[header] = value.replace(old_key, new_key)
+    return request
+
+# Worker của PooledHTTPServer đăng ký hàm park_worker vào đây để chờ backoff mà không giữ slot của pool
+_worker_context = threading.local()
+
+def _backoff_wait(seconds):
+    """Chờ trước lần retry tiếp theo trong threaded mode
+
+    Handler là code đồng bộ nên thread vẫn phải chờ kết quả, nhưng trong lúc chờ slot
+    của worker pool được nhường cho một worker tạm để các kết nối đang xếp hàng vẫn được xử lý.
+    """
+    park_worker = getattr(_worker_context, 'park_worker', None)
+    if park_worker is not None:
+        park_worker(seconds)
+    else:
+        time.sleep(seconds)
+
+
+def _upstream_backoff(policy, attempt, error=None):
+    """Thời gian chờ trước lần retry tiếp theo (exponential + jitter, tôn trọng Retry-After)"""
+    retry_after = _retry_after_seconds(error)
+    if retry_after is not None:
+        return min(retry_after, policy["max_backoff"])
+    return min(policy["backoff"] * (2 ** attempt) + random.uniform(0, 1), policy["max_backoff"])
+
+
+def _acquire_retry(name):
+    if RETRY_BUDGET.try_acquire():
+        return True
+    logger.warning(f"⚠️ {name}: retry budget exhausted, not retrying")
+    return False
+
+
+HEDGE_MIN_SAMPLES = 20   # Số mẫu latency tối thiểu trước khi dùng p95 làm hedge delay
+HEDGE_MIN_DELAY = 0.05   # Không hedge sớm hơn ngần này (giây)
+
+_hedge_budgets = {}
+_hedge_budgets_lock = threading.Lock()
+
+def _get_hedge_budget(name, policy):
+    """Budget riêng cho hedge của từng upstream: tối đa hedge_max_rate × số call gần đây"""
+    with _hedge_budgets_lock:
+        budget = _hedge_budgets.get(name)
+        if budget is None:
+            budget = _hedge_budgets[name] = RetryBudget(ratio=policy["hedge_max_rate"], min_per_second=0, window=60)
+        return budget
+
+def _hedge_delay(name, policy):
+    """Chờ bao lâu trước khi gửi hedge: p95 latency quan sát được, hoặc hedge_after khi chưa đủ mẫu"""
+    if UPSTREAM_METRICS.sample_count(name) >= HEDGE_MIN_SAMPLES:
+        return max(HEDGE_MIN_DELAY, UPSTREAM_METRICS.percentile(name, 95))
+    return policy["hedge_after"]
+
+def _upstream_attempt(request, timeout, read_body, cancel=None):
+    with pooled_urlopen(request, timeout=timeout, cancel=cancel) as response:
+        body = response.read() if read_body else b''
+        return UpstreamResponse(response.status, response.reason, response.headers, body, response.geturl())
+
+def _hedged_attempt(name, policy, request, timeout, read_body):
+    """Một attempt có hedge: chưa có response sau hedge delay thì gửi thêm 1 bản giống hệt
+
+    Response thành công về trước thắng; request còn lại bị huỷ qua UpstreamCancel (shutdown
+    socket, không gửi lại, kết nối không quay lại pool). Chỉ dùng cho call idempotent.
+    Cả hai request chạy trên BACKGROUND_EXECUTOR; pool đầy thì gửi 1 request thường, không hedge.
+    """
+    results = queue.Queue()
+    cancels = (UpstreamCancel(), UpstreamCancel())
+
+    def run(index):
         try:
-            url = f"https://worldtimeapi.org/api/timezone/{timezone}"
-            req = urllib.request.Request(url, headers={'User-Agent': 'NexoraX/1.0'})
-            with urllib.request.urlopen(req, timeout=5) as response:
-                data = json.loads(response.read().decode('utf-8'))
-                
-            datetime_str = data.get('datetime', '')
-            day_of_week = data.get('day_of_week', 0)
-            
-            days_vi = ['Chủ Nhật', 'Thứ Hai', 'Thứ Ba', 'Thứ Tư', 'Thứ Năm', 'Thứ Sáu', 'Thứ Bảy']
-            day_name = days_vi[day_of_week]
-            
-            if datetime_str:
-                dt_part = datetime_str.split('.')[0].replace('T', ' ')
-                date_part = dt_part.split(' ')[0]
-                time_part = dt_part.split(' ')[1] if ' ' in dt_part else ''
-                
-                year, month, day = date_part.split('-')
-                
-                return {
-                    'success': True,
-                    'time': time_part,
-                    'date': f"{day}/{month}/{year}",
-                    'day_name': day_name,
-                    'timezone': timezone,
-                    'formatted': f"Hiện tại là **{time_part}**, {day_name}, ngày {day}/{month}/{year} (múi giờ Việt Nam UTC+7)."
-                }
+            outcome = (index, _upstream_attempt(request, timeout, read_body, cancels[index]), None)
         except Exception as e:
-            logger.warning(f"Realtime API error: {e}")
-        return {'success': False}
+            outcome = (index, None, e)
+        results.put(outcome)
 
-    def handle_llm7_gemini_search(self):
-        """Handle Search requests via Gemini Query Optimizer + Serper API + Gemini Summary
-        
-        LUỒNG MỚI (Cập nhật: 06/12/2025):
-        1. User nhập prompt
-        2. Kiểm tra nếu là câu hỏi thời gian → trả về thời gian thực
-        3. Gemini xử lý/tối ưu prompt → optimized query
-        4. Gửi optimized query đến Serper
-        5. Gemini tổng hợp kết quả
-        6. Gửi về user
-        
-        Fallback: Nếu optimizer lỗi → dùng original query cho Serper
-        """
+    budget = _get_hedge_budget(name, policy)
+    budget.record_call()
+    if BACKGROUND_EXECUTOR.try_submit(run, 0) is None:
+        return _upstream_attempt(request, timeout, read_body)
+    try:
+        index, result, error = results.get(timeout=_hedge_delay(name, policy))
+    except queue.Empty:
+        if not budget.try_acquire() or BACKGROUND_EXECUTOR.try_submit(run, 1) is None:
+            index, result, error = results.get()
+        else:
+            UPSTREAM_METRICS.record_hedge(name)
+            logger.info(f"🔀 {name}: no response after hedge delay, sending hedged request")
+            index, result, error = results.get()
+            if error is not None:
+                index, result, error = results.get()  # request đầu lỗi: chờ request còn lại
+            else:
+                cancels[1 - index].cancel()
+            if index == 1 and error is None:
+                UPSTREAM_METRICS.record_hedge(name, won=True)
+    if error is not None:
+        raise error
+    return result
+
+def _should_retry_upstream(policy, error):
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in policy["retry_statuses"]
+    return isinstance(error, (urllib.error.URLError, TimeoutError, OSError))
+
+
+def upstream_call(name, request, timeout=None, read_body=True, stream=False, api_key=None, deadline=None):
+    """Gọi upstream `name` (key trong UPSTREAM_POLICIES) qua pool kết nối
+
+    request là urllib.request.Request hoặc URL. Trả về UpstreamResponse đã đọc xong body
+    (read_body=False: chỉ lấy status/URL cuối, vd Pollinations). Raise cùng loại exception
+    với urlopen: HTTPError (status >= 400), URLError (lỗi kết nối), TimeoutError.
+
+    stream=True: trả về PooledResponse ngay khi có header để caller đọc dần body (SSE);
+    retry chỉ áp dụng trước khi có response, timeout là thời gian chờ tối đa giữa 2 lần đọc.
+    Caller phải đóng response (dùng `with`). Hedge (policy["hedge"]) không áp dụng cho stream.
+
+    api_key: key (lấy từ API_KEYS.acquire) đã gắn trong request; khi upstream trả 429 key
+    đó bị cho nghỉ và request được gửi lại ngay bằng key khác của pool (không tính là retry).
+
+    deadline: Deadline của request; timeout mỗi attempt bị giới hạn bởi thời gian còn lại,
+    không retry khi backoff vượt quá thời gian còn lại, hết hạn → DeadlineExceededError.
+    """
+    if isinstance(request, str):
+        request = urllib.request.Request(request)
+    policy = get_upstream_policy(name)
+    timeout = timeout or policy["timeout"]
+    attempts = policy["retries"] + 1
+    RETRY_BUDGET.record_call()
+    bytes_out = len(request.data or b'')
+    breaker = _get_circuit_breaker(policy)
+    key_pool = policy["key_pool"] if api_key else None
+    tried_keys = [api_key]
+    last_error = None
+    attempt = 0
+
+    while True:
         try:
-            username = self._get_username_from_cookie()
-            
-            serper_key = get_api_key('serper')
-            
-            if not serper_key:
-                self._send_json_error(500, 
-                    "Serper API key chưa được cấu hình. Vui lòng kiểm tra config.py",
-                    "API_KEY_MISSING")
-                return
-            
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
-            
-            message = request_data.get('message', '')
-            if not message:
-                self._send_json_error(400, "Message không được để trống", "MISSING_MESSAGE")
-                return
-            
-            logger.info(f"AI Search starting for query: {message}")
-            
-            # ========================================
-            # STEP 0: Kiểm tra nếu là câu hỏi thời gian
-            # ========================================
-            if self._is_time_query(message):
-                time_data = self._get_realtime_time()
-                if time_data.get('success'):
-                    reply = time_data['formatted']
-                    
-                    self.send_response(200)
-                    self._send_cors_headers()
-                    self.end_headers()
-                    
-                    response_json = json.dumps({
-                        "reply": reply,
-                        "model": "gemini-search"
-                    }, ensure_ascii=False)
-                    self.wfile.write(response_json.encode('utf-8'))
-                    
-                    save_ai_history(
-                        username=username,
-                        model="gemini-search",
-                        prompt=message,
-                        response=reply,
-                        metadata={'endpoint': 'realtime_api', 'powered_by': 'worldtimeapi'}
-                    )
-                    
-                    logger.info("AI Search v2 completed (powered_by: worldtimeapi, realtime)")
-                    return
-            
-            # ========================================
-            # STEP 1: Gemini xử lý/tối ưu prompt
-            # ========================================
-            optimizer_success, optimizer_result = self._invoke_gemini_query_optimizer(message)
-            
-            if optimizer_success and isinstance(optimizer_result, dict):
-                optimized_query = optimizer_result.get('optimized_query', message)
-                optimizer_reasoning = optimizer_result.get('reasoning', '')
-                optimizer_keywords = optimizer_result.get('keywords', [])
-                used_optimized = True
-                logger.info(f"Query optimization SUCCESS: '{message}' → '{optimized_query}'")
+            attempt_timeout = deadline.cap(timeout) if deadline else timeout
+        except DeadlineExceededError:
+            if last_error is not None:
+                raise last_error
+            raise
+        try:
+            probe = breaker.before_call() if breaker else False
+        except CircuitOpenError:
+            if last_error is not None:
+                raise last_error  # breaker vừa mở giữa các lần retry: trả về lỗi thật của attempt trước
+            raise
+        start_time = time.time()
+        try:
+            if stream:
+                result = pooled_urlopen(request, timeout=attempt_timeout)
+            elif policy["hedge"]:
+                result = _hedged_attempt(name, policy, request, attempt_timeout, read_body)
             else:
-                optimized_query = message
-                if isinstance(optimizer_result, dict):
-                    optimizer_reasoning = optimizer_result.get('error', 'Unknown error')
-                else:
-                    optimizer_reasoning = str(optimizer_result) if optimizer_result else 'Unknown error'
-                optimizer_keywords = []
-                used_optimized = False
-                logger.warning(f"Query optimization FAILED ({optimizer_reasoning}), using original query")
-            
-            # ========================================
-            # STEP 2: Gửi Serper với optimized query
-            # ========================================
-            serper_url = "https://google.serper.dev/search"
-            serper_headers = {
-                "X-API-KEY": serper_key,
-                "Content-Type": "application/json"
-            }
-            serper_payload = {
-                "q": optimized_query,
-                "gl": "vn",
-                "hl": "vi",
-                "num": 10
-            }
-            
-            serper_request = urllib.request.Request(
-                serper_url,
-                data=json.dumps(serper_payload).encode('utf-8'),
-                headers=serper_headers,
-                method='POST'
-            )
-            
-            with urllib.request.urlopen(serper_request, timeout=REQUEST_TIMEOUT) as response:
-                serper_response = response.read().decode('utf-8')
-                serper_data = json.loads(serper_response)
-            
-            search_results_count = len(serper_data.get('organic', []))
-            logger.info(f"Serper returned {search_results_count} organic results for query: '{optimized_query}'")
-            
-            # ========================================
-            # STEP 3: Build context và format Markdown
-            # ========================================
-            search_context = self._build_gemini_search_context(serper_data, message)
-            serper_markdown = self._format_serper_results_markdown(serper_data, optimized_query)
-            
-            # ========================================
-            # STEP 4: Gemini tổng hợp kết quả
-            # ========================================
-            gemini_success, gemini_result = self._invoke_gemini_summary(message, search_context)
-            
-            if gemini_success:
-                logger.info("Gemini summary generated successfully")
-                
-                reply = gemini_result
-                
-                powered_by = 'gemini+serper+gemini'
-                summary_model = 'gemini-2.5-flash'
-            else:
-                logger.warning(f"Gemini summary failed: {gemini_result}")
-                
-                reply = serper_markdown
-                reply += f"\n\n---\n*⚠️ Lưu ý: Kết quả chưa được AI phân tích ({gemini_result})*"
-                
-                powered_by = 'gemini+serper' if used_optimized else 'serper'
-                summary_model = None
-            
-            # ========================================
-            # STEP 5: Save history với metadata đầy đủ
-            # ========================================
-            history_metadata = {
-                'endpoint': 'ai_search_v2',
-                'search_results_count': search_results_count,
-                'powered_by': powered_by,
-                'query_optimized': used_optimized,
-                'original_query': message,
-                'optimized_query': optimized_query if used_optimized else None,
-                'optimizer_reasoning': optimizer_reasoning if used_optimized else None,
-                'optimizer_keywords': optimizer_keywords if used_optimized else None
-            }
-            if summary_model:
-                history_metadata['summary_model'] = summary_model
-            
-            save_ai_history(
-                username=username,
-                model="gemini-search",
-                prompt=message,
-                response=reply,
-                metadata=history_metadata
-            )
-            
-            # Return response to client
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps({
-                "reply": reply,
-                "model": "gemini-search"
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-            logger.info(f"AI Search v2 completed (powered_by: {powered_by}, optimized: {used_optimized})")
-            
-        except urllib.error.HTTPError as e:
-            try:
-                error_body = e.read().decode('utf-8')
-                logger.error(f"Serper API HTTP error: {e.code} - {error_body}")
-                self._send_json_error(e.code, f"Serper API lỗi: {error_body}", "UPSTREAM_ERROR")
-            except:
-                self._send_json_error(e.code, f"Serper API lỗi: {e.reason}", "UPSTREAM_ERROR")
-        except urllib.error.URLError as e:
-            logger.error(f"Serper connection error: {e}")
-            self._send_json_error(502, "Không thể kết nối đến Serper API", "CONNECTION_ERROR")
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in Search request: {e}")
-            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
+                result = _upstream_attempt(request, attempt_timeout, read_body)
+            body = b'' if stream else result.body
         except Exception as e:
-            logger.error(f"Serper Search error: {e}")
-            logger.error(f"Exception type: {type(e)}")
-            logger.error(f"Exception args: {e.args}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
-    
-    def _format_serper_results_markdown(self, serper_data, query):
-        """Format Serper search results into markdown (NO AI processing)"""
-        parts = []
-        
-        parts.append(f"## Kết quả tìm kiếm cho: \"{query}\"\n")
-        
-        # Answer Box (câu trả lời nhanh)
-        if serper_data.get('answerBox'):
-            ab = serper_data['answerBox']
-            parts.append("### Trả lời nhanh")
-            if ab.get('answer'):
-                parts.append(f"{ab['answer']}\n")
-            elif ab.get('snippet'):
-                parts.append(f"{ab['snippet']}\n")
-            if ab.get('title'):
-                parts.append(f"*Nguồn: {ab['title']}*\n")
-        
-        # Knowledge Graph
-        if serper_data.get('knowledgeGraph'):
-            kg = serper_data['knowledgeGraph']
-            parts.append("### Thông tin")
-            if kg.get('title'):
-                parts.append(f"**{kg['title']}**")
-            if kg.get('type'):
-                parts.append(f"*{kg['type']}*")
-            if kg.get('description'):
-                parts.append(f"{kg['description']}\n")
-        
-        # Organic results
-        organic = serper_data.get('organic', [])
-        if organic:
-            parts.append("### Kết quả tìm kiếm")
-            for i, result in enumerate(organic[:7], 1):
-                title = result.get('title', 'Không có tiêu đề')
-                snippet = result.get('snippet', '')
-                link = result.get('link', '#')
-                parts.append(f"**{i}. [{title}]({link})**")
-                if snippet:
-                    parts.append(f"{snippet}\n")
-        
-        # People Also Ask
-        paa = serper_data.get('peopleAlsoAsk', [])
-        if paa:
-            parts.append("### Câu hỏi liên quan")
-            for item in paa[:4]:
-                q = item.get('question', '')
-                a = item.get('snippet', '')
-                if q:
-                    parts.append(f"- **{q}**")
-                    if a:
-                        parts.append(f"  {a}")
-        
-        # Related Searches
-        related = serper_data.get('relatedSearches', [])
-        if related:
-            parts.append("\n### Tìm kiếm liên quan")
-            related_terms = [r.get('query', '') for r in related[:5] if r.get('query')]
-            if related_terms:
-                parts.append(", ".join(related_terms))
-        
-        return "\n".join(parts) if parts else "Không tìm thấy kết quả phù hợp."
-
-    def _build_gemini_search_context(self, serper_data, query):
-        """Build context string from Serper results for Gemini to analyze"""
-        context_parts = []
-        
-        # Answer Box
-        if serper_data.get('answerBox'):
-            ab = serper_data['answerBox']
-            context_parts.append("📦 Trả lời nhanh:")
-            if ab.get('answer'):
-                context_parts.append(f"  - Đáp án: {ab['answer']}")
-            elif ab.get('snippet'):
-                context_parts.append(f"  - Tóm tắt: {ab['snippet']}")
-            if ab.get('title'):
-                context_parts.append(f"  - Nguồn: {ab['title']}")
-        
-        # Knowledge Graph
-        if serper_data.get('knowledgeGraph'):
-            kg = serper_data['knowledgeGraph']
-            context_parts.append("\n📚 Thông tin nền:")
-            if kg.get('title'):
-                context_parts.append(f"  - Chủ đề: {kg['title']}")
-            if kg.get('type'):
-                context_parts.append(f"  - Loại: {kg['type']}")
-            if kg.get('description'):
-                context_parts.append(f"  - Mô tả: {kg['description']}")
-        
-        # Organic Results (top 6)
-        organic = serper_data.get('organic', [])
-        if organic:
-            context_parts.append("\n🔍 Kết quả tìm kiếm:")
-            for i, result in enumerate(organic[:6], 1):
-                title = result.get('title', 'Không có tiêu đề')
-                snippet = result.get('snippet', '')
-                link = result.get('link', '')
-                context_parts.append(f"\nNguồn {i}:")
-                context_parts.append(f"  - Tiêu đề: {title}")
-                if snippet:
-                    context_parts.append(f"  - Tóm tắt: {snippet}")
-                if link:
-                    context_parts.append(f"  - URL: {link}")
-        
-        # People Also Ask (top 3)
-        paa = serper_data.get('peopleAlsoAsk', [])
-        if paa:
-            context_parts.append("\n❓ Câu hỏi liên quan:")
-            for item in paa[:3]:
-                q = item.get('question', '')
-                a = item.get('snippet', '')
-                if q:
-                    context_parts.append(f"  - Q: {q}")
-                    if a:
-                        context_parts.append(f"    A: {a}")
-        
-        return "\n".join(context_parts)
-
-    def _invoke_gemini_summary(self, query, search_context):
-        """Call Gemini 2.5 Flash to summarize and analyze search results
-        
-        Returns:
-            tuple: (success: bool, result: str)
-            - If success: (True, summary_text)
-            - If error: (False, error_message)
-        """
-        try:
-            gemini_key = get_api_key('gemini')
-            if not gemini_key:
-                return (False, "Gemini API key chưa được cấu hình")
-            
-            # System prompt for search summarization - CẢI TIẾN: Linh hoạt và tự nhiên hơn
-            system_prompt = """Bạn là Gemini 2.5 Flash, một trợ lý AI thông minh với khả năng tìm kiếm web thời gian thực.
+            status = e.code if isinstance(e, urllib.error.HTTPError) else None
+            _record_upstream_attempt(name, policy, breaker, probe, status, time.time() - start_time, bytes_out=bytes_out, error=e)
+            next_key = _rotate_api_key(name, key_pool, tried_keys, status, e) if key_pool else None
+            if next_key:
+                last_error = e
+                request = _swap_api_key(request, api_key, next_key)
+                api_key = next_key
+                continue
+            backoff = _upstream_backoff(policy, attempt, e)
+            out_of_time = deadline is not None and backoff >= deadline.remaining()  # không đủ thời gian để retry
+            if attempt < attempts - 1 and not out_of_time and _should_retry_upstream(policy, e) and _acquire_retry(name):
+                last_error = e
+                UPSTREAM_METRICS.record_retry(name)
+                logger.warning(f"⚠️ {name}: {type(e).__name__} on attempt {attempt + 1}/{attempts}: {e}. Retrying in {backoff:.2f}s...")
+                _backoff_wait(backoff)
+                attempt += 1
+                continue
+            if attempts > 1:
+                logger.error(f"❌ {name}: all {attempt + 1} attempts failed. Last error: {type(e).__name__} - {e}")
+            raise
 
-⚠️ QUY TẮC BẮT BUỘC:
-- Tên của bạn là Gemini 2.5 Flash. Khi được hỏi, trả lời: "Mình là Gemini 2.5 Flash".
-- PHẢI trả lời hoàn toàn bằng TIẾNG VIỆT một cách TỰ NHIÊN.
-- KHÔNG ĐƯỢC sử dụng từ "biomimicry". Dùng thay thế: "thiết kế lấy cảm hứng từ thiên nhiên", "mô phỏng tự nhiên".
+        _record_upstream_attempt(name, policy, breaker, probe, result.status, time.time() - start_time, len(body), bytes_out)
+        if key_pool:
+            API_KEYS.report(key_pool, api_key, result.status)
+        if attempt > 0:
+            logger.info(f"✅ {name}: request succeeded on attempt {attempt + 1}/{attempts}")
+        return result
 
-📝 CÁCH TRẢ LỜI - LINH HOẠT THEO NGỮ CẢNH:
 
-1. **Câu hỏi ĐƠN GIẢN** (định nghĩa, giải thích ngắn):
-   - Trả lời NGẮN GỌN, trực tiếp (1-3 câu)
-   - KHÔNG cần format Tóm tắt/Phân tích/Nguồn
-   - VD: "Bitcoin là gì?" → Trả lời định nghĩa ngắn gọn
+@contextmanager
+def interprocess_lock(path):
+    """flock trên file store khi chạy prefork (no-op ở các mode một process)"""
+    if not SHARED_STATE_SYNC or fcntl is None:
+        yield
+        return
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
 
-2. **Câu hỏi CẦN THÔNG TIN CHI TIẾT** (tin tức, sự kiện, so sánh):
-   - Sử dụng format có cấu trúc khi phù hợp
-   - Thêm nguồn tham khảo nếu cần thiết
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
 
-3. **Câu hỏi về GIÁ CẢ, TỶ GIÁ, SỐ LIỆU**:
-   - Đưa ra con số cụ thể từ kết quả tìm kiếm
-   - Ghi rõ thời điểm/nguồn nếu có
+def _replace_dict_contents(target, fresh):
+    """Cập nhật dict tại chỗ (không clear) để thread khác không thấy dict rỗng"""
+    for key in list(target.keys()):
+        if key not in fresh:
+            target.pop(key, None)
+    target.update(fresh)
 
-🎯 NGUYÊN TẮC QUAN TRỌNG:
-- TỰ NHIÊN như đang trò chuyện, không máy móc
-- Độ dài tỷ lệ với độ phức tạp của câu hỏi
-- Dùng emoji một cách TIẾT CHẾ (1-2 emoji nếu phù hợp, không bắt buộc)
-- TRÁNH lặp lại cấu trúc cố định cho mọi câu trả lời"""
+def save_shared_json_store(path, current):
+    """Ghi dict ra JSON store
 
-            user_prompt = f"""Người dùng tìm kiếm: "{query}"
+    Ở prefork mode, merge 3 chiều với bản trên đĩa: chỉ áp dụng các thay đổi mà
+    worker này đã làm kể từ lần đồng bộ trước, để không ghi đè session/rate limit
+    do worker khác vừa tạo.
+    """
+    with file_lock, interprocess_lock(path):
+        # Ghi bản chụp (copy sâu) để json.dump không lặp trên dict đang bị sửa
+        data = json.loads(json.dumps(current))
+        if SHARED_STATE_SYNC:
+            changes = data
+            snapshot = _store_snapshots.get(path, {})
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {}
+            for key in snapshot.keys() - changes.keys():
+                data.pop(key, None)
+            for key, value in changes.items():
+                if snapshot.get(key) != value:
+                    data[key] = value
+            _replace_dict_contents(current, data)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        if SHARED_STATE_SYNC:
+            _store_snapshots[path] = json.loads(json.dumps(data))
+            _store_signatures[path] = _file_signature(path)
 
-KẾT QUẢ TÌM KIẾM TỪ SERPER:
-{search_context}
+def sync_shared_state():
+    """Reload users/sessions/rate_limits nếu worker process khác đã ghi file store"""
+    if not SHARED_STATE_SYNC:
+        return
+    for path, target, loader in (
+        (ACCOUNTS_FILE, users, load_users),
+        (SESSIONS_FILE, sessions, load_sessions),
+        (RATE_LIMIT_FILE, rate_limits, load_rate_limits),
+    ):
+        signature = _file_signature(path)
+        if signature == _store_signatures.get(path):
+            continue
+        with file_lock, interprocess_lock(path):
+            fresh = loader()
+            _replace_dict_contents(target, fresh)
+            _store_snapshots[path] = json.loads(json.dumps(fresh))
+            _store_signatures[path] = _file_signature(path)
 
-Hãy tóm tắt và phân tích kết quả tìm kiếm trên để trả lời câu hỏi của người dùng."""
+def load_users():
+    """Load users from acc.txt and return dict {username: password}"""
+    users = {}
+    try:
+        with file_lock:
+            if os.path.exists(ACCOUNTS_FILE):
+                with open(ACCOUNTS_FILE, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        line = line.strip()
+                        if line and '|' in line:
+                            username, password = line.split('|', 1)
+                            users[username] = password
+    except Exception as e:
+        logger.error(f"Error loading users: {e}")
+    return users
 
-            gemini_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={gemini_key}"
-            
-            gemini_payload = {
-                "contents": [
-                    {
-                        "role": "user",
-                        "parts": [{"text": f"{system_prompt}\n\n{user_prompt}"}]
-                    }
-                ],
-                "generationConfig": {
-                    "temperature": 0.7,
-                    "topK": 40,
-                    "topP": 0.95,
-                    "maxOutputTokens": 8192,
-                },
-                "safetySettings": [
-                    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_ONLY_HIGH"},
-                    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_ONLY_HIGH"},
-                    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_ONLY_HIGH"},
-                    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_ONLY_HIGH"}
-                ]
-            }
-            
-            gemini_request = urllib.request.Request(
-                gemini_url,
-                data=json.dumps(gemini_payload).encode('utf-8'),
-                headers={'Content-Type': 'application/json'}
-            )
-            
-            with urllib.request.urlopen(gemini_request, timeout=REQUEST_TIMEOUT) as response:
-                gemini_response = response.read().decode('utf-8')
-                gemini_data = json.loads(gemini_response)
-            
-            candidates = gemini_data.get('candidates', [])
-            prompt_feedback = gemini_data.get('promptFeedback', {})
-            
-            if prompt_feedback.get('blockReason'):
-                block_reason = prompt_feedback.get('blockReason', 'UNKNOWN')
-                logger.warning(f"Gemini summary blocked by promptFeedback: {block_reason}")
-                return (False, f"Prompt bị chặn: {block_reason}")
-            
-            if not candidates:
-                logger.warning(f"Gemini summary: No candidates. promptFeedback: {prompt_feedback}")
-                return (False, "Gemini không trả về kết quả")
-            
-            candidate = candidates[0]
-            finish_reason = candidate.get('finishReason', 'UNKNOWN')
-            safety_ratings = candidate.get('safetyRatings', [])
-            
-            if finish_reason == 'SAFETY':
-                logger.warning(f"Gemini summary blocked by SAFETY: {safety_ratings}")
-                return (False, "Bị chặn bởi safety filter")
-            
-            if finish_reason == 'MAX_TOKENS':
-                logger.warning("Gemini summary truncated (MAX_TOKENS)")
-            
-            if candidate.get('content', {}).get('parts'):
-                summary_text = candidate['content']['parts'][0].get('text', '')
-                if summary_text:
-                    return (True, summary_text)
-            
-            logger.warning(f"Gemini summary: No text in response. finishReason: {finish_reason}, safetyRatings: {safety_ratings}")
-            return (False, "Gemini không trả về kết quả hợp lệ")
-            
-        except urllib.error.HTTPError as e:
-            error_msg = f"Gemini API lỗi HTTP {e.code}"
-            try:
-                error_body = e.read().decode('utf-8')
-                logger.warning(f"Gemini HTTP error: {e.code} - {error_body}")
-            except:
-                logger.warning(f"Gemini HTTP error: {e.code}")
-            return (False, error_msg)
-        except urllib.error.URLError as e:
-            logger.warning(f"Gemini connection error: {e}")
-            return (False, "Không thể kết nối đến Gemini")
-        except Exception as e:
-            logger.warning(f"Gemini summary error: {e}")
-            return (False, str(e))
+def save_user(username, password):
+    """Append new user to acc.txt and update in-memory cache"""
+    try:
+        with file_lock, interprocess_lock(ACCOUNTS_FILE):
+            with open(ACCOUNTS_FILE, 'a', encoding='utf-8') as f:
+                f.write(f"{username}|{password}\n")
+            users[username] = password
+        return True
+    except Exception as e:
+        logger.error(f"Error saving user: {e}")
+        return False
 
-    def _invoke_gemini_query_optimizer(self, user_prompt):
-        """Call Gemini 2.5 Flash to optimize/process user prompt before sending to Serper
-        
-        Luồng: User prompt → Gemini xử lý → Optimized query cho Serper
-        
-        Returns:
-            tuple: (success: bool, result: dict)
-            - If success: (True, {"optimized_query": str, "reasoning": str, "keywords": list})
-            - If error: (False, {"error": str})
-        """
-        try:
-            gemini_key = get_api_key('gemini')
-            if not gemini_key:
-                return (False, {"error": "Gemini API key chưa được cấu hình"})
-            
-            system_prompt = """Bạn là Gemini Query Optimizer - nhiệm vụ tối ưu hóa câu hỏi người dùng thành query tìm kiếm hiệu quả cho Serper/Google.
+def validate_username(username):
+    """Validate username format and strength"""
+    if not username:
+        return False, "Username không được để trống"
+    
+    if len(username) < 3:
+        return False, "Username phải có ít nhất 3 ký tự"
+    
+    if len(username) > 30:
+        return False, "Username không được vượt quá 30 ký tự"
+    
+    if '|' in username:
+        return False, "Username không được chứa ký tự '|'"
+    
+    import re
+    if not re.match(r'^[a-zA-Z0-9_]+$', username):
+        return False, "Username chỉ được chứa chữ cái, số và dấu gạch dưới"
+    
+    return True, "Valid"
 
-⚠️ QUY TẮC BẮT BUỘC:
-1. Phân tích ý định tìm kiếm của người dùng
-2. Tạo query tìm kiếm tối ưu (ngắn gọn, rõ ràng, có từ khóa chính)
-3. Trả về JSON với format chính xác
+def validate_password(password):
+    """Validate password strength"""
+    if not password:
+        return False, "Password không được để trống"
+    
+    if len(password) < 6:
+        return False, "Password phải có ít nhất 6 ký tự"
+    
+    if len(password) > 100:
+        return False, "Password không được vượt quá 100 ký tự"
+    
+    if '|' in password:
+        return False, "Password không được chứa ký tự '|'"
+    
+    import re
+    has_letter = bool(re.search(r'[a-zA-Z]', password))
+    has_number = bool(re.search(r'[0-9]', password))
+    
+    if not (has_letter and has_number):
+        return False, "Password phải chứa cả chữ và số"
+    
+    return True, "Valid"
 
-📝 OUTPUT FORMAT (JSON):
-{
-    "optimized_query": "query tìm kiếm tối ưu (50-150 ký tự, ưu tiên tiếng Việt nếu là câu hỏi tiếng Việt)",
-    "reasoning": "giải thích ngắn gọn lý do tối ưu (1-2 câu)",
-    "keywords": ["từ_khóa_1", "từ_khóa_2", "từ_khóa_3"]
-}
+def check_user_exists(username):
+    """Check if username already exists"""
+    return username in users
 
-🎯 HƯỚNG DẪN TỐI ƯU:
-- Loại bỏ từ thừa (ừ, à, nhé, nha, cho tôi biết, giúp tôi...)
-- Giữ nguyên tên riêng, thương hiệu, số liệu cụ thể
-- Thêm ngữ cảnh thời gian nếu cần (2025, mới nhất, hiện tại...)
-- Nếu hỏi về giá/tỷ giá → thêm "giá hiện tại" hoặc "tỷ giá hôm nay"
-- Nếu hỏi về tin tức → thêm "tin tức mới nhất"
-- Nếu hỏi định nghĩa đơn giản → giữ ngắn gọn, không thêm thừa
+def authenticate_user(username, password):
+    """Verify username and password"""
+    return users.get(username) == password
 
-⚠️ CHỈ trả về JSON thuần túy, KHÔNG có text giải thích bên ngoài JSON."""
+def load_sessions():
+    """Load sessions from JSON file and clean expired ones"""
+    try:
+        with file_lock:
+            if os.path.exists(SESSIONS_FILE):
+                with open(SESSIONS_FILE, 'r', encoding='utf-8') as f:
+                    stored_sessions = json.load(f)
+                    
+                # Clean expired sessions
+                current_time = time.time()
+                valid_sessions = {}
+                for session_id, data in stored_sessions.items():
+                    if current_time < data.get('expires_at', 0):
+                        # Keep full session data including remember_me flag
+                        valid_sessions[session_id] = {
+                            'username': data['username'],
+                            'expires_at': data['expires_at'],
+                            'remember_me': data.get('remember_me', False)
+                        }
+                        if 'display_name' in data:
+                            valid_sessions[session_id]['display_name'] = data['display_name']
+                    else:
+                        logger.info(f"Removed expired session for user: {data.get('username')}")
+                
+                return valid_sessions
+    except Exception as e:
+        logger.error(f"Error loading sessions: {e}")
+    return {}
 
-            user_message = f"""Tối ưu hóa câu hỏi sau thành query tìm kiếm:
+def save_sessions():
+    """Save current sessions to JSON file preserving expiry timestamps"""
+    try:
+        # Sessions are already in correct format with username and expires_at
+        save_shared_json_store(SESSIONS_FILE, sessions)
+        return True
+    except Exception as e:
+        logger.error(f"Error saving sessions: {e}")
+        return False
 
-"{user_prompt}"
+def generate_session_id():
+    """Generate random session ID"""
+    return secrets.token_urlsafe(32)
 
-Trả về JSON theo format đã chỉ định."""
+def create_session(username, remember_me=False, display_name=None):
+    """Create new session and return session_id"""
+    session_id = generate_session_id()
+    expiry_hours = (30 * 24) if remember_me else SESSION_EXPIRY_HOURS
+    with file_lock:
+        sessions[session_id] = {
+            'username': username,
+            'expires_at': time.time() + (expiry_hours * 3600),
+            'remember_me': remember_me,
+            'display_name': display_name or username
+        }
+        save_sessions()  # Persist to file
+    logger.info(f"Session created for user: {username} (Remember me: {remember_me})")
+    return session_id
 
-            gemini_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={gemini_key}"
-            
-            gemini_payload = {
-                "contents": [
-                    {
-                        "role": "user",
-                        "parts": [{"text": f"{system_prompt}\n\n{user_message}"}]
-                    }
-                ],
-                "generationConfig": {
-                    "temperature": 0.3,
-                    "topK": 20,
-                    "topP": 0.9,
-                    "maxOutputTokens": 2048,
-                    "responseMimeType": "application/json"
-                },
-                "safetySettings": [
-                    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_ONLY_HIGH"},
-                    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_ONLY_HIGH"},
-                    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_ONLY_HIGH"},
-                    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_ONLY_HIGH"}
-                ]
-            }
-            
-            gemini_request = urllib.request.Request(
-                gemini_url,
-                data=json.dumps(gemini_payload).encode('utf-8'),
-                headers={'Content-Type': 'application/json'}
-            )
-            
-            with urllib.request.urlopen(gemini_request, timeout=15) as response:
-                gemini_response = response.read().decode('utf-8')
-                gemini_data = json.loads(gemini_response)
-            
-            candidates = gemini_data.get('candidates', [])
-            prompt_feedback = gemini_data.get('promptFeedback', {})
-            
-            if prompt_feedback.get('blockReason'):
-                block_reason = prompt_feedback.get('blockReason', 'UNKNOWN')
-                logger.warning(f"Query optimizer blocked by promptFeedback: {block_reason}")
-                return (False, {"error": f"Prompt bị chặn: {block_reason}"})
-            
-            if not candidates:
-                logger.warning(f"Query optimizer: No candidates returned. promptFeedback: {prompt_feedback}")
-                return (False, {"error": "Gemini không trả về kết quả"})
-            
-            candidate = candidates[0]
-            finish_reason = candidate.get('finishReason', 'UNKNOWN')
-            safety_ratings = candidate.get('safetyRatings', [])
-            
-            if finish_reason == 'SAFETY':
-                logger.warning(f"Query optimizer blocked by SAFETY: {safety_ratings}")
-                return (False, {"error": "Bị chặn bởi safety filter"})
-            
-            if finish_reason not in ['STOP', 'MAX_TOKENS']:
-                logger.warning(f"Query optimizer unexpected finishReason: {finish_reason}")
-            
-            if candidate.get('content', {}).get('parts'):
-                response_text = candidate['content']['parts'][0].get('text', '')
-                if response_text:
-                    response_text = response_text.strip()
-                    if response_text.startswith('```json'):
-                        response_text = response_text[7:]
-                    if response_text.startswith('```'):
-                        response_text = response_text[3:]
-                    if response_text.endswith('```'):
-                        response_text = response_text[:-3]
-                    response_text = response_text.strip()
+def get_user_from_session(session_id):
+    """Get username from session_id, checking expiry"""
+    session_data = sessions.get(session_id)
+    if not session_data:
+        return None
+    
+    # Check if session has expired
+    if time.time() >= session_data.get('expires_at', 0):
+        # Session expired, remove it
+        delete_session(session_id)
+        logger.info(f"Session expired for user: {session_data.get('username')}")
+        return None
+    
+    return session_data.get('username')
+
+def delete_session(session_id):
+    """Delete session"""
+    with file_lock:
+        session_data = sessions.pop(session_id, None)
+        if session_data is None:
+            return False
+        save_sessions()  # Persist to file
+    logger.info(f"Session deleted for user: {session_data.get('username', 'Unknown')}")
+    return True
+
+def load_rate_limits():
+    """Load rate limits from JSON file and clean expired ones"""
+    try:
+        with file_lock:
+            if os.path.exists(RATE_LIMIT_FILE):
+                with open(RATE_LIMIT_FILE, 'r', encoding='utf-8') as f:
+                    stored_limits = json.load(f)
                     
-                    try:
-                        result = json.loads(response_text)
-                        if 'optimized_query' in result:
-                            logger.info(f"Query optimized: '{user_prompt}' → '{result['optimized_query']}'")
-                            return (True, result)
-                        else:
-                            logger.warning(f"Query optimizer missing optimized_query field: {response_text[:200]}")
-                            return (False, {"error": "JSON thiếu trường optimized_query"})
-                    except json.JSONDecodeError as e:
-                        logger.warning(f"Query optimizer JSON parse error: {e}, finishReason: {finish_reason}, raw: {response_text[:300]}")
-                        return (False, {"error": f"Không thể parse JSON: {str(e)}"})
-            
-            logger.warning(f"Query optimizer: No text in response. finishReason: {finish_reason}")
-            return (False, {"error": "Gemini không trả về kết quả hợp lệ"})
-            
-        except urllib.error.HTTPError as e:
-            error_msg = f"Gemini API lỗi HTTP {e.code}"
-            logger.warning(f"Query optimizer HTTP error: {e.code}")
-            return (False, {"error": error_msg})
-        except urllib.error.URLError as e:
-            logger.warning(f"Query optimizer connection error: {e}")
-            return (False, {"error": "Không thể kết nối đến Gemini"})
-        except Exception as e:
-            logger.warning(f"Query optimizer error: {e}")
-            return (False, {"error": str(e)})
+                current_time = time.time()
+                valid_limits = {}
+                for username, data in stored_limits.items():
+                    if current_time < data.get('locked_until', 0) or current_time - data.get('last_attempt', 0) < RATE_LIMIT_WINDOW:
+                        valid_limits[username] = data
+                
+                return valid_limits
+    except Exception as e:
+        logger.error(f"Error loading rate limits: {e}")
+    return {}
 
-    def handle_llm7_chat(self):
-        """Generic handler for all LLM7 models via LLM7.io"""
-        try:
-            # Get username from session cookie
-            username = self._get_username_from_cookie()
-            
-            # Get API key from config
-            api_key = get_api_key('llm7')
-            logger.info(f"LLM7 API Key configured: {'Yes' if api_key else 'No'}")
-            if not api_key:
-                self._send_json_error(500, 
-                    "LLM7 API key chưa được cấu hình. Vui lòng kiểm tra config.py",
-                    "API_KEY_MISSING")
-                return
-            
-            # Read request body
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
-            
-            # Extract model and message from request
-            model_id = request_data.get('model', 'gpt-5-chat')
-            message = request_data.get('message', '')
-            if not message:
-                self._send_json_error(400, "Message không được để trống", "MISSING_MESSAGE")
-                return
-            
-            # Extract files from request (for vision/image analysis)
-            files = request_data.get('files', [])
-            
-            # Build LLM7.io API URL
-            llm7_url = "https://api.llm7.io/v1/chat/completions"
-            llm7_headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
-            
-            # Support conversation history - check if messages array is provided
-            conversation_messages = request_data.get('messages', [])
-            
-            # Build messages array with system prompt and conversation history
-            # Sử dụng system prompt động dựa trên model_id
-            messages: list = [
-                {"role": "system", "content": get_llm7_system_prompt(model_id)}
-            ]
-            
-            # Add conversation history if provided
-            if conversation_messages:
-                messages.extend(conversation_messages)
-            else:
-                # Fallback to old format for backward compatibility
-                messages.append({"role": "user", "content": message})
-            
-            # IDENTITY GUARDRAIL: Thêm reminder message ngay trước user message cuối cùng
-            # để đảm bảo model không bị nhầm lẫn bởi conversation history từ model khác
-            identity_model_names = {
-                'gpt-5-chat': 'GPT-5', 'gpt-4o': 'GPT-4o', 'gpt-4': 'GPT-4',
-                'gpt-5-mini': 'GPT-5 Mini', 'gpt-5-nano-2025-08-07': 'GPT-5 Nano',
-                'gpt-o4-mini-2025-04-16': 'GPT-O4 Mini',
-                'bidara': 'BIDARA', 'deepseek-reasoning': 'DeepSeek Reasoning',
-                'deepseek-v3.1': 'DeepSeek V3.1',
-                'nova-fast': 'Nova Fast', 'gemma-2-2b-it': 'Gemma 2',
-                'qwen2.5-coder-32b-instruct': 'Qwen 2.5 Coder',
-                'mistral-medium-2508': 'Mistral Medium', 'mistral-small-2503': 'Mistral Small',
-                'mistral-small-3.1-24b-instruct-2503': 'Mistral Small 3.1',
-                'open-mixtral-8x7b': 'Mixtral 8x7B', 'roblox-rp': 'Roblox RP',
-                'Steelskull/L3.3-MS-Nevoria-70b': 'Nevoria 70B',
+def save_rate_limits():
+    """Save rate limits to JSON file"""
+    try:
+        save_shared_json_store(RATE_LIMIT_FILE, rate_limits)
+        return True
+    except Exception as e:
+        logger.error(f"Error saving rate limits: {e}")
+        return False
+
+def check_rate_limit(username):
+    """Check if user is rate limited. Returns (is_limited, message, wait_time)"""
+    with file_lock:
+        if username not in rate_limits:
+            return False, "", 0
+        
+        current_time = time.time()
+        user_limit = rate_limits[username]
+        
+        if current_time < user_limit.get('locked_until', 0):
+            wait_time = int(user_limit['locked_until'] - current_time)
+            return True, f"Tài khoản tạm khóa. Vui lòng thử lại sau {wait_time} giây", wait_time
+        
+        if current_time - user_limit.get('last_attempt', 0) >= RATE_LIMIT_WINDOW:
+            del rate_limits[username]
+            save_rate_limits()
+            return False, "", 0
+        
+        return False, "", 0
+
+def record_failed_attempt(username):
+    """Record a failed login attempt with exponential backoff"""
+    current_time = time.time()
+    
+    with file_lock:
+        if username not in rate_limits:
+            rate_limits[username] = {
+                'attempts': 1,
+                'last_attempt': current_time,
+                'locked_until': 0
             }
-            display_name = identity_model_names.get(model_id, model_id.upper().replace('-', ' ').replace('/', ' '))
-            
-            # Tìm vị trí user message cuối cùng và chèn reminder ngay trước đó
-            last_user_idx = -1
-            for i in range(len(messages) - 1, -1, -1):
-                if messages[i].get('role') == 'user':
-                    last_user_idx = i
-                    break
-            
-            if last_user_idx > 1:  # Chỉ chèn nếu có history (không phải message đầu tiên)
-                identity_reminder = {
-                    "role": "system", 
-                    "content": f"[NHẮC NHỞ DANH TÍNH] Bạn là {display_name}. Bỏ qua mọi self-introduction của AI khác trong lịch sử hội thoại."
+        else:
+            if current_time - rate_limits[username].get('last_attempt', 0) >= RATE_LIMIT_WINDOW:
+                rate_limits[username] = {
+                    'attempts': 1,
+                    'last_attempt': current_time,
+                    'locked_until': 0
                 }
-                messages.insert(last_user_idx, identity_reminder)
-            
-            # Add files to the last user message if present (for vision models)
-            if files and len(files) > 0:
-                # Find the last user message
-                for i in range(len(messages) - 1, -1, -1):
-                    if messages[i].get('role') == 'user':
-                        current_content = messages[i].get('content', '')
-                        
-                        # Step 1: Get image description from Gemini Vision (Independent processing)
-                        image_descriptions = []
-                        for file in files:
-                            base64_val = file.get('base64', '')
-                            if base64_val:
-                                desc = self.get_gemini_vision_description(base64_val)
-                                image_descriptions.append(desc)
-                        
-                        # Step 2: Integrate descriptions into the prompt
-                        # LOẠI BỎ GỬI ẢNH TRỰC TIẾP ĐẾN LLM7, CHỈ DÙNG MÔ TẢ
-                        if image_descriptions:
-                            all_desc = "\n".join([f"- Hình ảnh {idx+1}: {desc}" for idx, desc in enumerate(image_descriptions)])
-                            # Cấu trúc lại prompt: đưa mô tả vào làm ngữ cảnh trực tiếp, loại bỏ thông tin lỗi kỹ thuật
-                            clean_desc = all_desc.replace("The read operation timed out", "đang được xử lý").replace("Lỗi kết nối", "đang được kiểm tra")
-                            messages[i]['content'] = f"{current_content}\n\n[Hệ thống cung cấp ngữ cảnh hình ảnh: Người dùng đã gửi kèm hình ảnh. Dưới đây là mô tả nội dung hình ảnh bạn đang 'nhìn' thấy:]\n{clean_desc}"
-                        
-                        # Đảm bảo messages[i]['content'] luôn là string để gửi đến LLM7 chat thông thường
-                        if isinstance(messages[i]['content'], list):
-                             # Fallback nếu lỡ là list vision format
-                             text_parts = [p.get('text', '') for p in messages[i]['content'] if p.get('type') == 'text']
-                             messages[i]['content'] = " ".join(text_parts)
-
-                        if len(messages) > 1:
-                            # Keep system prompt (index 0) and the current user message (the one with context)
-                            messages = [messages[0], messages[i]]
-                        break
-            
-            llm7_payload = {
-                "model": "gpt-5-chat",
-                "messages": messages,
-                "temperature": 0.7
-            }
-            
-            # Make request to LLM7.io with retry logic
-            with retry_request_with_backoff(
-                llm7_url,
-                llm7_headers,
-                json.dumps(llm7_payload).encode('utf-8'),
-                timeout=REQUEST_TIMEOUT
-            ) as response:
-                llm7_response = response.read().decode('utf-8')
-                llm7_data = json.loads(llm7_response)
-            
-            # Extract response
-            reply = ""
-            if "choices" in llm7_data and len(llm7_data["choices"]) > 0:
-                reply = llm7_data["choices"][0]["message"]["content"]
             else:
-                reply = str(llm7_data)
+                rate_limits[username]['attempts'] += 1
+                rate_limits[username]['last_attempt'] = current_time
+        
+        attempts = rate_limits[username]['attempts']
+        
+        if attempts >= MAX_LOGIN_ATTEMPTS:
+            if attempts <= 7:
+                lockout_duration = 60
+            elif attempts <= 10:
+                lockout_duration = 300
+            else:
+                lockout_duration = 1800
             
-            # Save AI history
-            save_ai_history(
-                username=username,
-                model=model_id,
-                prompt=message,
-                response=reply,
-                metadata={'endpoint': 'llm7_chat', 'has_files': len(files) > 0}
-            )
+            rate_limits[username]['locked_until'] = current_time + lockout_duration
+            logger.warning(f"User {username} locked out for {lockout_duration}s after {attempts} failed attempts")
+        
+        save_rate_limits()
+    return attempts
+
+def reserve_login_attempt(username):
+    """Check rate limit và ghi trước 1 lần thử trong cùng 1 lần giữ lock
+
+    Tránh race check-then-record: N request đăng nhập song song không thể cùng lọt
+    qua check trước khi lần thất bại nào được ghi. Đăng nhập thành công sẽ
+    clear_rate_limit() nên lần thử ghi trước không ảnh hưởng.
+    Returns (is_limited, message, wait_time, attempts)
+    """
+    with file_lock:
+        is_limited, message, wait_time = check_rate_limit(username)
+        if is_limited:
+            return is_limited, message, wait_time, rate_limits[username].get('attempts', 0)
+        return False, "", 0, record_failed_attempt(username)
+
+def clear_rate_limit(username):
+    """Clear rate limit for successful login"""
+    with file_lock:
+        if rate_limits.pop(username, None) is None:
+            return
+        save_rate_limits()
+    logger.info(f"Rate limit cleared for user: {username}")
+
+def rotate_session(old_session_id):
+    """Rotate session ID for security. Returns new session_id or None"""
+    with file_lock:
+        old_session_data = sessions.pop(old_session_id, None)
+        if old_session_data is None:
+            return None
+        
+        username = old_session_data.get('username')
+        remember_me = old_session_data.get('remember_me', False)
+        
+        new_session_id = generate_session_id()
+        expiry_hours = (30 * 24) if remember_me else SESSION_EXPIRY_HOURS
+        
+        sessions[new_session_id] = {
+            'username': username,
+            'expires_at': time.time() + (expiry_hours * 3600),
+            'remember_me': remember_me
+        }
+        save_sessions()
+    
+    logger.info(f"Session rotated for user: {username}")
+    return new_session_id
+
+def cleanup_expired_data():
+    """Background task to cleanup expired sessions and rate limits"""
+    while True:
+        try:
+            time.sleep(3600)
             
-            # Return response to client
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
+            current_time = time.time()
+            expired_sessions = []
+            for session_id, data in list(sessions.items()):
+                if current_time >= data.get('expires_at', 0):
+                    expired_sessions.append(session_id)
             
-            response_json = json.dumps({
-                "reply": reply,
-                "model": "gpt-5-chat"
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
+            for session_id in expired_sessions:
+                delete_session(session_id)
             
-            logger.info(f"LLM7 {model_id} completed successfully")
+            if expired_sessions:
+                logger.info(f"Cleaned up {len(expired_sessions)} expired session(s)")
             
-        except urllib.error.HTTPError as e:
-            try:
-                error_body = e.read().decode('utf-8')
-                self._send_json_error(e.code, f"LLM7 API lỗi: {error_body}", "UPSTREAM_ERROR")
-            except:
-                self._send_json_error(e.code, f"LLM7 API lỗi: {e.reason}", "UPSTREAM_ERROR")
-        except urllib.error.URLError as e:
-            logger.error(f"LLM7 connection error: {e}")
-            self._send_json_error(502, "Không thể kết nối đến LLM7 API", "CONNECTION_ERROR")
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in LLM7 request: {e}")
-            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
+            expired_limits = []
+            for username, data in list(rate_limits.items()):
+                if current_time >= data.get('locked_until', 0) and current_time - data.get('last_attempt', 0) >= RATE_LIMIT_WINDOW:
+                    expired_limits.append(username)
+            
+            if expired_limits:
+                with file_lock:
+                    for username in expired_limits:
+                        rate_limits.pop(username, None)
+                    save_rate_limits()
+                logger.info(f"Cleaned up {len(expired_limits)} expired rate limit(s)")
+                
         except Exception as e:
-            logger.error(f"LLM7 chat error: {e}")
-            logger.error(f"Exception type: {type(e)}")
-            logger.error(f"Exception args: {e.args}")
-            # Lấy model name từ request_data nếu có thể
-            model_display_name = "AI"
-            try:
-                # Đảm bảo request_data tồn tại và có trường model
-                if 'request_data' in locals() and isinstance(request_data, dict):
-                    model_display_name = request_data.get('model', 'AI')
-            except:
-                pass
-            self._send_json_error(503, f"Xin lỗi, đã có lỗi xảy ra khi gọi {model_display_name}. Chi tiết: Lỗi hệ thống: {str(e)} Vui lòng thử lại hoặc chọn model khác.", "SYSTEM_ERROR")
+            logger.error(f"Error in cleanup task: {e}")
 
-    def handle_enhance_prompt(self):
-        """Enhance prompt using Gemini AI to expand Vietnamese abbreviations and improve quality"""
-        try:
-            # Get Gemini API key
-            gemini_key = get_api_key('gemini')
-            if not gemini_key or gemini_key == "your_gemini_api_key_here":
-                self._send_json_error(500, 
-                    "Gemini API key chưa được cấu hình. Vui lòng thêm GEMINI_API_KEY vào environment variables.",
-                    "API_KEY_MISSING")
-                return
-            
-            # Read request body
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
-            
-            # Extract user prompt
-            user_prompt = request_data.get('prompt', '')
-            if not user_prompt:
-                self._send_json_error(400, "Prompt không được để trống", "MISSING_PROMPT")
+def save_ai_history(username, model, prompt, response, metadata=None):
+    """Save AI call history to JSONL file with thread-safety"""
+    try:
+        history_entry = {
+            'timestamp': time.time(),
+            'username': username or 'anonymous',
+            'model': model,
+            'prompt': prompt[:500] if prompt else '',  # Limit prompt length
+            'response': response[:500] if response else '',  # Limit response length
+            'metadata': metadata or {}
+        }
+        
+        with file_lock:
+            with open(AI_HISTORY_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(history_entry, ensure_ascii=False) + '\n')
+        
+        logger.debug(f"AI history saved: {username} - {model}")
+        return True
+    except Exception as e:
+        logger.error(f"Error saving AI history: {e}")
+        return False
+
+# ===========================================
+# RESPONSE CACHE
+# Cache LRU + TTL trong bộ nhớ cho kết quả upstream lặp lại (Serper, ...), có stale-while-revalidate
+# ===========================================
+
+CACHES = {}  # name → TTLCache, để admin stats liệt kê hit ratio của mọi cache
+
+def normalize_cache_text(text):
+    """Chuẩn hoá text làm cache key: NFC (dấu tiếng Việt dựng sẵn/tổ hợp như nhau), casefold, gộp khoảng trắng"""
+    return ' '.join(unicodedata.normalize('NFC', str(text)).casefold().split())
+
+class BackgroundExecutor:
+    """Thread pool có giới hạn cho việc nền của request (call SingleFlight, hedged request, làm mới cache)
+
+    try_submit() không xếp hàng: hết slot thì trả về None để caller tự chạy inline, nên
+    task trong pool submit task con rồi chờ nó cũng không thể deadlock.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='nexorax-bg')
+        self._lock = threading.Lock()
+        self._active = 0
+        self._submitted = 0
+        self._rejected = 0
+
+    def try_submit(self, fn, *args):
+        """Chạy fn(*args) trên pool; trả về Future, hoặc None khi mọi thread đều bận"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            return None
+        with self._lock:
+            self._active += 1
+            self._submitted += 1
+        try:
+            return self._executor.submit(self._run, fn, args)
+        except RuntimeError:  # Interpreter đang tắt
+            self._done()
+            return None
+
+    def _run(self, fn, args):
+        try:
+            return fn(*args)
+        finally:
+            self._done()
+
+    def _done(self):
+        with self._lock:
+            self._active -= 1
+        self._slots.release()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "active": self._active,
+                "submitted": self._submitted,
+                "rejected": self._rejected
+            }
+
+BACKGROUND_EXECUTOR = BackgroundExecutor(get_background_workers())
+
+SINGLE_FLIGHTS = {}  # name → SingleFlight, để báo cáo trong /api/admin/stats
+
+class _Flight:
+    """Một call đang chạy của SingleFlight"""
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class SingleFlight:
+    """Gộp các call cùng key đang chạy đồng thời thành 1 call upstream (chống thundering herd)
+
+    Request đầu tiên của một key (leader) khởi chạy fn() trên BACKGROUND_EXECUTOR (pool đầy thì
+    leader tự chạy fn()); mọi request cùng key đến khi call chưa xong đều chờ và nhận chung
+    kết quả, hoặc chung exception nếu fn() lỗi.
+    Call xong là key được giải phóng ngay, kết quả không được giữ lại (việc đó là của cache).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights = {}  # key → _Flight
+        self._leaders = 0
+        self._shared = 0
+        SINGLE_FLIGHTS[name] = self
+
+    def do(self, key, fn, deadline=None, reserve=0.0):
+        """Trả về (value, shared); shared=True khi kết quả lấy từ call của request khác
+
+        fn(flight_deadline) nhận Deadline riêng của call dùng chung (get_request_deadline('flight')),
+        không phụ thuộc deadline của request nào, kể cả leader.
+        deadline/reserve: request (leader hay không) hết thời gian chờ (như Deadline.cap) trước
+        khi call xong thì raise DeadlineExceededError; call vẫn chạy tiếp cho các request còn lại.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self._leaders += 1
+            else:
+                self._shared += 1
+        if leader and BACKGROUND_EXECUTOR.try_submit(self._run, key, flight, fn) is None:
+            self._run(key, flight, fn)  # Pool nền đầy: leader chờ hết call, không bỏ ngang theo deadline được
+        while not flight.done.wait(deadline.cap(reserve=reserve) if deadline else None):
+            pass
+        if flight.error is not None:
+            raise flight.error
+        return flight.value, not leader
+
+    def _run(self, key, flight, fn):
+        try:
+            flight.value = fn(Deadline(get_request_deadline('flight')))
+        except Exception as e:
+            flight.error = e
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def get_stats(self):
+        with self._lock:
+            calls = self._leaders + self._shared
+            return {
+                "in_flight": len(self._flights),
+                "upstream_calls": self._leaders,
+                "shared": self._shared,
+                "shared_ratio": round(self._shared / calls, 4) if calls else None
+            }
+
+def _estimate_size(value):
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    try:
+        return len(json.dumps(value, ensure_ascii=False, default=str))
+    except (TypeError, ValueError):
+        return 1024
+
+class TTLCache:
+    """Cache LRU có TTL từng entry, giới hạn theo số entry và tổng dung lượng ước tính (bytes)
+
+    Entry hết TTL vẫn được giữ thêm stale_seconds: get_or_load trả về giá trị cũ ngay và
+    làm mới trên BACKGROUND_EXECUTOR (stale-while-revalidate). Vượt giới hạn thì bỏ entry ít dùng nhất.
+    Các miss đồng thời cùng key chỉ gọi loader 1 lần (self.flight, dùng chung kết quả/lỗi).
+    """
+
+    def __init__(self, name, max_entries=256, max_bytes=4 * 1024 * 1024, ttl=3600, stale_seconds=0):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_seconds = stale_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key → (value, expires_at, size), cuối = dùng gần nhất
+        self._bytes = 0
+        self._refreshing = set()
+        self._hits = 0
+        self._stale_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self.flight = SingleFlight(name)
+        CACHES[name] = self
+
+    def _lookup(self, key, now):
+        """(value, fresh) hoặc None; entry quá hạn stale bị xoá. Gọi khi đang giữ lock"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at, size = entry
+        if now >= expires_at + self.stale_seconds:
+            del self._entries[key]
+            self._bytes -= size
+            return None
+        self._entries.move_to_end(key)
+        return value, now < expires_at
+
+    def get(self, key):
+        """Giá trị còn hạn của key, None nếu không có (không dùng entry stale)"""
+        with self._lock:
+            found = self._lookup(key, time.time())
+            if found and found[1]:
+                self._hits += 1
+                return found[0]
+            self._misses += 1
+            return None
+
+    def set(self, key, value, ttl=None, size=None):
+        ttl = self.ttl if ttl is None else ttl
+        if self.max_entries <= 0 or ttl <= 0:
+            return
+        size = _estimate_size(value) if size is None else size
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (value, time.time() + ttl, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._evictions += 1
+
+    def get_or_load(self, key, loader, ttl=None, size=None, deadline=None):
+        """Lấy từ cache, hoặc gọi loader(flight_deadline) (lỗi của loader được raise như bình thường)
+
+        Trả về (value, status) với status "hit", "stale" (đang làm mới ở nền), "miss" hoặc
+        "shared" (miss nhưng dùng chung kết quả loader của request khác đang chạy cùng key).
+        loader nhận Deadline của call dùng chung (xem SingleFlight.do), không phải của request.
+        deadline: giới hạn thời gian request này chờ loader (DeadlineExceededError khi hết).
+        """
+        with self._lock:
+            found = self._lookup(key, time.time())
+            if found and found[1]:
+                self._hits += 1
+                return found[0], "hit"
+            if found:
+                self._stale_hits += 1
+                refresh = key not in self._refreshing
+                if refresh:
+                    self._refreshing.add(key)
+            else:
+                self._misses += 1
+        if found:
+            if refresh and BACKGROUND_EXECUTOR.try_submit(self._refresh, key, loader, ttl, size) is None:
+                with self._lock:
+                    self._refreshing.discard(key)  # Pool nền đầy: để request sau làm mới
+            return found[0], "stale"
+        
+        def load(flight_deadline):
+            # Leader trước có thể vừa set xong giữa lúc miss và lúc vào flight
+            with self._lock:
+                found = self._lookup(key, time.time())
+            if found and found[1]:
+                return found[0]
+            value = loader(flight_deadline)
+            self.set(key, value, ttl, size)
+            return value
+        
+        value, shared = self.flight.do(key, load, deadline)
+        return value, "shared" if shared else "miss"
+
+    def _refresh(self, key, loader, ttl, size):
+        try:
+            self.set(key, loader(Deadline(get_request_deadline('flight'))), ttl, size)
+        except Exception as e:
+            logger.warning(f"Cache {self.name}: background refresh failed, keeping stale entry: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self._hits + self._stale_hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "stale_hits": self._stale_hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "hit_ratio": round((self._hits + self._stale_hits) / lookups, 4) if lookups else None
+            }
+
+# Loại query tìm kiếm → chọn TTL cho kết quả Serper (SERPER_CACHE_TTLS); xét theo thứ tự, loại đầu tiên khớp được chọn
+SEARCH_QUERY_CLASSES = [
+    ("news", ('tin tức', 'tin mới', 'mới nhất', 'hôm nay', 'hôm qua', 'tuần này', 'trực tiếp', 'news', 'latest', 'breaking', 'today')),
+    ("price", ('giá', 'tỷ giá', 'bao nhiêu tiền', 'cổ phiếu', 'chứng khoán', 'bitcoin', 'btc', 'usd', 'price', 'prices', 'stock', 'exchange rate')),
+    ("weather", ('thời tiết', 'nhiệt độ', 'dự báo', 'mưa', 'bão', 'weather', 'forecast', 'temperature')),
+    ("definition", ('là gì', 'định nghĩa', 'nghĩa là', 'khái niệm', 'what is', 'meaning', 'definition', 'define')),
+]
+_SEARCH_QUERY_PATTERNS = [
+    (query_class, re.compile(r'\b(?:' + '|'.join(re.escape(word) for word in words) + r')\b'))
+    for query_class, words in SEARCH_QUERY_CLASSES
+]
+
+def classify_search_query(query):
+    """Loại của query tìm kiếm: news / price / weather / definition / default"""
+    normalized = normalize_cache_text(query)
+    for query_class, pattern in _SEARCH_QUERY_PATTERNS:
+        if pattern.search(normalized):
+            return query_class
+    return "default"
+
+SERPER_CACHE = TTLCache('serper', **get_cache_settings('serper'))
+OPTIMIZER_CACHE = TTLCache('optimizer', **get_cache_settings('optimizer'))
+VISION_CACHE = TTLCache('vision', **get_cache_settings('vision'))
+SUMMARY_FLIGHT = SingleFlight('summary')  # tóm tắt không cache (phụ thuộc kết quả Serper), chỉ gộp call đồng thời
+ENHANCE_CACHE = TTLCache('enhance', **get_cache_settings('enhance'))
+RESPONSE_CACHE = TTLCache('response', **get_cache_settings('response'))
+
+def response_cache_key(request_data, headers, model, turns, body=None):
+    """Key cache câu trả lời chat: sha256 của model + body gửi upstream (system prompt + messages)
+
+    Trả về None (không dùng cache) khi RESPONSE_CACHE_ENABLED tắt, request bỏ qua cache
+    ("cache": false hoặc Cache-Control: no-cache / no-store) hoặc có lịch sử hội thoại
+    (turns có nhiều hơn 1 lượt không phải system).
+    """
+    if not is_response_cache_enabled():
+        return None
+    cache_control = (headers.get('Cache-Control') or '').lower()
+    if request_data.get('cache') is False or 'no-cache' in cache_control or 'no-store' in cache_control:
+        return None
+    if sum(1 for turn in turns if not isinstance(turn, dict) or turn.get('role') != 'system') != 1:
+        return None
+    raw = json.dumps({"model": model, "body": turns if body is None else body}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def vision_cache_key(image_data_base64):
+    """sha256 của bytes ảnh đã decode (cùng một ảnh, có hay không có data: prefix, cho cùng key)"""
+    data = image_data_base64.split(',', 1)[1] if ',' in image_data_base64 else image_data_base64
+    try:
+        raw = base64.b64decode(data)
+    except (binascii.Error, ValueError):
+        raw = data.encode('utf-8', 'replace')
+    return hashlib.sha256(raw).hexdigest()
+
+def _vision_cache_path(key):
+    cache_dir = get_vision_cache_dir()
+    return os.path.join(cache_dir, f"{key}.json") if cache_dir else None
+
+def get_cached_vision_description(key):
+    """Mô tả ảnh đã cache: tìm trong bộ nhớ trước, sau đó tier trên đĩa (VISION_CACHE_DIR) nếu bật"""
+    description = VISION_CACHE.get(key)
+    path = _vision_cache_path(key)
+    if description is not None or not path:
+        return description
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    remaining_ttl = VISION_CACHE.ttl - (time.time() - entry.get('created_at', 0))
+    if remaining_ttl <= 0:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    VISION_CACHE.set(key, entry['description'], remaining_ttl)
+    return entry['description']
+
+def store_vision_description(key, description):
+    """Lưu mô tả ảnh vào cache bộ nhớ và (nếu bật) tier trên đĩa"""
+    VISION_CACHE.set(key, description)
+    path = _vision_cache_path(key)
+    if not path:
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"description": description, "created_at": time.time()}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Vision cache: cannot write {path}: {e}")
+
+# ===========================================
+# LOCAL CLOCK
+# Câu hỏi thời gian trả lời từ đồng hồ server + zoneinfo, tuỳ chọn hiệu chỉnh bằng offset NTP đo nền
+# ===========================================
+
+NTP_EPOCH_DELTA = 2208988800  # giây từ 1900-01-01 (epoch NTP) đến 1970-01-01
+
+def query_ntp_offset(server, timeout=2.0):
+    """Đo lệch giờ (giây) của đồng hồ local so với NTP server bằng 1 gói SNTP"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sent_at = time.time()
+        sock.sendto(b'\x1b' + 47 * b'\0', (server, 123))
+        data, _ = sock.recvfrom(48)
+        received_at = time.time()
+    if len(data) < 48:
+        raise ValueError(f"Short NTP response ({len(data)} bytes)")
+    recv_secs, recv_frac, xmit_secs, xmit_frac = struct.unpack('!4I', data[32:48])
+    server_recv = recv_secs - NTP_EPOCH_DELTA + recv_frac / 2 ** 32
+    server_xmit = xmit_secs - NTP_EPOCH_DELTA + xmit_frac / 2 ** 32
+    return ((server_recv - sent_at) + (server_xmit - received_at)) / 2
+
+class ClockMonitor:
+    """Đồng hồ cho câu trả lời thời gian: time.time() + offset NTP đo được (0 khi không bật kiểm tra)"""
+    
+    def __init__(self):
+        self.offset = 0.0
+        self.checked_at = None
+        self.last_error = None
+        self._started = False
+        self._lock = threading.Lock()
+    
+    def now(self):
+        return time.time() + self.offset
+    
+    def check(self, server, timeout=2.0, max_offset=2.0):
+        try:
+            offset = query_ntp_offset(server, timeout)
+        except (OSError, ValueError) as e:
+            self.last_error = str(e)
+            logger.warning(f"NTP check ({server}) failed: {e}")
+            return None
+        self.offset, self.checked_at, self.last_error = offset, time.time(), None
+        if abs(offset) > max_offset:
+            logger.warning(f"Server clock is off by {offset:+.3f}s from {server}; time answers are corrected")
+        return offset
+    
+    def start(self, settings):
+        """Chạy kiểm tra NTP định kỳ trong thread nền (1 lần / process)"""
+        with self._lock:
+            if self._started or not settings.get("enabled"):
                 return
-            
-            # Create system prompt for Vietnamese abbreviation expansion and enhancement
-            system_prompt = """Bạn là một AI chuyên xử lý tiếng Việt và mở rộng các từ viết tắt phổ biến ở Việt Nam.
+            self._started = True
+        
+        def run():
+            while True:
+                self.check(settings["server"], settings["timeout"], settings["max_offset"])
+                time.sleep(settings["interval"])
+        
+        threading.Thread(target=run, name="ntp-check", daemon=True).start()
+        logger.info(f"NTP clock check started ({settings['server']}, every {settings['interval']}s)")
+    
+    def get_stats(self):
+        return {
+            "offset_seconds": round(self.offset, 4),
+            "checked_at": self.checked_at,
+            "last_error": self.last_error,
+        }
+
+CLOCK = ClockMonitor()
+
+# Địa điểm được nhắc trong câu hỏi → múi giờ IANA; so khớp theo nguyên từ, tránh từ đa nghĩa
+# (vd "phương pháp", "cập nhật", "Thủ Đức" nên chỉ nhận "nước pháp", "nhật bản", "nước đức")
+TIMEZONE_ALIASES = [
+    (('việt nam', 'viet nam', 'vietnam', 'hà nội', 'ha noi', 'hanoi', 'sài gòn', 'sai gon', 'saigon', 'hồ chí minh', 'ho chi minh', 'tphcm'), 'Asia/Ho_Chi_Minh'),
+    (('nhật bản', 'nhat ban', 'nước nhật', 'japan', 'tokyo'), 'Asia/Tokyo'),
+    (('hàn quốc', 'han quoc', 'korea', 'seoul'), 'Asia/Seoul'),
+    (('trung quốc', 'trung quoc', 'china', 'bắc kinh', 'bac kinh', 'beijing', 'thượng hải', 'shanghai'), 'Asia/Shanghai'),
+    (('hồng kông', 'hong kong', 'hongkong'), 'Asia/Hong_Kong'),
+    (('đài loan', 'dai loan', 'taiwan', 'đài bắc', 'taipei'), 'Asia/Taipei'),
+    (('singapore',), 'Asia/Singapore'),
+    (('thái lan', 'thai lan', 'thailand', 'bangkok'), 'Asia/Bangkok'),
+    (('ấn độ', 'an do', 'india', 'new delhi', 'delhi'), 'Asia/Kolkata'),
+    (('dubai',), 'Asia/Dubai'),
+    (('nước anh', 'vương quốc anh', 'london', 'england', 'uk'), 'Europe/London'),
+    (('nước pháp', 'france', 'paris'), 'Europe/Paris'),
+    (('nước đức', 'germany', 'berlin'), 'Europe/Berlin'),
+    (('nước nga', 'russia', 'moscow', 'mát-xcơ-va'), 'Europe/Moscow'),
+    (('los angeles', 'california', 'san francisco', 'seattle'), 'America/Los_Angeles'),
+    (('chicago',), 'America/Chicago'),
+    (('nước mỹ', 'hoa kỳ', 'new york', 'washington', 'usa'), 'America/New_York'),
+    (('nước úc', 'australia', 'sydney', 'melbourne'), 'Australia/Sydney'),
+    (('utc', 'gmt'), 'UTC'),
+]
+_TIMEZONE_ALIAS_PATTERNS = [
+    # Alias chuẩn hoá giống câu hỏi (normalize_cache_text), khớp nguyên từ: không dính chữ cái trước/sau
+    (re.compile(r'(?<!\w)(?:' + '|'.join(re.escape(normalize_cache_text(name)) for name in names) + r')(?!\w)'), tz_name)
+    for names, tz_name in TIMEZONE_ALIASES
+]
+_IANA_TIMEZONE_PATTERN = re.compile(r'\b[A-Z][A-Za-z]+(?:/[A-Za-z_\-]+)+\b')
+DAYS_VI = ['Thứ Hai', 'Thứ Ba', 'Thứ Tư', 'Thứ Năm', 'Thứ Sáu', 'Thứ Bảy', 'Chủ Nhật']  # theo datetime.weekday()
+
+def resolve_timezone(message):
+    """Múi giờ người dùng nhắc tới trong câu hỏi (tên IANA hoặc địa điểm quen thuộc), mặc định DEFAULT_TIMEZONE
+
+    Câu hỏi được chuẩn hoá NFC trước khi so khớp: tiếng Việt gõ dạng tổ hợp (NFD) vẫn nhận ra địa điểm.
+    """
+    message = unicodedata.normalize('NFC', message)
+    for candidate in _IANA_TIMEZONE_PATTERN.findall(message):
+        try:
+            zoneinfo.ZoneInfo(candidate)
+            return candidate
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            continue
+    normalized = normalize_cache_text(message)
+    for pattern, tz_name in _TIMEZONE_ALIAS_PATTERNS:
+        if pattern.search(normalized):
+            return tz_name
+    return DEFAULT_TIMEZONE
+
+def get_local_time(tz_name=None):
+    """Thời gian hiện tại theo múi giờ tz_name, cùng format với câu trả lời realtime cũ"""
+    tz_name = tz_name or DEFAULT_TIMEZONE
+    try:
+        tz = zoneinfo.ZoneInfo(tz_name)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        if tz_name != 'Asia/Ho_Chi_Minh':
+            logger.warning(f"Unknown timezone: {tz_name}")
+            return {'success': False}
+        tz = dt_timezone(timedelta(hours=7))  # không có tzdata: Việt Nam cố định UTC+7
+    
+    now = datetime.fromtimestamp(CLOCK.now(), tz)
+    utc_offset = now.utcoffset() or timedelta(0)
+    offset_minutes = int(utc_offset.total_seconds() // 60)
+    sign = '+' if offset_minutes >= 0 else '-'
+    hours, minutes = divmod(abs(offset_minutes), 60)
+    utc_label = f"UTC{sign}{hours}" + (f":{minutes:02d}" if minutes else "")
+    zone_label = "Việt Nam" if tz_name == 'Asia/Ho_Chi_Minh' else tz_name
+    zone_label = utc_label if tz_name == 'UTC' else f"{zone_label} {utc_label}"
+    
+    time_part = now.strftime('%H:%M:%S')
+    date_part = now.strftime('%d/%m/%Y')
+    day_name = DAYS_VI[now.weekday()]
+    return {
+        'success': True,
+        'time': time_part,
+        'date': date_part,
+        'day_name': day_name,
+        'timezone': tz_name,
+        'formatted': f"Hiện tại là **{time_part}**, {day_name}, ngày {date_part} (múi giờ {zone_label})."
+    }
+
+# ===========================================
+# SHARED REQUEST/RESPONSE HELPERS
+# Dùng chung cho threaded handler và asyncio server để hai chế độ luôn trả về cùng kết quả
+# ===========================================
+
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta/models"
+LLM7_CHAT_URL = "https://api.llm7.io/v1/chat/completions"
+VISION_FALLBACK_TEXT = "Đang xử lý hình ảnh..."  # Trả về text trung lập thay vì lỗi kỹ thuật
+
+def get_cors_headers(origin):
+    """Tính CORS headers cho một origin, trả về list (header, value)"""
+    allowed_origins = get_allowed_origins()
+    if "*" in allowed_origins:
+        # For production environments like Render/Replit
+        return [('Access-Control-Allow-Origin', '*')]
+    if origin and origin in allowed_origins:
+        return [('Access-Control-Allow-Origin', origin), ('Vary', 'Origin')]
+    # Fallback to wildcard for production
+    return [('Access-Control-Allow-Origin', '*')]
+
+def get_username_from_cookie_header(cookie_header):
+    """Extract username from the session_id cookie in a Cookie header"""
+    try:
+        if not cookie_header:
+            return None
+
+        cookies = {}
+        for item in cookie_header.split(';'):
+            item = item.strip()
+            if '=' in item:
+                key, value = item.split('=', 1)
+                cookies[key] = value
+
+        session_id = cookies.get('session_id')
+        if session_id:
+            return get_user_from_session(session_id)
+    except Exception as e:
+        logger.debug(f"Error extracting username from cookie: {e}")
+    return None
+
+def gemini_generate_url(model, api_key):
+    """URL generateContent của Gemini cho model và key"""
+    return f"{GEMINI_API_BASE}/{model}:generateContent?key={api_key}"
+
+def gemini_stream_url(model, api_key):
+    """URL streamGenerateContent (Server-Sent Events) của Gemini cho model và key"""
+    return f"{GEMINI_API_BASE}/{model}:streamGenerateContent?alt=sse&key={api_key}"
+
+def iter_sse_events(response):
+    """Đọc stream Server-Sent Events từ upstream, yield (raw_event_bytes, data) cho từng event
+
+    data là nội dung các dòng "data:" của event ghép lại ('' nếu event không có data).
+    Không buffer quá một event để chunk được chuyển tiếp ngay khi upstream gửi.
+    """
+    lines = []
+    for line in response:
+        lines.append(line)
+        if line.strip():
+            continue
+        if len(lines) > 1:
+            yield b''.join(lines), _sse_event_data(lines)
+        lines = []
+    if any(line.strip() for line in lines):
+        yield b''.join(lines) + b'\n', _sse_event_data(lines)
+
+def _sse_event_data(lines):
+    data = [line.decode('utf-8', 'replace').rstrip('\r\n')[5:].lstrip(' ') for line in lines if line.startswith(b'data:')]
+    return '\n'.join(data)
+
+async def aiter_sse_events(response):
+    """Bản async của iter_sse_events cho AsyncStreamResponse (asyncio mode)"""
+    lines = []
+    async for line in response.iter_lines():
+        lines.append(line)
+        if line.strip():
+            continue
+        if len(lines) > 1:
+            yield b''.join(lines), _sse_event_data(lines)
+        lines = []
+    if any(line.strip() for line in lines):
+        yield b''.join(lines) + b'\n', _sse_event_data(lines)
+
+def format_sse_event(data, event=None):
+    """Encode một event SSE (data là dict/list sẽ được JSON encode)"""
+    if not isinstance(data, str):
+        data = json.dumps(data, ensure_ascii=False)
+    lines = [f"event: {event}"] if event else []
+    lines += [f"data: {line}" for line in data.split('\n')]
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+def extract_gemini_text(gemini_data):
+    """Lấy text của candidate đầu tiên trong response Gemini ('' nếu không có)"""
+    candidates = gemini_data.get('candidates') or []
+    if candidates:
+        candidate = candidates[0]
+        if 'content' in candidate and 'parts' in candidate['content']:
+            parts = candidate['content']['parts']
+            if len(parts) > 0:
+                return parts[0].get('text', '')
+    return ''
+
+def is_gemini_stream_final(chunk):
+    """Event cuối của stream Gemini: candidate có finishReason (STOP, MAX_TOKENS, SAFETY...)"""
+    return any(candidate.get('finishReason') for candidate in chunk.get('candidates') or [])
+
+def extract_gemini_prompt_text(payload):
+    """Lấy text của message cuối trong payload Gemini để lưu history"""
+    if 'contents' in payload and isinstance(payload['contents'], list) and len(payload['contents']) > 0:
+        last_content = payload['contents'][-1]
+        if 'parts' in last_content and isinstance(last_content['parts'], list) and len(last_content['parts']) > 0:
+            return last_content['parts'][0].get('text', '')
+    return ''
+
+def extract_llm7_reply(llm7_data):
+    """Lấy nội dung trả lời từ response OpenAI-style của LLM7"""
+    if "choices" in llm7_data and len(llm7_data["choices"]) > 0:
+        return llm7_data["choices"][0]["message"]["content"]
+    return str(llm7_data)
+
+def extract_llm7_delta(chunk):
+    """Lấy phần text của một chunk streaming (chat.completion.chunk) của LLM7"""
+    choices = chunk.get('choices') or []
+    if choices:
+        return (choices[0].get('delta') or {}).get('content') or ''
+    return ''
+
+def build_gemini_chat_payload(messages):
+    """Chuyển messages OpenAI-style (LLM7) sang payload generateContent của Gemini
+
+    Các system message (system prompt, identity reminder) được gộp vào systemInstruction.
+    """
+    system_parts = []
+    contents = []
+    for message in messages:
+        content = message.get('content', '')
+        if isinstance(content, list):
+            content = " ".join(part.get('text', '') for part in content if part.get('type') == 'text')
+        if message.get('role') == 'system':
+            system_parts.append(content)
+            continue
+        role = 'model' if message.get('role') == 'assistant' else 'user'
+        contents.append({"role": role, "parts": [{"text": content}]})
+    payload = {"contents": contents, "generationConfig": {"temperature": 0.7}}
+    if system_parts:
+        payload["systemInstruction"] = {"parts": [{"text": "\n\n".join(system_parts)}]}
+    return payload
+
+def build_chat_provider_call(step, messages, stream=False):
+    """Request cho một bước trong chuỗi failover chat
+
+    Trả về (upstream name, url, headers, body, api_key), hoặc None nếu provider chưa có API key.
+    """
+    provider, model = step["provider"], step["model"]
+    if provider == 'llm7':
+        api_key = API_KEYS.acquire('llm7')
+        if not api_key:
+            return None
+        payload = {"model": model, "messages": messages, "temperature": 0.7}
+        if stream:
+            payload["stream"] = True
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+        return 'llm7', LLM7_CHAT_URL, headers, json.dumps(payload).encode('utf-8'), api_key
+    if provider == 'gemini':
+        api_key = API_KEYS.acquire('gemini')
+        if not api_key or api_key == "your_gemini_api_key_here":
+            return None
+        url = gemini_stream_url(model, api_key) if stream else gemini_generate_url(model, api_key)
+        headers = {'Content-Type': 'application/json'}
+        return 'gemini', url, headers, json.dumps(build_gemini_chat_payload(messages)).encode('utf-8'), api_key
+    raise ValueError(f"Provider không hỗ trợ: {provider}")
+
+def extract_chat_reply(provider, data):
+    """Text trả lời (không stream) của provider trong chuỗi failover"""
+    return extract_gemini_text(data) if provider == 'gemini' else extract_llm7_reply(data)
+
+def extract_chat_delta(provider, data):
+    """Text của một event stream của provider trong chuỗi failover"""
+    return extract_gemini_text(data) if provider == 'gemini' else extract_llm7_delta(data)
+
+def build_chat_chunk(model, text):
+    """Chunk OpenAI-style (chat.completion.chunk) để client đọc stream giống hệt LLM7"""
+    return {
+        "object": "chat.completion.chunk",
+        "model": model,
+        "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]
+    }
+
+class NoChatProviderError(Exception):
+    """Không provider nào trong chuỗi failover của model có API key"""
+
+
+def build_chat_chain_calls(model_id, messages, stream=False):
+    """Các bước (step, call) của chuỗi failover đã có API key; chuỗi rỗng → NoChatProviderError"""
+    calls = []
+    for step in get_model_fallback_chain(model_id):
+        call = build_chat_provider_call(step, messages, stream)
+        if call is not None:
+            calls.append((step, call))
+    if not calls:
+        raise NoChatProviderError("Chưa cấu hình API key cho provider nào (LLM7/Gemini). Vui lòng kiểm tra config.py")
+    return calls
+
+def chat_step_deadline(deadline, index, total):
+    """Deadline cho bước index/total của chuỗi failover
+
+    Bước chưa phải cuối chỉ được phần chia đều của thời gian còn lại (timeout + retry của
+    provider đó không được ăn hết budget), bước cuối dùng toàn bộ phần còn lại.
+    """
+    if index == total - 1:
+        return deadline
+    return Deadline(deadline.remaining() / (total - index))
+
+def is_failover_error(error):
+    """Lỗi của provider cho phép chuyển sang provider tiếp theo: timeout, lỗi kết nối, 5xx, circuit mở"""
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500
+    return isinstance(error, (urllib.error.URLError, TimeoutError, ConnectionError))
+
+def chat_provider_metadata(step, failed_over):
+    """Metadata history ghi provider thực sự đã trả lời"""
+    metadata = {'provider': step["provider"], 'provider_model': step["model"]}
+    if failed_over:
+        metadata['failover_from'] = failed_over
+    return metadata
+
+SEARCH_OPTIMIZER_RESERVE = 10.0  # Giây trong deadline của AI Search phải chừa lại cho Serper + tóm tắt khi chạy optimizer
+FAILOVER_MIN_REMAINING = 2.0  # Còn ít hơn ngần này giây trong deadline thì không failover nữa
+
+def build_gemini_vision_payload(image_data_base64):
+    """Payload Gemini Vision mô tả một ảnh base64 (có hoặc không có data: prefix)"""
+    # Chuẩn bị dữ liệu base64 (bỏ prefix nếu có)
+    base64_data = image_data_base64
+    if ',' in image_data_base64:
+        base64_data = image_data_base64.split(',', 1)[1]
+
+    return {
+        "contents": [{
+            "parts": [
+                {"text": "Hãy mô tả chi tiết nội dung của hình ảnh này bằng tiếng Việt. Nếu có chữ trong ảnh, hãy trích xuất toàn bộ văn bản đó. Trả về kết quả ngắn gọn nhưng đầy đủ thông tin nhất có thể."},
+                {
+                    "inline_data": {
+                        "mime_type": "image/jpeg",
+                        "data": base64_data
+                    }
+                }
+            ]
+        }]
+    }
+
+# IDENTITY GUARDRAIL: tên hiển thị dùng trong reminder chèn trước user message cuối
+IDENTITY_MODEL_NAMES = {
+    'gpt-5-chat': 'GPT-5', 'gpt-4o': 'GPT-4o', 'gpt-4': 'GPT-4',
+    'gpt-5-mini': 'GPT-5 Mini', 'gpt-5-nano-2025-08-07': 'GPT-5 Nano',
+    'gpt-o4-mini-2025-04-16': 'GPT-O4 Mini',
+    'bidara': 'BIDARA', 'deepseek-reasoning': 'DeepSeek Reasoning',
+    'deepseek-v3.1': 'DeepSeek V3.1',
+    'nova-fast': 'Nova Fast', 'gemma-2-2b-it': 'Gemma 2',
+    'qwen2.5-coder-32b-instruct': 'Qwen 2.5 Coder',
+    'mistral-medium-2508': 'Mistral Medium', 'mistral-small-2503': 'Mistral Small',
+    'mistral-small-3.1-24b-instruct-2503': 'Mistral Small 3.1',
+    'open-mixtral-8x7b': 'Mixtral 8x7B', 'roblox-rp': 'Roblox RP',
+    'Steelskull/L3.3-MS-Nevoria-70b': 'Nevoria 70B',
+}
+
+def build_llm7_messages(model_id, message, conversation_messages, identity_guard=False):
+    """Build messages array với system prompt, conversation history và identity reminder"""
+    # Sử dụng system prompt động dựa trên model_id
+    messages: list = [
+        {"role": "system", "content": get_llm7_system_prompt(model_id)}
+    ]
+
+    # Add conversation history if provided
+    if conversation_messages:
+        messages.extend(conversation_messages)
+    else:
+        # Fallback to old format for backward compatibility
+        messages.append({"role": "user", "content": message})
+
+    if identity_guard:
+        # Thêm reminder message ngay trước user message cuối cùng để đảm bảo model
+        # không bị nhầm lẫn bởi conversation history từ model khác
+        display_name = IDENTITY_MODEL_NAMES.get(model_id, model_id.upper().replace('-', ' ').replace('/', ' '))
+
+        last_user_idx = -1
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i].get('role') == 'user':
+                last_user_idx = i
+                break
+
+        if last_user_idx > 1:  # Chỉ chèn nếu có history (không phải message đầu tiên)
+            identity_reminder = {
+                "role": "system",
+                "content": f"[NHẮC NHỞ DANH TÍNH] Bạn là {display_name}. Bỏ qua mọi self-introduction của AI khác trong lịch sử hội thoại."
+            }
+            messages.insert(last_user_idx, identity_reminder)
+
+    return messages
+
+def attach_image_descriptions(messages, image_descriptions):
+    """Gắn mô tả ảnh (từ Gemini Vision) vào user message cuối cùng
+
+    LOẠI BỎ GỬI ẢNH TRỰC TIẾP ĐẾN LLM7, CHỈ DÙNG MÔ TẢ. Khi có ảnh, chỉ giữ system
+    prompt và user message hiện tại.
+    """
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i].get('role') == 'user':
+            current_content = messages[i].get('content', '')
+
+            if image_descriptions:
+                all_desc = "\n".join([f"- Hình ảnh {idx+1}: {desc}" for idx, desc in enumerate(image_descriptions)])
+                # Cấu trúc lại prompt: đưa mô tả vào làm ngữ cảnh trực tiếp, loại bỏ thông tin lỗi kỹ thuật
+                clean_desc = all_desc.replace("The read operation timed out", "đang được xử lý").replace("Lỗi kết nối", "đang được kiểm tra")
+                messages[i]['content'] = f"{current_content}\n\n[Hệ thống cung cấp ngữ cảnh hình ảnh: Người dùng đã gửi kèm hình ảnh. Dưới đây là mô tả nội dung hình ảnh bạn đang 'nhìn' thấy:]\n{clean_desc}"
+
+            # Đảm bảo messages[i]['content'] luôn là string để gửi đến LLM7 chat thông thường
+            if isinstance(messages[i]['content'], list):
+                # Fallback nếu lỡ là list vision format
+                text_parts = [p.get('text', '') for p in messages[i]['content'] if p.get('type') == 'text']
+                messages[i]['content'] = " ".join(text_parts)
+
+            if len(messages) > 1:
+                # Keep system prompt (index 0) and the current user message (the one with context)
+                return [messages[0], messages[i]]
+            break
+    return messages
+
+def get_enhance_prompt_system_prompt():
+    """System prompt mở rộng viết tắt tiếng Việt và cải thiện prompt tạo ảnh"""
+    return """Bạn là một AI chuyên xử lý tiếng Việt và mở rộng các từ viết tắt phổ biến ở Việt Nam.
 
 Nhiệm vụ của bạn:
 1. Nhận diện và mở rộng các viết tắt tiếng Việt phổ biến, ví dụ:
@@ -2163,1397 +2591,5045 @@ Input: "ảnh BV Chợ Rẫy"
 Output: "Image of Cho Ray Hospital in Ho Chi Minh City, Vietnam, modern medical facility"
 
 Hãy xử lý prompt sau:"""
-            
-            # Build Gemini API URL - Gemini 3 Pro
-            gemini_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={gemini_key}"
-            
-            # Prepare Gemini request
-            gemini_payload = {
-                "contents": [{
-                    "parts": [{
-                        "text": f"{system_prompt}\n\n{user_prompt}"
-                    }]
-                }],
-                "generationConfig": {
-                    "temperature": 0.3,  # Lower temperature for more consistent expansion
-                    "topK": 20,
-                    "topP": 0.8,
-                    "maxOutputTokens": 500,
-                }
-            }
-            
-            gemini_request = urllib.request.Request(
-                gemini_url,
-                data=json.dumps(gemini_payload).encode('utf-8'),
-                headers={'Content-Type': 'application/json'}
-            )
-            
-            with urllib.request.urlopen(gemini_request, timeout=REQUEST_TIMEOUT) as response:
-                gemini_response = response.read().decode('utf-8')
-                gemini_data = json.loads(gemini_response)
-            
-            # Extract enhanced prompt
-            enhanced_prompt = ""
-            if "candidates" in gemini_data and len(gemini_data["candidates"]) > 0:
-                candidate = gemini_data["candidates"][0]
-                if "content" in candidate and "parts" in candidate["content"]:
-                    enhanced_prompt = candidate["content"]["parts"][0].get("text", "")
-            
-            if not enhanced_prompt:
-                enhanced_prompt = user_prompt  # Fallback to original
-            
-            # Return response to client
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps({
-                "original_prompt": user_prompt,
-                "enhanced_prompt": enhanced_prompt.strip(),
-                "success": True
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-            logger.info(f"Prompt enhanced: '{user_prompt}' -> '{enhanced_prompt.strip()}'")
-            
-        except urllib.error.HTTPError as e:
-            try:
-                error_body = e.read().decode('utf-8')
-                self._send_json_error(e.code, f"Gemini API lỗi: {error_body}", "UPSTREAM_ERROR")
-            except:
-                self._send_json_error(e.code, f"Gemini API lỗi: {e.reason}", "UPSTREAM_ERROR")
-        except urllib.error.URLError as e:
-            logger.error(f"Gemini connection error: {e}")
-            self._send_json_error(502, "Không thể kết nối đến Gemini API", "CONNECTION_ERROR")
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in enhance prompt request: {e}")
-            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
-        except Exception as e:
-            logger.error(f"Enhance prompt error: {e}")
-            logger.error(f"Exception type: {type(e)}")
-            logger.error(f"Exception args: {e.args}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
 
-    def handle_pollinations_generate(self):
-        """Generate image using Pollinations AI (Flux model) - Free, no API key required"""
-        try:
-            # Read request body
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
-            
-            # Extract parameters
-            prompt = request_data.get('prompt', '')
-            
-            if not prompt:
-                self._send_json_error(400, "Prompt không được để trống", "MISSING_PROMPT")
-                return
-            
-            # Validate prompt length (prevent oversized payloads)
-            if len(prompt) > 5000:
-                self._send_json_error(400, "Prompt quá dài. Vui lòng giới hạn trong 5000 ký tự.", "PROMPT_TOO_LONG")
-                return
-            
-            # Build Pollinations AI URL with Flux model
-            encoded_prompt = urllib.parse.quote(prompt)
-            pollinations_url = f"https://image.pollinations.ai/prompt/{encoded_prompt}?model=flux&width=1024&height=1024&enhance=true&nologo=true"
-            
-            logger.info(f"🎨 Đang gọi Pollinations AI (Flux) để vẽ: {prompt[:50]}...")
+def build_enhance_prompt_payload(user_prompt):
+    """Payload Gemini cho /api/enhance-prompt"""
+    return {
+        "contents": [{
+            "parts": [{
+                "text": f"{get_enhance_prompt_system_prompt()}\n\n{user_prompt}"
+            }]
+        }],
+        "generationConfig": {
+            "temperature": 0.3,  # Lower temperature for more consistent expansion
+            "topK": 20,
+            "topP": 0.8,
+            "maxOutputTokens": 500,
+        }
+    }
+
+def build_pollinations_url(prompt):
+    """Pollinations AI URL với Flux model"""
+    encoded_prompt = urllib.parse.quote(prompt)
+    return f"https://image.pollinations.ai/prompt/{encoded_prompt}?model=flux&width=1024&height=1024&enhance=true&nologo=true"
+
+# ===========================================
+# REQUEST BODY READER
+# Đọc body theo từng chunk vào buffer cấp phát một lần, từ chối sớm khi vượt giới hạn của route
+# ===========================================
+
+REQUEST_BODY_CHUNK = 64 * 1024
+
+class ClientDisconnectedError(Exception):
+    """Client đóng kết nối khi server đang stream response"""
+
+
+class RequestBodyError(Exception):
+    """Body request không hợp lệ; mang sẵn status + error code trả về client"""
+
+    def __init__(self, status_code, message, error_code):
+        super().__init__(message)
+        self.status_code = status_code
+        self.error_code = error_code
+
+def parse_content_length(headers, max_body):
+    """Validate Content-Length trước khi đọc body; None nếu request dùng chunked"""
+    if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        return None
+    content_length = headers.get('Content-Length')
+    if content_length is None:
+        raise RequestBodyError(411, "Thiếu Content-Length", "LENGTH_REQUIRED")
+    try:
+        content_length = int(content_length)
+    except ValueError:
+        content_length = -1
+    if content_length < 0:
+        raise RequestBodyError(400, "Content-Length không hợp lệ", "INVALID_CONTENT_LENGTH")
+    if content_length > max_body:
+        raise RequestBodyError(413, f"Dữ liệu gửi lên quá lớn (tối đa {max_body} bytes)", "PAYLOAD_TOO_LARGE")
+    return content_length
+
+def read_request_body(rfile, headers, max_body, spool_threshold=None):
+    """Đọc request body (Content-Length hoặc chunked) với giới hạn max_body
+
+    Trả về bytearray: json.loads đọc trực tiếp được, không cần decode/copy thêm.
+    Body lớn hơn spool_threshold (mặc định REQUEST_BODY_SPOOL_THRESHOLD) được đọc dần vào
+    SpooledTemporaryFile (đã seek(0)): lúc nhận, RAM mỗi request chỉ tốn tới ngưỡng này.
+    """
+    if spool_threshold is None:
+        spool_threshold = get_request_body_spool_threshold()
+    content_length = parse_content_length(headers, max_body)
+    if content_length is None:
+        return _read_chunked_request_body(rfile, max_body, spool_threshold)
+    if content_length > spool_threshold:
+        body = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+        _read_body_into(rfile, body, content_length)
+        body.seek(0)
+        return body
+    
+    body = bytearray(content_length)
+    view = memoryview(body)
+    received = 0
+    while received < content_length:
+        count = rfile.readinto(view[received:received + REQUEST_BODY_CHUNK])
+        if not count:
+            raise RequestBodyError(400, "Request body bị ngắt giữa chừng", "INCOMPLETE_BODY")
+        received += count
+    return body
+
+def _read_body_into(rfile, sink, size):
+    """Đọc đúng size bytes vào sink (bytearray hoặc file) theo từng phần REQUEST_BODY_CHUNK"""
+    write = sink.extend if isinstance(sink, bytearray) else sink.write
+    while size:
+        chunk = rfile.read(min(size, REQUEST_BODY_CHUNK))
+        if not chunk:
+            raise RequestBodyError(400, "Request body bị ngắt giữa chừng", "INCOMPLETE_BODY")
+        write(chunk)
+        size -= len(chunk)
+
+def _read_chunked_request_body(rfile, max_body, spool_threshold):
+    body = bytearray()
+    received = 0
+    while True:
+        size_line = rfile.readline(1024)
+        try:
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            raise RequestBodyError(400, "Chunked body không hợp lệ", "INVALID_CHUNK")
+        if size == 0:
+            # Bỏ qua trailers
+            while rfile.readline(1024) not in (b'\r\n', b'\n', b''):
+                pass
+            if not isinstance(body, bytearray):
+                body.seek(0)
+            return body
+        received += size
+        if received > max_body:
+            raise RequestBodyError(413, f"Dữ liệu gửi lên quá lớn (tối đa {max_body} bytes)", "PAYLOAD_TOO_LARGE")
+        if isinstance(body, bytearray) and received > spool_threshold:
+            spool = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+            spool.write(body)
+            body = spool
+        _read_body_into(rfile, body, size)
+        rfile.readline(1024)  # CRLF sau mỗi chunk
+
+def validate_request_files(files):
+    """Kiểm tra file đính kèm (base64) trước khi gửi Gemini Vision
+
+    Trả về (status, message, code) nếu không hợp lệ, None nếu OK. Kích thước được tính
+    từ độ dài chuỗi base64 nên không cần decode file.
+    """
+    if not isinstance(files, list):
+        return 400, "Trường files phải là danh sách", "INVALID_FILES"
+    for file in files:
+        if not isinstance(file, dict):
+            return 400, "Trường files phải là danh sách", "INVALID_FILES"
+        data = file.get('base64') or ''
+        if not isinstance(data, str):
+            return 400, "Dữ liệu file không hợp lệ", "INVALID_FILES"
+        start = data.find(',') + 1  # bỏ data:...;base64, prefix
+        decoded_size = (len(data) - start) * 3 // 4
+        if decoded_size > MAX_FILE_SIZE:
+            name = file.get('name', 'file')
+            return 413, f"File '{name}' vượt quá {MAX_FILE_SIZE // (1024 * 1024)}MB", "FILE_TOO_LARGE"
+    return None
+
+# ===========================================
+# STATIC FILES
+# File tĩnh giữ trong bộ nhớ kèm ETag/Last-Modified; _send_static_file trả 304 khi client còn bản đúng
+# ===========================================
+
+STATIC_CACHE = TTLCache('static', **get_cache_settings('static'))
+
+def load_static_file(file_path):
+    """Nội dung + validator (ETag mạnh theo sha256 nội dung, Last-Modified) của một file tĩnh
+
+    Giữ trong STATIC_CACHE, đọc lại từ đĩa khi mtime hoặc size của file thay đổi.
+    Raise FileNotFoundError / IsADirectoryError như open().
+    """
+    st = os.stat(file_path)
+    entry = STATIC_CACHE.get(file_path)
+    if entry is not None and entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size:
+        return entry
+    with open(file_path, 'rb') as file:
+        st = os.fstat(file.fileno())
+        content = file.read()
+    entry = {
+        "content": content,
+        "etag": f'"{hashlib.sha256(content).hexdigest()[:32]}"',
+        "last_modified": email.utils.formatdate(st.st_mtime, usegmt=True),
+        "mtime": int(st.st_mtime),
+        "mtime_ns": st.st_mtime_ns,
+        "size": st.st_size,
+    }
+    STATIC_CACHE.set(file_path, entry, size=len(content))
+    return entry
+
+def is_not_modified(headers, entry):
+    """Request có điều kiện (If-None-Match, hoặc If-Modified-Since nếu không có) mà bản client đang giữ vẫn đúng"""
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or entry["etag"] in tags
+    if_modified_since = headers.get('If-Modified-Since')
+    if not if_modified_since:
+        return False
+    try:
+        since = email.utils.parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=dt_timezone.utc)
+    return entry["mtime"] <= since.timestamp()
+
+# ===========================================
+# ROUTE REGISTRY
+# (method, path) → handler tra cứu O(1); route có path param ({name}) được match bằng regex biên dịch sẵn
+# ===========================================
+
+AI_MAX_BODY = MAX_FILE_SIZE * 2   # base64 file đính kèm + JSON overhead
+API_MAX_BODY = 64 * 1024          # auth/admin/search: chỉ là JSON nhỏ
+
+class Route:
+    """Một endpoint: handler + metadata (auth, giới hạn body, timeout class) + counters"""
+
+    def __init__(self, method, pattern, handler_name, auth=None, max_body=API_MAX_BODY, timeout_class="default"):
+        self.method = method
+        self.pattern = pattern
+        self.handler_name = handler_name
+        self.auth = auth  # None hoặc "session" (yêu cầu cookie đăng nhập hợp lệ)
+        self.max_body = max_body
+        self.timeout_class = timeout_class
+        self.hits = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.status_counts = {}
+
+    @property
+    def timeout(self):
+        return get_route_timeout(self.timeout_class)
+
+    def to_dict(self):
+        return {
+            "method": self.method,
+            "path": self.pattern,
+            "handler": self.handler_name,
+            "auth": self.auth,
+            "max_body": self.max_body,
+            "timeout_class": self.timeout_class,
+            "hits": self.hits,
+            "errors": self.errors,
+            "avg_latency_ms": round(self.total_latency / self.hits * 1000, 2) if self.hits else 0,
+            "max_latency_ms": round(self.max_latency * 1000, 2),
+            "status_counts": dict(self.status_counts)
+        }
+
+
+class Router:
+    """Route registry cho do_GET/do_POST"""
+
+    PARAM_PATTERN = re.compile(r"\{(\w+)\}")
+
+    def __init__(self):
+        self._static = {}    # (method, path) -> Route
+        self._dynamic = []   # (method, compiled regex, Route)
+        self._lock = threading.Lock()
+
+    def add(self, method, pattern, handler_name, **options):
+        route = Route(method, pattern, handler_name, **options)
+        if self.PARAM_PATTERN.search(pattern):
+            # split() xen kẽ phần literal và tên param: "/a/{id}/b" → ["/a/", "id", "/b"]
+            parts = self.PARAM_PATTERN.split(pattern)
+            regex = "^" + "".join(
+                re.escape(part) if i % 2 == 0 else f"(?P<{part}>[^/]+)"
+                for i, part in enumerate(parts)
+            ) + "$"
+            self._dynamic.append((method, re.compile(regex), route))
+        else:
+            key = (method, pattern)
+            if key in self._static:
+                raise ValueError(f"Route đã tồn tại: {method} {pattern}")
+            self._static[key] = route
+        return route
+
+    def match(self, method, path):
+        """Trả về (route, path_params) hoặc (None, None); bỏ qua query string"""
+        path = path.split('?', 1)[0]
+        route = self._static.get((method, path))
+        if route:
+            return route, {}
+        for route_method, regex, route in self._dynamic:
+            if route_method == method:
+                match = regex.match(path)
+                if match:
+                    return route, {name: unquote(value) for name, value in match.groupdict().items()}
+        return None, None
+
+    def record(self, route, status_code, latency):
+        with self._lock:
+            route.hits += 1
+            if status_code is None or status_code >= 500:
+                route.errors += 1
+            route.total_latency += latency
+            route.max_latency = max(route.max_latency, latency)
+            status_key = str(status_code) if status_code else "none"
+            route.status_counts[status_key] = route.status_counts.get(status_key, 0) + 1
+
+    def routes(self):
+        return list(self._static.values()) + [route for _, _, route in self._dynamic]
+
+    def get_stats(self):
+        with self._lock:
+            return [route.to_dict() for route in self.routes()]
+
+
+ROUTER = Router()
+
+# AI proxy (body lớn vì có thể kèm file base64, chờ upstream lâu)
+ROUTER.add('POST', '/api/gemini', 'handle_gemini_proxy', max_body=AI_MAX_BODY, timeout_class='slow')
+ROUTER.add('POST', '/api/gemini/stream', 'handle_gemini_stream', max_body=AI_MAX_BODY, timeout_class='slow')
+ROUTER.add('POST', '/api/llm7/gpt-5-chat', 'handle_llm7_gpt5chat', max_body=AI_MAX_BODY, timeout_class='slow')
+ROUTER.add('POST', '/api/llm7/gemini-search', 'handle_llm7_gemini_search', timeout_class='slow')
+ROUTER.add('POST', '/api/llm7/chat', 'handle_llm7_chat', max_body=AI_MAX_BODY, timeout_class='slow')
+ROUTER.add('POST', '/api/enhance-prompt', 'handle_enhance_prompt', timeout_class='slow')
+ROUTER.add('POST', '/api/pollinations/generate', 'handle_pollinations_generate', timeout_class='slow')
+
+# Search
+ROUTER.add('POST', '/api/search', 'handle_serpapi_search')
+ROUTER.add('POST', '/api/serpapi', 'handle_serpapi_search')
+ROUTER.add('POST', '/api/duckduckgo', 'handle_serpapi_search')
+ROUTER.add('POST', '/api/search-with-ai', 'handle_search_with_ai', timeout_class='slow')
+
+# Auth
+ROUTER.add('POST', '/api/auth/signup', 'handle_auth_signup', timeout_class='fast')
+ROUTER.add('POST', '/api/auth/login', 'handle_auth_login', timeout_class='fast')
+ROUTER.add('POST', '/api/auth/logout', 'handle_auth_logout', timeout_class='fast')
+ROUTER.add('GET', '/api/auth/check-session', 'handle_auth_check_session', timeout_class='fast')
+ROUTER.add('GET', '/api/auth/github/status', 'handle_github_oauth_status', timeout_class='fast')
+ROUTER.add('GET', '/auth/github', 'handle_github_oauth_start', timeout_class='fast')
+ROUTER.add('GET', '/auth/github/callback', 'handle_github_oauth_callback')
+
+# Admin
+ROUTER.add('GET', '/api/admin/users', 'handle_admin_get_users', timeout_class='fast')
+ROUTER.add('GET', '/api/admin/sessions', 'handle_admin_get_sessions', timeout_class='fast')
+ROUTER.add('GET', '/api/admin/stats', 'handle_admin_get_stats', timeout_class='fast')
+ROUTER.add('GET', '/api/admin/rate-limits', 'handle_admin_get_rate_limits', timeout_class='fast')
+ROUTER.add('GET', '/api/admin/logs', 'handle_admin_logs', timeout_class='fast')
+ROUTER.add('GET', '/api/admin/history', 'handle_admin_history', timeout_class='fast')
+ROUTER.add('GET', '/api/admin/usage', 'handle_admin_usage', timeout_class='fast')
+ROUTER.add('GET', '/api/admin/config', 'handle_admin_config', timeout_class='fast')
+ROUTER.add('GET', '/api/admin/routes', 'handle_admin_routes', timeout_class='fast')
+ROUTER.add('GET', '/api/admin/upstream', 'handle_admin_upstream', timeout_class='fast')
+ROUTER.add('GET', '/api/admin/circuits', 'handle_admin_circuits', timeout_class='fast')
+ROUTER.add('POST', '/api/admin/users/delete', 'handle_admin_delete_user', timeout_class='fast')
+ROUTER.add('POST', '/api/admin/sessions/delete', 'handle_admin_delete_session', timeout_class='fast')
+ROUTER.add('POST', '/api/admin/rate-limits/clear', 'handle_admin_clear_rate_limit', timeout_class='fast')
+ROUTER.add('POST', '/api/admin/config/update', 'handle_admin_config_update', timeout_class='fast')
+ROUTER.add('POST', '/api/admin/circuits/reset', 'handle_admin_circuit_reset', timeout_class='fast')
+
+# Health check
+ROUTER.add('GET', '/ping', 'handle_ping', timeout_class='fast')
+
+class NexoraXHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Custom HTTP request handler for NexoraX AI application"""
+    
+    # HTTP/1.1: kết nối được giữ lại giữa các request khi response có Content-Length
+    protocol_version = "HTTP/1.1"
+    
+    # Trạng thái framing của request/response hiện tại (reset trong handle_one_request)
+    _requests_on_connection = 0
+    _request_body = None
+    _body_consumed = False
+    _response_framed = False
+    _response_status = None
+    
+    # Route đang xử lý (set bởi _dispatch_route)
+    route = None
+    path_params = {}
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=os.getcwd(), **kwargs)
+    
+    def handle(self):
+        """Keep-alive loop: chờ request tiếp theo tối đa KEEPALIVE_IDLE_TIMEOUT giây
+
+        Trong lúc xử lý request, socket luôn có read timeout (timeout của route, hoặc
+        timeout "default" với request không qua route như file tĩnh) để client gửi dở
+        không giữ worker mãi.
+        """
+        idle_timeout, _ = get_keepalive_settings()
+        read_timeout = get_route_timeout('default')
+        self.close_connection = True
+        self.connection.settimeout(read_timeout)
+        self.handle_one_request()
+        while not self.close_connection:
+            try:
+                self.connection.settimeout(idle_timeout)
+                # peek chặn tới khi client gửi request mới, đóng kết nối hoặc hết idle timeout
+                if not self.rfile.peek(1):
+                    break
+                self.connection.settimeout(read_timeout)
+            except OSError:
+                break
+            self.handle_one_request()
+    
+    def handle_one_request(self):
+        self._request_body = None
+        self._body_consumed = False
+        self._response_framed = False
+        self._response_status = None
+        self._requests_on_connection += 1
+        try:
+            super().handle_one_request()
+        finally:
+            if not isinstance(self._request_body, (bytearray, type(None))):
+                self._request_body.close()  # file tạm của body đã spool
+    
+    def send_response(self, code, message=None):
+        self._response_framed = False
+        self._response_status = code
+        super().send_response(code, message)
+    
+    def send_header(self, keyword, value):
+        if keyword.lower() in ('content-length', 'transfer-encoding'):
+            self._response_framed = True
+        super().send_header(keyword, value)
+    
+    def end_headers(self):
+        """Quyết định giữ hay đóng kết nối trước khi gửi header"""
+        if not self.close_connection and self._should_close_connection():
+            self.send_header('Connection', 'close')
+        super().end_headers()
+    
+    def _should_close_connection(self):
+        idle_timeout, max_requests = get_keepalive_settings()
+        if idle_timeout <= 0 or self._requests_on_connection >= max_requests:
+            return True
+        # Response không có Content-Length/chunked: client chỉ biết hết body khi đóng kết nối
+        status = self._response_status or 200
+        has_body = status >= 200 and status not in (204, 304) and self.command != 'HEAD'
+        if has_body and not self._response_framed:
+            return True
+        # Body request chưa đọc sẽ bị hiểu nhầm thành request tiếp theo
+        if not self._body_consumed:
+            if self.headers.get('Transfer-Encoding'):
+                return True
+            try:
+                if int(self.headers.get('Content-Length', 0) or 0) != 0:
+                    return True
+            except ValueError:
+                return True  # Content-Length hỏng: không biết body kết thúc ở đâu
+        # Worker pool đang có kết nối chờ: nhường worker thay vì giữ kết nối idle
+        is_saturated = getattr(self.server, 'is_saturated', None)
+        return bool(is_saturated and is_saturated())
+    
+    def _read_request_body(self):
+        """Request body đã được _dispatch_route đọc sẵn (giới hạn theo route)"""
+        if self._request_body is None:
+            self._request_body = read_request_body(self.rfile, self.headers, API_MAX_BODY)
+            self._body_consumed = True
+        return self._request_body
+    
+    def _read_json_body(self):
+        """Parse JSON body trực tiếp từ bytes (body lớn đã spool ra file tạm thì đọc lại từ file)"""
+        body = self._read_request_body()
+        if not isinstance(body, bytearray):
+            body.seek(0)
+            body = body.read()
+        return json.loads(body)
+    
+    def _is_origin_allowed(self, origin):
+        """Check if origin is in secure allowed list"""
+        if not origin:
+            return True  # Allow requests without origin (server-to-server)
+        allowed_origins = get_allowed_origins()
+        # If allowed origins contains "*", allow all
+        if "*" in allowed_origins:
+            return True
+        return origin in allowed_origins
+    
+    def _send_cors_headers(self, origin=None):
+        """Send appropriate CORS headers securely"""
+        origin = origin or self.headers.get('Origin', '')
+        for header, value in get_cors_headers(origin):
+            self.send_header(header, value)
+    
+    def _send_json_response(self, status_code, data, headers=None):
+        """Send JSON response with Content-Length and proper CORS"""
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self._send_cors_headers()
+        for header, value in headers or ():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _send_json_error(self, status_code, error_message, error_code):
+        """Send JSON error response with proper CORS"""
+        self._send_json_response(status_code, {
+            "error": error_message,
+            "code": error_code
+        })
+    
+    def _send_circuit_open(self, error):
+        """503 khi circuit breaker của upstream đang mở (fail-fast, không gọi upstream)"""
+        logger.warning(f"Circuit '{error.name}' open, rejecting {self.path}")
+        self._send_json_response(503, {
+            "error": f"Dịch vụ {error.name} đang tạm thời gián đoạn. Vui lòng thử lại sau {error.retry_after} giây.",
+            "code": "CIRCUIT_OPEN",
+            "retry_after": error.retry_after
+        }, headers=[('Retry-After', str(error.retry_after))])
+    
+    def _start_event_stream(self):
+        """Gửi header cho response Server-Sent Events (chunked để vẫn giữ được keep-alive)"""
+        self._stream_chunked = self.request_version == 'HTTP/1.1'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')  # reverse proxy (Render/nginx) không được buffer SSE
+        if self._stream_chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self._send_cors_headers()
+        self.end_headers()
+    
+    def _write_stream(self, data):
+        """Ghi ngay một phần body của event stream xuống client"""
+        if not data:
+            return
+        if self._stream_chunked:
+            data = b'%X\r\n%s\r\n' % (len(data), data)
+        try:
+            self.wfile.write(data)
+            self.wfile.flush()
+        except OSError as e:
+            self.close_connection = True
+            raise ClientDisconnectedError(str(e)) from e
+    
+    def _send_sse_event(self, data, event=None):
+        """Gửi một event SSE (data là dict/list sẽ được JSON encode)"""
+        self._write_stream(format_sse_event(data, event))
+    
+    def _end_event_stream(self):
+        if self._stream_chunked:
+            self._stream_chunked = False
+            self._write_stream(b'0\r\n\r\n')
+    
+    def _send_redirect(self, location):
+        """Send 302 redirect (body rỗng, vẫn giữ được keep-alive)"""
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def _get_username_from_cookie(self):
+        """Extract username from session cookie"""
+        return get_username_from_cookie_header(self.headers.get('Cookie', ''))
+    
+    def get_gemini_vision_description(self, image_data_base64):
+        """
+        Sử dụng Gemini 2.5 Flash để mô tả hình ảnh trước khi gửi cho các model khác.
+        Đây là model độc lập, không ảnh hưởng đến Gemini chính trên web.
+        Mô tả được cache theo sha256 của ảnh: hỏi tiếp về cùng ảnh không gọi lại Vision.
+        """
+        try:
+            cache_key = vision_cache_key(image_data_base64)
+            description = get_cached_vision_description(cache_key)
+            if description is not None:
+                logger.info(f"Gemini Vision cache hit ({cache_key[:12]})")
+                return description
             
-            # Call Pollinations API - it returns the image directly
-            pollinations_request = urllib.request.Request(
-                pollinations_url,
-                headers={
-                    'User-Agent': 'NexoraX-AI/1.0'
-                }
+            api_key = API_KEYS.acquire('gemini')
+            if not api_key:
+                return "Không có API Key cho Gemini Vision."
+
+            url = gemini_generate_url('gemini-2.5-flash', api_key)
+            payload = build_gemini_vision_payload(image_data_base64)
+
+            req = urllib.request.Request(
+                url,
+                data=json.dumps(payload).encode('utf-8'),
+                headers={'Content-Type': 'application/json'}
             )
             
-            with urllib.request.urlopen(pollinations_request, timeout=120) as response:
-                # Get the final URL after redirects (this is the actual image URL)
-                final_url = response.geturl()
+            # Tăng timeout lên 60 giây để tránh lỗi "The read operation timed out"
+            with upstream_call('gemini_vision', req, api_key=api_key) as response:
+                result = json.loads(response.read().decode('utf-8'))
+                description = extract_gemini_text(result)
+                if description:
+                    store_vision_description(cache_key, description)
+                    return description
+            return VISION_FALLBACK_TEXT
+        except Exception as e:
+            logger.error(f"Gemini Vision Error: {e}")
+            return VISION_FALLBACK_TEXT
+
+    def do_POST(self):
+        """Handle POST requests for API proxy"""
+        sync_shared_state()
+        if not self._dispatch_route('POST'):
+            self._send_json_error(404, "API endpoint không tồn tại", "NOT_FOUND")
+
+    def _dispatch_route(self, method):
+        """Gọi handler của route khớp (method, path); trả về False nếu không có route"""
+        route, path_params = ROUTER.match(method, self.path)
+        if route is None:
+            return False
+        
+        self.route = route
+        self.path_params = path_params
+        connection = getattr(self, 'connection', None)  # None khi chạy qua asyncio bridge
+        if connection is not None:
+            connection.settimeout(route.timeout)
+        start_time = time.time()
+        try:
+            body_error = None
+            if method == 'POST':
+                # Đọc body trước khi vào handler: request sai/quá lớn bị từ chối trước khi tốn tài nguyên
+                try:
+                    self._request_body = read_request_body(self.rfile, self.headers, route.max_body)
+                    self._body_consumed = True
+                except RequestBodyError as e:
+                    body_error = e
+                    self.close_connection = True  # phần body còn lại trên socket không còn đọc được
+            
+            if body_error:
+                self._send_json_error(body_error.status_code, str(body_error), body_error.error_code)
+            elif route.auth == 'session' and not self._get_username_from_cookie():
+                self._send_json_error(401, "Vui lòng đăng nhập để sử dụng chức năng này", "UNAUTHORIZED")
+            else:
+                getattr(self, route.handler_name)()
+        finally:
+            ROUTER.record(route, self._response_status, time.time() - start_time)
+            if connection is not None:
+                connection.settimeout(get_route_timeout('default'))
+        return True
+
+    def handle_gemini_proxy(self):
+        """Proxy requests to Gemini API using server-side API key"""
+        try:
+            # Get username from session cookie
+            username = self._get_username_from_cookie()
+            
+            # Get API key from config hoặc environment
+            api_key = API_KEYS.acquire('gemini')
+            logger.info(f"API Key configured: {'Yes' if api_key and api_key != 'your_gemini_api_key_here' else 'No'}")
+            if not api_key or api_key == "your_gemini_api_key_here":
+                self._send_json_error(500, 
+                    "API key chưa được cấu hình. Vui lòng thêm GEMINI_API_KEY vào environment variables.",
+                    "API_KEY_MISSING")
+                return
+            
+            # Read request body
+            request_data = self._read_json_body()
+            
+            # Extract model from request
+            model = request_data.get('model', 'gemini-2.5-flash')
+            
+            # Build Gemini API URL
+            gemini_url = gemini_generate_url(model, api_key)
+            
+            # Get payload - supports both old and new format
+            payload = request_data.get('payload', {})
+            
+            # Extract prompt for history tracking
+            prompt_text = extract_gemini_prompt_text(payload)
+            
+            # The payload now contains the full conversation history in 'contents' array
+            # No need to modify - frontend already sends it in correct format
+            
+            # Câu hỏi 1 lượt giống hệt câu đã trả lời gần đây → dùng lại response đã cache
+            cache_key = response_cache_key(request_data, self.headers, model, payload.get('contents', []), payload)
+            gemini_response = RESPONSE_CACHE.get(cache_key) if cache_key else None
+            cached = gemini_response is not None
+            if cached:
+                logger.info(f"{model} response cache hit")
+            else:
+                # Prepare request for Gemini API
+                gemini_request = urllib.request.Request(
+                    gemini_url,
+                    data=json.dumps(payload).encode('utf-8'),
+                    headers={'Content-Type': 'application/json'}
+                )
                 
-                # Return response with image URL
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self._send_cors_headers()
-                self.end_headers()
+                # Make request to Gemini API with timeout
+                with upstream_call('gemini', gemini_request, api_key=api_key) as response:
+                    gemini_response = response.read()
+            
+            # Extract response text for history tracking
+            try:
+                response_data = json.loads(gemini_response.decode('utf-8'))
+                response_text = extract_gemini_text(response_data)
+                if cache_key and response_text and not cached:
+                    RESPONSE_CACHE.set(cache_key, gemini_response)
                 
-                response_json = json.dumps({
-                    "success": True,
-                    "image_url": final_url,
-                    "prompt": prompt,
-                    "model": "pollinations-flux"
-                }, ensure_ascii=False)
-                self.wfile.write(response_json.encode('utf-8'))
+                # Save AI history
+                metadata = {'endpoint': 'gemini_proxy'}
+                if cached:
+                    metadata['cached'] = True
+                save_ai_history(
+                    username=username,
+                    model=model,
+                    prompt=prompt_text,
+                    response=response_text,
+                    metadata=metadata
+                )
+            except Exception as e:
+                logger.debug(f"Error saving Gemini history: {e}")
                 
-                logger.info(f"✅ Ảnh đã tạo thành công với Pollinations AI (Flux)")
-                return
+            # Return response to client
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            # Send secure CORS headers
+            self._send_cors_headers()
+            self.send_header('Content-Length', str(len(gemini_response)))
+            self.end_headers()
+            self.wfile.write(gemini_response)
             
+        except CircuitOpenError as e:
+            self._send_circuit_open(e)
         except urllib.error.HTTPError as e:
+            # Forward exact status and error from Gemini API
             try:
                 error_body = e.read().decode('utf-8')
-                logger.error(f"Pollinations HTTP error: {e.code} - {error_body}")
-                self._send_json_error(e.code, f"Pollinations API lỗi: {error_body}", "UPSTREAM_ERROR")
+                self._send_json_error(e.code, f"Gemini API lỗi: {error_body}", "UPSTREAM_ERROR")
             except:
-                self._send_json_error(e.code, f"Pollinations API lỗi: {e.reason}", "UPSTREAM_ERROR")
+                self._send_json_error(e.code, f"Gemini API lỗi: {e.reason}", "UPSTREAM_ERROR")
         except urllib.error.URLError as e:
-            logger.error(f"Pollinations connection error: {e}")
-            self._send_json_error(502, "Không thể kết nối đến Pollinations API", "CONNECTION_ERROR")
+            logger.error(f"Gemini connection error: {e}")
+            self._send_json_error(502, "Không thể kết nối đến Gemini API", "CONNECTION_ERROR")
         except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in Pollinations request: {e}")
+            logger.error(f"Invalid JSON in request: {e}")
             self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
         except Exception as e:
-            logger.error(f"Pollinations generate error: {e}")
+            logger.error(f"Gemini proxy error: {e}")
             logger.error(f"Exception type: {type(e)}")
             logger.error(f"Exception args: {e.args}")
             self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
 
-    def handle_auth_signup(self):
-        """Handle user signup"""
+
+    def handle_gemini_stream(self):
+        """Streaming proxy: Gemini streamGenerateContent (SSE) → browser
+
+        Body giống /api/gemini. Mỗi event của Gemini được chuyển tiếp nguyên vẹn ngay khi
+        nhận; cuối stream gửi `event: done` (hoặc `event: error` nếu upstream lỗi giữa chừng).
+        """
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
-            
-            username = request_data.get('username', '').strip()
-            password = request_data.get('password', '').strip()
-            
-            if not username or not password:
-                self._send_json_error(400, "Username và password không được để trống", "MISSING_CREDENTIALS")
-                return
+            username = self._get_username_from_cookie()
             
-            valid_username, username_msg = validate_username(username)
-            if not valid_username:
-                self._send_json_error(400, username_msg, "INVALID_USERNAME")
+            api_key = API_KEYS.acquire('gemini')
+            if not api_key or api_key == "your_gemini_api_key_here":
+                self._send_json_error(500, 
+                    "API key chưa được cấu hình. Vui lòng thêm GEMINI_API_KEY vào environment variables.",
+                    "API_KEY_MISSING")
                 return
             
-            valid_password, password_msg = validate_password(password)
-            if not valid_password:
-                self._send_json_error(400, password_msg, "INVALID_PASSWORD")
-                return
+            request_data = self._read_json_body()
+            model = request_data.get('model', 'gemini-2.5-flash')
+            payload = request_data.get('payload', {})
+            prompt_text = extract_gemini_prompt_text(payload)
             
-            if check_user_exists(username):
-                self._send_json_error(400, "Username đã tồn tại", "USERNAME_EXISTS")
-                return
+            gemini_request = urllib.request.Request(
+                gemini_stream_url(model, api_key),
+                data=json.dumps(payload).encode('utf-8'),
+                headers={'Content-Type': 'application/json'}
+            )
+            start_time = time.time()
+            upstream = upstream_call('gemini', gemini_request, stream=True, api_key=api_key)
             
-            if save_user(username, password):
-                remember_me = request_data.get('remember_me', False)
-                session_id = create_session(username, remember_me=remember_me)
-                
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self._send_cors_headers()
-                
-                max_age = (30 * 24 * 3600) if remember_me else (7 * 24 * 3600)
-                cookie_value = f"session_id={session_id}; Path=/; HttpOnly; SameSite=Lax; Max-Age={max_age}"
-                if os.getenv('REPLIT_DOMAIN') or os.getenv('RENDER'):
-                    cookie_value += "; Secure"
-                self.send_header('Set-Cookie', cookie_value)
-                
-                self.end_headers()
-                
-                response_json = json.dumps({
-                    "success": True,
-                    "username": username,
-                    "remember_me": remember_me
-                }, ensure_ascii=False)
-                self.wfile.write(response_json.encode('utf-8'))
-                
-                logger.info(f"User registered successfully: {username}")
-            else:
-                self._send_json_error(500, "Lỗi khi lưu thông tin người dùng", "SAVE_ERROR")
-                
+        except CircuitOpenError as e:
+            self._send_circuit_open(e)
+            return
+        except urllib.error.HTTPError as e:
+            try:
+                error_body = e.read().decode('utf-8')
+                self._send_json_error(e.code, f"Gemini API lỗi: {error_body}", "UPSTREAM_ERROR")
+            except:
+                self._send_json_error(e.code, f"Gemini API lỗi: {e.reason}", "UPSTREAM_ERROR")
+            return
+        except urllib.error.URLError as e:
+            logger.error(f"Gemini stream connection error: {e}")
+            self._send_json_error(502, "Không thể kết nối đến Gemini API", "CONNECTION_ERROR")
+            return
         except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in signup request: {e}")
-            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ", "INVALID_JSON")
+            logger.error(f"Invalid JSON in request: {e}")
+            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
+            return
         except Exception as e:
-            logger.error(f"Signup error: {e}")
+            logger.error(f"Gemini stream error: {e}")
             self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+            return
+        
+        reply, ttft_ms, complete = self._relay_event_stream(
+            'gemini', "Gemini API", upstream, start_time, extract_gemini_text, {"model": model},
+            is_final=is_gemini_stream_final
+        )
+        if reply:
+            metadata = {'endpoint': 'gemini_stream', 'ttft_ms': ttft_ms}
+            if not complete:
+                metadata['incomplete'] = True
+            save_ai_history(
+                username=username,
+                model=model,
+                prompt=prompt_text,
+                response=reply,
+                metadata=metadata
+            )
 
-    def handle_auth_login(self):
-        """Handle user login - tự động tạo tài khoản nếu chưa tồn tại"""
+    def _relay_event_stream(self, name, label, upstream, start_time, extract_text, done_info, end_marker=None, is_final=None, translate=None):
+        """Chuyển tiếp SSE từ upstream xuống client ngay khi nhận từng event
+
+        extract_text lấy phần text từ data (đã parse JSON) của một event để ghép lại câu trả lời.
+        Upstream phải báo kết thúc bằng end_marker (data như "[DONE]" của OpenAI-style stream,
+        không chuyển tiếp) hoặc một event mà is_final(data đã parse) trả về True (vd finishReason
+        của Gemini); stream hết mà chưa thấy event kết thúc được coi là upstream ngắt giữa chừng.
+        translate(text): nếu có, gửi event do hàm này tạo từ text thay vì event gốc của upstream
+        (vd đổi stream Gemini sang chunk OpenAI-style khi failover).
+        Cuối stream luôn gửi `event: done` (kèm done_info) hoặc `event: error`.
+        Trả về (text đã ghép, ttft_ms, complete).
+        """
+        # Từ đây header 200 đã gửi: lỗi chỉ còn báo được qua event "error"
+        self._start_event_stream()
+        text_parts = []
+        ttft = None
+        complete = False
+        try:
+            with upstream:
+                for raw_event, data in iter_sse_events(upstream):
+                    if end_marker is not None and data == end_marker:
+                        complete = True
+                        break
+                    if translate is None:
+                        self._write_stream(raw_event)
+                    if not data:
+                        continue
+                    try:
+                        parsed = json.loads(data)
+                        text = extract_text(parsed)
+                        if is_final is not None and is_final(parsed):
+                            complete = True
+                    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                        continue
+                    if text:
+                        if ttft is None:
+                            ttft = time.time() - start_time
+                            UPSTREAM_METRICS.record_ttft(name, ttft)
+                        text_parts.append(text)
+                        if translate is not None:
+                            self._send_sse_event(translate(text))
+            if not complete:
+                raise ConnectionError("upstream đóng kết nối trước khi stream kết thúc")
+            done_info = dict(done_info, ttft_ms=round(ttft * 1000, 2) if ttft is not None else None)
+            self._send_sse_event(done_info, event="done")
+            self._end_event_stream()
+        except ClientDisconnectedError as e:
+            # Client đóng tab / mất mạng: dừng đọc upstream luôn (kết nối upstream bị đóng, không tốn thêm token)
+            logger.info(f"{label} stream aborted by client: {e}")
+        except Exception as e:
+            logger.error(f"{label} stream interrupted: {e}")
+            try:
+                self._send_sse_event({"error": f"{label} lỗi: {str(e)}", "code": "STREAM_ERROR"}, event="error")
+                self._end_event_stream()
+            except ClientDisconnectedError:
+                pass
+        return ''.join(text_parts), round(ttft * 1000, 2) if ttft is not None else None, complete
+
+    def handle_serpapi_search(self):
+        """Handle SerpAPI search requests"""
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
+            # Get API key from config hoặc environment
+            api_key = API_KEYS.acquire('serpapi')
+            logger.info(f"SerpAPI Key configured: {'Yes' if api_key and api_key != 'your_serpapi_api_key_here' else 'No'}")
+            if not api_key or api_key == "your_serpapi_api_key_here":
+                self._send_json_error(500, 
+                    "SerpAPI key chưa được cấu hình. Vui lòng thêm SERPAPI_API_KEY vào environment variables.",
+                    "API_KEY_MISSING")
+                return
             
-            username = request_data.get('username', '').strip()
-            password = request_data.get('password', '').strip()
+            # Read request body
+            request_data = self._read_json_body()
             
-            if not username or not password:
-                self._send_json_error(400, "Username và password không được để trống", "MISSING_CREDENTIALS")
+            # Extract query from request
+            query = request_data.get('query', '')
+            if not query:
+                self._send_json_error(400, "Query không được để trống", "MISSING_QUERY")
                 return
             
-            valid_username, username_err = validate_username(username)
-            valid_password, password_err = validate_password(password)
+            # Build SerpAPI URL for Google search
+            serpapi_url = "https://serpapi.com/search.json"
+            serpapi_params = {
+                "q": query,
+                "engine": "google",
+                "api_key": api_key,
+                "num": request_data.get('num', 10),  # Number of results
+                "hl": "vi",  # Vietnamese language
+                "gl": "vn"   # Vietnam location
+            }
             
-            if not valid_username:
-                self._send_json_error(400, username_err, "INVALID_USERNAME")
-                return
+            # Build URL with parameters
+            url_params = urllib.parse.urlencode(serpapi_params)
+            full_url = f"{serpapi_url}?{url_params}"
             
-            if not valid_password:
-                self._send_json_error(400, password_err, "INVALID_PASSWORD")
-                return
+            # Make request to SerpAPI with timeout
+            serpapi_request = urllib.request.Request(full_url)
+            with upstream_call('serpapi', serpapi_request, api_key=api_key) as response:
+                serpapi_response = response.read().decode('utf-8')
+                serpapi_data = json.loads(serpapi_response)
             
-            is_limited, limit_message, wait_time = check_rate_limit(username)
-            if is_limited:
-                self._send_json_error(429, limit_message, "RATE_LIMITED")
-                return
+            # Extract useful information from SerpAPI response
+            organic_results = serpapi_data.get('organic_results', [])
+            answer_box = serpapi_data.get('answer_box', {})
+            knowledge_graph = serpapi_data.get('knowledge_graph', {})
             
-            is_new_account = False
+            search_results = {
+                "query": query,
+                "answer": answer_box.get('answer', ''),
+                "snippet": answer_box.get('snippet', ''),
+                "title": answer_box.get('title', ''),
+                "link": answer_box.get('link', ''),
+                "knowledge_graph": knowledge_graph,
+                "organic_results": organic_results[:5],  # Limit to first 5
+                "total_results": serpapi_data.get('search_information', {}).get('total_results', 0)
+            }
             
-            if not check_user_exists(username):
-                if save_user(username, password):
-                    is_new_account = True
-                    logger.info(f"Auto-created new account for: {username}")
-                else:
-                    self._send_json_error(500, "Lỗi khi tạo tài khoản", "CREATE_ERROR")
-                    return
+            # Format the response for better use with Gemini
+            formatted_response = {
+                "search_query": query,
+                "search_results": search_results,
+                "summary": self._format_serpapi_summary(search_results),
+                "timestamp": int(time.time()) if 'time' in globals() else None
+            }
             
-            if authenticate_user(username, password):
-                clear_rate_limit(username)
-                remember_me = request_data.get('remember_me', False)
-                session_id = create_session(username, remember_me=remember_me)
-                
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self._send_cors_headers()
-                
-                max_age = (30 * 24 * 3600) if remember_me else (7 * 24 * 3600)
-                cookie_value = f"session_id={session_id}; Path=/; HttpOnly; SameSite=Lax; Max-Age={max_age}"
-                if os.getenv('REPLIT_DOMAIN') or os.getenv('RENDER'):
-                    cookie_value += "; Secure"
-                self.send_header('Set-Cookie', cookie_value)
-                
-                self.end_headers()
-                
-                response_json = json.dumps({
-                    "success": True,
-                    "username": username,
-                    "remember_me": remember_me,
-                    "is_new_account": is_new_account
-                }, ensure_ascii=False)
-                self.wfile.write(response_json.encode('utf-8'))
-                
-                if is_new_account:
-                    logger.info(f"New user registered and logged in: {username}")
-                else:
-                    logger.info(f"User logged in successfully: {username}")
-            else:
-                attempts = record_failed_attempt(username)
-                remaining = MAX_LOGIN_ATTEMPTS - attempts
-                if remaining > 0:
-                    error_msg = f"Mật khẩu không đúng. Còn {remaining} lần thử"
-                else:
-                    error_msg = "Quá nhiều lần thử. Tài khoản đã bị khóa tạm thời"
-                self._send_json_error(401, error_msg, "INVALID_CREDENTIALS")
-                
+            # Return response to client
+            self._send_json_response(200, formatted_response)
+            
+        except CircuitOpenError as e:
+            self._send_circuit_open(e)
+        except urllib.error.HTTPError as e:
+            try:
+                error_body = e.read().decode('utf-8')
+                self._send_json_error(e.code, f"SerpAPI lỗi: {error_body}", "UPSTREAM_ERROR")
+            except:
+                self._send_json_error(e.code, f"SerpAPI lỗi: {e.reason}", "UPSTREAM_ERROR")
+        except urllib.error.URLError as e:
+            logger.error(f"SerpAPI connection error: {e}")
+            self._send_json_error(502, "Không thể kết nối đến SerpAPI", "CONNECTION_ERROR")
         except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in login request: {e}")
-            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ", "INVALID_JSON")
+            logger.error(f"Invalid JSON in SerpAPI request: {e}")
+            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
         except Exception as e:
-            logger.error(f"Login error: {e}")
+            logger.error(f"SerpAPI search error: {e}")
+            logger.error(f"Exception type: {type(e)}")
+            logger.error(f"Exception args: {e.args}")
             self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+    
+    def _format_serpapi_summary(self, search_results):
+        """Format SerpAPI search results into a readable summary"""
+        summary_parts = []
+        
+        if search_results.get('answer'):
+            summary_parts.append(f"Trả lời: {search_results['answer']}")
+        
+        if search_results.get('snippet'):
+            summary_parts.append(f"Tóm tắt: {search_results['snippet']}")
+        
+        if search_results.get('title'):
+            summary_parts.append(f"Tiêu đề: {search_results['title']}")
+        
+        # Add knowledge graph information
+        knowledge_graph = search_results.get('knowledge_graph', {})
+        if knowledge_graph.get('description'):
+            summary_parts.append(f"Mô tả: {knowledge_graph['description']}")
+        
+        # Add organic results
+        organic_results = search_results.get('organic_results', [])
+        if organic_results:
+            result_texts = []
+            for result in organic_results[:3]:  # First 3 results
+                if result.get('title') and result.get('snippet'):
+                    result_texts.append(f"{result['title']}: {result['snippet'][:100]}...")
+            if result_texts:
+                summary_parts.append(f"Kết quả tìm kiếm:\n" + "\n".join(f"- {text}" for text in result_texts))
+        
+        total_results = search_results.get('total_results', 0)
+        if total_results > 0:
+            summary_parts.append(f"Tổng số kết quả: {total_results:,}")
+        
+        return '\n\n'.join(summary_parts) if summary_parts else "Không tìm thấy thông tin phù hợp."
 
-    def handle_auth_logout(self):
-        """Handle user logout"""
+    def handle_search_with_ai(self):
+        """Handle search requests that combine SerpAPI results with Gemini AI processing"""
         try:
-            session_id = None
-            
-            if 'Cookie' in self.headers:
-                cookies = self.headers['Cookie']
-                for cookie in cookies.split(';'):
-                    if 'session_id=' in cookie:
-                        session_id = cookie.split('session_id=')[1].strip()
-                        break
-            
-            if not session_id:
-                content_length = int(self.headers.get('Content-Length', 0))
-                if content_length > 0:
-                    post_data = self.rfile.read(content_length)
-                    request_data = json.loads(post_data.decode('utf-8'))
-                    session_id = request_data.get('session_id', '').strip()
+            # Get API keys for both Gemini and SerpAPI
+            gemini_key = API_KEYS.acquire('gemini')
+            serpapi_key = API_KEYS.acquire('serpapi')
             
-            if not session_id:
-                self._send_json_error(400, "Session ID không được để trống", "MISSING_SESSION_ID")
+            if not gemini_key or gemini_key == "your_gemini_api_key_here":
+                self._send_json_error(500, 
+                    "Gemini API key chưa được cấu hình. Vui lòng thêm GEMINI_API_KEY vào environment variables.",
+                    "API_KEY_MISSING")
                 return
+                
+            if not serpapi_key or serpapi_key == "your_serpapi_api_key_here":
+                self._send_json_error(500, 
+                    "SerpAPI key chưa được cấu hình. Vui lòng thêm SERPAPI_API_KEY vào environment variables.",
+                    "API_KEY_MISSING")
+                return
+
+            # Read request body
+            request_data = self._read_json_body()
             
-            delete_session(session_id)
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            
-            cookie_value = "session_id=; Path=/; HttpOnly; SameSite=Lax; Max-Age=0"
-            if os.getenv('REPLIT_DOMAIN') or os.getenv('RENDER'):
-                cookie_value += "; Secure"
-            self.send_header('Set-Cookie', cookie_value)
-            
-            self.end_headers()
-            
-            response_json = json.dumps({
-                "success": True,
-                "message": "Đăng xuất thành công"
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-                
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in logout request: {e}")
-            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ", "INVALID_JSON")
-        except Exception as e:
-            logger.error(f"Logout error: {e}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+            # Extract user query
+            user_query = request_data.get('query', '')
+            if not user_query:
+                self._send_json_error(400, "Query không được để trống", "MISSING_QUERY")
+                return
 
-    def handle_github_oauth_status(self):
-        """Kiểm tra xem GitHub OAuth đã được cấu hình chưa"""
-        try:
-            configured = is_github_oauth_configured()
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
+            # Step 1: Search SerpAPI
+            logger.info(f"Starting search for: {user_query}")
+            serpapi_url = "https://serpapi.com/search.json"
+            serpapi_params = {
+                "q": user_query,
+                "engine": "google",
+                "api_key": serpapi_key,
+                "num": 5,
+                "hl": "vi",
+                "gl": "vn"
+            }
             
-            response = json.dumps({
-                "configured": configured
-            })
-            self.wfile.write(response.encode('utf-8'))
-        except Exception as e:
-            logger.error(f"GitHub OAuth status check error: {e}")
-            self._send_json_error(500, "Lỗi kiểm tra cấu hình GitHub OAuth", "SYSTEM_ERROR")
+            url_params = urllib.parse.urlencode(serpapi_params)
+            full_url = f"{serpapi_url}?{url_params}"
+            
+            serpapi_request = urllib.request.Request(full_url)
+            with upstream_call('serpapi', serpapi_request, api_key=serpapi_key) as response:
+                serpapi_response = response.read().decode('utf-8')
+                serpapi_data = json.loads(serpapi_response)
 
-    def handle_github_oauth_start(self):
-        """Khởi tạo GitHub OAuth flow - redirect user đến GitHub"""
-        try:
-            client_id, client_secret = get_github_oauth_credentials()
+            # Format search results for AI processing
+            search_context = self._format_search_context_for_ai(serpapi_data, user_query)
             
-            if not client_id or not client_secret:
-                self.send_response(302)
-                self.send_header('Location', '/?error=github_not_configured')
-                self.end_headers()
-                return
+            # Step 2: Create enhanced prompt for Gemini
+            enhanced_prompt = self._create_search_enhanced_prompt(user_query, search_context)
             
-            state = secrets.token_urlsafe(32)
-            github_oauth_states[state] = {
-                'created_at': time.time(),
-                'expires_at': time.time() + GITHUB_STATE_EXPIRY
-            }
+            # Support conversation history - check if provided
+            conversation_history = request_data.get('conversation_history', [])
             
-            current_time = time.time()
-            expired_states = [s for s, data in github_oauth_states.items() 
-                           if current_time >= data.get('expires_at', 0)]
-            for s in expired_states:
-                del github_oauth_states[s]
+            # Step 3: Send to Gemini 3 Pro
+            gemini_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={gemini_key}"
             
-            replit_domain = os.getenv('REPLIT_DEV_DOMAIN', '') or os.getenv('REPLIT_DOMAIN', '')
-            if replit_domain:
-                callback_url = f"https://{replit_domain}/auth/github/callback"
+            # Build contents array with conversation history + enhanced prompt
+            contents = []
+            if conversation_history:
+                # Use conversation history if provided
+                contents = conversation_history.copy()
+                # Update the last message with enhanced prompt
+                if contents:
+                    contents[-1]["parts"][0]["text"] = enhanced_prompt
             else:
-                callback_url = "http://localhost:5000/auth/github/callback"
+                # Fallback to old format for backward compatibility
+                contents = [{
+                    "parts": [{
+                        "text": enhanced_prompt
+                    }]
+                }]
             
-            github_auth_url = (
-                f"https://github.com/login/oauth/authorize"
-                f"?client_id={client_id}"
-                f"&redirect_uri={urllib.parse.quote(callback_url)}"
-                f"&scope=user:email"
-                f"&state={state}"
+            gemini_payload = {
+                "contents": contents,
+                "generationConfig": {
+                    "temperature": 0.7,
+                    "topK": 40,
+                    "topP": 0.95,
+                    "maxOutputTokens": 8192,
+                },
+                "safetySettings": [
+                    {
+                        "category": "HARM_CATEGORY_HARASSMENT",
+                        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+                    },
+                    {
+                        "category": "HARM_CATEGORY_HATE_SPEECH",
+                        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+                    },
+                    {
+                        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+                        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+                    },
+                    {
+                        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+                        "threshold": "BLOCK_MEDIUM_AND_ABOVE"
+                    }
+                ]
+            }
+            
+            gemini_request = urllib.request.Request(
+                gemini_url,
+                data=json.dumps(gemini_payload).encode('utf-8'),
+                headers={'Content-Type': 'application/json'}
             )
             
-            logger.info(f"Starting GitHub OAuth flow, redirecting to GitHub")
+            with upstream_call('gemini', gemini_request, api_key=gemini_key) as response:
+                gemini_response = response.read().decode('utf-8')
+                gemini_data = json.loads(gemini_response)
+
+            # Format the final response
+            final_response = {
+                "query": user_query,
+                "model": "nexorax2-search",
+                "search_performed": True,
+                "search_results_count": len(serpapi_data.get('organic_results', [])),
+                "ai_response": gemini_data,
+                "search_context": search_context,
+                "timestamp": int(time.time())
+            }
+
+            # Return response to client
+            self._send_json_response(200, final_response)
             
-            self.send_response(302)
-            self.send_header('Location', github_auth_url)
-            self.end_headers()
+            logger.info(f"Search with AI completed for query: {user_query}")
             
+        except CircuitOpenError as e:
+            self._send_circuit_open(e)
+        except urllib.error.HTTPError as e:
+            try:
+                error_body = e.read().decode('utf-8')
+                self._send_json_error(e.code, f"API lỗi: {error_body}", "UPSTREAM_ERROR")
+            except:
+                self._send_json_error(e.code, f"API lỗi: {e.reason}", "UPSTREAM_ERROR")
+        except urllib.error.URLError as e:
+            logger.error(f"Search with AI connection error: {e}")
+            self._send_json_error(502, "Không thể kết nối đến dịch vụ tìm kiếm", "CONNECTION_ERROR")
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON in search with AI request: {e}")
+            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
         except Exception as e:
-            logger.error(f"GitHub OAuth start error: {e}")
-            self.send_response(302)
-            self.send_header('Location', '/?error=github_oauth_failed')
-            self.end_headers()
+            logger.error(f"Search with AI error: {e}")
+            logger.error(f"Exception type: {type(e)}")
+            logger.error(f"Exception args: {e.args}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
 
-    def handle_github_oauth_callback(self):
-        """Xử lý callback từ GitHub sau khi user authorize"""
+    def handle_llm7_gpt5chat(self):
+        """Handle GPT-5-chat requests via LLM7.io"""
         try:
-            from urllib.parse import parse_qs, urlparse
-            parsed = urlparse(self.path)
-            query_params = parse_qs(parsed.query)
-            
-            code = query_params.get('code', [None])[0]
-            state = query_params.get('state', [None])[0]
-            error = query_params.get('error', [None])[0]
-            
-            if error:
-                logger.warning(f"GitHub OAuth error: {error}")
-                self.send_response(302)
-                self.send_header('Location', f'/?error=github_denied&message={error}')
-                self.end_headers()
-                return
+            # Get username from session cookie
+            username = self._get_username_from_cookie()
             
-            if not code or not state:
-                logger.warning("GitHub OAuth callback missing code or state")
-                self.send_response(302)
-                self.send_header('Location', '/?error=github_invalid_callback')
-                self.end_headers()
-                return
+            # Read request body
+            request_data = self._read_json_body()
             
-            if state not in github_oauth_states:
-                logger.warning("GitHub OAuth callback invalid or expired state")
-                self.send_response(302)
-                self.send_header('Location', '/?error=github_invalid_state')
-                self.end_headers()
+            # Extract message from request
+            message = request_data.get('message', '')
+            if not message:
+                self._send_json_error(400, "Message không được để trống", "MISSING_MESSAGE")
                 return
             
-            state_data = github_oauth_states.pop(state)
-            if time.time() >= state_data.get('expires_at', 0):
-                logger.warning("GitHub OAuth callback expired state")
-                self.send_response(302)
-                self.send_header('Location', '/?error=github_expired_state')
-                self.end_headers()
+            # Extract files from request (for vision/image analysis)
+            files = request_data.get('files', [])
+            file_error = validate_request_files(files)
+            if file_error:
+                self._send_json_error(*file_error)
                 return
             
-            client_id, client_secret = get_github_oauth_credentials()
+            # Support conversation history - check if messages array is provided
+            conversation_messages = request_data.get('messages', [])
             
-            token_url = "https://github.com/login/oauth/access_token"
-            token_data = urllib.parse.urlencode({
-                'client_id': client_id,
-                'client_secret': client_secret,
-                'code': code
-            }).encode('utf-8')
+            # Build messages array with system prompt and conversation history
+            messages = build_llm7_messages('gpt-5-chat', message, conversation_messages)
             
-            token_request = urllib.request.Request(
-                token_url,
-                data=token_data,
-                headers={
-                    'Accept': 'application/json',
-                    'Content-Type': 'application/x-www-form-urlencoded'
-                }
-            )
+            # Add files to the last user message if present (for vision models)
+            if files and len(files) > 0:
+                # Get image description from Gemini Vision (Independent processing)
+                image_descriptions = [
+                    self.get_gemini_vision_description(file['base64'])
+                    for file in files if file.get('base64')
+                ]
+                messages = attach_image_descriptions(messages, image_descriptions)
             
-            with urllib.request.urlopen(token_request, timeout=30) as response:
-                token_response = json.loads(response.read().decode('utf-8'))
+            stream = bool(request_data.get('stream'))
             
-            access_token = token_response.get('access_token')
-            if not access_token:
-                error_desc = token_response.get('error_description', 'Unknown error')
-                logger.error(f"GitHub OAuth token error: {error_desc}")
-                self.send_response(302)
-                self.send_header('Location', f'/?error=github_token_failed&message={urllib.parse.quote(error_desc)}')
-                self.end_headers()
+            # Gọi LLM7, tự failover sang provider tiếp theo trong MODEL_FALLBACK_CHAINS khi lỗi
+            start_time = time.time()
+            step, response, failed_over = self._call_chat_chain('gpt-5-chat', messages, stream)
+            if stream:
+                self._relay_chat_stream(step, failed_over, response, start_time, username, "gpt-5-chat", message, 'llm7_gpt5chat', len(files) > 0)
                 return
             
-            user_request = urllib.request.Request(
-                "https://api.github.com/user",
-                headers={
-                    'Authorization': f'Bearer {access_token}',
-                    'Accept': 'application/vnd.github+json',
-                    'User-Agent': 'NexoraX-AI'
-                }
+            with response:
+                reply = extract_chat_reply(step["provider"], json.loads(response.read().decode('utf-8')))
+            
+            # Save AI history
+            metadata = {'endpoint': 'llm7_gpt5chat', 'has_files': len(files) > 0}
+            metadata.update(chat_provider_metadata(step, failed_over))
+            save_ai_history(
+                username=username,
+                model="gpt-5-chat",
+                prompt=message,
+                response=reply,
+                metadata=metadata
             )
             
-            with urllib.request.urlopen(user_request, timeout=30) as response:
-                github_user = json.loads(response.read().decode('utf-8'))
+            # Return response to client
+            self._send_json_response(200, {
+                "reply": reply,
+                "model": step["model"],
+                "provider": step["provider"]
+            })
             
-            github_id = github_user.get('id')
-            github_login = github_user.get('login')
-            github_email = github_user.get('email')
-            github_name = github_user.get('name') or github_login
-            
-            if not github_email:
-                try:
-                    email_request = urllib.request.Request(
-                        "https://api.github.com/user/emails",
-                        headers={
-                            'Authorization': f'Bearer {access_token}',
-                            'Accept': 'application/vnd.github+json',
-                            'User-Agent': 'NexoraX-AI'
-                        }
-                    )
-                    with urllib.request.urlopen(email_request, timeout=30) as response:
-                        emails = json.loads(response.read().decode('utf-8'))
-                        for email_obj in emails:
-                            if email_obj.get('primary') and email_obj.get('verified'):
-                                github_email = email_obj.get('email')
-                                break
-                except Exception as e:
-                    logger.debug(f"Could not fetch GitHub emails: {e}")
-            
-            username = f"gh_{github_login}"
-            oauth_password = f"oauth:github:{github_id}"
-            
-            if username not in users:
-                save_user(username, oauth_password)
-                logger.info(f"Created new GitHub user: {username}")
-            else:
-                if users.get(username) != oauth_password:
-                    logger.warning(f"Username {username} already exists with different credentials")
-            
-            session_id = create_session(username, remember_me=True, display_name=github_name)
-            
-            max_age = 30 * 24 * 3600
-            cookie_value = f"session_id={session_id}; Path=/; HttpOnly; SameSite=Lax; Max-Age={max_age}"
-            if os.getenv('REPLIT_DOMAIN') or os.getenv('REPLIT_DEV_DOMAIN') or os.getenv('RENDER'):
-                cookie_value += "; Secure"
-            
-            logger.info(f"GitHub OAuth login successful: {username} (display: {github_name})")
-            
-            self.send_response(302)
-            self.send_header('Set-Cookie', cookie_value)
-            self.send_header('Location', f'/?github_login=success&username={urllib.parse.quote(username)}&display_name={urllib.parse.quote(github_name)}')
-            self.end_headers()
+            logger.info("LLM7 GPT-5-chat completed successfully")
             
+        except NoChatProviderError as e:
+            self._send_json_error(500, str(e), "API_KEY_MISSING")
+        except CircuitOpenError as e:
+            self._send_circuit_open(e)
         except urllib.error.HTTPError as e:
-            logger.error(f"GitHub API HTTP error: {e.code} - {e.reason}")
-            self.send_response(302)
-            self.send_header('Location', f'/?error=github_api_error&code={e.code}')
-            self.end_headers()
+            try:
+                error_body = e.read().decode('utf-8')
+                self._send_json_error(e.code, f"LLM7 API lỗi: {error_body}", "UPSTREAM_ERROR")
+            except:
+                self._send_json_error(e.code, f"LLM7 API lỗi: {e.reason}", "UPSTREAM_ERROR")
         except urllib.error.URLError as e:
-            logger.error(f"GitHub API URL error: {e.reason}")
-            self.send_response(302)
-            self.send_header('Location', '/?error=github_network_error')
-            self.end_headers()
+            logger.error(f"LLM7 connection error: {e}")
+            self._send_json_error(502, "Không thể kết nối đến LLM7 API", "CONNECTION_ERROR")
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON in LLM7 request: {e}")
+            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
         except Exception as e:
-            logger.error(f"GitHub OAuth callback error: {e}")
-            self.send_response(302)
-            self.send_header('Location', '/?error=github_oauth_failed')
-            self.end_headers()
+            logger.error(f"LLM7 GPT-5-chat error: {e}")
+            logger.error(f"Exception type: {type(e)}")
+            logger.error(f"Exception args: {e.args}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
 
-    def handle_auth_check_session(self):
-        """Handle check session status"""
+    def _call_chat_chain(self, model_id, messages, stream=False):
+        """Gọi lần lượt các provider trong chuỗi failover của model_id đến khi có provider trả lời
+
+        Provider bị timeout, lỗi kết nối, 5xx hoặc circuit đang mở thì chuyển sang bước tiếp
+        theo nếu còn thời gian trong deadline; lỗi khác (4xx) trả về luôn.
+        Trả về (step, response, failed_over); response là PooledResponse khi stream=True.
+        """
+        calls = build_chat_chain_calls(model_id, messages, stream)
+        deadline = Deadline(get_model_fallback_deadline())
+        failed_over = []
+        last_error = None
+        for index, (step, call) in enumerate(calls):
+            if last_error is not None and deadline.remaining() < FAILOVER_MIN_REMAINING:
+                break
+            name, url, headers, data, api_key = call
+            request = urllib.request.Request(url, data=data, headers=headers)
+            step_deadline = chat_step_deadline(deadline, index, len(calls))
+            try:
+                return step, upstream_call(name, request, stream=stream, api_key=api_key, deadline=step_deadline), failed_over
+            except Exception as e:
+                if not is_failover_error(e) or index == len(calls) - 1:
+                    raise
+                last_error = e
+                failed_over.append(step["provider"])
+                logger.warning(f"🔀 {model_id}: {step['provider']} failed ({type(e).__name__}: {e}), failing over to {calls[index + 1][0]['provider']}")
+        raise last_error
+
+    def _relay_chat_stream(self, step, failed_over, upstream, start_time, username, model_id, message, endpoint, has_files, cache_key=None):
+        """Streaming mode của /api/llm7/chat và /api/llm7/gpt-5-chat (body có "stream": true)
+
+        Chuyển tiếp các chunk `data:` OpenAI-style của LLM7 xuống client (stream của Gemini khi
+        failover được đổi sang cùng định dạng); câu trả lời ghép từ các delta vẫn được lưu vào
+        history (kể cả khi upstream ngắt giữa chừng, đánh dấu incomplete).
+        cache_key: stream hoàn chỉnh thì lưu câu trả lời vào RESPONSE_CACHE.
+        """
+        provider = step["provider"]
+        done_info = {"model": step["model"], "provider": provider}
+        if provider == 'gemini':
+            reply, ttft_ms, complete = self._relay_event_stream(
+                'gemini', "Gemini API", upstream, start_time, extract_gemini_text, done_info,
+                is_final=is_gemini_stream_final, translate=lambda text: build_chat_chunk(step["model"], text)
+            )
+        else:
+            reply, ttft_ms, complete = self._relay_event_stream(
+                'llm7', "LLM7 API", upstream, start_time, extract_llm7_delta, done_info, end_marker='[DONE]'
+            )
+        if cache_key and reply and complete:
+            RESPONSE_CACHE.set(cache_key, {"reply": reply, "model": step["model"], "provider": provider})
+        if reply:
+            metadata = {'endpoint': endpoint, 'has_files': has_files, 'stream': True, 'ttft_ms': ttft_ms}
+            metadata.update(chat_provider_metadata(step, failed_over))
+            if not complete:
+                metadata['incomplete'] = True
+            save_ai_history(
+                username=username,
+                model=model_id,
+                prompt=message,
+                response=reply,
+                metadata=metadata
+            )
+        logger.info(f"{model_id} stream via {provider} {'completed' if complete else 'ended early'} ({len(reply)} chars)")
+
+    def _send_cached_chat_reply(self, cached, stream, username, model_id, message, endpoint):
+        """Trả câu trả lời lấy từ RESPONSE_CACHE, cùng định dạng với response thật (JSON hoặc SSE 1 chunk)"""
+        logger.info(f"{model_id} response cache hit")
+        if stream:
+            self._start_event_stream()
+            try:
+                self._send_sse_event(build_chat_chunk(cached["model"], cached["reply"]))
+                self._send_sse_event({"model": cached["model"], "provider": cached["provider"], "ttft_ms": 0, "cached": True}, event="done")
+                self._end_event_stream()
+            except ClientDisconnectedError:
+                return
+        else:
+            self._send_json_response(200, dict(cached))
+        save_ai_history(
+            username=username,
+            model=model_id,
+            prompt=message,
+            response=cached["reply"],
+            metadata={'endpoint': endpoint, 'has_files': False, 'stream': stream, 'cached': True, 'provider': cached["provider"]}
+        )
+
+    def _is_time_query(self, message):
+        """Kiểm tra xem query có phải về thời gian/ngày hiện tại không"""
+        normalized = message.lower()
+        time_patterns = [
+            'mấy giờ', 'may gio', 'bây giờ', 'bay gio', 'giờ hiện tại',
+            'ngày mấy', 'ngay may', 'hôm nay là', 'thứ mấy', 'thu may',
+            'what time', 'current time', 'time now', 'what day', 'today'
+        ]
+        return any(p in normalized for p in time_patterns)
+    
+    def handle_llm7_gemini_search(self):
+        """Handle Search requests via Gemini Query Optimizer + Serper API + Gemini Summary
+        
+        LUỒNG MỚI (Cập nhật: 06/12/2025):
+        1. User nhập prompt
+        2. Kiểm tra nếu là câu hỏi thời gian → trả về thời gian thực
+        3. Gemini xử lý/tối ưu prompt → optimized query
+        4. Gửi optimized query đến Serper
+        5. Gemini tổng hợp kết quả
+        6. Gửi về user
+        
+        Fallback: Nếu optimizer lỗi → dùng original query cho Serper
+        """
         try:
-            session_id = None
+            # Deadline cho cả pipeline (optimizer → Serper → tóm tắt), tính từ lúc nhận request
+            deadline = Deadline(get_request_deadline('search'))
+            username = self._get_username_from_cookie()
             
-            if 'Cookie' in self.headers:
-                cookies = self.headers['Cookie']
-                for cookie in cookies.split(';'):
-                    if 'session_id=' in cookie:
-                        session_id = cookie.split('session_id=')[1].strip()
-                        break
+            serper_key = API_KEYS.acquire('serper')
             
-            if not session_id and 'Authorization' in self.headers:
-                auth_header = self.headers['Authorization']
-                if auth_header.startswith('Bearer '):
-                    session_id = auth_header[7:].strip()
+            if not serper_key:
+                self._send_json_error(500, 
+                    "Serper API key chưa được cấu hình. Vui lòng kiểm tra config.py",
+                    "API_KEY_MISSING")
+                return
             
-            if 'session_id' in self.path:
-                from urllib.parse import parse_qs, urlparse
-                parsed = urlparse(self.path)
-                query_params = parse_qs(parsed.query)
-                if 'session_id' in query_params:
-                    session_id = query_params['session_id'][0]
+            request_data = self._read_json_body()
             
-            if session_id:
-                username = get_user_from_session(session_id)
-                if username:
-                    rotated = False
-                    session_data = sessions.get(session_id)
-                    if session_data and session_data is not None:
-                        current_time = time.time()
-                        expires_at = session_data.get('expires_at', 0)
-                        total_duration = (30 * 24 * 3600) if session_data.get('remember_me') else (SESSION_EXPIRY_HOURS * 3600)
-                        time_remaining = expires_at - current_time
-                        
-                        if time_remaining < (total_duration * 0.25):
-                            new_session_id = rotate_session(session_id)
-                            if new_session_id:
-                                session_id = new_session_id
-                                rotated = True
-                    
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
-                    self._send_cors_headers()
+            message = request_data.get('message', '')
+            if not message:
+                self._send_json_error(400, "Message không được để trống", "MISSING_MESSAGE")
+                return
+            
+            logger.info(f"AI Search starting for query: {message}")
+            
+            if request_data.get('stream'):
+                self._stream_gemini_search(username, message, serper_key, deadline)
+                return
+            
+            # ========================================
+            # STEP 0: Kiểm tra nếu là câu hỏi thời gian
+            # ========================================
+            if self._is_time_query(message):
+                time_data = get_local_time(resolve_timezone(message))
+                if time_data.get('success'):
+                    reply = time_data['formatted']
                     
-                    if rotated and session_data is not None:
-                        remember_me = session_data.get('remember_me', False)
-                        max_age = (30 * 24 * 3600) if remember_me else (7 * 24 * 3600)
-                        cookie_value = f"session_id={session_id}; Path=/; HttpOnly; SameSite=Lax; Max-Age={max_age}"
-                        if os.getenv('REPLIT_DOMAIN') or os.getenv('RENDER'):
-                            cookie_value += "; Secure"
-                        self.send_header('Set-Cookie', cookie_value)
+                    self._send_json_response(200, {
+                        "reply": reply,
+                        "model": "gemini-search"
+                    })
                     
-                    self.end_headers()
+                    save_ai_history(
+                        username=username,
+                        model="gemini-search",
+                        prompt=message,
+                        response=reply,
+                        metadata={'endpoint': 'realtime_api', 'powered_by': 'local_clock'}
+                    )
                     
-                    display_name = session_data.get('display_name', username) if session_data else username
-                    response_json = json.dumps({
-                        "valid": True,
-                        "username": username,
-                        "display_name": display_name,
-                        "rotated": rotated
-                    }, ensure_ascii=False)
-                    self.wfile.write(response_json.encode('utf-8'))
+                    logger.info("AI Search v2 completed (powered_by: local_clock, realtime)")
                     return
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
+            # ========================================
+            # STEP 1: Gemini xử lý/tối ưu prompt
+            # ========================================
+            optimized_query, optimizer_reasoning, optimizer_keywords, used_optimized = self._optimize_search_query(message, deadline)
             
-            response_json = json.dumps({
-                "valid": False,
-                "username": None
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
+            # ========================================
+            # STEP 2: Gửi Serper với optimized query
+            # ========================================
+            serper_data = self._serper_search(serper_key, optimized_query, deadline)
+            search_results_count = len(serper_data.get('organic', []))
+            
+            # ========================================
+            # STEP 3: Build context và format Markdown
+            # ========================================
+            search_context = self._build_gemini_search_context(serper_data, message)
+            serper_markdown = self._format_serper_results_markdown(serper_data, optimized_query)
+            
+            # ========================================
+            # STEP 4: Gemini tổng hợp kết quả
+            # ========================================
+            # Hết deadline thì trả về kết quả Serper chưa có tóm tắt
+            gemini_success, gemini_result = self._invoke_gemini_summary(message, search_context, deadline)
+            
+            if gemini_success:
+                logger.info("Gemini summary generated successfully")
                 
-        except Exception as e:
-            logger.error(f"Check session error: {e}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+                reply = gemini_result
+                
+                powered_by = 'gemini+serper+gemini'
+                summary_model = 'gemini-2.5-flash'
+            else:
+                logger.warning(f"Gemini summary failed: {gemini_result}")
+                
+                reply = serper_markdown
+                reply += f"\n\n---\n*⚠️ Lưu ý: Kết quả chưa được AI phân tích ({gemini_result})*"
+                
+                powered_by = 'gemini+serper' if used_optimized else 'serper'
+                summary_model = None
+            
+            # ========================================
+            # STEP 5: Save history với metadata đầy đủ
+            # ========================================
+            history_metadata = {
+                'endpoint': 'ai_search_v2',
+                'search_results_count': search_results_count,
+                'powered_by': powered_by,
+                'query_optimized': used_optimized,
+                'original_query': message,
+                'optimized_query': optimized_query if used_optimized else None,
+                'optimizer_reasoning': optimizer_reasoning if used_optimized else None,
+                'optimizer_keywords': optimizer_keywords if used_optimized else None
+            }
+            if summary_model:
+                history_metadata['summary_model'] = summary_model
+            
+            save_ai_history(
+                username=username,
+                model="gemini-search",
+                prompt=message,
+                response=reply,
+                metadata=history_metadata
+            )
+            
+            # Return response to client
+            self._send_json_response(200, {
+                "reply": reply,
+                "model": "gemini-search"
+            })
+            
+            logger.info(f"AI Search v2 completed (powered_by: {powered_by}, optimized: {used_optimized})")
+            
+        except DeadlineExceededError as e:
+            logger.warning(f"AI Search deadline exceeded: {e}")
+            self._send_json_error(504, "Tìm kiếm mất quá nhiều thời gian. Vui lòng thử lại.", "DEADLINE_EXCEEDED")
+        except CircuitOpenError as e:
+            self._send_circuit_open(e)
+        except urllib.error.HTTPError as e:
+            try:
+                error_body = e.read().decode('utf-8')
+                logger.error(f"Serper API HTTP error: {e.code} - {error_body}")
+                self._send_json_error(e.code, f"Serper API lỗi: {error_body}", "UPSTREAM_ERROR")
+            except:
+                self._send_json_error(e.code, f"Serper API lỗi: {e.reason}", "UPSTREAM_ERROR")
+        except urllib.error.URLError as e:
+            logger.error(f"Serper connection error: {e}")
+            self._send_json_error(502, "Không thể kết nối đến Serper API", "CONNECTION_ERROR")
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON in Search request: {e}")
+            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
+        except Exception as e:
+            logger.error(f"Serper Search error: {e}")
+            logger.error(f"Exception type: {type(e)}")
+            logger.error(f"Exception args: {e.args}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+    
+    def _stream_gemini_search(self, username, message, serper_key, deadline=None):
+        """Streaming mode của /api/llm7/gemini-search (body có "stream": true)
+
+        Gửi SSE ngay khi từng bước của pipeline xong, thay vì chờ cả 3 bước:
+        - event "stage" {"stage": "optimize"}: query đã tối ưu
+        - event "stage" {"stage": "search"}: kết quả Serper dạng Markdown (_format_serper_results_markdown)
+        - event "summary" {"text"}: từng đoạn tóm tắt của Gemini khi vừa sinh ra
+        - event "stage" {"stage": "summary", "success": false}: tóm tắt lỗi, client hiển thị Markdown + note
+        - event "done" (kèm thời gian từng bước) hoặc "error"
+        Mọi bước dùng chung deadline của request; hết hạn giữa lúc tóm tắt thì dừng với phần đã có.
+        """
+        self._start_event_stream()
+        timings = {}
+        try:
+            # STEP 0: câu hỏi thời gian → trả lời ngay
+            if self._is_time_query(message):
+                time_data = get_local_time(resolve_timezone(message))
+                if time_data.get('success'):
+                    reply = time_data['formatted']
+                    self._send_sse_event({"text": reply}, event="summary")
+                    self._send_sse_event({"model": "gemini-search", "powered_by": "local_clock", "timings_ms": timings}, event="done")
+                    self._end_event_stream()
+                    save_ai_history(
+                        username=username,
+                        model="gemini-search",
+                        prompt=message,
+                        response=reply,
+                        metadata={'endpoint': 'realtime_api', 'powered_by': 'local_clock', 'stream': True}
+                    )
+                    return
+            
+            # STEP 1: tối ưu query
+            stage_start = time.time()
+            optimized_query, optimizer_reasoning, optimizer_keywords, used_optimized = self._optimize_search_query(message, deadline)
+            timings['optimize'] = round((time.time() - stage_start) * 1000, 2)
+            self._send_sse_event({
+                "stage": "optimize",
+                "optimized_query": optimized_query,
+                "query_optimized": used_optimized,
+                "keywords": optimizer_keywords,
+                "elapsed_ms": timings['optimize']
+            }, event="stage")
+            
+            # STEP 2: Serper
+            stage_start = time.time()
+            serper_data = self._serper_search(serper_key, optimized_query, deadline)
+            search_results_count = len(serper_data.get('organic', []))
+            serper_markdown = self._format_serper_results_markdown(serper_data, optimized_query)
+            timings['search'] = round((time.time() - stage_start) * 1000, 2)
+            self._send_sse_event({
+                "stage": "search",
+                "results_count": search_results_count,
+                "markdown": serper_markdown,
+                "elapsed_ms": timings['search']
+            }, event="stage")
+            
+            # STEP 3: Gemini tổng hợp, stream từng đoạn
+            stage_start = time.time()
+            search_context = self._build_gemini_search_context(serper_data, message)
+            gemini_success, gemini_result = self._stream_gemini_summary(
+                message, search_context,
+                lambda text: self._send_sse_event({"text": text}, event="summary"),
+                deadline
+            )
+            timings['summary'] = round((time.time() - stage_start) * 1000, 2)
+            
+            if gemini_success:
+                reply = gemini_result
+                powered_by = 'gemini+serper+gemini'
+                summary_model = 'gemini-2.5-flash'
+            else:
+                logger.warning(f"Gemini summary failed: {gemini_result}")
+                note = f"\n\n---\n*⚠️ Lưu ý: Kết quả chưa được AI phân tích ({gemini_result})*"
+                reply = serper_markdown + note
+                powered_by = 'gemini+serper' if used_optimized else 'serper'
+                summary_model = None
+                self._send_sse_event({
+                    "stage": "summary",
+                    "success": False,
+                    "error": gemini_result,
+                    "note": note,
+                    "elapsed_ms": timings['summary']
+                }, event="stage")
+            
+            self._send_sse_event({"model": "gemini-search", "powered_by": powered_by, "timings_ms": timings}, event="done")
+            self._end_event_stream()
+        except ClientDisconnectedError as e:
+            logger.info(f"AI Search stream aborted by client: {e}")
+            return
+        except Exception as e:
+            if isinstance(e, DeadlineExceededError):
+                error = {"error": "Tìm kiếm mất quá nhiều thời gian. Vui lòng thử lại.", "code": "DEADLINE_EXCEEDED"}
+            elif isinstance(e, CircuitOpenError):
+                error = {"error": f"Dịch vụ {e.name} đang tạm thời gián đoạn. Vui lòng thử lại sau {e.retry_after} giây.", "code": "CIRCUIT_OPEN"}
+            elif isinstance(e, urllib.error.HTTPError):
+                error = {"error": f"Serper API lỗi: {e.code} {e.reason}", "code": "UPSTREAM_ERROR"}
+            elif isinstance(e, urllib.error.URLError):
+                error = {"error": "Không thể kết nối đến Serper API", "code": "CONNECTION_ERROR"}
+            else:
+                error = {"error": f"Lỗi hệ thống: {str(e)}", "code": "SYSTEM_ERROR"}
+            logger.error(f"AI Search stream error: {e}")
+            try:
+                self._send_sse_event(error, event="error")
+                self._end_event_stream()
+            except ClientDisconnectedError:
+                pass
+            return
+        
+        history_metadata = {
+            'endpoint': 'ai_search_v2',
+            'stream': True,
+            'timings_ms': timings,
+            'search_results_count': search_results_count,
+            'powered_by': powered_by,
+            'query_optimized': used_optimized,
+            'original_query': message,
+            'optimized_query': optimized_query if used_optimized else None,
+            'optimizer_reasoning': optimizer_reasoning if used_optimized else None,
+            'optimizer_keywords': optimizer_keywords if used_optimized else None
+        }
+        if summary_model:
+            history_metadata['summary_model'] = summary_model
+        save_ai_history(
+            username=username,
+            model="gemini-search",
+            prompt=message,
+            response=reply,
+            metadata=history_metadata
+        )
+        logger.info(f"AI Search v2 stream completed (powered_by: {powered_by}, timings: {timings})")
+    
+    def _optimize_search_query(self, message, deadline=None):
+        """STEP 1 của AI Search: trả về (optimized_query, reasoning, keywords, used_optimized)
+
+        Optimizer lỗi (hoặc không đủ thời gian trong deadline) → dùng nguyên message làm query
+        (reasoning là thông báo lỗi).
+        """
+        optimizer_success, optimizer_result = self._invoke_gemini_query_optimizer(message, deadline)
+        
+        if optimizer_success and isinstance(optimizer_result, dict):
+            optimized_query = optimizer_result.get('optimized_query', message)
+            logger.info(f"Query optimization SUCCESS: '{message}' → '{optimized_query}'")
+            return optimized_query, optimizer_result.get('reasoning', ''), optimizer_result.get('keywords', []), True
+        
+        if isinstance(optimizer_result, dict):
+            optimizer_reasoning = optimizer_result.get('error', 'Unknown error')
+        else:
+            optimizer_reasoning = str(optimizer_result) if optimizer_result else 'Unknown error'
+        logger.warning(f"Query optimization FAILED ({optimizer_reasoning}), using original query")
+        return message, optimizer_reasoning, [], False
+    
+    def _serper_search(self, serper_key, query, deadline=None):
+        """STEP 2 của AI Search: gọi Serper, trả về response JSON (raise lỗi upstream như urlopen)
+
+        Kết quả được cache (SERPER_CACHE) theo query đã chuẩn hoá + gl/hl/num, TTL theo loại query;
+        các request đồng thời cùng query chỉ gọi Serper 1 lần.
+        """
+        params = {
+            "q": query,
+            "gl": "vn",
+            "hl": "vi",
+            "num": 10
+        }
+        
+        def fetch(deadline):
+            serper_request = urllib.request.Request(
+                "https://google.serper.dev/search",
+                data=json.dumps(params).encode('utf-8'),
+                headers={
+                    "X-API-KEY": serper_key,
+                    "Content-Type": "application/json"
+                },
+                method='POST'
+            )
+            with upstream_call('serper', serper_request, api_key=serper_key, deadline=deadline) as response:
+                return json.loads(response.read().decode('utf-8'))
+        
+        query_class = classify_search_query(query)
+        cache_key = (normalize_cache_text(query), params["gl"], params["hl"], params["num"])
+        serper_data, cache_status = SERPER_CACHE.get_or_load(
+            cache_key, fetch, get_serper_cache_ttl(query_class), deadline=deadline
+        )
+        if cache_status != "miss":
+            logger.info(f"Serper cache {cache_status} ({query_class}) for query: '{query}'")
+            return serper_data
+        
+        logger.info(f"Serper returned {len(serper_data.get('organic', []))} organic results for query: '{query}'")
+        return serper_data
+    
+    def _format_serper_results_markdown(self, serper_data, query):
+        """Format Serper search results into markdown (NO AI processing)"""
+        parts = []
+        
+        parts.append(f"## Kết quả tìm kiếm cho: \"{query}\"\n")
+        
+        # Answer Box (câu trả lời nhanh)
+        if serper_data.get('answerBox'):
+            ab = serper_data['answerBox']
+            parts.append("### Trả lời nhanh")
+            if ab.get('answer'):
+                parts.append(f"{ab['answer']}\n")
+            elif ab.get('snippet'):
+                parts.append(f"{ab['snippet']}\n")
+            if ab.get('title'):
+                parts.append(f"*Nguồn: {ab['title']}*\n")
+        
+        # Knowledge Graph
+        if serper_data.get('knowledgeGraph'):
+            kg = serper_data['knowledgeGraph']
+            parts.append("### Thông tin")
+            if kg.get('title'):
+                parts.append(f"**{kg['title']}**")
+            if kg.get('type'):
+                parts.append(f"*{kg['type']}*")
+            if kg.get('description'):
+                parts.append(f"{kg['description']}\n")
+        
+        # Organic results
+        organic = serper_data.get('organic', [])
+        if organic:
+            parts.append("### Kết quả tìm kiếm")
+            for i, result in enumerate(organic[:7], 1):
+                title = result.get('title', 'Không có tiêu đề')
+                snippet = result.get('snippet', '')
+                link = result.get('link', '#')
+                parts.append(f"**{i}. [{title}]({link})**")
+                if snippet:
+                    parts.append(f"{snippet}\n")
+        
+        # People Also Ask
+        paa = serper_data.get('peopleAlsoAsk', [])
+        if paa:
+            parts.append("### Câu hỏi liên quan")
+            for item in paa[:4]:
+                q = item.get('question', '')
+                a = item.get('snippet', '')
+                if q:
+                    parts.append(f"- **{q}**")
+                    if a:
+                        parts.append(f"  {a}")
+        
+        # Related Searches
+        related = serper_data.get('relatedSearches', [])
+        if related:
+            parts.append("\n### Tìm kiếm liên quan")
+            related_terms = [r.get('query', '') for r in related[:5] if r.get('query')]
+            if related_terms:
+                parts.append(", ".join(related_terms))
+        
+        return "\n".join(parts) if parts else "Không tìm thấy kết quả phù hợp."
+
+    def _build_gemini_search_context(self, serper_data, query):
+        """Build context string from Serper results for Gemini to analyze"""
+        context_parts = []
+        
+        # Answer Box
+        if serper_data.get('answerBox'):
+            ab = serper_data['answerBox']
+            context_parts.append("📦 Trả lời nhanh:")
+            if ab.get('answer'):
+                context_parts.append(f"  - Đáp án: {ab['answer']}")
+            elif ab.get('snippet'):
+                context_parts.append(f"  - Tóm tắt: {ab['snippet']}")
+            if ab.get('title'):
+                context_parts.append(f"  - Nguồn: {ab['title']}")
+        
+        # Knowledge Graph
+        if serper_data.get('knowledgeGraph'):
+            kg = serper_data['knowledgeGraph']
+            context_parts.append("\n📚 Thông tin nền:")
+            if kg.get('title'):
+                context_parts.append(f"  - Chủ đề: {kg['title']}")
+            if kg.get('type'):
+                context_parts.append(f"  - Loại: {kg['type']}")
+            if kg.get('description'):
+                context_parts.append(f"  - Mô tả: {kg['description']}")
+        
+        # Organic Results (top 6)
+        organic = serper_data.get('organic', [])
+        if organic:
+            context_parts.append("\n🔍 Kết quả tìm kiếm:")
+            for i, result in enumerate(organic[:6], 1):
+                title = result.get('title', 'Không có tiêu đề')
+                snippet = result.get('snippet', '')
+                link = result.get('link', '')
+                context_parts.append(f"\nNguồn {i}:")
+                context_parts.append(f"  - Tiêu đề: {title}")
+                if snippet:
+                    context_parts.append(f"  - Tóm tắt: {snippet}")
+                if link:
+                    context_parts.append(f"  - URL: {link}")
+        
+        # People Also Ask (top 3)
+        paa = serper_data.get('peopleAlsoAsk', [])
+        if paa:
+            context_parts.append("\n❓ Câu hỏi liên quan:")
+            for item in paa[:3]:
+                q = item.get('question', '')
+                a = item.get('snippet', '')
+                if q:
+                    context_parts.append(f"  - Q: {q}")
+                    if a:
+                        context_parts.append(f"    A: {a}")
+        
+        return "\n".join(context_parts)
+
+    def _build_gemini_summary_payload(self, query, search_context):
+        """Payload Gemini cho bước tổng hợp kết quả tìm kiếm (dùng chung cho bản thường và streaming)"""
+        # System prompt for search summarization - CẢI TIẾN: Linh hoạt và tự nhiên hơn
+        system_prompt = """Bạn là Gemini 2.5 Flash, một trợ lý AI thông minh với khả năng tìm kiếm web thời gian thực.
+
+⚠️ QUY TẮC BẮT BUỘC:
+- Tên của bạn là Gemini 2.5 Flash. Khi được hỏi, trả lời: "Mình là Gemini 2.5 Flash".
+- PHẢI trả lời hoàn toàn bằng TIẾNG VIỆT một cách TỰ NHIÊN.
+- KHÔNG ĐƯỢC sử dụng từ "biomimicry". Dùng thay thế: "thiết kế lấy cảm hứng từ thiên nhiên", "mô phỏng tự nhiên".
+
+📝 CÁCH TRẢ LỜI - LINH HOẠT THEO NGỮ CẢNH:
+
+1. **Câu hỏi ĐƠN GIẢN** (định nghĩa, giải thích ngắn):
+   - Trả lời NGẮN GỌN, trực tiếp (1-3 câu)
+   - KHÔNG cần format Tóm tắt/Phân tích/Nguồn
+   - VD: "Bitcoin là gì?" → Trả lời định nghĩa ngắn gọn
+
+2. **Câu hỏi CẦN THÔNG TIN CHI TIẾT** (tin tức, sự kiện, so sánh):
+   - Sử dụng format có cấu trúc khi phù hợp
+   - Thêm nguồn tham khảo nếu cần thiết
+
+3. **Câu hỏi về GIÁ CẢ, TỶ GIÁ, SỐ LIỆU**:
+   - Đưa ra con số cụ thể từ kết quả tìm kiếm
+   - Ghi rõ thời điểm/nguồn nếu có
+
+🎯 NGUYÊN TẮC QUAN TRỌNG:
+- TỰ NHIÊN như đang trò chuyện, không máy móc
+- Độ dài tỷ lệ với độ phức tạp của câu hỏi
+- Dùng emoji một cách TIẾT CHẾ (1-2 emoji nếu phù hợp, không bắt buộc)
+- TRÁNH lặp lại cấu trúc cố định cho mọi câu trả lời"""
+
+        user_prompt = f"""Người dùng tìm kiếm: "{query}"
+
+KẾT QUẢ TÌM KIẾM TỪ SERPER:
+{search_context}
+
+Hãy tóm tắt và phân tích kết quả tìm kiếm trên để trả lời câu hỏi của người dùng."""
+
+        gemini_payload = {
+            "contents": [
+                {
+                    "role": "user",
+                    "parts": [{"text": f"{system_prompt}\n\n{user_prompt}"}]
+                }
+            ],
+            "generationConfig": {
+                "temperature": 0.7,
+                "topK": 40,
+                "topP": 0.95,
+                "maxOutputTokens": 8192,
+            },
+            "safetySettings": [
+                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_ONLY_HIGH"},
+                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_ONLY_HIGH"},
+                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_ONLY_HIGH"},
+                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_ONLY_HIGH"}
+            ]
+        }
+        return gemini_payload
+    
+    def _invoke_gemini_summary(self, query, search_context, deadline=None):
+        """Call Gemini 2.5 Flash to summarize and analyze search results
+        
+        Các request đồng thời cùng query + kết quả Serper dùng chung 1 call tóm tắt.
+        
+        Returns:
+            tuple: (success: bool, result: str)
+            - If success: (True, summary_text)
+            - If error: (False, error_message)
+        """
+        flight_key = hashlib.sha256(f"{query}\0{search_context}".encode('utf-8')).hexdigest()
+        try:
+            result, shared = SUMMARY_FLIGHT.do(
+                flight_key, lambda flight_deadline: self._request_gemini_summary(query, search_context, flight_deadline),
+                deadline
+            )
+        except DeadlineExceededError as e:
+            logger.warning(f"Gemini summary: gave up waiting for in-flight call: {e}")
+            return (False, "Hết thời gian chờ tóm tắt")
+        if shared:
+            logger.info(f"Gemini summary: shared in-flight call for query '{query}'")
+        return result
+
+    def _request_gemini_summary(self, query, search_context, deadline=None):
+        """Gọi Gemini tóm tắt cho _invoke_gemini_summary"""
+        try:
+            gemini_key = API_KEYS.acquire('gemini')
+            if not gemini_key:
+                return (False, "Gemini API key chưa được cấu hình")
+            
+            gemini_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={gemini_key}"
+            
+            gemini_payload = self._build_gemini_summary_payload(query, search_context)
+            
+            gemini_request = urllib.request.Request(
+                gemini_url,
+                data=json.dumps(gemini_payload).encode('utf-8'),
+                headers={'Content-Type': 'application/json'}
+            )
+            
+            with upstream_call('gemini', gemini_request, api_key=gemini_key, deadline=deadline) as response:
+                gemini_response = response.read().decode('utf-8')
+                gemini_data = json.loads(gemini_response)
+            
+            candidates = gemini_data.get('candidates', [])
+            prompt_feedback = gemini_data.get('promptFeedback', {})
+            
+            if prompt_feedback.get('blockReason'):
+                block_reason = prompt_feedback.get('blockReason', 'UNKNOWN')
+                logger.warning(f"Gemini summary blocked by promptFeedback: {block_reason}")
+                return (False, f"Prompt bị chặn: {block_reason}")
+            
+            if not candidates:
+                logger.warning(f"Gemini summary: No candidates. promptFeedback: {prompt_feedback}")
+                return (False, "Gemini không trả về kết quả")
+            
+            candidate = candidates[0]
+            finish_reason = candidate.get('finishReason', 'UNKNOWN')
+            safety_ratings = candidate.get('safetyRatings', [])
+            
+            if finish_reason == 'SAFETY':
+                logger.warning(f"Gemini summary blocked by SAFETY: {safety_ratings}")
+                return (False, "Bị chặn bởi safety filter")
+            
+            if finish_reason == 'MAX_TOKENS':
+                logger.warning("Gemini summary truncated (MAX_TOKENS)")
+            
+            if candidate.get('content', {}).get('parts'):
+                summary_text = candidate['content']['parts'][0].get('text', '')
+                if summary_text:
+                    return (True, summary_text)
+            
+            logger.warning(f"Gemini summary: No text in response. finishReason: {finish_reason}, safetyRatings: {safety_ratings}")
+            return (False, "Gemini không trả về kết quả hợp lệ")
+            
+        except TimeoutError as e:
+            logger.warning(f"Gemini summary timed out: {e}")
+            return (False, "Hết thời gian chờ tóm tắt")
+        except urllib.error.HTTPError as e:
+            error_msg = f"Gemini API lỗi HTTP {e.code}"
+            try:
+                error_body = e.read().decode('utf-8')
+                logger.warning(f"Gemini HTTP error: {e.code} - {error_body}")
+            except:
+                logger.warning(f"Gemini HTTP error: {e.code}")
+            return (False, error_msg)
+        except urllib.error.URLError as e:
+            logger.warning(f"Gemini connection error: {e}")
+            return (False, "Không thể kết nối đến Gemini")
+        except Exception as e:
+            logger.warning(f"Gemini summary error: {e}")
+            return (False, str(e))
+
+    def _stream_gemini_summary(self, query, search_context, on_text, deadline=None):
+        """Bản streaming của _invoke_gemini_summary: gọi on_text(text) cho từng đoạn vừa nhận
+
+        Returns: (success, summary_text hoặc error_message) giống _invoke_gemini_summary.
+        Hết deadline giữa chừng thì dừng đọc và trả về phần tóm tắt đã nhận.
+        ClientDisconnectedError từ on_text được raise tiếp để dừng pipeline.
+        """
+        try:
+            gemini_key = API_KEYS.acquire('gemini')
+            if not gemini_key:
+                return (False, "Gemini API key chưa được cấu hình")
+            
+            gemini_request = urllib.request.Request(
+                gemini_stream_url('gemini-2.5-flash', gemini_key),
+                data=json.dumps(self._build_gemini_summary_payload(query, search_context)).encode('utf-8'),
+                headers={'Content-Type': 'application/json'}
+            )
+            
+            start_time = time.time()
+            text_parts = []
+            with upstream_call('gemini', gemini_request, stream=True, api_key=gemini_key, deadline=deadline) as response:
+                for _, data in iter_sse_events(response):
+                    if deadline:
+                        # Lần đọc tiếp theo không được chờ quá thời gian còn lại của request
+                        response.settimeout(deadline.cap())
+                    if not data:
+                        continue
+                    chunk = json.loads(data)
+                    block_reason = chunk.get('promptFeedback', {}).get('blockReason')
+                    if block_reason:
+                        logger.warning(f"Gemini summary blocked by promptFeedback: {block_reason}")
+                        return (False, f"Prompt bị chặn: {block_reason}")
+                    candidates = chunk.get('candidates') or []
+                    if candidates and candidates[0].get('finishReason') == 'SAFETY':
+                        logger.warning(f"Gemini summary blocked by SAFETY: {candidates[0].get('safetyRatings', [])}")
+                        return (False, "Bị chặn bởi safety filter")
+                    text = extract_gemini_text(chunk)
+                    if text:
+                        if not text_parts:
+                            UPSTREAM_METRICS.record_ttft('gemini', time.time() - start_time)
+                        text_parts.append(text)
+                        on_text(text)
+            
+            if text_parts:
+                return (True, ''.join(text_parts))
+            logger.warning("Gemini summary stream: No text in response")
+            return (False, "Gemini không trả về kết quả hợp lệ")
+            
+        except ClientDisconnectedError:
+            raise
+        except TimeoutError as e:
+            # Hết deadline giữa chừng: giữ phần tóm tắt đã gửi cho client
+            logger.warning(f"Gemini summary stream timed out after {len(text_parts)} chunks: {e}")
+            if text_parts:
+                return (True, ''.join(text_parts))
+            return (False, "Hết thời gian chờ tóm tắt")
+        except urllib.error.HTTPError as e:
+            logger.warning(f"Gemini HTTP error: {e.code}")
+            return (False, f"Gemini API lỗi HTTP {e.code}")
+        except urllib.error.URLError as e:
+            logger.warning(f"Gemini connection error: {e}")
+            return (False, "Không thể kết nối đến Gemini")
+        except Exception as e:
+            logger.warning(f"Gemini summary stream error: {e}")
+            return (False, str(e))
+
+    def _invoke_gemini_query_optimizer(self, user_prompt, deadline=None):
+        """Call Gemini 2.5 Flash to optimize/process user prompt before sending to Serper
+        
+        Luồng: User prompt → Gemini xử lý → Optimized query cho Serper
+        Kết quả thành công được cache (OPTIMIZER_CACHE) theo prompt đã chuẩn hoá, prompt
+        lặp lại bỏ qua hẳn bước gọi Gemini; các request đồng thời cùng prompt dùng chung 1 call.
+        
+        Returns:
+            tuple: (success: bool, result: dict)
+            - If success: (True, {"optimized_query": str, "reasoning": str, "keywords": list})
+            - If error: (False, {"error": str})
+        """
+        cache_key = normalize_cache_text(user_prompt)
+        cached = OPTIMIZER_CACHE.get(cache_key)
+        if cached is not None:
+            logger.info(f"Query optimizer cache hit: '{user_prompt}' → '{cached['optimized_query']}'")
+            return (True, dict(cached))
+        
+        try:
+            (success, result), shared = OPTIMIZER_CACHE.flight.do(
+                cache_key, lambda flight_deadline: self._request_query_optimization(user_prompt, cache_key, flight_deadline),
+                deadline, SEARCH_OPTIMIZER_RESERVE
+            )
+        except DeadlineExceededError as e:
+            logger.warning(f"Query optimizer: gave up waiting for in-flight call: {e}")
+            return (False, {"error": str(e)})
+        if shared:
+            logger.info(f"Query optimizer: shared in-flight call for '{user_prompt}'")
+        return (success, dict(result))
+
+    def _request_query_optimization(self, user_prompt, cache_key, deadline=None):
+        """Gọi Gemini optimizer cho _invoke_gemini_query_optimizer (lỗi trả về dạng (False, {"error"}))"""
+        try:
+            gemini_key = API_KEYS.acquire('gemini')
+            if not gemini_key:
+                return (False, {"error": "Gemini API key chưa được cấu hình"})
+            
+            system_prompt = """Bạn là Gemini Query Optimizer - nhiệm vụ tối ưu hóa câu hỏi người dùng thành query tìm kiếm hiệu quả cho Serper/Google.
+
+⚠️ QUY TẮC BẮT BUỘC:
+1. Phân tích ý định tìm kiếm của người dùng
+2. Tạo query tìm kiếm tối ưu (ngắn gọn, rõ ràng, có từ khóa chính)
+3. Trả về JSON với format chính xác
+
+📝 OUTPUT FORMAT (JSON):
+{
+    "optimized_query": "query tìm kiếm tối ưu (50-150 ký tự, ưu tiên tiếng Việt nếu là câu hỏi tiếng Việt)",
+    "reasoning": "giải thích ngắn gọn lý do tối ưu (1-2 câu)",
+    "keywords": ["từ_khóa_1", "từ_khóa_2", "từ_khóa_3"]
+}
+
+🎯 HƯỚNG DẪN TỐI ƯU:
+- Loại bỏ từ thừa (ừ, à, nhé, nha, cho tôi biết, giúp tôi...)
+- Giữ nguyên tên riêng, thương hiệu, số liệu cụ thể
+- Thêm ngữ cảnh thời gian nếu cần (2025, mới nhất, hiện tại...)
+- Nếu hỏi về giá/tỷ giá → thêm "giá hiện tại" hoặc "tỷ giá hôm nay"
+- Nếu hỏi về tin tức → thêm "tin tức mới nhất"
+- Nếu hỏi định nghĩa đơn giản → giữ ngắn gọn, không thêm thừa
+
+⚠️ CHỈ trả về JSON thuần túy, KHÔNG có text giải thích bên ngoài JSON."""
+
+            user_message = f"""Tối ưu hóa câu hỏi sau thành query tìm kiếm:
+
+"{user_prompt}"
+
+Trả về JSON theo format đã chỉ định."""
+
+            gemini_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={gemini_key}"
+            
+            gemini_payload = {
+                "contents": [
+                    {
+                        "role": "user",
+                        "parts": [{"text": f"{system_prompt}\n\n{user_message}"}]
+                    }
+                ],
+                "generationConfig": {
+                    "temperature": 0.3,
+                    "topK": 20,
+                    "topP": 0.9,
+                    "maxOutputTokens": 2048,
+                    "responseMimeType": "application/json"
+                },
+                "safetySettings": [
+                    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_ONLY_HIGH"},
+                    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_ONLY_HIGH"},
+                    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_ONLY_HIGH"},
+                    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_ONLY_HIGH"}
+                ]
+            }
+            
+            gemini_request = urllib.request.Request(
+                gemini_url,
+                data=json.dumps(gemini_payload).encode('utf-8'),
+                headers={'Content-Type': 'application/json'}
+            )
+            
+            # Chừa thời gian cho Serper + tóm tắt: optimizer chỉ là bước phụ
+            timeout = get_upstream_policy('gemini_optimizer')["timeout"]
+            if deadline:
+                timeout = deadline.cap(timeout, reserve=SEARCH_OPTIMIZER_RESERVE)
+            with upstream_call('gemini_optimizer', gemini_request, timeout=timeout, api_key=gemini_key, deadline=deadline) as response:
+                gemini_response = response.read().decode('utf-8')
+                gemini_data = json.loads(gemini_response)
+            
+            candidates = gemini_data.get('candidates', [])
+            prompt_feedback = gemini_data.get('promptFeedback', {})
+            
+            if prompt_feedback.get('blockReason'):
+                block_reason = prompt_feedback.get('blockReason', 'UNKNOWN')
+                logger.warning(f"Query optimizer blocked by promptFeedback: {block_reason}")
+                return (False, {"error": f"Prompt bị chặn: {block_reason}"})
+            
+            if not candidates:
+                logger.warning(f"Query optimizer: No candidates returned. promptFeedback: {prompt_feedback}")
+                return (False, {"error": "Gemini không trả về kết quả"})
+            
+            candidate = candidates[0]
+            finish_reason = candidate.get('finishReason', 'UNKNOWN')
+            safety_ratings = candidate.get('safetyRatings', [])
+            
+            if finish_reason == 'SAFETY':
+                logger.warning(f"Query optimizer blocked by SAFETY: {safety_ratings}")
+                return (False, {"error": "Bị chặn bởi safety filter"})
+            
+            if finish_reason not in ['STOP', 'MAX_TOKENS']:
+                logger.warning(f"Query optimizer unexpected finishReason: {finish_reason}")
+            
+            if candidate.get('content', {}).get('parts'):
+                response_text = candidate['content']['parts'][0].get('text', '')
+                if response_text:
+                    response_text = response_text.strip()
+                    if response_text.startswith('```json'):
+                        response_text = response_text[7:]
+                    if response_text.startswith('```'):
+                        response_text = response_text[3:]
+                    if response_text.endswith('```'):
+                        response_text = response_text[:-3]
+                    response_text = response_text.strip()
+                    
+                    try:
+                        result = json.loads(response_text)
+                        if 'optimized_query' in result:
+                            logger.info(f"Query optimized: '{user_prompt}' → '{result['optimized_query']}'")
+                            OPTIMIZER_CACHE.set(cache_key, {
+                                "optimized_query": result['optimized_query'],
+                                "reasoning": result.get('reasoning', ''),
+                                "keywords": result.get('keywords', [])
+                            })
+                            return (True, result)
+                        else:
+                            logger.warning(f"Query optimizer missing optimized_query field: {response_text[:200]}")
+                            return (False, {"error": "JSON thiếu trường optimized_query"})
+                    except json.JSONDecodeError as e:
+                        logger.warning(f"Query optimizer JSON parse error: {e}, finishReason: {finish_reason}, raw: {response_text[:300]}")
+                        return (False, {"error": f"Không thể parse JSON: {str(e)}"})
+            
+            logger.warning(f"Query optimizer: No text in response. finishReason: {finish_reason}")
+            return (False, {"error": "Gemini không trả về kết quả hợp lệ"})
+            
+        except urllib.error.HTTPError as e:
+            error_msg = f"Gemini API lỗi HTTP {e.code}"
+            logger.warning(f"Query optimizer HTTP error: {e.code}")
+            return (False, {"error": error_msg})
+        except urllib.error.URLError as e:
+            logger.warning(f"Query optimizer connection error: {e}")
+            return (False, {"error": "Không thể kết nối đến Gemini"})
+        except Exception as e:
+            logger.warning(f"Query optimizer error: {e}")
+            return (False, {"error": str(e)})
+
+    def handle_llm7_chat(self):
+        """Generic handler for all LLM7 models via LLM7.io"""
+        try:
+            # Get username from session cookie
+            username = self._get_username_from_cookie()
+            
+            # Read request body
+            request_data = self._read_json_body()
+            
+            # Extract model and message from request
+            model_id = request_data.get('model', 'gpt-5-chat')
+            message = request_data.get('message', '')
+            if not message:
+                self._send_json_error(400, "Message không được để trống", "MISSING_MESSAGE")
+                return
+            
+            # Extract files from request (for vision/image analysis)
+            files = request_data.get('files', [])
+            file_error = validate_request_files(files)
+            if file_error:
+                self._send_json_error(*file_error)
+                return
+            
+            # Support conversation history - check if messages array is provided
+            conversation_messages = request_data.get('messages', [])
+            
+            # Build messages array with system prompt, conversation history và identity guardrail
+            messages = build_llm7_messages(model_id, message, conversation_messages, identity_guard=True)
+            
+            # Add files to the last user message if present (for vision models)
+            if files and len(files) > 0:
+                # Get image description from Gemini Vision (Independent processing)
+                image_descriptions = [
+                    self.get_gemini_vision_description(file['base64'])
+                    for file in files if file.get('base64')
+                ]
+                messages = attach_image_descriptions(messages, image_descriptions)
+            
+            stream = bool(request_data.get('stream'))
+            
+            # Câu hỏi 1 lượt (không file) giống hệt câu đã trả lời gần đây → dùng lại câu trả lời đã cache
+            cache_key = None if files else response_cache_key(request_data, self.headers, model_id, messages)
+            cached = RESPONSE_CACHE.get(cache_key) if cache_key else None
+            if cached is not None:
+                self._send_cached_chat_reply(cached, stream, username, model_id, message, 'llm7_chat')
+                return
+            
+            # Gọi LLM7, tự failover sang provider tiếp theo trong MODEL_FALLBACK_CHAINS khi lỗi
+            start_time = time.time()
+            step, response, failed_over = self._call_chat_chain(model_id, messages, stream)
+            if stream:
+                self._relay_chat_stream(step, failed_over, response, start_time, username, model_id, message, 'llm7_chat', len(files) > 0, cache_key)
+                return
+            
+            with response:
+                reply = extract_chat_reply(step["provider"], json.loads(response.read().decode('utf-8')))
+            if cache_key and reply:
+                RESPONSE_CACHE.set(cache_key, {"reply": reply, "model": step["model"], "provider": step["provider"]})
+            
+            # Save AI history
+            metadata = {'endpoint': 'llm7_chat', 'has_files': len(files) > 0}
+            metadata.update(chat_provider_metadata(step, failed_over))
+            save_ai_history(
+                username=username,
+                model=model_id,
+                prompt=message,
+                response=reply,
+                metadata=metadata
+            )
+            
+            # Return response to client
+            self._send_json_response(200, {
+                "reply": reply,
+                "model": step["model"],
+                "provider": step["provider"]
+            })
+            
+            logger.info(f"{model_id} completed successfully via {step['provider']}")
+            
+        except NoChatProviderError as e:
+            self._send_json_error(500, str(e), "API_KEY_MISSING")
+        except CircuitOpenError as e:
+            self._send_circuit_open(e)
+        except urllib.error.HTTPError as e:
+            try:
+                error_body = e.read().decode('utf-8')
+                self._send_json_error(e.code, f"LLM7 API lỗi: {error_body}", "UPSTREAM_ERROR")
+            except:
+                self._send_json_error(e.code, f"LLM7 API lỗi: {e.reason}", "UPSTREAM_ERROR")
+        except urllib.error.URLError as e:
+            logger.error(f"LLM7 connection error: {e}")
+            self._send_json_error(502, "Không thể kết nối đến LLM7 API", "CONNECTION_ERROR")
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON in LLM7 request: {e}")
+            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
+        except Exception as e:
+            logger.error(f"LLM7 chat error: {e}")
+            logger.error(f"Exception type: {type(e)}")
+            logger.error(f"Exception args: {e.args}")
+            # Lấy model name từ request_data nếu có thể
+            model_display_name = "AI"
+            try:
+                # Đảm bảo request_data tồn tại và có trường model
+                if 'request_data' in locals() and isinstance(request_data, dict):
+                    model_display_name = request_data.get('model', 'AI')
+            except:
+                pass
+            self._send_json_error(503, f"Xin lỗi, đã có lỗi xảy ra khi gọi {model_display_name}. Chi tiết: Lỗi hệ thống: {str(e)} Vui lòng thử lại hoặc chọn model khác.", "SYSTEM_ERROR")
+
+    def handle_enhance_prompt(self):
+        """Enhance prompt using Gemini AI to expand Vietnamese abbreviations and improve quality"""
+        try:
+            # Get Gemini API key
+            gemini_key = API_KEYS.acquire('gemini')
+            if not gemini_key or gemini_key == "your_gemini_api_key_here":
+                self._send_json_error(500, 
+                    "Gemini API key chưa được cấu hình. Vui lòng thêm GEMINI_API_KEY vào environment variables.",
+                    "API_KEY_MISSING")
+                return
+            
+            # Read request body
+            request_data = self._read_json_body()
+            
+            # Extract user prompt
+            user_prompt = request_data.get('prompt', '')
+            if not user_prompt:
+                self._send_json_error(400, "Prompt không được để trống", "MISSING_PROMPT")
+                return
+            
+            # Bấm "tạo lại" với cùng prompt → dùng kết quả đã cache, không gọi Gemini
+            cache_key = normalize_cache_text(user_prompt)
+            cached = ENHANCE_CACHE.get(cache_key)
+            if cached is not None:
+                logger.info(f"Enhance prompt cache hit: '{user_prompt}'")
+                self._send_json_response(200, {
+                    "original_prompt": user_prompt,
+                    "enhanced_prompt": cached,
+                    "success": True
+                })
+                return
+            
+            # Build Gemini API URL
+            gemini_url = gemini_generate_url('gemini-2.5-flash', gemini_key)
+            
+            # Prepare Gemini request (mở rộng viết tắt tiếng Việt + cải thiện prompt)
+            gemini_payload = build_enhance_prompt_payload(user_prompt)
+            
+            gemini_request = urllib.request.Request(
+                gemini_url,
+                data=json.dumps(gemini_payload).encode('utf-8'),
+                headers={'Content-Type': 'application/json'}
+            )
+            
+            with upstream_call('gemini', gemini_request, api_key=gemini_key) as response:
+                gemini_response = response.read().decode('utf-8')
+                gemini_data = json.loads(gemini_response)
+            
+            # Extract enhanced prompt
+            enhanced_prompt = extract_gemini_text(gemini_data)
+            
+            if enhanced_prompt:
+                ENHANCE_CACHE.set(cache_key, enhanced_prompt.strip())
+            else:
+                enhanced_prompt = user_prompt  # Fallback to original (không cache)
+            
+            # Return response to client
+            self._send_json_response(200, {
+                "original_prompt": user_prompt,
+                "enhanced_prompt": enhanced_prompt.strip(),
+                "success": True
+            })
+            
+            logger.info(f"Prompt enhanced: '{user_prompt}' -> '{enhanced_prompt.strip()}'")
+            
+        except CircuitOpenError as e:
+            self._send_circuit_open(e)
+        except urllib.error.HTTPError as e:
+            try:
+                error_body = e.read().decode('utf-8')
+                self._send_json_error(e.code, f"Gemini API lỗi: {error_body}", "UPSTREAM_ERROR")
+            except:
+                self._send_json_error(e.code, f"Gemini API lỗi: {e.reason}", "UPSTREAM_ERROR")
+        except urllib.error.URLError as e:
+            logger.error(f"Gemini connection error: {e}")
+            self._send_json_error(502, "Không thể kết nối đến Gemini API", "CONNECTION_ERROR")
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON in enhance prompt request: {e}")
+            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
+        except Exception as e:
+            logger.error(f"Enhance prompt error: {e}")
+            logger.error(f"Exception type: {type(e)}")
+            logger.error(f"Exception args: {e.args}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_pollinations_generate(self):
+        """Generate image using Pollinations AI (Flux model) - Free, no API key required"""
+        try:
+            # Read request body
+            request_data = self._read_json_body()
+            
+            # Extract parameters
+            prompt = request_data.get('prompt', '')
+            
+            if not prompt:
+                self._send_json_error(400, "Prompt không được để trống", "MISSING_PROMPT")
+                return
+            
+            # Validate prompt length (prevent oversized payloads)
+            if len(prompt) > 5000:
+                self._send_json_error(400, "Prompt quá dài. Vui lòng giới hạn trong 5000 ký tự.", "PROMPT_TOO_LONG")
+                return
+            
+            # Build Pollinations AI URL with Flux model
+            pollinations_url = build_pollinations_url(prompt)
+            
+            logger.info(f"🎨 Đang gọi Pollinations AI (Flux) để vẽ: {prompt[:50]}...")
+            
+            # Call Pollinations API - it returns the image directly
+            pollinations_request = urllib.request.Request(
+                pollinations_url,
+                headers={
+                    'User-Agent': 'NexoraX-AI/1.0'
+                }
+            )
+            
+            with upstream_call('pollinations', pollinations_request, read_body=False) as response:
+                # Get the final URL after redirects (this is the actual image URL)
+                final_url = response.geturl()
+                
+                # Return response with image URL
+                self._send_json_response(200, {
+                    "success": True,
+                    "image_url": final_url,
+                    "prompt": prompt,
+                    "model": "pollinations-flux"
+                })
+                
+                logger.info(f"✅ Ảnh đã tạo thành công với Pollinations AI (Flux)")
+                return
+            
+        except CircuitOpenError as e:
+            self._send_circuit_open(e)
+        except urllib.error.HTTPError as e:
+            try:
+                error_body = e.read().decode('utf-8')
+                logger.error(f"Pollinations HTTP error: {e.code} - {error_body}")
+                self._send_json_error(e.code, f"Pollinations API lỗi: {error_body}", "UPSTREAM_ERROR")
+            except:
+                self._send_json_error(e.code, f"Pollinations API lỗi: {e.reason}", "UPSTREAM_ERROR")
+        except urllib.error.URLError as e:
+            logger.error(f"Pollinations connection error: {e}")
+            self._send_json_error(502, "Không thể kết nối đến Pollinations API", "CONNECTION_ERROR")
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON in Pollinations request: {e}")
+            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
+        except Exception as e:
+            logger.error(f"Pollinations generate error: {e}")
+            logger.error(f"Exception type: {type(e)}")
+            logger.error(f"Exception args: {e.args}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_auth_signup(self):
+        """Handle user signup"""
+        try:
+            request_data = self._read_json_body()
+            
+            username = request_data.get('username', '').strip()
+            password = request_data.get('password', '').strip()
+            
+            if not username or not password:
+                self._send_json_error(400, "Username và password không được để trống", "MISSING_CREDENTIALS")
+                return
+            
+            valid_username, username_msg = validate_username(username)
+            if not valid_username:
+                self._send_json_error(400, username_msg, "INVALID_USERNAME")
+                return
+            
+            valid_password, password_msg = validate_password(password)
+            if not valid_password:
+                self._send_json_error(400, password_msg, "INVALID_PASSWORD")
+                return
+            
+            if check_user_exists(username):
+                self._send_json_error(400, "Username đã tồn tại", "USERNAME_EXISTS")
+                return
+            
+            if save_user(username, password):
+                remember_me = request_data.get('remember_me', False)
+                session_id = create_session(username, remember_me=remember_me)
+                
+                max_age = (30 * 24 * 3600) if remember_me else (7 * 24 * 3600)
+                cookie_value = f"session_id={session_id}; Path=/; HttpOnly; SameSite=Lax; Max-Age={max_age}"
+                if os.getenv('REPLIT_DOMAIN') or os.getenv('RENDER'):
+                    cookie_value += "; Secure"
+                
+                self._send_json_response(200, {
+                    "success": True,
+                    "username": username,
+                    "remember_me": remember_me
+                }, headers=[('Set-Cookie', cookie_value)])
+                
+                logger.info(f"User registered successfully: {username}")
+            else:
+                self._send_json_error(500, "Lỗi khi lưu thông tin người dùng", "SAVE_ERROR")
+                
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON in signup request: {e}")
+            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ", "INVALID_JSON")
+        except Exception as e:
+            logger.error(f"Signup error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_auth_login(self):
+        """Handle user login - tự động tạo tài khoản nếu chưa tồn tại"""
+        try:
+            request_data = self._read_json_body()
+            
+            username = request_data.get('username', '').strip()
+            password = request_data.get('password', '').strip()
+            
+            if not username or not password:
+                self._send_json_error(400, "Username và password không được để trống", "MISSING_CREDENTIALS")
+                return
+            
+            valid_username, username_err = validate_username(username)
+            valid_password, password_err = validate_password(password)
+            
+            if not valid_username:
+                self._send_json_error(400, username_err, "INVALID_USERNAME")
+                return
+            
+            if not valid_password:
+                self._send_json_error(400, password_err, "INVALID_PASSWORD")
+                return
+            
+            is_limited, limit_message, wait_time, attempts = reserve_login_attempt(username)
+            if is_limited:
+                self._send_json_error(429, limit_message, "RATE_LIMITED")
+                return
+            
+            is_new_account = False
+            
+            if not check_user_exists(username):
+                if save_user(username, password):
+                    is_new_account = True
+                    logger.info(f"Auto-created new account for: {username}")
+                else:
+                    self._send_json_error(500, "Lỗi khi tạo tài khoản", "CREATE_ERROR")
+                    return
+            
+            if authenticate_user(username, password):
+                clear_rate_limit(username)
+                remember_me = request_data.get('remember_me', False)
+                session_id = create_session(username, remember_me=remember_me)
+                
+                max_age = (30 * 24 * 3600) if remember_me else (7 * 24 * 3600)
+                cookie_value = f"session_id={session_id}; Path=/; HttpOnly; SameSite=Lax; Max-Age={max_age}"
+                if os.getenv('REPLIT_DOMAIN') or os.getenv('RENDER'):
+                    cookie_value += "; Secure"
+                
+                self._send_json_response(200, {
+                    "success": True,
+                    "username": username,
+                    "remember_me": remember_me,
+                    "is_new_account": is_new_account
+                }, headers=[('Set-Cookie', cookie_value)])
+                
+                if is_new_account:
+                    logger.info(f"New user registered and logged in: {username}")
+                else:
+                    logger.info(f"User logged in successfully: {username}")
+            else:
+                remaining = MAX_LOGIN_ATTEMPTS - attempts
+                if remaining > 0:
+                    error_msg = f"Mật khẩu không đúng. Còn {remaining} lần thử"
+                else:
+                    error_msg = "Quá nhiều lần thử. Tài khoản đã bị khóa tạm thời"
+                self._send_json_error(401, error_msg, "INVALID_CREDENTIALS")
+                
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON in login request: {e}")
+            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ", "INVALID_JSON")
+        except Exception as e:
+            logger.error(f"Login error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_auth_logout(self):
+        """Handle user logout"""
+        try:
+            session_id = None
+            
+            if 'Cookie' in self.headers:
+                cookies = self.headers['Cookie']
+                for cookie in cookies.split(';'):
+                    if 'session_id=' in cookie:
+                        session_id = cookie.split('session_id=')[1].strip()
+                        break
+            
+            if not session_id:
+                post_data = self._read_request_body()
+                if post_data:
+                    request_data = self._read_json_body()
+                    session_id = request_data.get('session_id', '').strip()
+            
+            if not session_id:
+                self._send_json_error(400, "Session ID không được để trống", "MISSING_SESSION_ID")
+                return
+            
+            delete_session(session_id)
+            
+            cookie_value = "session_id=; Path=/; HttpOnly; SameSite=Lax; Max-Age=0"
+            if os.getenv('REPLIT_DOMAIN') or os.getenv('RENDER'):
+                cookie_value += "; Secure"
+            
+            self._send_json_response(200, {
+                "success": True,
+                "message": "Đăng xuất thành công"
+            }, headers=[('Set-Cookie', cookie_value)])
+                
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON in logout request: {e}")
+            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ", "INVALID_JSON")
+        except Exception as e:
+            logger.error(f"Logout error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_github_oauth_status(self):
+        """Kiểm tra xem GitHub OAuth đã được cấu hình chưa"""
+        try:
+            configured = is_github_oauth_configured()
+            self._send_json_response(200, {
+                "configured": configured
+            })
+        except Exception as e:
+            logger.error(f"GitHub OAuth status check error: {e}")
+            self._send_json_error(500, "Lỗi kiểm tra cấu hình GitHub OAuth", "SYSTEM_ERROR")
+
+    def handle_github_oauth_start(self):
+        """Khởi tạo GitHub OAuth flow - redirect user đến GitHub"""
+        try:
+            client_id, client_secret = get_github_oauth_credentials()
+            
+            if not client_id or not client_secret:
+                self._send_redirect('/?error=github_not_configured')
+                return
+            
+            state = secrets.token_urlsafe(32)
+            github_oauth_states[state] = {
+                'created_at': time.time(),
+                'expires_at': time.time() + GITHUB_STATE_EXPIRY
+            }
+            
+            current_time = time.time()
+            expired_states = [s for s, data in github_oauth_states.items() 
+                           if current_time >= data.get('expires_at', 0)]
+            for s in expired_states:
+                del github_oauth_states[s]
+            
+            replit_domain = os.getenv('REPLIT_DEV_DOMAIN', '') or os.getenv('REPLIT_DOMAIN', '')
+            if replit_domain:
+                callback_url = f"https://{replit_domain}/auth/github/callback"
+            else:
+                callback_url = "http://localhost:5000/auth/github/callback"
+            
+            github_auth_url = (
+                f"https://github.com/login/oauth/authorize"
+                f"?client_id={client_id}"
+                f"&redirect_uri={urllib.parse.quote(callback_url)}"
+                f"&scope=user:email"
+                f"&state={state}"
+            )
+            
+            logger.info(f"Starting GitHub OAuth flow, redirecting to GitHub")
+            
+            self._send_redirect(github_auth_url)
+            
+        except Exception as e:
+            logger.error(f"GitHub OAuth start error: {e}")
+            self._send_redirect('/?error=github_oauth_failed')
+
+    def handle_github_oauth_callback(self):
+        """Xử lý callback từ GitHub sau khi user authorize"""
+        try:
+            from urllib.parse import parse_qs, urlparse
+            parsed = urlparse(self.path)
+            query_params = parse_qs(parsed.query)
+            
+            code = query_params.get('code', [None])[0]
+            state = query_params.get('state', [None])[0]
+            error = query_params.get('error', [None])[0]
+            
+            if error:
+                logger.warning(f"GitHub OAuth error: {error}")
+                self._send_redirect(f'/?error=github_denied&message={error}')
+                return
+            
+            if not code or not state:
+                logger.warning("GitHub OAuth callback missing code or state")
+                self._send_redirect('/?error=github_invalid_callback')
+                return
+            
+            if state not in github_oauth_states:
+                logger.warning("GitHub OAuth callback invalid or expired state")
+                self._send_redirect('/?error=github_invalid_state')
+                return
+            
+            state_data = github_oauth_states.pop(state)
+            if time.time() >= state_data.get('expires_at', 0):
+                logger.warning("GitHub OAuth callback expired state")
+                self._send_redirect('/?error=github_expired_state')
+                return
+            
+            client_id, client_secret = get_github_oauth_credentials()
+            
+            token_url = "https://github.com/login/oauth/access_token"
+            token_data = urllib.parse.urlencode({
+                'client_id': client_id,
+                'client_secret': client_secret,
+                'code': code
+            }).encode('utf-8')
+            
+            token_request = urllib.request.Request(
+                token_url,
+                data=token_data,
+                headers={
+                    'Accept': 'application/json',
+                    'Content-Type': 'application/x-www-form-urlencoded'
+                }
+            )
+            
+            with upstream_call('github', token_request) as response:
+                token_response = json.loads(response.read().decode('utf-8'))
+            
+            access_token = token_response.get('access_token')
+            if not access_token:
+                error_desc = token_response.get('error_description', 'Unknown error')
+                logger.error(f"GitHub OAuth token error: {error_desc}")
+                self._send_redirect(f'/?error=github_token_failed&message={urllib.parse.quote(error_desc)}')
+                return
+            
+            user_request = urllib.request.Request(
+                "https://api.github.com/user",
+                headers={
+                    'Authorization': f'Bearer {access_token}',
+                    'Accept': 'application/vnd.github+json',
+                    'User-Agent': 'NexoraX-AI'
+                }
+            )
+            
+            with upstream_call('github', user_request) as response:
+                github_user = json.loads(response.read().decode('utf-8'))
+            
+            github_id = github_user.get('id')
+            github_login = github_user.get('login')
+            github_email = github_user.get('email')
+            github_name = github_user.get('name') or github_login
+            
+            if not github_email:
+                try:
+                    email_request = urllib.request.Request(
+                        "https://api.github.com/user/emails",
+                        headers={
+                            'Authorization': f'Bearer {access_token}',
+                            'Accept': 'application/vnd.github+json',
+                            'User-Agent': 'NexoraX-AI'
+                        }
+                    )
+                    with upstream_call('github', email_request) as response:
+                        emails = json.loads(response.read().decode('utf-8'))
+                        for email_obj in emails:
+                            if email_obj.get('primary') and email_obj.get('verified'):
+                                github_email = email_obj.get('email')
+                                break
+                except Exception as e:
+                    logger.debug(f"Could not fetch GitHub emails: {e}")
+            
+            username = f"gh_{github_login}"
+            oauth_password = f"oauth:github:{github_id}"
+            
+            if username not in users:
+                save_user(username, oauth_password)
+                logger.info(f"Created new GitHub user: {username}")
+            else:
+                if users.get(username) != oauth_password:
+                    logger.warning(f"Username {username} already exists with different credentials")
+            
+            session_id = create_session(username, remember_me=True, display_name=github_name)
+            
+            max_age = 30 * 24 * 3600
+            cookie_value = f"session_id={session_id}; Path=/; HttpOnly; SameSite=Lax; Max-Age={max_age}"
+            if os.getenv('REPLIT_DOMAIN') or os.getenv('REPLIT_DEV_DOMAIN') or os.getenv('RENDER'):
+                cookie_value += "; Secure"
+            
+            logger.info(f"GitHub OAuth login successful: {username} (display: {github_name})")
+            
+            self.send_response(302)
+            self.send_header('Set-Cookie', cookie_value)
+            self.send_header('Location', f'/?github_login=success&username={urllib.parse.quote(username)}&display_name={urllib.parse.quote(github_name)}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            
+        except urllib.error.HTTPError as e:
+            logger.error(f"GitHub API HTTP error: {e.code} - {e.reason}")
+            self._send_redirect(f'/?error=github_api_error&code={e.code}')
+        except urllib.error.URLError as e:
+            logger.error(f"GitHub API URL error: {e.reason}")
+            self._send_redirect('/?error=github_network_error')
+        except Exception as e:
+            logger.error(f"GitHub OAuth callback error: {e}")
+            self._send_redirect('/?error=github_oauth_failed')
+
+    def handle_auth_check_session(self):
+        """Handle check session status"""
+        try:
+            session_id = None
+            
+            if 'Cookie' in self.headers:
+                cookies = self.headers['Cookie']
+                for cookie in cookies.split(';'):
+                    if 'session_id=' in cookie:
+                        session_id = cookie.split('session_id=')[1].strip()
+                        break
+            
+            if not session_id and 'Authorization' in self.headers:
+                auth_header = self.headers['Authorization']
+                if auth_header.startswith('Bearer '):
+                    session_id = auth_header[7:].strip()
+            
+            if 'session_id' in self.path:
+                from urllib.parse import parse_qs, urlparse
+                parsed = urlparse(self.path)
+                query_params = parse_qs(parsed.query)
+                if 'session_id' in query_params:
+                    session_id = query_params['session_id'][0]
+            
+            if session_id:
+                username = get_user_from_session(session_id)
+                if username:
+                    rotated = False
+                    session_data = sessions.get(session_id)
+                    if session_data and session_data is not None:
+                        current_time = time.time()
+                        expires_at = session_data.get('expires_at', 0)
+                        total_duration = (30 * 24 * 3600) if session_data.get('remember_me') else (SESSION_EXPIRY_HOURS * 3600)
+                        time_remaining = expires_at - current_time
+                        
+                        if time_remaining < (total_duration * 0.25):
+                            new_session_id = rotate_session(session_id)
+                            if new_session_id:
+                                session_id = new_session_id
+                                rotated = True
+                    
+                    cookie_headers = []
+                    
+                    if rotated and session_data is not None:
+                        remember_me = session_data.get('remember_me', False)
+                        max_age = (30 * 24 * 3600) if remember_me else (7 * 24 * 3600)
+                        cookie_value = f"session_id={session_id}; Path=/; HttpOnly; SameSite=Lax; Max-Age={max_age}"
+                        if os.getenv('REPLIT_DOMAIN') or os.getenv('RENDER'):
+                            cookie_value += "; Secure"
+                        cookie_headers.append(('Set-Cookie', cookie_value))
+                    
+                    display_name = session_data.get('display_name', username) if session_data else username
+                    self._send_json_response(200, {
+                        "valid": True,
+                        "username": username,
+                        "display_name": display_name,
+                        "rotated": rotated
+                    }, headers=cookie_headers)
+                    return
+            
+            self._send_json_response(200, {
+                "valid": False,
+                "username": None
+            })
+                
+        except Exception as e:
+            logger.error(f"Check session error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_admin_get_users(self):
+        """Admin API: Get all users"""
+        try:
+            user_list = []
+            for username, password in list(users.items()):
+                user_list.append({
+                    "username": username,
+                    "password_length": len(password)
+                })
+            
+            self._send_json_response(200, {
+                "success": True,
+                "total_users": len(user_list),
+                "users": user_list
+            })
+            
+            logger.info(f"Admin API: Retrieved {len(user_list)} users")
+            
+        except Exception as e:
+            logger.error(f"Admin get users error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_admin_get_sessions(self):
+        """Admin API: Get all active sessions"""
+        try:
+            current_time = time.time()
+            session_list = []
+            
+            for session_id, session_data in list(sessions.items()):
+                expires_at = session_data.get('expires_at', 0)
+                time_remaining = expires_at - current_time
+                
+                session_list.append({
+                    "session_id": session_id[:16] + "...",
+                    "username": session_data.get('username'),
+                    "remember_me": session_data.get('remember_me', False),
+                    "expires_at": expires_at,
+                    "time_remaining_seconds": int(time_remaining) if time_remaining > 0 else 0,
+                    "is_expired": time_remaining <= 0
+                })
+            
+            self._send_json_response(200, {
+                "success": True,
+                "total_sessions": len(session_list),
+                "sessions": session_list
+            })
+            
+            logger.info(f"Admin API: Retrieved {len(session_list)} sessions")
+            
+        except Exception as e:
+            logger.error(f"Admin get sessions error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_admin_routes(self):
+        """Admin API: Route registry với số lượt gọi và latency theo route"""
+        try:
+            routes = sorted(ROUTER.get_stats(), key=lambda r: r["hits"], reverse=True)
+            self._send_json_response(200, {
+                "success": True,
+                "total": len(routes),
+                "routes": routes
+            })
+        except Exception as e:
+            logger.error(f"Admin routes error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_admin_upstream(self):
+        """Admin API: Metrics và policy của từng upstream provider"""
+        try:
+            metrics = UPSTREAM_METRICS.get_stats()
+            upstreams = {}
+            for name in sorted(set(UPSTREAM_POLICIES) | set(metrics)):
+                if name == 'default':
+                    continue
+                policy = get_upstream_policy(name)
+                breaker = _get_circuit_breaker(policy)
+                upstreams[name] = {
+                    "policy": policy,
+                    "metrics": metrics.get(name),
+                    "circuit_state": breaker.state if breaker else None
+                }
+            pools = {"threaded": UPSTREAM_POOL.get_stats()}
+            if isinstance(self.server, AsyncNexoraXServer):
+                pools["asyncio"] = ASYNC_UPSTREAM_POOL.get_stats()
+            self._send_json_response(200, {
+                "success": True,
+                "upstreams": upstreams,
+                "retry_budget": RETRY_BUDGET.get_stats(),
+                "connection_pools": pools
+            })
+        except Exception as e:
+            logger.error(f"Admin upstream error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_admin_circuits(self):
+        """Admin API: Trạng thái circuit breaker của từng upstream"""
+        try:
+            for name in UPSTREAM_POLICIES:
+                if name != 'default':
+                    _get_circuit_breaker(get_upstream_policy(name))  # tạo sẵn để hiển thị cả breaker chưa dùng
+            circuits = CIRCUIT_BREAKERS.get_stats()
+            self._send_json_response(200, {
+                "success": True,
+                "open": sorted(name for name, stats in circuits.items() if stats["state"] != CircuitBreaker.CLOSED),
+                "circuits": circuits
+            })
+        except Exception as e:
+            logger.error(f"Admin circuits error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_admin_circuit_reset(self):
+        """Admin API: Đóng circuit breaker thủ công (vd sau khi đã xác nhận upstream hồi phục)"""
+        try:
+            request_data = self._read_json_body()
+            name = request_data.get('name', '')
+            if name not in CIRCUIT_BREAKERS.names():
+                self._send_json_error(404, f"Circuit '{name}' không tồn tại", "CIRCUIT_NOT_FOUND")
+                return
+            CIRCUIT_BREAKERS.get(name).reset()
+            logger.info(f"Admin API: Reset circuit '{name}'")
+            self._send_json_response(200, {"success": True, "circuit": CIRCUIT_BREAKERS.get(name).get_stats()})
+        except json.JSONDecodeError:
+            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "INVALID_JSON")
+        except Exception as e:
+            logger.error(f"Admin circuit reset error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_admin_get_stats(self):
+        """Admin API: Get system statistics"""
+        try:
+            current_time = time.time()
+            
+            active_sessions_count = sum(1 for s in list(sessions.values()) if current_time < s.get('expires_at', 0))
+            expired_sessions_count = sum(1 for s in list(sessions.values()) if current_time >= s.get('expires_at', 0))
+            
+            locked_users_count = sum(1 for data in rate_limits.values() if current_time < data.get('locked_until', 0))
+            
+            stats = {
+                "users": {
+                    "total": len(users),
+                    "locked": locked_users_count
+                },
+                "sessions": {
+                    "total": len(sessions),
+                    "active": active_sessions_count,
+                    "expired": expired_sessions_count
+                },
+                "rate_limits": {
+                    "total": len(rate_limits),
+                    "currently_locked": locked_users_count
+                },
+                "system": {
+                    "session_expiry_hours": SESSION_EXPIRY_HOURS,
+                    "max_login_attempts": MAX_LOGIN_ATTEMPTS,
+                    "rate_limit_window_seconds": RATE_LIMIT_WINDOW
+                }
+            }
+            
+            if hasattr(self.server, 'get_stats'):
+                stats["server"] = self.server.get_stats()
+            
+            stats["upstream_pool"] = UPSTREAM_POOL.get_stats()
+            if isinstance(self.server, AsyncNexoraXServer):
+                stats["async_upstream_pool"] = ASYNC_UPSTREAM_POOL.get_stats()
+            stats["caches"] = {name: cache.get_stats() for name, cache in CACHES.items()}
+            stats["single_flight"] = {name: flight.get_stats() for name, flight in SINGLE_FLIGHTS.items()}
+            stats["background_executor"] = BACKGROUND_EXECUTOR.get_stats()
+            stats["clock"] = CLOCK.get_stats()
+            
+            self._send_json_response(200, {
+                "success": True,
+                "stats": stats
+            })
+            
+            logger.info("Admin API: Retrieved system stats")
+            
+        except Exception as e:
+            logger.error(f"Admin get stats error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_admin_get_rate_limits(self):
+        """Admin API: Get all rate limits"""
+        try:
+            current_time = time.time()
+            rate_limit_list = []
+            
+            for username, data in list(rate_limits.items()):
+                locked_until = data.get('locked_until', 0)
+                time_remaining = locked_until - current_time if current_time < locked_until else 0
+                
+                rate_limit_list.append({
+                    "username": username,
+                    "attempts": data.get('attempts', 0),
+                    "last_attempt": data.get('last_attempt', 0),
+                    "locked_until": locked_until,
+                    "is_locked": current_time < locked_until,
+                    "time_remaining_seconds": int(time_remaining)
+                })
+            
+            self._send_json_response(200, {
+                "success": True,
+                "total_rate_limits": len(rate_limit_list),
+                "rate_limits": rate_limit_list
+            })
+            
+            logger.info(f"Admin API: Retrieved {len(rate_limit_list)} rate limits")
+            
+        except Exception as e:
+            logger.error(f"Admin get rate limits error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_admin_delete_user(self):
+        """Admin API: Delete a user"""
+        try:
+            request_data = self._read_json_body()
+            
+            username = request_data.get('username', '').strip()
+            
+            if not username:
+                self._send_json_error(400, "Username không được để trống", "MISSING_USERNAME")
+                return
+            
+            if username not in users:
+                self._send_json_error(404, f"User '{username}' không tồn tại", "USER_NOT_FOUND")
+                return
+            
+            with file_lock, interprocess_lock(ACCOUNTS_FILE):
+                # Prefork: lấy thêm user do worker khác vừa tạo trước khi ghi đè acc.txt
+                if SHARED_STATE_SYNC:
+                    _replace_dict_contents(users, load_users())
+                users.pop(username, None)
+                with open(ACCOUNTS_FILE, 'w', encoding='utf-8') as f:
+                    for user, pwd in users.items():
+                        f.write(f"{user}|{pwd}\n")
+            
+            sessions_to_delete = [sid for sid, data in list(sessions.items()) if data.get('username') == username]
+            for sid in sessions_to_delete:
+                delete_session(sid)
+            
+            with file_lock:
+                if rate_limits.pop(username, None) is not None:
+                    save_rate_limits()
+            
+            self._send_json_response(200, {
+                "success": True,
+                "message": f"User '{username}' đã được xóa thành công",
+                "sessions_deleted": len(sessions_to_delete)
+            })
+            
+            logger.info(f"Admin API: Deleted user '{username}' and {len(sessions_to_delete)} sessions")
+            
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON in delete user request: {e}")
+            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ", "INVALID_JSON")
+        except Exception as e:
+            logger.error(f"Admin delete user error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_admin_delete_session(self):
+        """Admin API: Delete a session by username"""
+        try:
+            request_data = self._read_json_body()
+            
+            username = request_data.get('username', '').strip()
+            
+            if not username:
+                self._send_json_error(400, "Username không được để trống", "MISSING_USERNAME")
+                return
+            
+            sessions_to_delete = [sid for sid, data in list(sessions.items()) if data.get('username') == username]
+            
+            if not sessions_to_delete:
+                self._send_json_error(404, f"Không tìm thấy session nào của user '{username}'", "SESSION_NOT_FOUND")
+                return
+            
+            for sid in sessions_to_delete:
+                delete_session(sid)
+            
+            self._send_json_response(200, {
+                "success": True,
+                "message": f"Đã xóa {len(sessions_to_delete)} session(s) của user '{username}'",
+                "sessions_deleted": len(sessions_to_delete)
+            })
+            
+            logger.info(f"Admin API: Deleted {len(sessions_to_delete)} sessions for user '{username}'")
+            
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON in delete session request: {e}")
+            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ", "INVALID_JSON")
+        except Exception as e:
+            logger.error(f"Admin delete session error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_admin_clear_rate_limit(self):
+        """Admin API: Clear rate limit for a user"""
+        try:
+            request_data = self._read_json_body()
+            
+            username = request_data.get('username', '').strip()
+            
+            if not username:
+                self._send_json_error(400, "Username không được để trống", "MISSING_USERNAME")
+                return
+            
+            with file_lock:
+                removed = rate_limits.pop(username, None) is not None
+                if removed:
+                    save_rate_limits()
+            if not removed:
+                self._send_json_error(404, f"User '{username}' không có rate limit", "RATE_LIMIT_NOT_FOUND")
+                return
+            
+            self._send_json_response(200, {
+                "success": True,
+                "message": f"Đã xóa rate limit cho user '{username}'"
+            })
+            
+            logger.info(f"Admin API: Cleared rate limit for user '{username}'")
+            
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON in clear rate limit request: {e}")
+            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ", "INVALID_JSON")
+        except Exception as e:
+            logger.error(f"Admin clear rate limit error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_admin_logs(self):
+        """Admin API: Get server logs from server.log file"""
+        try:
+            # Parse query parameters
+            from urllib.parse import parse_qs, urlparse
+            parsed = urlparse(self.path)
+            params = parse_qs(parsed.query)
+            
+            limit = int(params.get('limit', ['100'])[0])
+            level_filter = params.get('level', [None])[0]  # INFO, ERROR, WARNING
+            
+            logs = []
+            total_lines = 0
+            
+            # Read server.log file
+            if os.path.exists(LOG_FILE):
+                with file_lock:
+                    with open(LOG_FILE, 'r', encoding='utf-8') as f:
+                        all_lines = f.readlines()
+                        total_lines = len(all_lines)
+                        
+                        # Filter by level if specified
+                        if level_filter:
+                            filtered_lines = [line for line in all_lines if f'- {level_filter} -' in line]
+                        else:
+                            filtered_lines = all_lines
+                        
+                        # Get last N lines
+                        recent_lines = filtered_lines[-limit:]
+                        
+                        for line in recent_lines:
+                            logs.append({
+                                'timestamp': line[:23] if len(line) > 23 else '',
+                                'content': line.strip()
+                            })
+            
+            self._send_json_response(200, {
+                "success": True,
+                "total_lines": total_lines,
+                "filtered_count": len(logs),
+                "limit": limit,
+                "level_filter": level_filter,
+                "logs": logs
+            })
+            
+            logger.info(f"Admin API: Retrieved {len(logs)} log entries")
+            
+        except Exception as e:
+            logger.error(f"Admin get logs error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_admin_history(self):
+        """Admin API: Get AI call history from ai_history.jsonl"""
+        try:
+            # Parse query parameters
+            from urllib.parse import parse_qs, urlparse
+            parsed = urlparse(self.path)
+            params = parse_qs(parsed.query)
+            
+            username_filter = params.get('username', [None])[0]
+            model_filter = params.get('model', [None])[0]
+            limit = int(params.get('limit', ['50'])[0])
+            
+            history = []
+            total_records = 0
+            
+            # Read ai_history.jsonl file
+            if os.path.exists(AI_HISTORY_FILE):
+                with file_lock:
+                    with open(AI_HISTORY_FILE, 'r', encoding='utf-8') as f:
+                        for line in f:
+                            if line.strip():
+                                try:
+                                    entry = json.loads(line.strip())
+                                    total_records += 1
+                                    
+                                    # Apply filters
+                                    if username_filter and entry.get('username') != username_filter:
+                                        continue
+                                    if model_filter and entry.get('model') != model_filter:
+                                        continue
+                                    
+                                    history.append(entry)
+                                except json.JSONDecodeError:
+                                    continue
+            
+            # Get last N entries
+            history = history[-limit:]
+            
+            self._send_json_response(200, {
+                "success": True,
+                "total_records": total_records,
+                "filtered_count": len(history),
+                "limit": limit,
+                "filters": {
+                    "username": username_filter,
+                    "model": model_filter
+                },
+                "history": history
+            })
+            
+            logger.info(f"Admin API: Retrieved {len(history)} AI history entries")
+            
+        except Exception as e:
+            logger.error(f"Admin get history error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_admin_usage(self):
+        """Admin API: Get AI usage statistics aggregated from history"""
+        try:
+            users_stats = {}
+            models_stats = {}
+            
+            # Read and aggregate ai_history.jsonl file
+            if os.path.exists(AI_HISTORY_FILE):
+                with file_lock:
+                    with open(AI_HISTORY_FILE, 'r', encoding='utf-8') as f:
+                        for line in f:
+                            if line.strip():
+                                try:
+                                    entry = json.loads(line.strip())
+                                    username = entry.get('username', 'anonymous')
+                                    model = entry.get('model', 'unknown')
+                                    
+                                    # Count by user
+                                    if username not in users_stats:
+                                        users_stats[username] = {
+                                            'username': username,
+                                            'total_calls': 0,
+                                            'models_used': {}
+                                        }
+                                    users_stats[username]['total_calls'] += 1
+                                    
+                                    if model not in users_stats[username]['models_used']:
+                                        users_stats[username]['models_used'][model] = 0
+                                    users_stats[username]['models_used'][model] += 1
+                                    
+                                    # Count by model
+                                    if model not in models_stats:
+                                        models_stats[model] = {
+                                            'model': model,
+                                            'total_calls': 0,
+                                            'unique_users': set()
+                                        }
+                                    models_stats[model]['total_calls'] += 1
+                                    models_stats[model]['unique_users'].add(username)
+                                    
+                                except json.JSONDecodeError:
+                                    continue
+            
+            # Convert sets to counts
+            models_list = []
+            for model, data in models_stats.items():
+                models_list.append({
+                    'model': model,
+                    'total_calls': data['total_calls'],
+                    'unique_users': len(data['unique_users'])
+                })
+            
+            # Sort by total_calls descending
+            users_list = sorted(users_stats.values(), key=lambda x: x['total_calls'], reverse=True)
+            models_list = sorted(models_list, key=lambda x: x['total_calls'], reverse=True)
+            
+            self._send_json_response(200, {
+                "success": True,
+                "total_calls": sum(u['total_calls'] for u in users_list),
+                "unique_users": len(users_list),
+                "unique_models": len(models_list),
+                "users_stats": users_list,
+                "models_stats": models_list
+            })
+            
+            logger.info("Admin API: Retrieved AI usage statistics")
+            
+        except Exception as e:
+            logger.error(f"Admin get usage error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_admin_config(self):
+        """Admin API: Get current configuration (Universal)"""
+        try:
+            config_data = {}
+            
+            # Danh sách các dịch vụ mặc định
+            default_services = ['gemini', 'serpapi', 'serper', 'llm7']
+            
+            # Lấy tất cả keys từ config_override trước (đây là các key đã được admin lưu)
+            with config.config_lock:
+                for service_key, value in config.config_override.items():
+                    config_data[service_key] = value
+            
+            # Sau đó lấy các dịch vụ mặc định nếu chưa có trong override
+            for service in default_services:
+                if service not in config_data:
+                    val = get_api_key(service)
+                    if val:
+                        config_data[service] = val
+            
+            # Số request/lỗi của từng key trong pool (key được che, chỉ hiện 4 ký tự cuối)
+            key_pools = {}
+            for service in config_data:
+                if get_api_keys(service):
+                    key_pools[service] = API_KEYS.get_stats(service)
+            
+            self._send_json_response(200, {
+                "success": True,
+                "config": config_data,
+                "key_pools": key_pools
+            })
+            
+            logger.info("Admin API: Retrieved universal config")
+            
+        except Exception as e:
+            logger.error(f"Admin get config error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def handle_admin_config_update(self):
+        """Admin API: Update ANY API key configuration"""
+        try:
+            request_data = self._read_json_body()
+            
+            service = request_data.get('service', '').strip().lower()
+            api_key = request_data.get('api_key', '')
+            # Pool nhiều key: gửi list trong "api_keys" hoặc chuỗi phân cách bằng dấu phẩy
+            if isinstance(request_data.get('api_keys'), list):
+                api_key = [str(key).strip() for key in request_data['api_keys'] if str(key).strip()]
+            else:
+                api_key = str(api_key).strip()
+            
+            if not service:
+                self._send_json_error(400, "Service không được để trống", "MISSING_SERVICE")
+                return
+            
+            if not api_key:
+                self._send_json_error(400, "API key không được để trống", "MISSING_API_KEY")
+                return
+            
+            # Cập nhật cấu hình (Hỗ trợ mọi key bất kỳ)
+            if not save_config_override(service, api_key):
+                self._send_json_error(500, "Không thể lưu cấu hình", "SAVE_ERROR")
+                return
+            
+            self._send_json_response(200, {
+                "success": True,
+                "message": f"Cấu hình cho '{service}' đã được cập nhật thành công"
+            })
+            
+            logger.info(f"Admin API: Updated universal config for service '{service}'")
+            
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON in config update request: {e}")
+            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ", "INVALID_JSON")
+        except Exception as e:
+            logger.error(f"Admin config update error: {e}")
+            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+
+    def _format_search_context_for_ai(self, serpapi_data, query):
+        """Format SerpAPI data into context for AI processing"""
+        context_parts = []
+        
+        # Add answer box if available
+        answer_box = serpapi_data.get('answer_box', {})
+        if answer_box.get('answer'):
+            context_parts.append(f"Câu trả lời nhanh: {answer_box['answer']}")
+        if answer_box.get('snippet'):
+            context_parts.append(f"Thông tin tổng quan: {answer_box['snippet']}")
+        if answer_box.get('title'):
+            context_parts.append(f"Tiêu đề: {answer_box['title']}")
+        
+        # Add knowledge graph information
+        knowledge_graph = serpapi_data.get('knowledge_graph', {})
+        if knowledge_graph.get('description'):
+            context_parts.append(f"Định nghĩa: {knowledge_graph['description']}")
+        if knowledge_graph.get('title'):
+            context_parts.append(f"Chủ đề chính: {knowledge_graph['title']}")
+        
+        # Add organic search results
+        organic_results = serpapi_data.get('organic_results', [])
+        if organic_results:
+            result_info = []
+            for result in organic_results[:5]:  # First 5 results
+                if result.get('title') and result.get('snippet'):
+                    result_info.append(f"{result['title']}: {result['snippet']}")
+            if result_info:
+                context_parts.append(f"Kết quả tìm kiếm từ Google:\n" + "\n".join(f"- {info}" for info in result_info))
+        
+        # Add search information
+        search_info = serpapi_data.get('search_information', {})
+        if search_info.get('total_results'):
+            context_parts.append(f"Tổng số kết quả tìm thấy: {search_info['total_results']:,}")
+        
+        return "\n\n".join(context_parts) if context_parts else "Không tìm thấy thông tin từ nguồn tìm kiếm."
+
+    def _create_search_enhanced_prompt(self, user_query, search_context):
+        """Create an enhanced prompt for Gemini that includes search context"""
+        prompt = f"""Bạn là NexoraX 2, một AI assistant được tích hợp với khả năng tìm kiếm thông tin thời gian thực qua Google Search. Hãy trả lời câu hỏi của người dùng dựa trên thông tin tìm kiếm được cung cấp và kiến thức của bạn.
+
+Câu hỏi của người dùng: {user_query}
+
+Thông tin tìm kiếm từ Google (qua SerpAPI):
+{search_context}
+
+Hướng dẫn trả lời:
+1. Sử dụng thông tin tìm kiếm để đưa ra câu trả lời chính xác và cập nhật
+2. Nếu thông tin tìm kiếm không đủ, hãy bổ sung từ kiến thức của bạn
+3. Trả lời bằng tiếng Việt một cách tự nhiên và dễ hiểu
+4. Nếu có nguồn thông tin, hãy đề cập đến nguồn đó
+5. Nếu thông tin không rõ ràng hoặc mâu thuẫn, hãy nói rõ điều đó
+6. Sử dụng emoji một cách tự nhiên trong câu trả lời để làm cho thông tin sinh động và thú vị hơn (không lạm dụng)
+
+Vui lòng trả lời:"""
+        
+        return prompt
+
+    def _send_static_file(self, file_path, content_type, headers):
+        """Gửi file tĩnh với Content-Length, ETag và Last-Modified (đọc file trước để 404 không bị lẫn vào body)
+
+        Nội dung lấy từ STATIC_CACHE; request có If-None-Match / If-Modified-Since còn khớp nhận 304 không body.
+        """
+        try:
+            entry = load_static_file(file_path)
+        except (FileNotFoundError, IsADirectoryError):
+            self.send_error(404)
+            return
+        headers = [('ETag', entry["etag"]), ('Last-Modified', entry["last_modified"])] + list(headers)
+        if is_not_modified(self.headers, entry):
+            self.send_response(304)
+            for header, value in headers:
+                self.send_header(header, value)
+            self.end_headers()
+            return
+        content = entry["content"]
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        for header, value in headers:
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def handle_ping(self):
+        """Health check"""
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain')
+        self.send_header('Content-Length', '4')
+        self.end_headers()
+        self.wfile.write(b"pong")
+
+    def do_OPTIONS(self):
+        """Handle CORS preflight requests"""
+        self.send_response(200)
+        # Use secure CORS headers consistently
+        self._send_cors_headers()
+        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Max-Age', '3600')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        """Handle GET requests with proper MIME types and caching"""
+        sync_shared_state()
+        # Log all requests
+        logger.info(f"GET {self.path} from {self.client_address[0]}")
+        
+        if self._dispatch_route('GET'):
+            return
+        
+        # Bỏ query string (vd "src/js/main.js?v=2") trước khi so khớp path và tra STATIC_CACHE
+        path = unquote(urllib.parse.urlsplit(self.path).path)
+        
+        # Handle root path
+        if path == '/':
+            path = self.path = '/index.html'
+        elif path == '/admin' or path == '/admin/':
+            path = self.path = '/admin.html'
+        
+        # translate_path: file tuyệt đối trong thư mục phục vụ (cũng bỏ query, chặn "..")
+        file_path = self.translate_path(self.path)
+        
+        # Set proper MIME types; "no-cache" = browser luôn hỏi lại bằng ETag, file không đổi thì nhận 304
+        if path.endswith('.css'):
+            self._send_static_file(file_path, 'text/css', [
+                ('Cache-Control', 'no-cache')
+            ])
+            return
+        
+        elif path.endswith('.js'):
+            self._send_static_file(file_path, 'application/javascript', [
+                ('Cache-Control', 'no-cache')
+            ])
+            return
+        
+        elif path.endswith('.html'):
+            self._send_static_file(file_path, 'text/html', [
+                ('Cache-Control', 'no-cache')
+            ])
+            return
+        
+        # For all other files, use default handler
+        super().do_GET()
+    
+    def log_message(self, format, *args):
+        """Override default logging to use our logger"""
+        logger.info(f"{self.client_address[0]} - {format % args}")
+
+class PooledHTTPServer(socketserver.TCPServer):
+    """TCPServer xử lý request song song bằng worker pool có giới hạn
+
+    Accept loop chỉ nhận kết nối và đẩy vào hàng đợi; các worker thread lấy ra
+    xử lý. Khi hàng đợi đầy, kết nối mới bị trả về 503 ngay thay vì treo.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    OVERLOAD_BODY = json.dumps({
+        "error": "Server đang quá tải, vui lòng thử lại",
+        "code": "SERVER_BUSY"
+    }, ensure_ascii=False).encode('utf-8')
+    OVERLOAD_RESPONSE = (
+        b"HTTP/1.1 503 Service Unavailable\r\n"
+        b"Content-Type: application/json\r\n"
+        b"Retry-After: 1\r\n"
+        b"Connection: close\r\n"
+        b"Content-Length: " + str(len(OVERLOAD_BODY)).encode('ascii') + b"\r\n"
+        b"\r\n" + OVERLOAD_BODY
+    )
+
+    def __init__(self, server_address, handler_class, pool_size=32, queue_size=128, backlog=256, reuse_port=False, max_stand_ins=None):
+        # request_queue_size phải được set trước khi listen() trong TCPServer.__init__
+        self.request_queue_size = backlog
+        # SO_REUSEPORT: nhiều worker process bind cùng port, kernel chia kết nối
+        self.allow_reuse_port = reuse_port
+        self.pool_size = pool_size
+        self._jobs = queue.Queue(maxsize=queue_size)
+        self._stats_lock = threading.Lock()
+        self._active = 0
+        self._served = 0
+        self._rejected = 0
+        self._parked = 0
+        self._stand_ins = 0
+        # Số worker tạm tối đa chạy cùng lúc: pool không bao giờ vượt pool_size + max_stand_ins thread
+        self.max_stand_ins = max(1, pool_size // 4) if max_stand_ins is None else max_stand_ins
+        self._stand_in_slots = threading.BoundedSemaphore(self.max_stand_ins) if self.max_stand_ins > 0 else None
+        self._workers = []
+        super().__init__(server_address, handler_class)
+        for i in range(pool_size):
+            worker = threading.Thread(target=self._worker_loop, name=f"nexorax-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def process_request(self, request, client_address):
+        """Đưa kết nối vào hàng đợi thay vì xử lý ngay trên accept loop"""
+        try:
+            self._jobs.put_nowait((request, client_address))
+        except queue.Full:
+            with self._stats_lock:
+                self._rejected += 1
+            logger.warning(f"Worker pool full, rejecting connection from {client_address[0]}")
+            try:
+                request.sendall(self.OVERLOAD_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def _worker_loop(self):
+        _worker_context.park_worker = self.park_worker
+        _worker_context.stand_ins = []
+        while True:
+            # Worker tạm của lần park trước còn đang xử lý dở: chờ nó xong rồi mới nhận kết nối mới
+            while _worker_context.stand_ins:
+                _worker_context.stand_ins.pop().join()
+            job = self._jobs.get()
+            if job is None:
+                break
+            self._process_job(job)
+
+    def _process_job(self, job):
+        request, client_address = job
+        with self._stats_lock:
+            self._active += 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._stats_lock:
+                self._active -= 1
+                self._served += 1
+
+    def park_worker(self, seconds):
+        """Worker hiện tại chờ `seconds` (backoff retry) và nhường slot cho một worker tạm
+
+        Worker tạm chỉ nhận kết nối mới cho đến lúc worker chính hết chờ, rồi thoát sau khi
+        xong kết nối đang xử lý dở; worker chính không nhận kết nối mới trước khi worker tạm
+        thoát. Số worker tạm bị giới hạn bởi max_stand_ins; hết slot thì chỉ chờ như thường.
+        """
+        slots = self._stand_in_slots
+        if slots is None or not slots.acquire(blocking=False):
+            time.sleep(seconds)
+            return
+        resume_at = time.monotonic() + seconds
+        with self._stats_lock:
+            self._parked += 1
+            self._stand_ins += 1
+        stand_in = threading.Thread(target=self._stand_in_loop, args=(resume_at,), name="nexorax-stand-in", daemon=True)
+        stand_in.start()
+        _worker_context.stand_ins.append(stand_in)
+        try:
+            time.sleep(seconds)
+        finally:
+            with self._stats_lock:
+                self._parked -= 1
+
+    def _stand_in_loop(self, resume_at):
+        # Không đăng ký park_worker: worker tạm gặp backoff thì chờ bình thường, không sinh thêm worker tạm
+        try:
+            while True:
+                remaining = resume_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    job = self._jobs.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if job is None:
+                    self._jobs.put_nowait(None)  # tín hiệu dừng là của worker chính
+                    break
+                self._process_job(job)
+        finally:
+            self._stand_in_slots.release()
+
+    def get_stats(self):
+        """Thống kê worker pool cho admin API"""
+        with self._stats_lock:
+            return {
+                "pool_size": self.pool_size,
+                "active_workers": self._active,
+                "queued": self._jobs.qsize(),
+                "queue_capacity": self._jobs.maxsize,
+                "served": self._served,
+                "rejected": self._rejected,
+                "parked_workers": self._parked,
+                "stand_in_workers_started": self._stand_ins,
+                "max_stand_in_workers": self.max_stand_ins
+            }
+
+    def is_saturated(self):
+        """True khi có kết nối đang chờ worker (handler sẽ không giữ keep-alive)"""
+        return not self._jobs.empty()
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._workers:
+            try:
+                self._jobs.put_nowait(None)
+            except queue.Full:
+                break
+
+
+# ===========================================
+# ASYNCIO SERVER MODE (SERVER_MODE = "asyncio")
+# ===========================================
+
+_async_ssl_context = None
+
+def _get_async_ssl_context():
+    global _async_ssl_context
+    if _async_ssl_context is None:
+        _async_ssl_context = ssl.create_default_context()
+    return _async_ssl_context
+
+
+async def _async_read_http_body(reader, headers):
+    """Đọc body theo chunked, Content-Length hoặc tới khi upstream đóng kết nối"""
+    if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        chunks = []
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b';', 1)[0].strip() or b'0', 16)
+            if size == 0:
+                # Bỏ qua trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        return b''.join(chunks)
+
+    content_length = headers.get('Content-Length')
+    if content_length is not None:
+        return await reader.readexactly(int(content_length))
+    return await reader.read()
+
+
+class AsyncUpstreamConnectionPool:
+    """Pool kết nối (reader, writer) keep-alive theo host cho asyncio mode
+
+    Kết nối chỉ được dùng trên event loop, nhưng stats/idle còn được admin API đọc từ bridge
+    thread nên mọi thay đổi đi qua self._lock như UpstreamConnectionPool.
+    """
+
+    def __init__(self, max_idle_per_host=8, idle_timeout=30, health_check=True):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self._lock = threading.Lock()
+        self._idle = {}  # key -> [(reader, writer, last_used)]
+        self._stats = {"hits": 0, "misses": 0, "stale_retries": 0, "expired": 0, "unhealthy": 0, "released": 0}
+
+    async def acquire(self, key):
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                entry = idle.pop() if idle else None
+            if entry is None:
+                break
+            reader, writer, last_used = entry
+            if time.time() - last_used > self.idle_timeout:
+                self._count("expired")
+                writer.close()
+            elif self.health_check and (reader.at_eof() or writer.is_closing()):
+                self._count("unhealthy")
+                writer.close()
+            else:
+                self._count("hits")
+                return reader, writer, True
+
+        self._count("misses")
+        scheme, host, port = key
+        try:
+            reader, writer = await asyncio.open_connection(
+                host, port, ssl=_get_async_ssl_context() if scheme == 'https' else None
+            )
+        except OSError as e:
+            raise urllib.error.URLError(e)
+        return reader, writer, False
+
+    def release(self, key, reader, writer):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            keep = len(idle) < self.max_idle_per_host and not writer.is_closing()
+            if keep:
+                idle.append((reader, writer, time.time()))
+                self._stats["released"] += 1
+        if not keep:
+            writer.close()
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["idle"] = {f"{scheme}://{host}:{port}": len(idle) for (scheme, host, port), idle in self._idle.items()}
+        total = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / total, 3) if total else 0
+        return stats
+
+
+ASYNC_UPSTREAM_POOL = AsyncUpstreamConnectionPool(*get_upstream_pool_settings())
+
+
+async def _async_send_request(reader, writer, method, parts, headers, data):
+    """Gửi request và đọc status line + headers; trả về (status, reason, headers) hoặc None nếu upstream đã đóng"""
+    target = parts.path or '/'
+    if parts.query:
+        target += '?' + parts.query
+    request_lines = [
+        f"{method} {target} HTTP/1.1",
+        f"Host: {parts.netloc}",
+        "Accept-Encoding: identity"
+    ]
+    request_lines += [f"{key}: {value}" for key, value in headers.items()]
+    if data is not None:
+        request_lines.append(f"Content-Length: {len(data)}")
+    writer.write(("\r\n".join(request_lines) + "\r\n\r\n").encode('latin-1'))
+    if data:
+        writer.write(data)
+    await writer.drain()
+
+    status_line = await reader.readline()
+    if not status_line:
+        return None
+    _, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+
+    raw_headers = b''
+    while True:
+        line = await reader.readline()
+        raw_headers += line
+        if line in (b'\r\n', b'\n', b''):
+            break
+    return int(status), reason, http.client.parse_headers(io.BytesIO(raw_headers))
+
+
+def _is_reusable_response(response_headers):
+    """Response có framing rõ ràng và upstream không yêu cầu đóng kết nối"""
+    if response_headers.get('Connection', '').lower() == 'close':
+        return False
+    return ('chunked' in response_headers.get('Transfer-Encoding', '').lower()
+            or response_headers.get('Content-Length') is not None)
+
+
+class AsyncStreamResponse:
+    """Response upstream chưa đọc body (stream=True), đọc dần từng dòng cho SSE
+
+    Mỗi lần đọc có timeout riêng (giống socket timeout của PooledResponse). Kết nối chỉ
+    được trả về ASYNC_UPSTREAM_POOL khi body đã đọc hết; đóng giữa chừng (client ngắt,
+    lỗi) thì đóng luôn kết nối để upstream dừng sinh token.
+    """
+
+    body = b''
+
+    def __init__(self, status, reason, headers, url, key, reader, writer, read_timeout):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.url = url
+        self._key = key
+        self._reader = reader
+        self._writer = writer
+        self._read_timeout = read_timeout
+        self._chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+        content_length = headers.get('Content-Length')
+        self._remaining = int(content_length) if content_length is not None and not self._chunked else None
+        self._reusable = _is_reusable_response(headers)
+        self._eof = False
+        self._closed = False
+
+    async def _read(self, coro):
+        try:
+            return await asyncio.wait_for(coro, self._read_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"The read operation timed out after {self._read_timeout}s")
+
+    async def _read_data(self):
+        """Phần body tiếp theo theo chunked, Content-Length hoặc tới khi upstream đóng (b'' khi hết)"""
+        if self._chunked:
+            size_line = await self._read(self._reader.readline())
+            if not size_line:
+                self._reusable = False  # Upstream đóng giữa chừng
+                return b''
+            size = int(size_line.split(b';', 1)[0].strip() or b'0', 16)
+            if size == 0:
+                while (await self._read(self._reader.readline())) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''
+            data = await self._read(self._reader.readexactly(size))
+            await self._read(self._reader.readexactly(2))
+            return data
+        if self._remaining is not None:
+            if self._remaining <= 0:
+                return b''
+            data = await self._read(self._reader.read(min(self._remaining, 65536)))
+            if not data:
+                self._reusable = False
+            self._remaining -= len(data)
+            return data
+        return await self._read(self._reader.read(65536))
+
+    async def iter_lines(self):
+        """Yield từng dòng của body ngay khi nhận được (giữ nguyên ký tự xuống dòng)"""
+        buffer = b''
+        while True:
+            data = await self._read_data()
+            if not data:
+                break
+            buffer += data
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                yield line + b'\n'
+        self._eof = True
+        if buffer:
+            yield buffer
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._eof and self._reusable:
+            ASYNC_UPSTREAM_POOL.release(self._key, self._reader, self._writer)
+        else:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+async def _async_http_exchange(method, url, headers, data, read_body, max_redirects, stream=False, timeout=None):
+    for _ in range(max_redirects + 1):
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        key = (scheme, parts.hostname, parts.port or (443 if scheme == 'https' else 80))
+
+        for attempt in range(2):
+            reader, writer, reused = await ASYNC_UPSTREAM_POOL.acquire(key)
+            try:
+                result = await _async_send_request(reader, writer, method, parts, headers, data)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                writer.close()
+                if reused and attempt == 0:
+                    ASYNC_UPSTREAM_POOL._count("stale_retries")
+                    continue
+                raise urllib.error.URLError(e)
+            except BaseException:
+                writer.close()
+                raise
+            if result is None:
+                writer.close()
+                # Kết nối keep-alive cũ đã bị upstream đóng: gửi lại trên kết nối mới
+                if reused and attempt == 0:
+                    ASYNC_UPSTREAM_POOL._count("stale_retries")
+                    continue
+                raise urllib.error.URLError("Upstream đóng kết nối trước khi trả response")
+            break
+
+        status, reason, response_headers = result
+        reusable = _is_reusable_response(response_headers)
+        try:
+            location = response_headers.get('Location')
+            is_redirect = status in (301, 302, 303, 307, 308) and location
+            if stream and not is_redirect and status < 400:
+                # Body (SSE) được đọc dần bởi người gọi; kết nối thuộc về AsyncStreamResponse
+                return AsyncStreamResponse(status, reason, response_headers, url, key, reader, writer, timeout)
+            body = b''
+            if read_body or is_redirect or status >= 400:
+                body = await _async_read_http_body(reader, response_headers)
+            else:
+                reusable = False  # Body chưa đọc còn nằm trên socket
+        except BaseException:
+            writer.close()
+            raise
+        if reusable:
+            ASYNC_UPSTREAM_POOL.release(key, reader, writer)
+        else:
+            writer.close()
+
+        if is_redirect:
+            url = urllib.parse.urljoin(url, location)
+            if status == 303 or (status in (301, 302) and method == 'POST'):
+                method, data = 'GET', None
+            continue
+
+        if status >= 400:
+            raise urllib.error.HTTPError(url, status, reason, response_headers, io.BytesIO(body))
+        return UpstreamResponse(status, reason, response_headers, body, url)
+
+    raise urllib.error.URLError(f"Quá nhiều redirect khi gọi {url}")
+
+
+async def async_http_request(method, url, headers=None, data=None, timeout=REQUEST_TIMEOUT, read_body=True, max_redirects=5, stream=False):
+    """Async HTTP(S) client tối giản cho upstream (chỉ dùng stdlib asyncio + ssl)
+
+    Raise cùng loại exception với urllib để xử lý lỗi giống threaded mode:
+    urllib.error.HTTPError (status >= 400), urllib.error.URLError (lỗi kết nối), TimeoutError.
+    read_body=False chỉ lấy status/headers/URL cuối (dùng cho Pollinations).
+    stream=True trả về AsyncStreamResponse ngay khi có headers (timeout áp dụng cho từng lần đọc body).
+    """
+    try:
+        return await asyncio.wait_for(
+            _async_http_exchange(method, url, headers or {}, data, read_body, max_redirects, stream, timeout),
+            timeout
+        )
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"The read operation timed out after {timeout}s")
 
-    def handle_admin_get_users(self):
-        """Admin API: Get all users"""
-        try:
-            user_list = []
-            for username, password in users.items():
-                user_list.append({
-                    "username": username,
-                    "password_length": len(password)
-                })
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps({
-                "success": True,
-                "total_users": len(user_list),
-                "users": user_list
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-            logger.info(f"Admin API: Retrieved {len(user_list)} users")
-            
-        except Exception as e:
-            logger.error(f"Admin get users error: {e}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
 
-    def handle_admin_get_sessions(self):
-        """Admin API: Get all active sessions"""
+async def _async_hedged_attempt(name, policy, method, url, headers, data, timeout, read_body):
+    """Bản async của _hedged_attempt: request thua bị cancel (kết nối của nó bị đóng)"""
+    budget = _get_hedge_budget(name, policy)
+    budget.record_call()
+    tasks = [asyncio.ensure_future(async_http_request(method, url, headers, data, timeout=timeout, read_body=read_body))]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=_hedge_delay(name, policy))
+        if not done and budget.try_acquire():
+            UPSTREAM_METRICS.record_hedge(name)
+            logger.info(f"🔀 {name}: no response after hedge delay, sending hedged request")
+            tasks.append(asyncio.ensure_future(async_http_request(method, url, headers, data, timeout=timeout, read_body=read_body)))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not tasks[0]:
+                        UPSTREAM_METRICS.record_hedge(name, won=True)
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def async_upstream_call(name, method, url, headers=None, data=None, timeout=None, read_body=True, api_key=None, deadline=None, stream=False):
+    """Bản async của upstream_call: cùng policy/metrics/pool key, chờ backoff bằng asyncio.sleep
+
+    stream=True trả về AsyncStreamResponse (không hedge, giống upstream_call).
+    """
+    policy = get_upstream_policy(name)
+    timeout = timeout or policy["timeout"]
+    attempts = policy["retries"] + 1
+    RETRY_BUDGET.record_call()
+    bytes_out = len(data or b'')
+    breaker = _get_circuit_breaker(policy)
+    key_pool = policy["key_pool"] if api_key else None
+    tried_keys = [api_key]
+    headers = dict(headers or {})
+    last_error = None
+    attempt = 0
+
+    while True:
         try:
-            current_time = time.time()
-            session_list = []
-            
-            for session_id, session_data in sessions.items():
-                expires_at = session_data.get('expires_at', 0)
-                time_remaining = expires_at - current_time
-                
-                session_list.append({
-                    "session_id": session_id[:16] + "...",
-                    "username": session_data.get('username'),
-                    "remember_me": session_data.get('remember_me', False),
-                    "expires_at": expires_at,
-                    "time_remaining_seconds": int(time_remaining) if time_remaining > 0 else 0,
-                    "is_expired": time_remaining <= 0
-                })
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps({
-                "success": True,
-                "total_sessions": len(session_list),
-                "sessions": session_list
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-            logger.info(f"Admin API: Retrieved {len(session_list)} sessions")
-            
+            attempt_timeout = deadline.cap(timeout) if deadline else timeout
+        except DeadlineExceededError:
+            if last_error is not None:
+                raise last_error
+            raise
+        try:
+            probe = breaker.before_call() if breaker else False
+        except CircuitOpenError:
+            if last_error is not None:
+                raise last_error
+            raise
+        start_time = time.time()
+        try:
+            if stream:
+                response = await async_http_request(method, url, headers, data, timeout=attempt_timeout, stream=True)
+            elif policy["hedge"]:
+                response = await _async_hedged_attempt(name, policy, method, url, headers, data, attempt_timeout, read_body)
+            else:
+                response = await async_http_request(method, url, headers, data, timeout=attempt_timeout, read_body=read_body)
+        except asyncio.CancelledError:
+            if probe:
+                breaker.release_probe()  # probe bị huỷ không phải lỗi upstream: chỉ trả lại slot
+            raise
         except Exception as e:
-            logger.error(f"Admin get sessions error: {e}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+            status = e.code if isinstance(e, urllib.error.HTTPError) else None
+            _record_upstream_attempt(name, policy, breaker, probe, status, time.time() - start_time, bytes_out=bytes_out, error=e)
+            next_key = _rotate_api_key(name, key_pool, tried_keys, status, e) if key_pool else None
+            if next_key:
+                last_error = e
+                url = url.replace(api_key, next_key)
+                headers = {header: value.replace(api_key, next_key) for header, value in headers.items()}
+                api_key = next_key
+                continue
+            backoff = _upstream_backoff(policy, attempt, e)
+            out_of_time = deadline is not None and backoff >= deadline.remaining()  # không đủ thời gian để retry
+            if attempt < attempts - 1 and not out_of_time and _should_retry_upstream(policy, e) and _acquire_retry(name):
+                last_error = e
+                UPSTREAM_METRICS.record_retry(name)
+                logger.warning(f"⚠️ {name}: {type(e).__name__} on attempt {attempt + 1}/{attempts}: {e}. Retrying in {backoff:.2f}s...")
+                await asyncio.sleep(backoff)
+                attempt += 1
+                continue
+            if attempts > 1:
+                logger.error(f"❌ {name}: all {attempt + 1} attempts failed. Last error: {type(e).__name__} - {e}")
+            raise
 
-    def handle_admin_get_stats(self):
-        """Admin API: Get system statistics"""
+        _record_upstream_attempt(name, policy, breaker, probe, response.status, time.time() - start_time, len(response.body), bytes_out)
+        if key_pool:
+            API_KEYS.report(key_pool, api_key, response.status)
+        if attempt > 0:
+            logger.info(f"✅ {name}: request succeeded on attempt {attempt + 1}/{attempts}")
+        return response
+
+
+async def _async_read_request_body(reader, method, headers, max_body):
+    """Bản async của read_request_body; trả về (body, raw bytes) để bridge parse lại được"""
+    if method != 'POST' and 'Content-Length' not in headers and 'Transfer-Encoding' not in headers:
+        return b'', b''
+    content_length = parse_content_length(headers, max_body)
+    if content_length is not None:
+        body = await reader.readexactly(content_length) if content_length else b''
+        return body, body
+    
+    body = bytearray()
+    raw = bytearray()
+    while True:
+        size_line = await reader.readline()
+        raw += size_line
         try:
-            current_time = time.time()
-            
-            active_sessions_count = sum(1 for s in sessions.values() if current_time < s.get('expires_at', 0))
-            expired_sessions_count = sum(1 for s in sessions.values() if current_time >= s.get('expires_at', 0))
-            
-            locked_users_count = sum(1 for data in rate_limits.values() if current_time < data.get('locked_until', 0))
-            
-            stats = {
-                "users": {
-                    "total": len(users),
-                    "locked": locked_users_count
-                },
-                "sessions": {
-                    "total": len(sessions),
-                    "active": active_sessions_count,
-                    "expired": expired_sessions_count
-                },
-                "rate_limits": {
-                    "total": len(rate_limits),
-                    "currently_locked": locked_users_count
-                },
-                "system": {
-                    "session_expiry_hours": SESSION_EXPIRY_HOURS,
-                    "max_login_attempts": MAX_LOGIN_ATTEMPTS,
-                    "rate_limit_window_seconds": RATE_LIMIT_WINDOW
-                }
-            }
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps({
-                "success": True,
-                "stats": stats
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-            logger.info("Admin API: Retrieved system stats")
-            
-        except Exception as e:
-            logger.error(f"Admin get stats error: {e}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            raise RequestBodyError(400, "Chunked body không hợp lệ", "INVALID_CHUNK")
+        if size == 0:
+            while True:
+                trailer = await reader.readline()
+                raw += trailer
+                if trailer in (b'\r\n', b'\n', b''):
+                    return bytes(body), bytes(raw)
+        if len(body) + size > max_body:
+            raise RequestBodyError(413, f"Dữ liệu gửi lên quá lớn (tối đa {max_body} bytes)", "PAYLOAD_TOO_LARGE")
+        chunk = await reader.readexactly(size)
+        body += chunk
+        raw += chunk + await reader.readline()
 
-    def handle_admin_get_rate_limits(self):
-        """Admin API: Get all rate limits"""
+
+class AsyncRequest:
+    """HTTP request đã parse trong asyncio mode"""
+
+    def __init__(self, method, path, version, headers, body, raw, client_address):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+        self.raw = raw
+        self.client_address = client_address
+        self.sequence = 1  # Thứ tự request trên kết nối keep-alive
+        self.username = None  # User của session cookie, _serve_native tra ngoài event loop
+        self.event_stream = None  # AsyncEventStream cho route trả SSE native
+
+    @property
+    def route_path(self):
+        return self.path.split('?', 1)[0]
+
+    @property
+    def wants_event_stream(self):
+        """Body có "stream": true → chạy qua bridge, trừ route có trong event_stream_routes"""
+        if b'"stream"' not in self.body:
+            return False
         try:
-            current_time = time.time()
-            rate_limit_list = []
-            
-            for username, data in rate_limits.items():
-                locked_until = data.get('locked_until', 0)
-                time_remaining = locked_until - current_time if current_time < locked_until else 0
-                
-                rate_limit_list.append({
-                    "username": username,
-                    "attempts": data.get('attempts', 0),
-                    "last_attempt": data.get('last_attempt', 0),
-                    "locked_until": locked_until,
-                    "is_locked": current_time < locked_until,
-                    "time_remaining_seconds": int(time_remaining)
-                })
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps({
-                "success": True,
-                "total_rate_limits": len(rate_limit_list),
-                "rate_limits": rate_limit_list
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-            logger.info(f"Admin API: Retrieved {len(rate_limit_list)} rate limits")
-            
-        except Exception as e:
-            logger.error(f"Admin get rate limits error: {e}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+            return bool(json.loads(self.body).get('stream'))
+        except (ValueError, AttributeError):
+            return False
 
-    def handle_admin_delete_user(self):
-        """Admin API: Delete a user"""
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('Connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+
+class _LoopWriter(io.RawIOBase):
+    """wfile cho threaded handler chạy qua bridge: ghi thẳng vào asyncio transport
+
+    Mỗi write() chờ drain() trên event loop (có giới hạn thời gian) để client đọc
+    chậm không làm buffer transport phình vô hạn, và raise BrokenPipeError khi
+    client đã đóng kết nối để handler SSE nhận ClientDisconnectedError.
+    """
+
+    WRITE_TIMEOUT = 30  # Giây tối đa chờ client nhận hết dữ liệu của một lần ghi
+
+    def __init__(self, loop, writer):
+        super().__init__()
+        self._loop = loop
+        self._writer = writer
+
+    def writable(self):
+        return True
+
+    async def _write_and_drain(self, data):
+        if self._writer.transport.is_closing():
+            raise BrokenPipeError("Client đã đóng kết nối")
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def write(self, data):
+        data = bytes(data)
+        if self._writer.transport.is_closing():
+            raise BrokenPipeError("Client đã đóng kết nối")
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
-            
-            username = request_data.get('username', '').strip()
-            
-            if not username:
-                self._send_json_error(400, "Username không được để trống", "MISSING_USERNAME")
-                return
-            
-            if username not in users:
-                self._send_json_error(404, f"User '{username}' không tồn tại", "USER_NOT_FOUND")
-                return
-            
-            del users[username]
-            
-            with file_lock:
-                with open(ACCOUNTS_FILE, 'w', encoding='utf-8') as f:
-                    for user, pwd in users.items():
-                        f.write(f"{user}|{pwd}\n")
-            
-            sessions_to_delete = [sid for sid, data in sessions.items() if data.get('username') == username]
-            for sid in sessions_to_delete:
-                delete_session(sid)
-            
-            if username in rate_limits:
-                del rate_limits[username]
-                save_rate_limits()
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps({
-                "success": True,
-                "message": f"User '{username}' đã được xóa thành công",
-                "sessions_deleted": len(sessions_to_delete)
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-            logger.info(f"Admin API: Deleted user '{username}' and {len(sessions_to_delete)} sessions")
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in delete user request: {e}")
-            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ", "INVALID_JSON")
-        except Exception as e:
-            logger.error(f"Admin delete user error: {e}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+            future = asyncio.run_coroutine_threadsafe(self._write_and_drain(data), self._loop)
+        except RuntimeError as e:  # Event loop đã đóng (server đang tắt)
+            raise BrokenPipeError(str(e)) from e
+        try:
+            future.result(timeout=self.WRITE_TIMEOUT)
+        except TimeoutError:
+            future.cancel()
+            self._loop.call_soon_threadsafe(self._writer.transport.abort)
+            raise BrokenPipeError("Client không nhận dữ liệu quá thời gian chờ ghi")
+        except ConnectionError as e:
+            raise BrokenPipeError(str(e)) from e
+        return len(data)
 
-    def handle_admin_delete_session(self):
-        """Admin API: Delete a session by username"""
+
+class AsyncEventStream:
+    """Response Server-Sent Events của route native (cùng định dạng với _start_event_stream)
+
+    Giống _LoopWriter: mỗi lần ghi chờ drain() có giới hạn thời gian, client đã đóng
+    kết nối thì raise ClientDisconnectedError để dừng đọc upstream.
+    """
+
+    WRITE_TIMEOUT = _LoopWriter.WRITE_TIMEOUT
+
+    def __init__(self, writer, request):
+        self._writer = writer
+        self._chunked = request.version == 'HTTP/1.1'
+        self._origin = request.headers.get('Origin', '')
+        self.started = False
+        self.finished = False  # Đã gửi chunk kết thúc: kết nối còn dùng lại được
+
+    async def start(self):
+        self.started = True
+        lines = [
+            "HTTP/1.1 200 OK",
+            "Content-Type: text/event-stream; charset=utf-8",
+            "Cache-Control: no-cache",
+            "X-Accel-Buffering: no"
+        ]
+        lines.append("Transfer-Encoding: chunked" if self._chunked else "Connection: close")
+        lines += [f"{header}: {value}" for header, value in get_cors_headers(self._origin)]
+        await self._send(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+
+    async def write(self, data):
+        if not data:
+            return
+        if self._chunked:
+            data = b'%X\r\n%s\r\n' % (len(data), data)
+        await self._send(data)
+
+    async def send_event(self, data, event=None):
+        await self.write(format_sse_event(data, event))
+
+    async def end(self):
+        if self._chunked:
+            await self._send(b'0\r\n\r\n')
+            self.finished = True
+
+    async def _send(self, data):
+        if self._writer.transport.is_closing():
+            raise ClientDisconnectedError("Client đã đóng kết nối")
+        self._writer.write(data)
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
-            
-            username = request_data.get('username', '').strip()
-            
-            if not username:
-                self._send_json_error(400, "Username không được để trống", "MISSING_USERNAME")
-                return
-            
-            sessions_to_delete = [sid for sid, data in sessions.items() if data.get('username') == username]
-            
-            if not sessions_to_delete:
-                self._send_json_error(404, f"Không tìm thấy session nào của user '{username}'", "SESSION_NOT_FOUND")
-                return
-            
-            for sid in sessions_to_delete:
-                delete_session(sid)
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps({
-                "success": True,
-                "message": f"Đã xóa {len(sessions_to_delete)} session(s) của user '{username}'",
-                "sessions_deleted": len(sessions_to_delete)
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-            logger.info(f"Admin API: Deleted {len(sessions_to_delete)} sessions for user '{username}'")
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in delete session request: {e}")
-            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ", "INVALID_JSON")
+            await asyncio.wait_for(self._writer.drain(), self.WRITE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._writer.transport.abort()
+            raise ClientDisconnectedError("Client không nhận dữ liệu quá thời gian chờ ghi")
+        except ConnectionError as e:
+            raise ClientDisconnectedError(str(e)) from e
+
+
+class AsyncNexoraXServer:
+    """asyncio server giữ nguyên routes của NexoraXHTTPRequestHandler
+
+    Các endpoint AI proxy (chủ yếu là chờ upstream) chạy dạng coroutine native nên
+    một process giữ được hàng nghìn request đang chờ mà không tốn 1 thread/request;
+    route trong event_stream_routes relay SSE native khi client xin stream.
+    Các route còn lại (static, auth, admin, search pipeline) chạy qua bridge: request
+    đã parse được đưa cho NexoraXHTTPRequestHandler trong thread pool có giới hạn.
+    """
+
+    def __init__(self, server_address, bridge_workers=32, backlog=256):
+        self.server_address = server_address
+        # Giây chờ request tiếp theo / số request tối đa trên một kết nối keep-alive
+        self.idle_timeout, self.max_keepalive_requests = get_keepalive_settings()
+        self.bridge_workers = bridge_workers
+        self.backlog = backlog
+        self.max_body_size = MAX_FILE_SIZE * 2  # base64 + JSON overhead
+        self._executor = None
+        self._stats = {
+            "connections": 0,
+            "native_in_flight": 0,
+            "native_served": 0,
+            "bridged_served": 0
+        }
+        self.routes = {
+            ('POST', '/api/gemini'): self._route_gemini_proxy,
+            ('POST', '/api/llm7/chat'): self._route_llm7_chat,
+            ('POST', '/api/llm7/gpt-5-chat'): self._route_llm7_gpt5chat,
+            ('POST', '/api/enhance-prompt'): self._route_enhance_prompt,
+            ('POST', '/api/pollinations/generate'): self._route_pollinations_generate,
+            ('POST', '/api/gemini/stream'): self._route_gemini_stream,
+        }
+        # Route tự trả Server-Sent Events qua request.event_stream; route khác gặp "stream": true
+        # (vd search pipeline) vẫn chạy qua bridge
+        self.event_stream_routes = {
+            ('POST', '/api/llm7/chat'),
+            ('POST', '/api/llm7/gpt-5-chat'),
+            ('POST', '/api/gemini/stream'),
+        }
+
+    def get_stats(self):
+        """Thống kê asyncio server cho admin API"""
+        stats = dict(self._stats)
+        stats["mode"] = "asyncio"
+        stats["bridge_workers"] = self.bridge_workers
+        return stats
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        from concurrent.futures import ThreadPoolExecutor
+        self._executor = ThreadPoolExecutor(max_workers=self.bridge_workers, thread_name_prefix='nexorax-bridge')
+        host, port = self.server_address
+        server = await asyncio.start_server(
+            self._handle_connection, host, port,
+            backlog=self.backlog, reuse_address=True
+        )
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def _handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername') or ('unknown', 0)
+        client_address = tuple(peer[:2])
+        self._stats["connections"] += 1
+        served = 0
+        try:
+            while True:
+                request = await self._read_request(reader, writer, client_address)
+                if request is None:
+                    break
+                served += 1
+                request.sequence = served
+
+                route_key = (request.method, request.route_path)
+                route = self.routes.get(route_key)
+                if route and (route_key in self.event_stream_routes or not request.wants_event_stream):
+                    keep_alive = await self._serve_native(route, request, writer)
+                else:
+                    keep_alive = await self._serve_bridged(request, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
         except Exception as e:
-            logger.error(f"Admin delete session error: {e}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+            logger.error(f"Async connection error from {client_address[0]}: {e}")
+        finally:
+            writer.close()
 
-    def handle_admin_clear_rate_limit(self):
-        """Admin API: Clear rate limit for a user"""
+    async def _read_request(self, reader, writer, client_address):
+        """Parse request line + headers + body; trả về None khi client đóng/idle"""
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
-            
-            username = request_data.get('username', '').strip()
-            
-            if not username:
-                self._send_json_error(400, "Username không được để trống", "MISSING_USERNAME")
-                return
-            
-            if username not in rate_limits:
-                self._send_json_error(404, f"User '{username}' không có rate limit", "RATE_LIMIT_NOT_FOUND")
-                return
-            
-            del rate_limits[username]
-            save_rate_limits()
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps({
-                "success": True,
-                "message": f"Đã xóa rate limit cho user '{username}'"
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-            logger.info(f"Admin API: Cleared rate limit for user '{username}'")
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in clear rate limit request: {e}")
-            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ", "INVALID_JSON")
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.idle_timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, asyncio.LimitOverrunError):
+            return None
+
+        request_line, _, header_bytes = head.partition(b"\r\n")
+        try:
+            method, path, version = request_line.decode('latin-1').split()
+        except ValueError:
+            self._write_response(writer, 400, {"error": "Bad request", "code": "BAD_REQUEST"}, keep_alive=False)
+            return None
+        headers = http.client.parse_headers(io.BytesIO(header_bytes))
+
+        route, _ = ROUTER.match(method, path)
+        max_body = route.max_body if route else self.max_body_size
+        try:
+            body, raw_body = await _async_read_request_body(reader, method, headers, max_body)
+        except RequestBodyError as e:
+            self._write_response(writer, e.status_code, {"error": str(e), "code": e.error_code}, keep_alive=False)
+            return None
+        return AsyncRequest(method, path, version, headers, body, head + raw_body, client_address)
+
+    def _write_response(self, writer, status_code, payload, keep_alive=True, origin=''):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        status = http.HTTPStatus(status_code)
+        lines = [
+            f"HTTP/1.1 {status.value} {status.phrase}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(body)}"
+        ]
+        lines += [f"{header}: {value}" for header, value in get_cors_headers(origin)]
+        if isinstance(payload, dict) and payload.get("retry_after"):
+            lines.append(f"Retry-After: {payload['retry_after']}")  # CIRCUIT_OPEN
+        if not keep_alive:
+            lines.append("Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body)
+
+    async def _serve_native(self, route, request, writer):
+        self._stats["native_in_flight"] += 1
+        start_time = time.time()
+        registered_route, _ = ROUTER.match(request.method, request.path)
+        request.event_stream = AsyncEventStream(writer, request)
+        try:
+            loop = asyncio.get_running_loop()
+            request.username = await loop.run_in_executor(self._executor, self._load_request_user, request)
+            if registered_route and registered_route.auth == 'session' and not request.username:
+                # Giống _dispatch_route của threaded handler
+                status_code, payload = 401, {"error": "Vui lòng đăng nhập để sử dụng chức năng này", "code": "UNAUTHORIZED"}
+            else:
+                status_code, payload = await route(request)
         except Exception as e:
-            logger.error(f"Admin clear rate limit error: {e}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+            logger.error(f"Async route error on {request.path}: {e}")
+            status_code, payload = 503, {"error": f"Lỗi hệ thống: {str(e)}", "code": "SYSTEM_ERROR"}
+        finally:
+            self._stats["native_in_flight"] -= 1
+            self._stats["native_served"] += 1
+        if registered_route:
+            ROUTER.record(registered_route, status_code, time.time() - start_time)
 
-    def handle_admin_logs(self):
-        """Admin API: Get server logs from server.log file"""
+        keep_alive = (request.keep_alive and self.idle_timeout > 0
+                      and request.sequence < self.max_keepalive_requests)
+        if request.event_stream.started:
+            # Route đã tự gửi response SSE (lỗi giữa chừng đã báo qua event "error")
+            logger.info(f"{request.client_address[0]} - \"{request.method} {request.path} {request.version}\" 200 (async stream)")
+            return keep_alive and request.event_stream.finished
+        self._write_response(writer, status_code, payload, keep_alive=keep_alive, origin=request.headers.get('Origin', ''))
+        logger.info(f"{request.client_address[0]} - \"{request.method} {request.path} {request.version}\" {status_code} (async)")
+        return keep_alive
+
+    async def _serve_bridged(self, request, writer):
+        loop = asyncio.get_running_loop()
+        wfile = _LoopWriter(loop, writer)
+        keep_alive = await loop.run_in_executor(self._executor, self._run_threaded_handler, request, wfile)
+        self._stats["bridged_served"] += 1
+        return keep_alive
+
+    def _load_request_user(self, request):
+        """Chạy trong bridge pool: đồng bộ shared state rồi tra session (có file I/O) như do_GET/do_POST"""
+        sync_shared_state()
+        return get_username_from_cookie_header(request.headers.get('Cookie', ''))
+
+    def _run_threaded_handler(self, request, wfile):
+        """Chạy NexoraXHTTPRequestHandler cho một request đã đọc sẵn"""
+        handler = NexoraXHTTPRequestHandler.__new__(NexoraXHTTPRequestHandler)
+        handler.directory = os.getcwd()
+        handler.server = self
+        handler.request = None
+        handler.client_address = request.client_address
+        handler.rfile = io.BytesIO(request.raw)
+        handler.wfile = wfile
+        handler.close_connection = True
+        handler._requests_on_connection = request.sequence - 1
         try:
-            # Parse query parameters
-            from urllib.parse import parse_qs, urlparse
-            parsed = urlparse(self.path)
-            params = parse_qs(parsed.query)
-            
-            limit = int(params.get('limit', ['100'])[0])
-            level_filter = params.get('level', [None])[0]  # INFO, ERROR, WARNING
-            
-            logs = []
-            total_lines = 0
-            
-            # Read server.log file
-            if os.path.exists(LOG_FILE):
-                with file_lock:
-                    with open(LOG_FILE, 'r', encoding='utf-8') as f:
-                        all_lines = f.readlines()
-                        total_lines = len(all_lines)
-                        
-                        # Filter by level if specified
-                        if level_filter:
-                            filtered_lines = [line for line in all_lines if f'- {level_filter} -' in line]
-                        else:
-                            filtered_lines = all_lines
-                        
-                        # Get last N lines
-                        recent_lines = filtered_lines[-limit:]
-                        
-                        for line in recent_lines:
-                            logs.append({
-                                'timestamp': line[:23] if len(line) > 23 else '',
-                                'content': line.strip()
-                            })
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps({
-                "success": True,
-                "total_lines": total_lines,
-                "filtered_count": len(logs),
-                "limit": limit,
-                "level_filter": level_filter,
-                "logs": logs
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-            logger.info(f"Admin API: Retrieved {len(logs)} log entries")
-            
+            handler.handle_one_request()
         except Exception as e:
-            logger.error(f"Admin get logs error: {e}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+            logger.error(f"Bridged handler error on {request.path}: {e}")
+            return False
+        return not handler.close_connection
 
-    def handle_admin_history(self):
-        """Admin API: Get AI call history from ai_history.jsonl"""
+    def _upstream_error(self, exc, service_label, connection_message, system_message=None):
+        """Map exception upstream → (status, payload) giống các except block của threaded handler"""
+        if isinstance(exc, NoChatProviderError):
+            return 500, {"error": str(exc), "code": "API_KEY_MISSING"}
+        if isinstance(exc, CircuitOpenError):
+            logger.warning(f"Circuit '{exc.name}' open, rejecting {service_label} request")
+            return 503, {
+                "error": f"Dịch vụ {exc.name} đang tạm thời gián đoạn. Vui lòng thử lại sau {exc.retry_after} giây.",
+                "code": "CIRCUIT_OPEN",
+                "retry_after": exc.retry_after
+            }
+        if isinstance(exc, urllib.error.HTTPError):
+            try:
+                error_body = exc.read().decode('utf-8')
+                return exc.code, {"error": f"{service_label} lỗi: {error_body}", "code": "UPSTREAM_ERROR"}
+            except Exception:
+                return exc.code, {"error": f"{service_label} lỗi: {exc.reason}", "code": "UPSTREAM_ERROR"}
+        if isinstance(exc, urllib.error.URLError):
+            logger.error(f"{service_label} connection error: {exc}")
+            return 502, {"error": connection_message, "code": "CONNECTION_ERROR"}
+        if isinstance(exc, json.JSONDecodeError):
+            logger.error(f"Invalid JSON in {service_label} request: {exc}")
+            return 400, {"error": "Dữ liệu gửi lên không hợp lệ. Vui lòng kiểm tra định dạng JSON.", "code": "INVALID_JSON"}
+        logger.error(f"{service_label} async error: {exc}")
+        logger.error(f"Exception type: {type(exc)}")
+        return 503, {"error": system_message or f"Lỗi hệ thống: {str(exc)}", "code": "SYSTEM_ERROR"}
+
+    async def _vision_description(self, image_data_base64):
+        """Bản async của get_gemini_vision_description"""
         try:
-            # Parse query parameters
-            from urllib.parse import parse_qs, urlparse
-            parsed = urlparse(self.path)
-            params = parse_qs(parsed.query)
-            
-            username_filter = params.get('username', [None])[0]
-            model_filter = params.get('model', [None])[0]
-            limit = int(params.get('limit', ['50'])[0])
-            
-            history = []
-            total_records = 0
-            
-            # Read ai_history.jsonl file
-            if os.path.exists(AI_HISTORY_FILE):
-                with file_lock:
-                    with open(AI_HISTORY_FILE, 'r', encoding='utf-8') as f:
-                        for line in f:
-                            if line.strip():
-                                try:
-                                    entry = json.loads(line.strip())
-                                    total_records += 1
-                                    
-                                    # Apply filters
-                                    if username_filter and entry.get('username') != username_filter:
-                                        continue
-                                    if model_filter and entry.get('model') != model_filter:
-                                        continue
-                                    
-                                    history.append(entry)
-                                except json.JSONDecodeError:
-                                    continue
-            
-            # Get last N entries
-            history = history[-limit:]
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps({
-                "success": True,
-                "total_records": total_records,
-                "filtered_count": len(history),
-                "limit": limit,
-                "filters": {
-                    "username": username_filter,
-                    "model": model_filter
-                },
-                "history": history
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-            logger.info(f"Admin API: Retrieved {len(history)} AI history entries")
+            cache_key = vision_cache_key(image_data_base64)
+            description = await asyncio.to_thread(get_cached_vision_description, cache_key)
+            if description is not None:
+                logger.info(f"Gemini Vision cache hit ({cache_key[:12]})")
+                return description
             
+            api_key = API_KEYS.acquire('gemini')
+            if not api_key:
+                return "Không có API Key cho Gemini Vision."
+            response = await async_upstream_call(
+                'gemini_vision',
+                'POST',
+                gemini_generate_url('gemini-2.5-flash', api_key),
+                {'Content-Type': 'application/json'},
+                json.dumps(build_gemini_vision_payload(image_data_base64)).encode('utf-8'),
+                api_key=api_key
+            )
+            description = extract_gemini_text(response.json())
+            if not description:
+                return VISION_FALLBACK_TEXT
+            await asyncio.to_thread(store_vision_description, cache_key, description)
+            return description
         except Exception as e:
-            logger.error(f"Admin get history error: {e}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+            logger.error(f"Gemini Vision Error: {e}")
+            return VISION_FALLBACK_TEXT
 
-    def handle_admin_usage(self):
-        """Admin API: Get AI usage statistics aggregated from history"""
+    async def _route_gemini_proxy(self, request):
+        username = request.username
+        api_key = API_KEYS.acquire('gemini')
+        if not api_key or api_key == "your_gemini_api_key_here":
+            return 500, {
+                "error": "API key chưa được cấu hình. Vui lòng thêm GEMINI_API_KEY vào environment variables.",
+                "code": "API_KEY_MISSING"
+            }
         try:
-            users_stats = {}
-            models_stats = {}
-            
-            # Read and aggregate ai_history.jsonl file
-            if os.path.exists(AI_HISTORY_FILE):
-                with file_lock:
-                    with open(AI_HISTORY_FILE, 'r', encoding='utf-8') as f:
-                        for line in f:
-                            if line.strip():
-                                try:
-                                    entry = json.loads(line.strip())
-                                    username = entry.get('username', 'anonymous')
-                                    model = entry.get('model', 'unknown')
-                                    
-                                    # Count by user
-                                    if username not in users_stats:
-                                        users_stats[username] = {
-                                            'username': username,
-                                            'total_calls': 0,
-                                            'models_used': {}
-                                        }
-                                    users_stats[username]['total_calls'] += 1
-                                    
-                                    if model not in users_stats[username]['models_used']:
-                                        users_stats[username]['models_used'][model] = 0
-                                    users_stats[username]['models_used'][model] += 1
-                                    
-                                    # Count by model
-                                    if model not in models_stats:
-                                        models_stats[model] = {
-                                            'model': model,
-                                            'total_calls': 0,
-                                            'unique_users': set()
-                                        }
-                                    models_stats[model]['total_calls'] += 1
-                                    models_stats[model]['unique_users'].add(username)
-                                    
-                                except json.JSONDecodeError:
-                                    continue
-            
-            # Convert sets to counts
-            models_list = []
-            for model, data in models_stats.items():
-                models_list.append({
-                    'model': model,
-                    'total_calls': data['total_calls'],
-                    'unique_users': len(data['unique_users'])
-                })
-            
-            # Sort by total_calls descending
-            users_list = sorted(users_stats.values(), key=lambda x: x['total_calls'], reverse=True)
-            models_list = sorted(models_list, key=lambda x: x['total_calls'], reverse=True)
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps({
-                "success": True,
-                "total_calls": sum(u['total_calls'] for u in users_list),
-                "unique_users": len(users_list),
-                "unique_models": len(models_list),
-                "users_stats": users_list,
-                "models_stats": models_list
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-            logger.info("Admin API: Retrieved AI usage statistics")
-            
+            request_data = json.loads(request.body)
+            model = request_data.get('model', 'gemini-2.5-flash')
+            payload = request_data.get('payload', {})
+            prompt_text = extract_gemini_prompt_text(payload)
+
+            cache_key = response_cache_key(request_data, request.headers, model, payload.get('contents', []), payload)
+            body = RESPONSE_CACHE.get(cache_key) if cache_key else None
+            cached = body is not None
+            if cached:
+                logger.info(f"{model} response cache hit")
+            else:
+                response = await async_upstream_call(
+                    'gemini',
+                    'POST',
+                    gemini_generate_url(model, api_key),
+                    {'Content-Type': 'application/json'},
+                    json.dumps(payload).encode('utf-8'),
+                    api_key=api_key
+                )
+                body = response.body
+
+            try:
+                response_text = extract_gemini_text(json.loads(body))
+                if cache_key and response_text and not cached:
+                    RESPONSE_CACHE.set(cache_key, body)
+                metadata = {'endpoint': 'gemini_proxy'}
+                if cached:
+                    metadata['cached'] = True
+                await asyncio.to_thread(save_ai_history, username, model, prompt_text, response_text, metadata)
+            except Exception as e:
+                logger.debug(f"Error saving Gemini history: {e}")
+            return 200, body
+        except Exception as e:
+            return self._upstream_error(e, "Gemini API", "Không thể kết nối đến Gemini API")
+
+    async def _route_gemini_stream(self, request):
+        """Bản async của handle_gemini_stream"""
+        username = request.username
+        api_key = API_KEYS.acquire('gemini')
+        if not api_key or api_key == "your_gemini_api_key_here":
+            return 500, {
+                "error": "API key chưa được cấu hình. Vui lòng thêm GEMINI_API_KEY vào environment variables.",
+                "code": "API_KEY_MISSING"
+            }
+        try:
+            request_data = json.loads(request.body)
+            model = request_data.get('model', 'gemini-2.5-flash')
+            payload = request_data.get('payload', {})
+            prompt_text = extract_gemini_prompt_text(payload)
+            start_time = time.time()
+            upstream = await async_upstream_call(
+                'gemini',
+                'POST',
+                gemini_stream_url(model, api_key),
+                {'Content-Type': 'application/json'},
+                json.dumps(payload).encode('utf-8'),
+                api_key=api_key,
+                stream=True
+            )
+        except Exception as e:
+            return self._upstream_error(e, "Gemini API", "Không thể kết nối đến Gemini API")
+
+        reply, ttft_ms, complete = await self._relay_event_stream(
+            request.event_stream, 'gemini', "Gemini API", upstream, start_time, extract_gemini_text, {"model": model},
+            is_final=is_gemini_stream_final
+        )
+        if reply:
+            metadata = {'endpoint': 'gemini_stream', 'ttft_ms': ttft_ms}
+            if not complete:
+                metadata['incomplete'] = True
+            await asyncio.to_thread(save_ai_history, username, model, prompt_text, reply, metadata)
+        return 200, None
+
+    async def _relay_event_stream(self, stream, name, label, upstream, start_time, extract_text, done_info, end_marker=None, is_final=None, translate=None):
+        """Bản async của NexoraXHTTPRequestHandler._relay_event_stream, ghi vào AsyncEventStream"""
+        text_parts = []
+        ttft = None
+        complete = False
+        try:
+            with upstream:
+                # Từ đây header 200 đã gửi: lỗi chỉ còn báo được qua event "error"
+                await stream.start()
+                async for raw_event, data in aiter_sse_events(upstream):
+                    if end_marker is not None and data == end_marker:
+                        complete = True
+                        break
+                    if translate is None:
+                        await stream.write(raw_event)
+                    if not data:
+                        continue
+                    try:
+                        parsed = json.loads(data)
+                        text = extract_text(parsed)
+                        if is_final is not None and is_final(parsed):
+                            complete = True
+                    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                        continue
+                    if text:
+                        if ttft is None:
+                            ttft = time.time() - start_time
+                            UPSTREAM_METRICS.record_ttft(name, ttft)
+                        text_parts.append(text)
+                        if translate is not None:
+                            await stream.send_event(translate(text))
+            if not complete:
+                raise ConnectionError("upstream đóng kết nối trước khi stream kết thúc")
+            done_info = dict(done_info, ttft_ms=round(ttft * 1000, 2) if ttft is not None else None)
+            await stream.send_event(done_info, event="done")
+            await stream.end()
+        except ClientDisconnectedError as e:
+            logger.info(f"{label} stream aborted by client: {e}")
         except Exception as e:
-            logger.error(f"Admin get usage error: {e}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+            logger.error(f"{label} stream interrupted: {e}")
+            try:
+                await stream.send_event({"error": f"{label} lỗi: {str(e)}", "code": "STREAM_ERROR"}, event="error")
+                await stream.end()
+            except ClientDisconnectedError:
+                pass
+        return ''.join(text_parts), round(ttft * 1000, 2) if ttft is not None else None, complete
 
-    def handle_admin_config(self):
-        """Admin API: Get current configuration (Universal)"""
+    async def _relay_chat_stream(self, stream, step, failed_over, upstream, start_time, username, model_id, message, endpoint, has_files, cache_key=None):
+        """Bản async của NexoraXHTTPRequestHandler._relay_chat_stream"""
+        provider = step["provider"]
+        done_info = {"model": step["model"], "provider": provider}
+        if provider == 'gemini':
+            reply, ttft_ms, complete = await self._relay_event_stream(
+                stream, 'gemini', "Gemini API", upstream, start_time, extract_gemini_text, done_info,
+                is_final=is_gemini_stream_final, translate=lambda text: build_chat_chunk(step["model"], text)
+            )
+        else:
+            reply, ttft_ms, complete = await self._relay_event_stream(
+                stream, 'llm7', "LLM7 API", upstream, start_time, extract_llm7_delta, done_info, end_marker='[DONE]'
+            )
+        if cache_key and reply and complete:
+            RESPONSE_CACHE.set(cache_key, {"reply": reply, "model": step["model"], "provider": provider})
+        if reply:
+            metadata = {'endpoint': endpoint, 'has_files': has_files, 'stream': True, 'ttft_ms': ttft_ms}
+            metadata.update(chat_provider_metadata(step, failed_over))
+            if not complete:
+                metadata['incomplete'] = True
+            await asyncio.to_thread(save_ai_history, username, model_id, message, reply, metadata)
+        logger.info(f"{model_id} stream via {provider} {'completed' if complete else 'ended early'} ({len(reply)} chars, async)")
+
+    async def _route_llm7_chat(self, request):
+        return await self._llm7_completion(request, fixed_model=None)
+
+    async def _route_llm7_gpt5chat(self, request):
+        return await self._llm7_completion(request, fixed_model='gpt-5-chat')
+
+    async def _call_chat_chain(self, model_id, messages, stream=False):
+        """Bản async của NexoraXHTTPRequestHandler._call_chat_chain (response là AsyncStreamResponse khi stream=True)"""
+        calls = build_chat_chain_calls(model_id, messages, stream)
+        deadline = Deadline(get_model_fallback_deadline())
+        failed_over = []
+        last_error = None
+        for index, (step, call) in enumerate(calls):
+            if last_error is not None and deadline.remaining() < FAILOVER_MIN_REMAINING:
+                break
+            name, url, headers, data, api_key = call
+            step_deadline = chat_step_deadline(deadline, index, len(calls))
+            try:
+                return step, await async_upstream_call(name, 'POST', url, headers, data, api_key=api_key, deadline=step_deadline, stream=stream), failed_over
+            except Exception as e:
+                if not is_failover_error(e) or index == len(calls) - 1:
+                    raise
+                last_error = e
+                failed_over.append(step["provider"])
+                logger.warning(f"🔀 {model_id}: {step['provider']} failed ({type(e).__name__}: {e}), failing over to {calls[index + 1][0]['provider']}")
+        raise last_error
+
+    async def _llm7_completion(self, request, fixed_model=None):
+        """/api/llm7/chat (fixed_model=None) và /api/llm7/gpt-5-chat"""
+        username = request.username
+        model_id = fixed_model or 'AI'
         try:
-            config_data = {}
-            
-            # Danh sách các dịch vụ mặc định
-            default_services = ['gemini', 'serpapi', 'serper', 'llm7']
-            
-            # Lấy tất cả keys từ config_override trước (đây là các key đã được admin lưu)
-            with config.config_lock:
-                for service_key, value in config.config_override.items():
-                    config_data[service_key] = value
-            
-            # Sau đó lấy các dịch vụ mặc định nếu chưa có trong override
-            for service in default_services:
-                if service not in config_data:
-                    val = get_api_key(service)
-                    if val:
-                        config_data[service] = val
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps({
-                "success": True,
-                "config": config_data
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-            logger.info("Admin API: Retrieved universal config")
-            
+            request_data = json.loads(request.body)
+            model_id = fixed_model or request_data.get('model', 'gpt-5-chat')
+            message = request_data.get('message', '')
+            if not message:
+                return 400, {"error": "Message không được để trống", "code": "MISSING_MESSAGE"}
+
+            files = request_data.get('files', [])
+            file_error = validate_request_files(files)
+            if file_error:
+                status_code, error_message, error_code = file_error
+                return status_code, {"error": error_message, "code": error_code}
+            messages = build_llm7_messages(
+                model_id, message, request_data.get('messages', []),
+                identity_guard=fixed_model is None
+            )
+            if files:
+                # Mô tả các ảnh song song bằng Gemini Vision
+                image_descriptions = await asyncio.gather(*[
+                    self._vision_description(file['base64'])
+                    for file in files if file.get('base64')
+                ])
+                messages = attach_image_descriptions(messages, list(image_descriptions))
+
+            stream = bool(request_data.get('stream'))
+            endpoint = 'llm7_chat' if fixed_model is None else 'llm7_gpt5chat'
+
+            # Chỉ /api/llm7/chat dùng cache câu trả lời (giống handle_llm7_chat)
+            cache_key = None if files or fixed_model else response_cache_key(request_data, request.headers, model_id, messages)
+            cached = RESPONSE_CACHE.get(cache_key) if cache_key else None
+            if cached is not None:
+                logger.info(f"{model_id} response cache hit (async)")
+                metadata = {'endpoint': 'llm7_chat', 'has_files': False, 'stream': stream, 'cached': True, 'provider': cached["provider"]}
+                await asyncio.to_thread(save_ai_history, username, model_id, message, cached["reply"], metadata)
+                if not stream:
+                    return 200, dict(cached)
+                try:
+                    await request.event_stream.start()
+                    await request.event_stream.send_event(build_chat_chunk(cached["model"], cached["reply"]))
+                    await request.event_stream.send_event({"model": cached["model"], "provider": cached["provider"], "ttft_ms": 0, "cached": True}, event="done")
+                    await request.event_stream.end()
+                except ClientDisconnectedError:
+                    pass
+                return 200, None
+
+            start_time = time.time()
+            step, response, failed_over = await self._call_chat_chain(model_id, messages, stream)
+            if stream:
+                await self._relay_chat_stream(
+                    request.event_stream, step, failed_over, response, start_time,
+                    username, model_id, message, endpoint, len(files) > 0, cache_key
+                )
+                return 200, None
+            reply = extract_chat_reply(step["provider"], response.json())
+            if cache_key and reply:
+                RESPONSE_CACHE.set(cache_key, {"reply": reply, "model": step["model"], "provider": step["provider"]})
+
+            metadata = {'endpoint': endpoint, 'has_files': len(files) > 0}
+            metadata.update(chat_provider_metadata(step, failed_over))
+            await asyncio.to_thread(save_ai_history, username, model_id, message, reply, metadata)
+            logger.info(f"{model_id} completed successfully via {step['provider']} (async)")
+            return 200, {"reply": reply, "model": step["model"], "provider": step["provider"]}
         except Exception as e:
-            logger.error(f"Admin get config error: {e}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+            system_message = None
+            if fixed_model is None:
+                system_message = f"Xin lỗi, đã có lỗi xảy ra khi gọi {model_id}. Chi tiết: Lỗi hệ thống: {str(e)} Vui lòng thử lại hoặc chọn model khác."
+            return self._upstream_error(e, "LLM7 API", "Không thể kết nối đến LLM7 API", system_message)
 
-    def handle_admin_config_update(self):
-        """Admin API: Update ANY API key configuration"""
+    async def _route_enhance_prompt(self, request):
+        gemini_key = API_KEYS.acquire('gemini')
+        if not gemini_key or gemini_key == "your_gemini_api_key_here":
+            return 500, {
+                "error": "Gemini API key chưa được cấu hình. Vui lòng thêm GEMINI_API_KEY vào environment variables.",
+                "code": "API_KEY_MISSING"
+            }
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_data = json.loads(post_data.decode('utf-8'))
-            
-            service = request_data.get('service', '').strip().lower()
-            api_key = request_data.get('api_key', '').strip()
-            
-            if not service:
-                self._send_json_error(400, "Service không được để trống", "MISSING_SERVICE")
-                return
-            
-            if not api_key:
-                self._send_json_error(400, "API key không được để trống", "MISSING_API_KEY")
-                return
-            
-            # Cập nhật cấu hình (Hỗ trợ mọi key bất kỳ)
-            if not save_config_override(service, api_key):
-                self._send_json_error(500, "Không thể lưu cấu hình", "SAVE_ERROR")
-                return
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._send_cors_headers()
-            self.end_headers()
-            
-            response_json = json.dumps({
+            request_data = json.loads(request.body)
+            user_prompt = request_data.get('prompt', '')
+            if not user_prompt:
+                return 400, {"error": "Prompt không được để trống", "code": "MISSING_PROMPT"}
+
+            cache_key = normalize_cache_text(user_prompt)
+            cached = ENHANCE_CACHE.get(cache_key)
+            if cached is not None:
+                logger.info(f"Enhance prompt cache hit: '{user_prompt}'")
+                return 200, {"original_prompt": user_prompt, "enhanced_prompt": cached, "success": True}
+
+            response = await async_upstream_call(
+                'gemini',
+                'POST',
+                gemini_generate_url('gemini-2.5-flash', gemini_key),
+                {'Content-Type': 'application/json'},
+                json.dumps(build_enhance_prompt_payload(user_prompt)).encode('utf-8'),
+                api_key=gemini_key
+            )
+            enhanced_prompt = extract_gemini_text(response.json())
+            if enhanced_prompt:
+                ENHANCE_CACHE.set(cache_key, enhanced_prompt.strip())
+            else:
+                enhanced_prompt = user_prompt
+
+            logger.info(f"Prompt enhanced: '{user_prompt}' -> '{enhanced_prompt.strip()}'")
+            return 200, {
+                "original_prompt": user_prompt,
+                "enhanced_prompt": enhanced_prompt.strip(),
+                "success": True
+            }
+        except Exception as e:
+            return self._upstream_error(e, "Gemini API", "Không thể kết nối đến Gemini API")
+
+    async def _route_pollinations_generate(self, request):
+        try:
+            request_data = json.loads(request.body)
+            prompt = request_data.get('prompt', '')
+            if not prompt:
+                return 400, {"error": "Prompt không được để trống", "code": "MISSING_PROMPT"}
+            if len(prompt) > 5000:
+                return 400, {"error": "Prompt quá dài. Vui lòng giới hạn trong 5000 ký tự.", "code": "PROMPT_TOO_LONG"}
+
+            logger.info(f"🎨 Đang gọi Pollinations AI (Flux) để vẽ: {prompt[:50]}...")
+            response = await async_upstream_call(
+                'pollinations',
+                'GET',
+                build_pollinations_url(prompt),
+                {'User-Agent': 'NexoraX-AI/1.0'},
+                read_body=False
+            )
+            logger.info("✅ Ảnh đã tạo thành công với Pollinations AI (Flux)")
+            return 200, {
                 "success": True,
-                "message": f"Cấu hình cho '{service}' đã được cập nhật thành công"
-            }, ensure_ascii=False)
-            self.wfile.write(response_json.encode('utf-8'))
-            
-            logger.info(f"Admin API: Updated universal config for service '{service}'")
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in config update request: {e}")
-            self._send_json_error(400, "Dữ liệu gửi lên không hợp lệ", "INVALID_JSON")
+                "image_url": response.url,
+                "prompt": prompt,
+                "model": "pollinations-flux"
+            }
         except Exception as e:
-            logger.error(f"Admin config update error: {e}")
-            self._send_json_error(503, f"Lỗi hệ thống: {str(e)}", "SYSTEM_ERROR")
+            return self._upstream_error(e, "Pollinations API", "Không thể kết nối đến Pollinations API")
 
-    def _format_search_context_for_ai(self, serpapi_data, query):
-        """Format SerpAPI data into context for AI processing"""
-        context_parts = []
-        
-        # Add answer box if available
-        answer_box = serpapi_data.get('answer_box', {})
-        if answer_box.get('answer'):
-            context_parts.append(f"Câu trả lời nhanh: {answer_box['answer']}")
-        if answer_box.get('snippet'):
-            context_parts.append(f"Thông tin tổng quan: {answer_box['snippet']}")
-        if answer_box.get('title'):
-            context_parts.append(f"Tiêu đề: {answer_box['title']}")
-        
-        # Add knowledge graph information
-        knowledge_graph = serpapi_data.get('knowledge_graph', {})
-        if knowledge_graph.get('description'):
-            context_parts.append(f"Định nghĩa: {knowledge_graph['description']}")
-        if knowledge_graph.get('title'):
-            context_parts.append(f"Chủ đề chính: {knowledge_graph['title']}")
-        
-        # Add organic search results
-        organic_results = serpapi_data.get('organic_results', [])
-        if organic_results:
-            result_info = []
-            for result in organic_results[:5]:  # First 5 results
-                if result.get('title') and result.get('snippet'):
-                    result_info.append(f"{result['title']}: {result['snippet']}")
-            if result_info:
-                context_parts.append(f"Kết quả tìm kiếm từ Google:\n" + "\n".join(f"- {info}" for info in result_info))
-        
-        # Add search information
-        search_info = serpapi_data.get('search_information', {})
-        if search_info.get('total_results'):
-            context_parts.append(f"Tổng số kết quả tìm thấy: {search_info['total_results']:,}")
-        
-        return "\n\n".join(context_parts) if context_parts else "Không tìm thấy thông tin từ nguồn tìm kiếm."
 
-    def _create_search_enhanced_prompt(self, user_query, search_context):
-        """Create an enhanced prompt for Gemini that includes search context"""
-        prompt = f"""Bạn là NexoraX 2, một AI assistant được tích hợp với khả năng tìm kiếm thông tin thời gian thực qua Google Search. Hãy trả lời câu hỏi của người dùng dựa trên thông tin tìm kiếm được cung cấp và kiến thức của bạn.
+# Prefork supervisor
+PREFORK_RESTART_DELAY = 1.0     # Chờ tối thiểu trước khi respawn worker vừa crash
+PREFORK_SHUTDOWN_GRACE = 10.0   # Thời gian chờ worker tự dừng trước khi SIGKILL
 
-Câu hỏi của người dùng: {user_query}
+def _run_prefork_worker(worker_id, port, pool_size, queue_size, backlog):
+    """Chạy trong process con: 1 PooledHTTPServer bind chung port qua SO_REUSEPORT"""
+    global SHARED_STATE_SYNC
+    SHARED_STATE_SYNC = True
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-Thông tin tìm kiếm từ Google (qua SerpAPI):
-{search_context}
+    # Fork copy dict của supervisor; đọc lại store để có snapshot cho merge khi save
+    sync_shared_state()
+    # Không dùng chung socket upstream với process khác
+    UPSTREAM_POOL.clear()
 
-Hướng dẫn trả lời:
-1. Sử dụng thông tin tìm kiếm để đưa ra câu trả lời chính xác và cập nhật
-2. Nếu thông tin tìm kiếm không đủ, hãy bổ sung từ kiến thức của bạn
-3. Trả lời bằng tiếng Việt một cách tự nhiên và dễ hiểu
-4. Nếu có nguồn thông tin, hãy đề cập đến nguồn đó
-5. Nếu thông tin không rõ ràng hoặc mâu thuẫn, hãy nói rõ điều đó
-6. Sử dụng emoji một cách tự nhiên trong câu trả lời để làm cho thông tin sinh động và thú vị hơn (không lạm dụng)
+    # Chỉ worker 0 chạy cleanup để các process không cùng ghi đè file store
+    if worker_id == 0:
+        cleanup_thread = threading.Thread(target=cleanup_expired_data, daemon=True)
+        cleanup_thread.start()
+    CLOCK.start(get_ntp_check_settings())
 
-Vui lòng trả lời:"""
-        
-        return prompt
+    httpd = PooledHTTPServer(("0.0.0.0", port), NexoraXHTTPRequestHandler,
+                             pool_size=pool_size, queue_size=queue_size,
+                             backlog=backlog, reuse_port=True)
 
-    def do_OPTIONS(self):
-        """Handle CORS preflight requests"""
-        self.send_response(200)
-        # Use secure CORS headers consistently
-        self._send_cors_headers()
-        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.send_header('Access-Control-Max-Age', '3600')
-        self.end_headers()
+    def handle_sigterm(signum, frame):
+        # shutdown() chờ serve_forever thoát nên phải gọi từ thread khác
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
 
-    def do_GET(self):
-        """Handle GET requests with proper MIME types and caching"""
-        # Log all requests
-        logger.info(f"GET {self.path} from {self.client_address[0]}")
-        
-        # Handle GitHub OAuth endpoints
-        if self.path == '/auth/github' or self.path.startswith('/auth/github?'):
-            self.handle_github_oauth_start()
-            return
-        elif self.path.startswith('/auth/github/callback'):
-            self.handle_github_oauth_callback()
-            return
-        elif self.path == '/api/auth/github/status':
-            self.handle_github_oauth_status()
-            return
-        
-        # Handle check-session endpoint
-        if self.path.startswith('/api/auth/check-session'):
-            self.handle_auth_check_session()
-            return
-        
-        # Handle admin GET endpoints
-        if self.path == '/api/admin/users':
-            self.handle_admin_get_users()
-            return
-        elif self.path == '/api/admin/sessions':
-            self.handle_admin_get_sessions()
-            return
-        elif self.path == '/api/admin/stats':
-            self.handle_admin_get_stats()
-            return
-        elif self.path == '/api/admin/rate-limits':
-            self.handle_admin_get_rate_limits()
-            return
-        elif self.path.startswith('/api/admin/logs'):
-            self.handle_admin_logs()
-            return
-        elif self.path.startswith('/api/admin/history'):
-            self.handle_admin_history()
-            return
-        elif self.path.startswith('/api/admin/usage'):
-            self.handle_admin_usage()
-            return
-        elif self.path.startswith('/api/admin/config'):
-            self.handle_admin_config()
-            return
-        
-        # Handle root path
-        if self.path == '/':
-            self.path = '/index.html'
-        elif self.path == '/admin' or self.path == '/admin/':
-            self.path = '/admin.html'
-        elif self.path == '/ping':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b"pong")
-            return
-        
-        # Clean path
-        path = unquote(self.path)
-        
-        # Set proper MIME types
-        if path.endswith('.css'):
-            self.send_response(200)
-            self.send_header('Content-type', 'text/css')
-            self.send_header('Cache-Control', 'no-cache')
-            self.end_headers()
-            
-            try:
-                with open(path[1:], 'rb') as file:
-                    self.wfile.write(file.read())
-            except FileNotFoundError:
-                self.send_error(404)
-            return
-        
-        elif path.endswith('.js'):
-            self.send_response(200)
-            self.send_header('Content-type', 'application/javascript')
-            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Expires', '0')
-            self.end_headers()
-            
-            try:
-                with open(path[1:], 'rb') as file:
-                    self.wfile.write(file.read())
-            except FileNotFoundError:
-                self.send_error(404)
-            return
-        
-        elif path.endswith('.html'):
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.send_header('Cache-Control', 'no-cache')
-            self.end_headers()
-            
-            try:
-                with open(path[1:] if path != '/index.html' else 'index.html', 'rb') as file:
-                    self.wfile.write(file.read())
-            except FileNotFoundError:
-                self.send_error(404)
-            return
-        
-        # For all other files, use default handler
-        super().do_GET()
-    
-    def log_message(self, format, *args):
-        """Override default logging to use our logger"""
-        logger.info(f"{self.client_address[0]} - {format % args}")
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    logger.info(f"Prefork worker {worker_id} (pid {os.getpid()}) serving on port {port}")
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        logger.info(f"Prefork worker {worker_id} (pid {os.getpid()}) stopped")
+
+def _spawn_prefork_worker(worker_id, port, pool_size, queue_size, backlog):
+    """Fork 1 worker process, trả về pid ở process cha"""
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 0
+        try:
+            _run_prefork_worker(worker_id, port, pool_size, queue_size, backlog)
+        except Exception as e:
+            logger.error(f"Prefork worker {worker_id} crashed: {e}")
+            exit_code = 1
+        finally:
+            logging.shutdown()
+            os._exit(exit_code)
+    return pid
+
+def run_prefork_supervisor(port, workers, pool_size, queue_size, backlog):
+    """Fork N worker process dùng chung listening port, respawn khi crash, dừng theo thứ tự khi SIGTERM"""
+    if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError("Prefork mode cần os.fork và SO_REUSEPORT (Linux/BSD)")
+
+    stopping = threading.Event()
+
+    def handle_stop(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+
+    children = {}  # pid -> worker_id
+    last_spawn = {}
+    for worker_id in range(workers):
+        pid = _spawn_prefork_worker(worker_id, port, pool_size, queue_size, backlog)
+        children[pid] = worker_id
+        last_spawn[worker_id] = time.time()
+
+    logger.info(f"Server mode: prefork ({workers} workers x pool {pool_size}, queue {queue_size}, backlog {backlog})")
+    logger.info(f"NexoraX AI Server running on http://0.0.0.0:{port}/")
+    logger.info("Press Ctrl+C to stop the server")
+
+    while not stopping.is_set():
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid, status = 0, 0
+        if pid == 0:
+            stopping.wait(0.5)
+            continue
+        worker_id = children.pop(pid, None)
+        if worker_id is None or stopping.is_set():
+            continue
+        logger.warning(f"Prefork worker {worker_id} (pid {pid}) exited with status {status}, restarting")
+        # Tránh respawn liên tục nếu worker crash ngay khi khởi động
+        delay = PREFORK_RESTART_DELAY - (time.time() - last_spawn[worker_id])
+        if delay > 0:
+            stopping.wait(delay)
+            if stopping.is_set():
+                break
+        new_pid = _spawn_prefork_worker(worker_id, port, pool_size, queue_size, backlog)
+        children[new_pid] = worker_id
+        last_spawn[worker_id] = time.time()
+
+    logger.info(f"Stopping {len(children)} prefork workers...")
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    deadline = time.time() + PREFORK_SHUTDOWN_GRACE
+    while children and time.time() < deadline:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.1)
+            continue
+        children.pop(pid, None)
+
+    for pid in children:
+        logger.warning(f"Prefork worker pid {pid} did not stop in time, killing")
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+    logger.info("Server stopped")
 
 def run_server(port=None):
     """Run the NexoraX AI server"""
     if port is None:
         port = int(os.environ.get('PORT', 5000))
-    
+
     handler = NexoraXHTTPRequestHandler
-    
-    # Allow reuse of socket address to prevent "Address already in use" errors
-    socketserver.TCPServer.allow_reuse_address = True
-    
+    pool_size, queue_size, backlog = get_server_concurrency()
+    server_mode = get_server_mode()
+
+    if server_mode == 'prefork':
+        # Fork trước khi start bất kỳ thread nào (cleanup thread chạy trong worker 0)
+        try:
+            run_prefork_supervisor(port, get_server_workers(), pool_size, queue_size, backlog)
+        except Exception as e:
+            logger.error(f"Server error: {e}")
+        return
+
     cleanup_thread = threading.Thread(target=cleanup_expired_data, daemon=True)
     cleanup_thread.start()
     logger.info("Background cleanup task started")
-    
+    CLOCK.start(get_ntp_check_settings())
+
     try:
-        with socketserver.TCPServer(("0.0.0.0", port), handler) as httpd:
+        if server_mode == 'asyncio':
+            async_server = AsyncNexoraXServer(("0.0.0.0", port), bridge_workers=pool_size, backlog=backlog)
+            logger.info(f"Server mode: asyncio (bridge pool {pool_size} workers, backlog {backlog})")
+            logger.info(f"NexoraX AI Server running on http://0.0.0.0:{port}/")
+            logger.info("Press Ctrl+C to stop the server")
+            async_server.serve_forever()
+            return
+
+        with PooledHTTPServer(("0.0.0.0", port), handler, pool_size=pool_size, queue_size=queue_size, backlog=backlog) as httpd:
+            logger.info(f"Worker pool: {pool_size} workers, queue {queue_size}, backlog {backlog}")
             logger.info(f"NexoraX AI Server running on http://0.0.0.0:{port}/")
             logger.info("Press Ctrl+C to stop the server")
             
@@ -52,6 +52,66 @@ export function prepareConversationHistoryLLM7(messages, limit = 5) {
     }));
 }
 
+// ===================================
+// SERVER-SENT EVENTS
+// ===================================
+
+/**
+ * Đọc response text/event-stream, gọi onEvent(event, data) cho từng event
+ * @param {Response} response - Response của fetch
+ * @param {Function} onEvent - Callback nhận tên event ('message' nếu không có) và data đã JSON.parse
+ */
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    
+    const dispatch = (rawEvent) => {
+        let event = 'message';
+        const dataLines = [];
+        rawEvent.split(/\r?\n/).forEach(line => {
+            if (line.startsWith('event:')) event = line.slice(6).trim();
+            else if (line.startsWith('data:')) dataLines.push(line.slice(5).replace(/^ /, ''));
+        });
+        if (dataLines.length === 0) return;
+        onEvent(event, JSON.parse(dataLines.join('\n')));
+    };
+    
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split(/\r?\n\r?\n/);
+        buffer = events.pop();
+        events.forEach(dispatch);
+    }
+    if (buffer.trim()) dispatch(buffer);
+}
+
+/**
+ * Đọc stream OpenAI-style (LLM7) và cập nhật aiMessage theo từng delta
+ * @returns {Promise<string>} Toàn bộ câu trả lời đã ghép
+ */
+async function readChatCompletionStream(response, aiMessage, updateCallback) {
+    let responseText = '';
+    await readEventStream(response, (event, data) => {
+        if (event === 'error') {
+            throw new Error(data.error || 'LLM7 API stream bị gián đoạn');
+        }
+        if (event !== 'message') return;
+        
+        const delta = data.choices && data.choices[0] && data.choices[0].delta;
+        if (!delta || !delta.content) return;
+        
+        responseText += delta.content;
+        aiMessage.content = responseText;
+        aiMessage.isTyping = false;
+        aiMessage.isFinalized = true; // Render trực tiếp, không chạy lại typewriter cho mỗi chunk
+        updateCallback(aiMessage);
+    });
+    return responseText;
+}
+
 // ===================================
 // GEMINI API
 // ===================================
@@ -67,7 +127,7 @@ export function prepareConversationHistoryLLM7(messages, limit = 5) {
  */
 export async function getGeminiResponse(message, aiMessage, files, conversationHistory, updateCallback, signal = null) {
     try {
-        const url = API_ENDPOINTS.GEMINI;
+        const url = API_ENDPOINTS.GEMINI_STREAM;
         
         // Build contents array từ history + current message
         const contents = [...conversationHistory];
@@ -144,26 +204,30 @@ export async function getGeminiResponse(message, aiMessage, files, conversationH
             throw new Error(errorData.error || 'HTTP error! status: ' + response.status);
         }
         
-        const data = await response.json();
-        console.log('Gemini API response:', data);
-        
-        // Extract response text
+        // Server-Sent Events: hiển thị từng phần câu trả lời ngay khi Gemini gửi về
         let responseText = '';
-        if (data.candidates && data.candidates.length > 0) {
-            const candidate = data.candidates[0];
-            if (candidate.content && candidate.content.parts && candidate.content.parts.length > 0) {
-                responseText = candidate.content.parts[0].text;
-            } else {
-                responseText = JSON.stringify(candidate);
+        await readEventStream(response, (event, data) => {
+            if (event === 'error') {
+                throw new Error(data.error || 'Gemini API stream bị gián đoạn');
             }
-        } else {
-            responseText = data.text || JSON.stringify(data);
-        }
+            if (event !== 'message') return;
+            
+            const candidate = data.candidates && data.candidates[0];
+            const text = candidate?.content?.parts?.[0]?.text;
+            if (!text) return;
+            
+            responseText += text;
+            aiMessage.content = responseText;
+            aiMessage.isTyping = false;
+            aiMessage.isFinalized = true; // Render trực tiếp, không chạy lại typewriter cho mỗi chunk
+            updateCallback(aiMessage);
+        });
         
-        // Update AI message
-        aiMessage.content = responseText;
-        aiMessage.isTyping = false;
-        updateCallback(aiMessage);
+        if (!responseText) {
+            aiMessage.content = 'Gemini không trả về kết quả hợp lệ. Vui lòng thử lại.';
+            aiMessage.isTyping = false;
+            updateCallback(aiMessage);
+        }
         
     } catch (error) {
         console.error('Gemini API Error:', error);
@@ -205,7 +269,8 @@ export async function getLLM7GPT5ChatResponse(message, aiMessage, files, convers
         const requestBody = {
             message: message,
             messages: conversationHistory,
-            files: files || [] // Thêm files vào request body
+            files: files || [], // Thêm files vào request body
+            stream: true
         };
         
         const response = await fetch(url, {
@@ -222,14 +287,12 @@ export async function getLLM7GPT5ChatResponse(message, aiMessage, files, convers
             throw new Error(errorData.error || 'HTTP error! status: ' + response.status);
         }
         
-        const data = await response.json();
-        console.log('LLM7 GPT-5 response:', data);
-        
-        const responseText = data.reply || JSON.stringify(data);
-        
-        aiMessage.content = responseText;
-        aiMessage.isTyping = false;
-        updateCallback(aiMessage);
+        const responseText = await readChatCompletionStream(response, aiMessage, updateCallback);
+        if (!responseText) {
+            aiMessage.content = 'GPT-5 không trả về kết quả hợp lệ. Vui lòng thử lại.';
+            aiMessage.isTyping = false;
+            updateCallback(aiMessage);
+        }
         
     } catch (error) {
         console.error('LLM7 GPT-5 Error:', error);
@@ -267,7 +330,8 @@ export async function getLLM7GeminiSearchResponse(message, aiMessage, files, con
         const requestBody = {
             message: message,
             messages: conversationHistory,
-            files: files || [] // Thêm files vào request body
+            files: files || [], // Thêm files vào request body
+            stream: true
         };
         
         const response = await fetch(url, {
@@ -284,15 +348,36 @@ export async function getLLM7GeminiSearchResponse(message, aiMessage, files, con
             throw new Error(errorData.error || 'HTTP error! status: ' + response.status);
         }
         
-        const data = await response.json();
-        console.log('LLM7 Gemini Search response:', data);
-        
-        let responseText = data.reply || JSON.stringify(data);
-        responseText += '\n\n*🔍 Sử dụng Gemini Search với tìm kiếm thời gian thực*';
+        // Hiển thị từng bước: query đã tối ưu → kết quả Serper → tóm tắt của Gemini
+        const showContent = (content) => {
+            aiMessage.content = content;
+            aiMessage.isTyping = false;
+            aiMessage.isFinalized = true; // Render trực tiếp, không chạy lại typewriter cho mỗi bước
+            updateCallback(aiMessage);
+        };
+        let searchMarkdown = '';
+        let responseText = '';
+        await readEventStream(response, (event, data) => {
+            if (event === 'error') {
+                throw new Error(data.error || 'Gemini Search bị gián đoạn');
+            }
+            if (event === 'stage' && data.stage === 'optimize') {
+                showContent(`🔎 Đang tìm kiếm: **${data.optimized_query}**`);
+            } else if (event === 'stage' && data.stage === 'search') {
+                searchMarkdown = data.markdown;
+                showContent(searchMarkdown);
+            } else if (event === 'stage' && data.stage === 'summary' && data.success === false) {
+                responseText = searchMarkdown + data.note;
+                showContent(responseText);
+            } else if (event === 'summary') {
+                responseText += data.text;
+                showContent(responseText);
+            } else if (event === 'done') {
+                console.log('LLM7 Gemini Search timings (ms):', data.timings_ms);
+            }
+        });
         
-        aiMessage.content = responseText;
-        aiMessage.isTyping = false;
-        updateCallback(aiMessage);
+        showContent((responseText || searchMarkdown) + '\n\n*🔍 Sử dụng Gemini Search với tìm kiếm thời gian thực*');
         
     } catch (error) {
         console.error('LLM7 Gemini Search Error:', error);
@@ -332,7 +417,8 @@ export async function getLLM7Response(modelId, message, aiMessage, files, conver
             model: modelId,
             message: message,
             messages: conversationHistory,
-            files: files || [] // Thêm files vào request body
+            files: files || [], // Thêm files vào request body
+            stream: true
         };
         
         const response = await fetch(url, {
@@ -349,10 +435,7 @@ export async function getLLM7Response(modelId, message, aiMessage, files, conver
             throw new Error(errorData.error || 'HTTP error! status: ' + response.status);
         }
         
-        const data = await response.json();
-        console.log(`LLM7 ${modelId} response:`, data);
-        
-        let responseText = data.reply || JSON.stringify(data);
+        let responseText = await readChatCompletionStream(response, aiMessage, updateCallback);
         
         // Fix: Một số model (như gemma-2-2b-it) trả về raw JSON string
         // Cần parse thêm một lớp để lấy message content
@@ -371,7 +454,7 @@ export async function getLLM7Response(modelId, message, aiMessage, files, conver
             console.log('Could not parse nested JSON, using original response');
         }
         
-        aiMessage.content = responseText;
+        aiMessage.content = responseText || `${modelId} không trả về kết quả hợp lệ. Vui lòng thử lại.`;
         aiMessage.isTyping = false;
         updateCallback(aiMessage);
         
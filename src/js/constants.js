@@ -333,6 +333,7 @@ export const BREAKPOINTS = {
  */
 export const API_ENDPOINTS = {
     GEMINI: '/api/gemini',
+    GEMINI_STREAM: '/api/gemini/stream',
     LLM7_CHAT: '/api/llm7/chat',
     LLM7_GPT5_CHAT: '/api/llm7/gpt-5-chat',
     LLM7_GEMINI_SEARCH: '/api/llm7/gemini-search',
@@ -0,0 +1,13 @@
+"""Cấu hình chung cho test: import server.py từ thư mục gốc repo
+
+server.py đọc/ghi acc.txt, sessions_store.json, server.log... theo thư mục hiện tại, nên test
+chạy trong một thư mục tạm để không đụng dữ liệu thật.
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.chdir(tempfile.mkdtemp(prefix='nexorax-test-'))
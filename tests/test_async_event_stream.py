@@ -0,0 +1,114 @@
+"""Relay SSE native trong asyncio mode: AsyncStreamResponse + AsyncNexoraXServer._llm7_completion"""
+
+import asyncio
+import email.message
+import json
+
+import pytest
+
+import server
+from test_event_stream import sse_events
+
+
+class FakeClientWriter:
+    """StreamWriter giả của kết nối client: gom lại mọi byte đã ghi"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.transport = self
+
+    def is_closing(self):
+        return False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+
+def dechunk(raw):
+    """Body SSE từ response chunked (giữ header để dùng lại sse_events)"""
+    head, _, body = bytes(raw).partition(b'\r\n\r\n')
+    data = b''
+    while body:
+        size_line, _, body = body.partition(b'\r\n')
+        size = int(size_line, 16)
+        if size == 0:
+            break
+        data, body = data + body[:size], body[size + 2:]
+    return head + b'\r\n\r\n' + data
+
+
+def llm7_chunk(text):
+    return b'data: ' + json.dumps(server.build_chat_chunk("gpt-5-chat", text)).encode('utf-8') + b'\n\n'
+
+
+async def start_upstream(events, finish=True):
+    """Upstream SSE chunked; mỗi event bị cắt làm đôi để kiểm tra ghép dòng qua nhiều chunk"""
+    async def handle(reader, writer):
+        head = await reader.readuntil(b'\r\n\r\n')
+        length = int(head.lower().split(b'content-length: ', 1)[1].split(b'\r\n', 1)[0])
+        await reader.readexactly(length)
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n')
+        for event in events:
+            for part in (event[:7], event[7:]):
+                writer.write(b'%X\r\n%s\r\n' % (len(part), part))
+            await writer.drain()
+        if finish:
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        writer.close()
+
+    upstream = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return upstream, f"http://127.0.0.1:{upstream.sockets[0].getsockname()[1]}/v1/chat/completions"
+
+
+def make_request(body):
+    headers = email.message.Message()
+    headers['Cache-Control'] = 'no-store'
+    raw = json.dumps(body).encode('utf-8')
+    return server.AsyncRequest('POST', '/api/llm7/chat', 'HTTP/1.1', headers, raw, raw, ('127.0.0.1', 0))
+
+
+async def stream_chat(monkeypatch, events, finish=True):
+    upstream, url = await start_upstream(events, finish)
+    monkeypatch.setattr(server, 'LLM7_CHAT_URL', url)
+    request = make_request({"model": "gpt-5-chat", "message": "hi", "stream": True})
+    writer = FakeClientWriter()
+    request.event_stream = server.AsyncEventStream(writer, request)
+    async with upstream:
+        status, payload = await server.AsyncNexoraXServer(('127.0.0.1', 0))._llm7_completion(request)
+    return status, payload, request.event_stream, sse_events(dechunk(writer.data))
+
+
+@pytest.fixture
+def llm7_only(monkeypatch):
+    monkeypatch.setattr(server.API_KEYS, 'acquire', lambda service: 'llm7-key' if service == 'llm7' else None)
+
+
+def test_native_chat_stream_relays_chunks(monkeypatch, llm7_only):
+    events = [llm7_chunk("Xin "), llm7_chunk("chào"), b'data: [DONE]\n\n']
+    status, payload, stream, client_events = asyncio.run(stream_chat(monkeypatch, events))
+    assert (status, payload) == (200, None)
+    assert stream.finished
+    assert [event for event, _ in client_events] == ['message', 'message', 'done']
+    assert json.loads(client_events[-1][1])["provider"] == 'llm7'
+
+
+def test_native_chat_stream_truncated_sends_error(monkeypatch, llm7_only):
+    status, _, stream, client_events = asyncio.run(stream_chat(monkeypatch, [llm7_chunk("Xin ")], finish=False))
+    assert status == 200
+    assert client_events[-1][0] == 'error'
+    assert json.loads(client_events[-1][1])["code"] == 'STREAM_ERROR'
+
+
+def test_stream_response_reads_lines_across_chunks():
+    async def run():
+        upstream, url = await start_upstream([b'data: 1\n\n', b'data: 2\n\n'])
+        async with upstream:
+            response = await server.async_http_request('POST', url, data=b'{}', timeout=5, stream=True)
+            with response:
+                return [event async for event in server.aiter_sse_events(response)]
+
+    assert [data for _, data in asyncio.run(run())] == ['1', '2']
@@ -0,0 +1,151 @@
+"""Cache trong bộ nhớ: TTLCache, SingleFlight, BackgroundExecutor"""
+
+import threading
+import types
+
+import pytest
+
+import server
+
+
+@pytest.fixture(autouse=True)
+def registries(monkeypatch):
+    # Cache/flight tạo trong test không lẫn vào /api/admin/stats của các test khác
+    monkeypatch.setattr(server, 'CACHES', {})
+    monkeypatch.setattr(server, 'SINGLE_FLIGHTS', {})
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server, 'time', types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+def test_entry_expires_after_ttl(clock):
+    cache = server.TTLCache('t', ttl=10)
+    cache.set('k', 'v')
+    assert cache.get('k') == 'v'
+    clock[0] += 11
+    assert cache.get('k') is None
+
+
+def test_lru_eviction_by_entries_and_bytes():
+    cache = server.TTLCache('t', max_entries=2, max_bytes=10)
+    cache.set('a', '1234')
+    cache.set('b', '1234')
+    cache.get('a')  # a dùng gần nhất → b bị bỏ trước
+    cache.set('c', '1234')
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == ('1234', None, '1234')
+    cache.set('d', '12345678')  # vượt max_bytes: bỏ tiếp các entry cũ nhất
+    assert cache.get('a') is None
+    assert cache.get_stats()["evictions"] == 3
+    cache.set('huge', 'x' * 11)  # lớn hơn cả cache: không lưu
+    assert cache.get('huge') is None
+
+
+def test_stale_entry_served_while_refreshing(clock):
+    cache = server.TTLCache('t', ttl=10, stale_seconds=60)
+    cache.set('k', 'old')
+    clock[0] += 11
+    refreshed = threading.Event()
+
+    def loader(deadline):
+        refreshed.set()
+        return 'new'
+
+    assert cache.get_or_load('k', loader) == ('old', 'stale')
+    assert refreshed.wait(5)
+    for _ in range(100):
+        if cache.get('k') == 'new':
+            break
+        threading.Event().wait(0.01)
+    assert cache.get('k') == 'new'
+
+
+def test_concurrent_misses_share_one_call():
+    flight = server.SingleFlight('t')
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def fn(deadline):
+        calls.append(1)
+        release.wait(5)
+        return 'value'
+
+    def request():
+        results.append(flight.do('k', fn))
+
+    threads = [threading.Thread(target=request) for _ in range(5)]
+    threads[0].start()
+    while flight.get_stats()["in_flight"] == 0:
+        threading.Event().wait(0.001)
+    for thread in threads[1:]:
+        thread.start()
+    while flight.get_stats()["shared"] < 4:
+        threading.Event().wait(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert sorted(results) == [('value', False)] + [('value', True)] * 4
+    assert flight.get_stats()["in_flight"] == 0
+
+
+def test_error_is_shared_and_key_released():
+    flight = server.SingleFlight('t')
+
+    def fail(deadline):
+        raise ValueError("upstream lỗi")
+
+    with pytest.raises(ValueError):
+        flight.do('k', fail)
+    assert flight.do('k', lambda deadline: 'ok') == ('ok', False)
+
+
+def test_waiter_deadline_exceeded_while_call_continues():
+    flight = server.SingleFlight('t')
+    release = threading.Event()
+    finished = threading.Event()
+
+    def fn(deadline):
+        release.wait(5)
+        finished.set()
+        return 'late'
+
+    with pytest.raises(server.DeadlineExceededError):
+        flight.do('k', fn, deadline=server.Deadline(0.05))
+    release.set()
+    assert finished.wait(5)
+
+
+def test_full_background_pool_runs_leader_inline(monkeypatch):
+    executor = server.BackgroundExecutor(1)
+    monkeypatch.setattr(server, 'BACKGROUND_EXECUTOR', executor)
+    release = threading.Event()
+    assert executor.try_submit(release.wait, 5) is not None
+    assert executor.try_submit(release.wait, 5) is None
+
+    caller = threading.current_thread()
+    ran_in = []
+    value = server.SingleFlight('t').do('k', lambda deadline: ran_in.append(threading.current_thread()) or 'v')
+    release.set()
+    assert value == ('v', False)
+    assert ran_in == [caller]
+    assert executor.get_stats()["rejected"] == 2
+
+
+def test_stale_refresh_skipped_when_background_pool_full(clock, monkeypatch):
+    executor = server.BackgroundExecutor(1)
+    monkeypatch.setattr(server, 'BACKGROUND_EXECUTOR', executor)
+    release = threading.Event()
+    executor.try_submit(release.wait, 5)
+    cache = server.TTLCache('t', ttl=10, stale_seconds=60)
+    cache.set('k', 'old')
+    clock[0] += 11
+    try:
+        assert cache.get_or_load('k', lambda deadline: 'new') == ('old', 'stale')
+    finally:
+        release.set()
+    assert not cache._refreshing  # request sau vẫn được làm mới
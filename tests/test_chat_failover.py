@@ -0,0 +1,53 @@
+"""Chuỗi failover của chat endpoint: build_chat_chain_calls / chat_step_deadline"""
+
+import json
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def api_keys(monkeypatch):
+    keys = {'llm7': 'llm7-key', 'gemini': 'gemini-key'}
+    monkeypatch.setattr(server.API_KEYS, 'acquire', lambda service: keys.get(service))
+    return keys
+
+
+def test_requested_model_reaches_llm7_payload(api_keys):
+    calls = server.build_chat_chain_calls('deepseek-v3.1', [{"role": "user", "content": "hi"}])
+    step, (name, url, headers, body, api_key) = calls[0]
+    assert step == {"provider": "llm7", "model": "deepseek-v3.1"}
+    assert name == 'llm7'
+    assert json.loads(body)["model"] == 'deepseek-v3.1'
+
+
+def test_fallback_steps_come_from_config(api_keys):
+    calls = server.build_chat_chain_calls('gpt-5-chat', [{"role": "user", "content": "hi"}], stream=True)
+    assert [step["provider"] for step, _ in calls] == ['llm7', 'gemini']
+    assert json.loads(calls[0][1][3])["stream"] is True
+
+
+def test_fallback_disabled_keeps_only_requested_model(api_keys, monkeypatch):
+    monkeypatch.setenv('MODEL_FALLBACK_ENABLED', 'false')
+    calls = server.build_chat_chain_calls('mistral-small', [])
+    assert [step for step, _ in calls] == [{"provider": "llm7", "model": "mistral-small"}]
+
+
+def test_missing_keys_skip_provider(monkeypatch):
+    monkeypatch.setattr(server.API_KEYS, 'acquire', lambda service: 'g' if service == 'gemini' else None)
+    calls = server.build_chat_chain_calls('gpt-5-chat', [])
+    assert [step["provider"] for step, _ in calls] == ['gemini']
+
+
+def test_no_provider_raises(monkeypatch):
+    monkeypatch.setattr(server.API_KEYS, 'acquire', lambda service: None)
+    with pytest.raises(server.NoChatProviderError):
+        server.build_chat_chain_calls('gpt-5-chat', [])
+
+
+def test_step_deadline_splits_remaining_budget():
+    deadline = server.Deadline(9)
+    first = server.chat_step_deadline(deadline, 0, 3)
+    assert 2.5 < first.remaining() <= 3
+    assert server.chat_step_deadline(deadline, 2, 3) is deadline
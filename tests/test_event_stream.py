@@ -0,0 +1,95 @@
+"""Relay SSE từ upstream xuống client: _relay_event_stream"""
+
+import email.message
+import io
+import json
+
+import server
+
+
+class FakeUpstream:
+    """Response upstream giả: iterate theo dòng như PooledResponse"""
+
+    def __init__(self, body):
+        self._lines = io.BytesIO(body).readlines()
+
+    def __iter__(self):
+        return iter(self._lines)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def make_handler():
+    handler = server.NexoraXHTTPRequestHandler.__new__(server.NexoraXHTTPRequestHandler)
+    handler.request_version = 'HTTP/1.0'  # không chunked: body là SSE thuần, dễ parse
+    handler.requestline = 'POST /api/gemini/stream HTTP/1.0'
+    handler.command = 'POST'
+    handler.client_address = ('127.0.0.1', 0)
+    handler.headers = email.message.Message()
+    handler.wfile = io.BytesIO()
+    handler.close_connection = True
+    return handler
+
+
+def sse_events(raw):
+    """[(event, data)] từ body SSE đã gửi cho client (bỏ qua phần header HTTP)"""
+    body = raw.split(b'\r\n\r\n', 1)[1].decode('utf-8')
+    events = []
+    for block in body.split('\n\n'):
+        if not block.strip():
+            continue
+        event, data = 'message', []
+        for line in block.split('\n'):
+            if line.startswith('event: '):
+                event = line[7:]
+            elif line.startswith('data:'):
+                data.append(line[5:].lstrip(' '))
+        events.append((event, '\n'.join(data)))
+    return events
+
+
+def gemini_chunk(text, finish_reason=None):
+    candidate = {"content": {"parts": [{"text": text}]}}
+    if finish_reason:
+        candidate["finishReason"] = finish_reason
+    return b'data: ' + json.dumps({"candidates": [candidate]}).encode('utf-8') + b'\n\n'
+
+
+def relay_gemini(body):
+    handler = make_handler()
+    result = handler._relay_event_stream(
+        'gemini', "Gemini API", FakeUpstream(body), 0.0, server.extract_gemini_text, {"model": "m"},
+        is_final=server.is_gemini_stream_final
+    )
+    return result, sse_events(handler.wfile.getvalue())
+
+
+def test_gemini_stream_with_finish_reason_completes():
+    (reply, _, complete), events = relay_gemini(gemini_chunk("Xin ") + gemini_chunk("chào", "STOP"))
+    assert reply == "Xin chào"
+    assert complete
+    assert events[-1][0] == 'done'
+
+
+def test_gemini_stream_without_final_chunk_sends_error():
+    (reply, _, complete), events = relay_gemini(gemini_chunk("Xin ") + gemini_chunk("ch"))
+    assert reply == "Xin ch"
+    assert not complete
+    assert events[-1][0] == 'error'
+    assert json.loads(events[-1][1])["code"] == 'STREAM_ERROR'
+
+
+def test_llm7_stream_requires_done_marker():
+    chunk = b'data: ' + json.dumps(server.build_chat_chunk("gpt-5-chat", "hi")).encode('utf-8') + b'\n\n'
+    for body, expected in ((chunk + b'data: [DONE]\n\n', 'done'), (chunk, 'error')):
+        handler = make_handler()
+        reply, _, complete = handler._relay_event_stream(
+            'llm7', "LLM7 API", FakeUpstream(body), 0.0, server.extract_llm7_delta, {}, end_marker='[DONE]'
+        )
+        assert reply == "hi"
+        assert complete == (expected == 'done')
+        assert sse_events(handler.wfile.getvalue())[-1][0] == expected
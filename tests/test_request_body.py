@@ -0,0 +1,73 @@
+"""Đọc request body có giới hạn: read_request_body"""
+
+import email.message
+import io
+
+import pytest
+
+import server
+
+
+def make_headers(**values):
+    headers = email.message.Message()
+    for name, value in values.items():
+        headers[name.replace('_', '-')] = value
+    return headers
+
+
+def chunked(*parts):
+    return b''.join(b'%X\r\n%s\r\n' % (len(part), part) for part in parts) + b'0\r\n\r\n'
+
+
+def read(body, headers, max_body=1024, spool_threshold=1024):
+    return server.read_request_body(io.BytesIO(body), headers, max_body, spool_threshold)
+
+
+@pytest.mark.parametrize("headers, status, code", [
+    (make_headers(), 411, 'LENGTH_REQUIRED'),
+    (make_headers(Content_Length='abc'), 400, 'INVALID_CONTENT_LENGTH'),
+    (make_headers(Content_Length='-1'), 400, 'INVALID_CONTENT_LENGTH'),
+    (make_headers(Content_Length='2048'), 413, 'PAYLOAD_TOO_LARGE'),
+])
+def test_content_length_rejected_before_reading(headers, status, code):
+    with pytest.raises(server.RequestBodyError) as error:
+        read(b'', headers)
+    assert (error.value.status_code, error.value.error_code) == (status, code)
+
+
+def test_truncated_body_is_incomplete():
+    with pytest.raises(server.RequestBodyError) as error:
+        read(b'{"a":', make_headers(Content_Length='10'))
+    assert error.value.error_code == 'INCOMPLETE_BODY'
+
+
+def test_small_body_stays_in_memory():
+    body = read(b'{"a": 1}', make_headers(Content_Length='8'))
+    assert isinstance(body, bytearray)
+    assert body == b'{"a": 1}'
+
+
+def test_large_body_is_spooled():
+    payload = b'x' * 600
+    body = read(payload, make_headers(Content_Length='600'), spool_threshold=256)
+    assert not isinstance(body, bytearray)
+    assert body.read() == payload
+
+
+def test_chunked_body_spools_past_threshold():
+    body = read(chunked(b'a' * 200, b'b' * 200), make_headers(Transfer_Encoding='chunked'), spool_threshold=256)
+    assert not isinstance(body, bytearray)
+    assert body.read() == b'a' * 200 + b'b' * 200
+    assert read(chunked(b'ab', b'cd'), make_headers(Transfer_Encoding='chunked')) == b'abcd'
+
+
+def test_chunked_body_over_limit():
+    with pytest.raises(server.RequestBodyError) as error:
+        read(chunked(b'a' * 800, b'b' * 800), make_headers(Transfer_Encoding='chunked'))
+    assert error.value.status_code == 413
+
+
+def test_invalid_chunk_size():
+    with pytest.raises(server.RequestBodyError) as error:
+        read(b'zz\r\nabc\r\n0\r\n\r\n', make_headers(Transfer_Encoding='chunked'))
+    assert error.value.error_code == 'INVALID_CHUNK'
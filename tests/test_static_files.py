@@ -0,0 +1,84 @@
+"""Phục vụ file tĩnh: STATIC_CACHE, ETag/Last-Modified và 304"""
+
+import http.client
+import os
+import threading
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def static_server(tmp_path, monkeypatch):
+    (tmp_path / 'src' / 'js').mkdir(parents=True)
+    (tmp_path / 'src' / 'js' / 'main.js').write_text('console.log("hi");\n')
+    (tmp_path / 'index.html').write_text('<html></html>\n')
+    monkeypatch.chdir(tmp_path)
+    httpd = server.PooledHTTPServer(('127.0.0.1', 0), server.NexoraXHTTPRequestHandler, pool_size=2, queue_size=4)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd.server_address[1], tmp_path
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def get(port, path, headers=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        conn.request('GET', path, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        conn.close()
+
+
+def test_js_with_query_string_uses_etag_and_304(static_server):
+    port, _ = static_server
+    status, headers, body = get(port, '/src/js/main.js?v=2')
+    assert status == 200
+    assert body == b'console.log("hi");\n'
+    assert headers['Content-type'] == 'application/javascript'
+    assert 'ETag' in headers and 'Last-Modified' in headers
+
+    status, _, body = get(port, '/src/js/main.js?v=3', {'If-None-Match': headers['ETag']})
+    assert status == 304
+    assert body == b''
+
+
+def test_root_serves_index_with_etag(static_server):
+    port, _ = static_server
+    status, headers, body = get(port, '/?utm=x')
+    assert status == 200
+    assert body == b'<html></html>\n'
+    assert 'ETag' in headers
+
+
+def test_changed_file_gets_new_etag(static_server):
+    port, root = static_server
+    _, first, _ = get(port, '/src/js/main.js')
+    path = root / 'src' / 'js' / 'main.js'
+    path.write_text('console.log("changed");\n')
+    os.utime(path, ns=(path.stat().st_mtime_ns + 10**9,) * 2)
+    status, second, body = get(port, '/src/js/main.js', {'If-None-Match': first['ETag']})
+    assert status == 200
+    assert body == b'console.log("changed");\n'
+    assert second['ETag'] != first['ETag']
+
+
+def test_missing_file_is_404(static_server):
+    port, _ = static_server
+    status, _, _ = get(port, '/src/js/missing.js?v=1')
+    assert status == 404
+
+
+def test_is_not_modified_validators():
+    entry = {"etag": '"abc"', "mtime": 1_700_000_000}
+    assert server.is_not_modified({'If-None-Match': 'W/"abc", "def"'}, entry)
+    assert server.is_not_modified({'If-None-Match': '*'}, entry)
+    assert not server.is_not_modified({'If-None-Match': '"def"'}, entry)
+    # If-None-Match được ưu tiên hơn If-Modified-Since
+    assert not server.is_not_modified({'If-None-Match': '"def"', 'If-Modified-Since': 'Wed, 01 Jan 2031 00:00:00 GMT'}, entry)
+    assert server.is_not_modified({'If-Modified-Since': 'Wed, 01 Jan 2031 00:00:00 GMT'}, entry)
+    assert not server.is_not_modified({'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'}, entry)
+    assert not server.is_not_modified({'If-Modified-Since': 'not a date'}, entry)
@@ -0,0 +1,156 @@
+"""Độ bền khi gọi upstream: circuit breaker, retry budget, hedged request"""
+
+import threading
+import types
+import urllib.error
+
+import pytest
+
+import server
+
+
+HEDGE_POLICY = {"hedge_max_rate": 1.0, "hedge_after": 0.05}
+BREAKER_SETTINGS = {"window": 4, "min_calls": 4, "error_rate": 0.5, "slow_rate": 0.8, "open_seconds": 30, "half_open_probes": 1}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server, 'time', types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+def open_breaker():
+    breaker = server.CircuitBreaker('test', dict(BREAKER_SETTINGS))
+    for failed in (False, True, False, True):
+        breaker.record(breaker.before_call(), failed)
+    return breaker
+
+
+def test_breaker_opens_at_error_rate_and_fails_fast(clock):
+    breaker = server.CircuitBreaker('test', dict(BREAKER_SETTINGS))
+    for _ in range(3):
+        breaker.record(breaker.before_call(), True)
+    assert breaker.state == breaker.CLOSED  # chưa đủ min_calls
+    breaker.record(breaker.before_call(), False)
+    assert breaker.state == breaker.OPEN
+    clock[0] += 10
+    with pytest.raises(server.CircuitOpenError) as error:
+        breaker.before_call()
+    assert error.value.retry_after == 20
+
+
+def test_slow_calls_open_breaker(clock):
+    breaker = server.CircuitBreaker('test', dict(BREAKER_SETTINGS))
+    for _ in range(4):
+        breaker.record(breaker.before_call(), False, slow=True)
+    assert breaker.state == breaker.OPEN
+
+
+def test_half_open_probe_closes_or_reopens(clock):
+    breaker = open_breaker()
+    clock[0] += 30
+    probe = breaker.before_call()
+    assert probe is True and breaker.state == breaker.HALF_OPEN
+    with pytest.raises(server.CircuitOpenError):
+        breaker.before_call()  # chỉ 1 probe đồng thời
+    breaker.record(probe, True)
+    assert breaker.state == breaker.OPEN
+
+    clock[0] += 30
+    breaker.record(breaker.before_call(), False)
+    assert breaker.state == breaker.CLOSED
+    assert breaker.get_stats()["window_calls"] == 0
+
+
+def test_released_probe_frees_slot_without_outcome(clock):
+    breaker = open_breaker()
+    clock[0] += 30
+    assert breaker.before_call() is True
+    breaker.release_probe()
+    assert breaker.state == breaker.HALF_OPEN
+    assert breaker.before_call() is True
+
+
+def test_client_errors_do_not_count_as_failures(clock):
+    breaker = server.CircuitBreaker('test', dict(BREAKER_SETTINGS))
+    policy = {"slow_call": 20}
+    for status in (400, 404, 401, 422):
+        server._record_upstream_attempt('test', policy, breaker, breaker.before_call(), status, 0.1)
+    assert breaker.state == breaker.CLOSED
+    for status in (429, 503):  # 4xx cũ vẫn trong cửa sổ: 2/4 lỗi là đủ mở
+        server._record_upstream_attempt('test', policy, breaker, breaker.before_call(), status, 0.1)
+    assert breaker.state == breaker.OPEN
+
+
+def test_retry_budget_allowance_and_window(clock):
+    budget = server.RetryBudget(ratio=0.5, min_per_second=0, window=10)
+    assert not budget.try_acquire()
+    for _ in range(4):
+        budget.record_call()
+    assert [budget.try_acquire() for _ in range(3)] == [True, True, False]
+    assert budget.get_stats()["exhausted"] == 2
+    clock[0] += 11  # call và retry cũ ra khỏi cửa sổ
+    budget.record_call()
+    budget.record_call()
+    assert budget.try_acquire()
+    assert budget.get_stats()["calls_in_window"] == 2
+
+
+def test_retry_budget_minimum_rate():
+    budget = server.RetryBudget(ratio=0, min_per_second=0.2, window=10)
+    assert [budget.try_acquire() for _ in range(3)] == [True, True, False]
+
+
+def test_exhausted_budget_stops_retries(monkeypatch):
+    policy = dict(server.UPSTREAM_POLICIES["default"], retries=3, backoff=0, max_backoff=0, hedge=False, circuit=None, key_pool=None)
+    monkeypatch.setattr(server, 'get_upstream_policy', lambda name: dict(policy))
+    monkeypatch.setattr(server, 'RETRY_BUDGET', server.RetryBudget(ratio=0, min_per_second=0, window=10))
+    calls = []
+
+    def failing_attempt(request, timeout, read_body, cancel=None):
+        calls.append(1)
+        raise urllib.error.URLError("connection refused")
+
+    monkeypatch.setattr(server, '_upstream_attempt', failing_attempt)
+    with pytest.raises(urllib.error.URLError):
+        server.upstream_call('test', 'http://127.0.0.1:9/')
+    assert len(calls) == 1
+
+
+@pytest.fixture
+def attempts(monkeypatch):
+    """_upstream_attempt giả: attempt đầu treo tới khi bị huỷ, các attempt sau trả về ngay"""
+    calls = []
+
+    def fake_attempt(request, timeout, read_body, cancel=None):
+        calls.append(threading.current_thread())
+        if len(calls) == 1 and cancel is not None:
+            for _ in range(500):
+                if cancel.cancelled:
+                    raise server.UpstreamCancelledError("cancelled")
+                threading.Event().wait(0.01)
+        return f"response-{len(calls)}"
+
+    monkeypatch.setattr(server, '_upstream_attempt', fake_attempt)
+    monkeypatch.setattr(server, '_hedge_budgets', {})
+    return calls
+
+
+def test_slow_attempt_is_hedged(attempts, monkeypatch):
+    monkeypatch.setattr(server, 'BACKGROUND_EXECUTOR', server.BackgroundExecutor(2))
+    assert server._hedged_attempt('test-hedge', HEDGE_POLICY, None, 5, True) == 'response-2'
+    assert len(attempts) == 2
+    assert all(thread.name.startswith('nexorax-bg') for thread in attempts)
+
+
+def test_hedge_skipped_when_background_pool_full(attempts, monkeypatch):
+    executor = server.BackgroundExecutor(1)
+    monkeypatch.setattr(server, 'BACKGROUND_EXECUTOR', executor)
+    release = threading.Event()
+    executor.try_submit(release.wait, 5)
+    try:
+        assert server._hedged_attempt('test-hedge', HEDGE_POLICY, None, 5, True) == 'response-1'
+    finally:
+        release.set()
+    assert attempts == [threading.current_thread()]